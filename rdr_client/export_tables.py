@@ -7,6 +7,18 @@
 #
 # "directory" indicates a directory inside the GCS bucket to write the files to
 #
+# "format" can be set to "avro" to export tables in the rdr database to Avro files, which keep the
+# types of the columns.
+#
+# Large tables in the rdr database are exported in parts (split by primary key) to a directory
+# named after the table, e.g. participant/part-00000.csv, which also holds a manifest.json
+# listing the parts once they have all been written. The number of rows in each part is set by
+# the table_export_rows_per_part config value.
+#
+# With --snapshot, all the tables are exported from the same consistent snapshot of the database
+# (by a pool of table_export_snapshot_workers threads in one task), and manifest.json listing the
+# files for every table is written to the directory when they are all complete.
+#
 # If "rdr" is chosen for the database, the data will be written to <ENVIRONMENT>-rdr-export;
 # If "cdm" or "voc" are chosen, the data will be written to <ENVIRONMENT>-cdm.
 
@@ -21,7 +33,9 @@ def export_tables(client):
                                                client.args.directory))
   request_body = {'database': client.args.database,
                   'tables': table_names,
-                  'directory': client.args.directory}
+                  'directory': client.args.directory,
+                  'format': client.args.format,
+                  'snapshot': client.args.snapshot}
   response = client.request_json('ExportTables', 'POST', request_body)
   logging.info('Data is being exported to: %s' % response['destination'])
 
@@ -34,4 +48,8 @@ if __name__ == '__main__':
   parser.add_argument('--directory',
                       help='A directory to write CSV output to inside the GCS bucket',
                       required=True)
+  parser.add_argument('--format', help='The format of the output files (csv or avro)',
+                      default='csv')
+  parser.add_argument('--snapshot', help='Export the tables from a consistent snapshot',
+                      action='store_true')
   export_tables(Client(parser=parser, base_path='offline'))
@@ -12,6 +12,10 @@ PPI_EXTRA_SYSTEM = "http://terminology.pmi-ops.org/CodeSystem/ppi-extra"
 
 SITE_ID_SYSTEM = "https://www.pmi-ops.org/site-id"
 HEALTHPRO_USERNAME_SYSTEM = "https://www.pmi-ops.org/healthpro-username"
+# Systems of the biobank order identifiers listed in the Biobank reconciliation reports.
+PMI_OPS_SYSTEM = "https://www.pmi-ops.org"
+KIT_ID_SYSTEM = "https://orders.mayomedicallaboratories.com/kit-id"
+TRACKING_NUMBER_SYSTEM = "https://orders.mayomedicallaboratories.com/tracking-number"
 
 FIRST_NAME_QUESTION_CODE = "PIIName_First"
 LAST_NAME_QUESTION_CODE = "PIIName_Last"
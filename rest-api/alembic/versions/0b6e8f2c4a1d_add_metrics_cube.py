@@ -0,0 +1,32 @@
+"""add metrics_cube
+
+Revision ID: 0b6e8f2c4a1d
+Revises: f15c7a3e92d4
+Create Date: 2017-10-30 11:42:17.503216
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '0b6e8f2c4a1d'
+down_revision = 'f15c7a3e92d4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('metrics_cube',
+    sa.Column('metrics_version_id', sa.Integer(), nullable=False),
+    sa.Column('name', sa.String(length=80), nullable=False),
+    sa.Column('hpo_id', sa.String(length=20), nullable=False),
+    sa.Column('cells', sa.BLOB(), nullable=False),
+    sa.ForeignKeyConstraint(['metrics_version_id'], ['metrics_version.metrics_version_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('metrics_version_id', 'name', 'hpo_id')
+  )
+
+
+def downgrade():
+  op.drop_table('metrics_cube')
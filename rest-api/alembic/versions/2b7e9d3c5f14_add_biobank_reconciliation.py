@@ -0,0 +1,62 @@
+"""add biobank_reconciliation
+
+Revision ID: 2b7e9d3c5f14
+Revises: 8c2d4f6a1e93
+Create Date: 2017-11-10 16:23:05.118426
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import model.utils
+from participant_enums import BiobankReconciliationStatus
+
+
+# revision identifiers, used by Alembic.
+revision = '2b7e9d3c5f14'
+down_revision = '8c2d4f6a1e93'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('biobank_reconciliation',
+    sa.Column('biobank_id', sa.Integer(), nullable=False),
+    sa.Column('test', sa.String(length=80), nullable=False),
+    sa.Column('status', model.utils.Enum(BiobankReconciliationStatus), nullable=False),
+    sa.Column('sent_count', sa.Integer(), nullable=False),
+    sa.Column('sent_order_id', sa.UnicodeText(), nullable=True),
+    sa.Column('sent_collection_time', model.utils.UTCDateTime(), nullable=True),
+    sa.Column('sent_processed_time', model.utils.UTCDateTime(), nullable=True),
+    sa.Column('sent_finalized_time', model.utils.UTCDateTime(), nullable=True),
+    sa.Column('source_site_name', sa.UnicodeText(), nullable=True),
+    sa.Column('source_site_consortium', sa.UnicodeText(), nullable=True),
+    sa.Column('source_site_mayolink_client_number', sa.UnicodeText(), nullable=True),
+    sa.Column('source_site_hpo', sa.UnicodeText(), nullable=True),
+    sa.Column('source_site_hpo_type', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_site_name', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_site_consortium', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_site_mayolink_client_number', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_site_hpo', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_site_hpo_type', sa.UnicodeText(), nullable=True),
+    sa.Column('finalized_username', sa.UnicodeText(), nullable=True),
+    sa.Column('biospecimen_kit_id', sa.UnicodeText(), nullable=True),
+    sa.Column('fedex_tracking_number', sa.UnicodeText(), nullable=True),
+    sa.Column('received_count', sa.Integer(), nullable=False),
+    sa.Column('received_sample_id', sa.UnicodeText(), nullable=True),
+    sa.Column('received_time', model.utils.UTCDateTime(), nullable=True),
+    sa.Column('received_create_time', model.utils.UTCDateTime(), nullable=True),
+    sa.Column('elapsed_hours', sa.Integer(), nullable=True),
+    sa.Column('last_time', model.utils.UTCDateTime(), nullable=True),
+    sa.ForeignKeyConstraint(['biobank_id'], ['participant.biobank_id'], ),
+    sa.PrimaryKeyConstraint('biobank_id', 'test')
+  )
+  op.create_index('biobank_reconciliation_last_time', 'biobank_reconciliation', ['last_time'],
+                  unique=False)
+  op.create_index('biobank_reconciliation_status_last_time', 'biobank_reconciliation',
+                  ['status', 'last_time'], unique=False)
+
+
+def downgrade():
+  op.drop_index('biobank_reconciliation_status_last_time', table_name='biobank_reconciliation')
+  op.drop_index('biobank_reconciliation_last_time', table_name='biobank_reconciliation')
+  op.drop_table('biobank_reconciliation')
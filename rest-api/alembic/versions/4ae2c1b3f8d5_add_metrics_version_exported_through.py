@@ -0,0 +1,26 @@
+"""add metrics_version.exported_through
+
+Revision ID: 4ae2c1b3f8d5
+Revises: 7e250583b9cb
+Create Date: 2017-10-12 11:02:37.518204
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import model.utils
+
+
+# revision identifiers, used by Alembic.
+revision = '4ae2c1b3f8d5'
+down_revision = '7e250583b9cb'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.add_column('metrics_version', sa.Column('exported_through', model.utils.UTCDateTime(),
+                                             nullable=True))
+
+
+def downgrade():
+  op.drop_column('metrics_version', 'exported_through')
@@ -0,0 +1,32 @@
+"""add hpo_counter
+
+Revision ID: 5a1e3c9d7b20
+Revises: 0b6e8f2c4a1d
+Create Date: 2017-11-02 15:07:41.228573
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '5a1e3c9d7b20'
+down_revision = '0b6e8f2c4a1d'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('hpo_counter',
+    sa.Column('hpo_id', sa.Integer(), nullable=False),
+    sa.Column('metric', sa.String(length=80), nullable=False),
+    sa.Column('value', sa.String(length=80), nullable=False),
+    sa.Column('participant_type', sa.String(length=1), nullable=False),
+    sa.Column('count', sa.Integer(), nullable=False),
+    sa.ForeignKeyConstraint(['hpo_id'], ['hpo.hpo_id'], ),
+    sa.PrimaryKeyConstraint('hpo_id', 'metric', 'value', 'participant_type')
+  )
+
+
+def downgrade():
+  op.drop_table('hpo_counter')
@@ -0,0 +1,33 @@
+"""add indexes for the metrics export
+
+Revision ID: 62bb9927a7e4
+Revises: 7e0cccbad642
+Create Date: 2017-10-20 14:37:05.902451
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import model.utils
+
+
+# revision identifiers, used by Alembic.
+revision = '62bb9927a7e4'
+down_revision = '7e0cccbad642'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_index('biobank_order_participant_created', 'biobank_order',
+                  ['participant_id', 'created'], unique=False)
+  op.create_index('physical_measurements_participant_created', 'physical_measurements',
+                  ['participant_id', 'created'], unique=False)
+  op.create_index('biobank_stored_sample_biobank_test_confirmed', 'biobank_stored_sample',
+                  ['biobank_id', 'test', 'confirmed'], unique=False)
+
+
+def downgrade():
+  op.drop_index('biobank_stored_sample_biobank_test_confirmed',
+                table_name='biobank_stored_sample')
+  op.drop_index('physical_measurements_participant_created', table_name='physical_measurements')
+  op.drop_index('biobank_order_participant_created', table_name='biobank_order')
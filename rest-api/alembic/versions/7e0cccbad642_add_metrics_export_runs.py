@@ -0,0 +1,39 @@
+"""add metrics_export_run and metrics_export_shard
+
+Revision ID: 7e0cccbad642
+Revises: 4ae2c1b3f8d5
+Create Date: 2017-10-19 10:14:52.311027
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import model.utils
+
+
+# revision identifiers, used by Alembic.
+revision = '7e0cccbad642'
+down_revision = '4ae2c1b3f8d5'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('metrics_export_run',
+    sa.Column('metrics_export_run_id', sa.Integer(), nullable=False),
+    sa.Column('export_time', model.utils.UTCDateTime(), nullable=False),
+    sa.Column('pipeline_started', sa.Boolean(), nullable=False),
+    sa.PrimaryKeyConstraint('metrics_export_run_id')
+  )
+  op.create_table('metrics_export_shard',
+    sa.Column('metrics_export_run_id', sa.Integer(), nullable=False),
+    sa.Column('file_name', sa.String(length=255), nullable=False),
+    sa.Column('complete', sa.Boolean(), nullable=False),
+    sa.ForeignKeyConstraint(['metrics_export_run_id'], ['metrics_export_run.metrics_export_run_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('metrics_export_run_id', 'file_name')
+  )
+
+
+def downgrade():
+  op.drop_table('metrics_export_shard')
+  op.drop_table('metrics_export_run')
@@ -0,0 +1,36 @@
+"""add biobank_samples_file
+
+Revision ID: 8c2d4f6a1e93
+Revises: 5a1e3c9d7b20
+Create Date: 2017-11-08 11:42:17.503861
+
+"""
+from alembic import op
+import sqlalchemy as sa
+import model.utils
+
+
+# revision identifiers, used by Alembic.
+revision = '8c2d4f6a1e93'
+down_revision = '5a1e3c9d7b20'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('biobank_samples_file',
+    sa.Column('file_name', sa.String(length=255), nullable=False),
+    sa.Column('timestamp', model.utils.UTCDateTime(), nullable=False),
+    sa.Column('processed', model.utils.UTCDateTime(), nullable=False),
+    sa.Column('inserted', sa.Integer(), nullable=False),
+    sa.Column('updated', sa.Integer(), nullable=False),
+    sa.Column('unchanged', sa.Integer(), nullable=False),
+    sa.PrimaryKeyConstraint('file_name')
+  )
+  op.create_index('biobank_samples_file_timestamp', 'biobank_samples_file', ['timestamp'],
+                  unique=False)
+
+
+def downgrade():
+  op.drop_index('biobank_samples_file_timestamp', table_name='biobank_samples_file')
+  op.drop_table('biobank_samples_file')
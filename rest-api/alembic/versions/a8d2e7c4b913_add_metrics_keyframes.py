@@ -0,0 +1,34 @@
+"""add metrics_keyframe and metrics_bucket.keyframe_date
+
+Revision ID: a8d2e7c4b913
+Revises: 62bb9927a7e4
+Create Date: 2017-10-24 14:21:09.640155
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'a8d2e7c4b913'
+down_revision = '62bb9927a7e4'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('metrics_keyframe',
+    sa.Column('metrics_version_id', sa.Integer(), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('hpo_id', sa.String(length=20), nullable=False),
+    sa.Column('metrics', sa.BLOB(), nullable=False),
+    sa.ForeignKeyConstraint(['metrics_version_id'], ['metrics_version.metrics_version_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('metrics_version_id', 'date', 'hpo_id')
+  )
+  op.add_column('metrics_bucket', sa.Column('keyframe_date', sa.Date(), nullable=True))
+
+
+def downgrade():
+  op.drop_column('metrics_bucket', 'keyframe_date')
+  op.drop_table('metrics_keyframe')
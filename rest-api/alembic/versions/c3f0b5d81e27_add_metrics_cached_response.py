@@ -0,0 +1,32 @@
+"""add metrics_cached_response
+
+Revision ID: c3f0b5d81e27
+Revises: a8d2e7c4b913
+Create Date: 2017-10-25 11:48:30.271544
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import mysql
+
+
+# revision identifiers, used by Alembic.
+revision = 'c3f0b5d81e27'
+down_revision = 'a8d2e7c4b913'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('metrics_cached_response',
+    sa.Column('metrics_version_id', sa.Integer(), nullable=False),
+    sa.Column('request_key', sa.String(length=80), nullable=False),
+    sa.Column('response', mysql.LONGBLOB(), nullable=False),
+    sa.ForeignKeyConstraint(['metrics_version_id'], ['metrics_version.metrics_version_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('metrics_version_id', 'request_key')
+  )
+
+
+def downgrade():
+  op.drop_table('metrics_cached_response')
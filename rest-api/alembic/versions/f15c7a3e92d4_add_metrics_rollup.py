@@ -0,0 +1,34 @@
+"""add metrics_rollup
+
+Revision ID: f15c7a3e92d4
+Revises: c3f0b5d81e27
+Create Date: 2017-10-26 16:05:42.118390
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f15c7a3e92d4'
+down_revision = 'c3f0b5d81e27'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+  op.create_table('metrics_rollup',
+    sa.Column('metrics_version_id', sa.Integer(), nullable=False),
+    sa.Column('granularity', sa.String(length=10), nullable=False),
+    sa.Column('date', sa.Date(), nullable=False),
+    sa.Column('hpo_id', sa.String(length=20), nullable=False),
+    sa.Column('last_date', sa.Date(), nullable=False),
+    sa.Column('metrics', sa.BLOB(), nullable=False),
+    sa.ForeignKeyConstraint(['metrics_version_id'], ['metrics_version.metrics_version_id'],
+                            ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('metrics_version_id', 'granularity', 'date', 'hpo_id')
+  )
+
+
+def downgrade():
+  op.drop_table('metrics_rollup')
@@ -1,10 +1,15 @@
 import api_util
+import config
 import datetime
 import json
+import zlib
 
 from api_util import HEALTHPRO
-from dao.metrics_dao import MetricsBucketDao
-from flask import request
+from dao.metrics_dao import MetricsBucketDao, MetricsCachedResponseDao, MetricsVersionDao
+from dao.metrics_dao import DAY, ROLLUP_GRANULARITIES, GZIP_WBITS
+from dao.metrics_dao import get_period_start, make_client_json
+from dao.metrics_index import get_metrics_index, project_metrics
+from flask import request, Response
 from flask.ext.restful import Resource
 from werkzeug.exceptions import BadRequest
 
@@ -18,10 +23,21 @@ class MetricsApi(Resource):
     resource = request.get_data()
     start_date = None
     end_date = None
+    diffs = False
+    metrics = None
+    hpo_ids = None
+    granularity = DAY
     if resource:
       resource_json = json.loads(resource)
       start_date_str = resource_json.get('start_date')
       end_date_str = resource_json.get('end_date')
+      # If set, buckets after the first one for each HPO only contain changed metrics.
+      diffs = bool(resource_json.get('diffs'))
+      # If set, only metrics equal to or starting with one of these (followed by a '.') are
+      # returned, and only for these HPO IDs ('' for metrics across all HPOs.)
+      metrics = api_util.get_json_string_list(resource_json, 'metrics')
+      hpo_ids = api_util.get_json_string_list(resource_json, 'hpo_ids')
+      granularity = resource_json.get('granularity') or DAY
       if start_date_str:
         try:
           start_date = datetime.datetime.strptime(start_date_str, DATE_FORMAT).date()
@@ -32,7 +48,45 @@ class MetricsApi(Resource):
           end_date = datetime.datetime.strptime(end_date_str, DATE_FORMAT).date()
         except ValueError:
           raise BadRequest("Invalid start date: %s" % end_date_str)
-    buckets = dao.get_active_buckets(start_date, end_date)
+      if granularity != DAY and granularity not in ROLLUP_GRANULARITIES:
+        raise BadRequest("Invalid granularity: %s" % granularity)
+      if diffs and granularity != DAY:
+        raise BadRequest("diffs can only be requested with day granularity")
+    if granularity != DAY:
+      return _get_rollups(granularity, start_date, end_date, metrics, hpo_ids)
+    if (config.getSetting(config.METRICS_CACHE_RESPONSES, False) and metrics is None
+        and hpo_ids is None):
+      return _make_json_response(
+          MetricsCachedResponseDao().get_serving_response(start_date, end_date, diffs))
+    if diffs:
+      bucket_diffs = dao.get_active_bucket_diffs(start_date, end_date, hpo_ids)
+      if bucket_diffs is None:
+        return []
+      return [make_client_json(bucket.date, bucket.hpoId,
+                               project_metrics(json.loads(bucket.metrics), metrics), previous_date)
+              for bucket, previous_date in bucket_diffs]
+    buckets = dao.get_active_buckets(start_date, end_date, hpo_ids)
     if buckets is None:
       return []
-    return [dao.to_client_json(bucket) for bucket in buckets]
+    return [make_client_json(bucket.date, bucket.hpoId,
+                             project_metrics(json.loads(bucket.metrics), metrics))
+            for bucket in buckets]
+
+def _get_rollups(granularity, start_date, end_date, metrics, hpo_ids):
+  """Returns the serving version's weekly or monthly metrics, from its in-memory index."""
+  version = MetricsVersionDao().get_serving_version()
+  if version is None:
+    return []
+  index = get_metrics_index(version.metricsVersionId, granularity)
+  if start_date:
+    # Include the period containing start_date.
+    start_date = get_period_start(start_date, granularity)
+  return [make_client_json(date, hpo_id, entries)
+          for date, hpo_id, entries in index.select(metrics, hpo_ids, start_date, end_date)]
+
+def _make_json_response(gzipped_json):
+  """Returns a response with pre-serialized JSON, compressed if the client accepts gzip."""
+  if 'gzip' in request.accept_encodings:
+    return Response(gzipped_json, mimetype='application/json',
+                    headers={'Content-Encoding': 'gzip'})
+  return Response(zlib.decompress(gzipped_json, GZIP_WBITS), mimetype='application/json')
@@ -0,0 +1,45 @@
+import api_util
+import json
+
+from api_util import HEALTHPRO
+from dao.metrics_cube import get_cube
+from dao.metrics_dao import MetricsVersionDao
+from flask import request
+from flask.ext.restful import Resource
+from werkzeug.exceptions import BadRequest, NotFound
+
+class MetricsCubeApi(Resource):
+  """API that returns participant counts from a metrics cube in the serving metrics version, for
+  each combination of values of the requested dimensions."""
+
+  @api_util.auth_required(HEALTHPRO)
+  def post(self):
+    resource = request.get_data()
+    resource_json = json.loads(resource) if resource else {}
+    name = resource_json.get('cube')
+    if not name:
+      raise BadRequest("cube is required")
+    # The dimensions to break the counts down by; the counts are summed over the others.
+    dimensions = api_util.get_json_string_list(resource_json, 'dimensions')
+    # Dict of dimension -> list of values; only participants with one of the values are counted.
+    filters = resource_json.get('filters') or {}
+    if not isinstance(filters, dict):
+      raise BadRequest("filters must be a dict of dimension to values")
+    for dimension in filters:
+      api_util.get_json_string_list(filters, dimension)
+
+    version = MetricsVersionDao().get_serving_version()
+    cube = get_cube(version.metricsVersionId, name) if version else None
+    if cube is None:
+      raise NotFound("Metrics cube %s not found" % name)
+    if dimensions is None:
+      dimensions = cube.dimensions
+    unknown_dimensions = [dimension for dimension in dimensions + filters.keys()
+                          if dimension not in cube.dimensions]
+    if unknown_dimensions:
+      raise BadRequest("Unknown dimensions for metrics cube %s: %s"
+                       % (name, ', '.join(unknown_dimensions)))
+    return {'cube': name,
+            'dimensions': dimensions,
+            'cells': [{'facets': dict(zip(dimensions, values)), 'count': count}
+                      for values, count in cube.aggregate(dimensions, filters)]}
@@ -0,0 +1,38 @@
+import api_util
+import clock
+import collections
+import json
+
+from api_util import HEALTHPRO
+from dao.hpo_counter_dao import HpoCounterDao
+from dao.hpo_dao import HPODao
+from dao.metrics_dao import make_client_json
+from dao.metrics_index import project_metrics
+from flask import request
+from flask.ext.restful import Resource
+
+class MetricsCurrentCountsApi(Resource):
+  """API that returns the current participant counts for each HPO (and across all HPOs) from the
+  live HPO counters, in the same format as the Metrics API's buckets for today."""
+
+  @api_util.auth_required(HEALTHPRO)
+  def post(self):
+    resource = request.get_data()
+    resource_json = json.loads(resource) if resource else {}
+    # As for the Metrics API: if set, only these metrics (or metrics starting with them followed
+    # by a '.') are returned, for these HPO IDs ('' for counts across all HPOs.)
+    metrics = api_util.get_json_string_list(resource_json, 'metrics')
+    hpo_ids = api_util.get_json_string_list(resource_json, 'hpo_ids')
+
+    hpo_dao = HPODao()
+    counts = {hpo_dao.get(hpo_id).name: hpo_counts
+              for hpo_id, hpo_counts in HpoCounterDao().get_counts().iteritems()}
+    cross_hpo_counts = collections.Counter()
+    for hpo_counts in counts.itervalues():
+      cross_hpo_counts.update(hpo_counts)
+    counts[''] = dict(cross_hpo_counts)
+
+    today = clock.CLOCK.now().date()
+    return [make_client_json(today, hpo_id, project_metrics(counts[hpo_id], metrics))
+            for hpo_id in sorted(counts)
+            if hpo_ids is None or hpo_id in hpo_ids]
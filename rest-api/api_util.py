@@ -249,6 +249,15 @@ def parse_json_enum(obj, field_name, enum_cls):
   if field_name in obj and obj[field_name] is not None:
     obj[field_name] = enum_cls(obj[field_name])
 
+def get_json_string_list(obj, field_name):
+  """Returns a field of a dictionary that must be a list of strings, or None if it isn't set."""
+  value = obj.get(field_name)
+  if value is None:
+    return None
+  if not isinstance(value, list) or not all(isinstance(v, basestring) for v in value):
+    raise BadRequest("%s must be a list of strings" % field_name)
+  return value
+
 def format_json_enum(obj, field_name):
   """Converts a field of a dictionary from a enum to an string."""
   if field_name in obj and obj[field_name] is not None:
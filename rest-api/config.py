@@ -21,10 +21,45 @@ CONFIG_CACHE_TTL_SECONDS = 60
 
 BIOBANK_ID_PREFIX = 'biobank_id_prefix'
 METRICS_SHARDS = 'metrics_shards'
+# Encoding for metrics pipeline intermediate data; 'text' (the default) or 'binary'.
+METRICS_CODEC = 'metrics_codec'
+# Set to false to compute daily metrics counts in pure Python rather than with NumPy.
+METRICS_USE_NUMPY = 'metrics_use_numpy'
+# Set to true to calculate counts and write buckets for each HPO in a single MapReduce.
+METRICS_FUSED_STAGES = 'metrics_fused_stages'
+# Set to true to have the metrics pipeline read its input from the database rather than from CSVs
+# exported to GCS.
+METRICS_READ_FROM_DATABASE = 'metrics_read_from_database'
+# Number of metrics export tasks that run at once.
+METRICS_EXPORT_CONCURRENCY = 'metrics_export_concurrency'
+# If set, full metrics runs with fused stages write a keyframe of each HPO's metrics every this
+# many days, and buckets holding only the differences from the last keyframe.
+METRICS_BUCKET_KEYFRAME_DAYS = 'metrics_bucket_keyframe_days'
+# Set to true to serve Metrics API responses from gzip-compressed JSON cached in the database.
+METRICS_CACHE_RESPONSES = 'metrics_cache_responses'
+# JSON dict of metrics cube names to the lists of metrics fields they count participants by (no
+# cubes are written by default); see offline/metrics_config.py.
+METRICS_CUBES = 'metrics_cubes'
+# Set to true to gzip-compress the CSVs exported for the metrics pipeline.
+METRICS_EXPORT_GZIP = 'metrics_export_gzip'
+# Number of rows SqlExporter fetches from the database at a time (1000 by default).
+SQL_EXPORT_BATCH_SIZE = 'sql_export_batch_size'
+# Number of rows in each part file when ExportTables splits up large tables (1000000 by default).
+TABLE_EXPORT_ROWS_PER_PART = 'table_export_rows_per_part'
+# Number of threads exporting tables from a snapshot in ExportTables (4 by default).
+TABLE_EXPORT_SNAPSHOT_WORKERS = 'table_export_snapshot_workers'
 PARTICIPANT_SUMMARY_SHARDS = 'participant_summary_shards'
 AGE_RANGE_SHARDS = 'age_range_shards'
 BIOBANK_SAMPLES_SHARDS = 'biobank_samples_shards'
 BIOBANK_SAMPLES_BUCKET_NAME = 'biobank_samples_bucket_name'
+# Set to true to have Biobank samples imports import every CSV uploaded since the last import,
+# rather than only the latest.
+BIOBANK_SAMPLES_IMPORT_UNPROCESSED = 'biobank_samples_import_unprocessed'
+# Prefix of the names of the sample CSVs in the bucket; imports of unprocessed CSVs only list
+# files with this prefix, after the last processed file ('' by default, to list every file.)
+BIOBANK_SAMPLES_FILE_PREFIX = 'biobank_samples_file_prefix'
+# Number of threads writing samples to the database during Biobank samples imports (4 by default).
+BIOBANK_SAMPLES_IMPORT_WRITERS = 'biobank_samples_import_writers'
 CONSENT_PDF_BUCKET = 'consent_pdf_bucket'
 USER_INFO = 'user_info'
 SYNC_SHARDS_PER_CHANNEL = 'sync_shards_per_channel'
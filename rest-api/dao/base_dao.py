@@ -9,7 +9,8 @@ from fhirclient.models.domainresource import DomainResource
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 from protorpc import messages
 from query import Operator, PropertyType, FieldFilter, Results
-from sqlalchemy import or_, and_
+from sqlalchemy import inspect, or_, and_
+from sqlalchemy.dialects.mysql import insert as mysql_insert
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import BadRequest, NotFound, PreconditionFailed, ServiceUnavailable
 
@@ -373,6 +374,40 @@ class UpsertableDao(BaseDao):
     with self.session() as session:
       return self.upsert_with_session(session, obj)
 
+  def upsert_all(self, objs):
+    """Upserts a list of objects with a single multi-row statement (INSERT ... ON DUPLICATE KEY
+    UPDATE in MySQL, INSERT OR REPLACE in SQLite.)
+
+    Unlike upsert(), this bypasses the session (and _do_upsert), so it is only suitable for
+    models without relationships to save; every column is written, even if the attribute is None.
+    Returns the number of objects upserted.
+    """
+    if not objs:
+      return 0
+    with self.session() as session:
+      return self.upsert_all_with_session(session, objs)
+
+  def upsert_all_with_session(self, session, objs):
+    """Upserts a list of objects as in upsert_all, with the specified session."""
+    if not objs:
+      return 0
+    table = self.model_type.__table__
+    column_attrs = [(attr.key, attr.columns[0].name)
+                    for attr in inspect(self.model_type).column_attrs]
+    rows = [{column_name: getattr(obj, key) for key, column_name in column_attrs}
+            for obj in objs]
+    for obj in objs:
+      self._validate_upsert(session, obj)
+    if self._database.db_type == 'sqlite':
+      statement = table.insert().prefix_with('OR REPLACE').values(rows)
+    else:
+      statement = mysql_insert(table).values(rows)
+      statement = statement.on_duplicate_key_update(
+          **{column.name: statement.inserted[column.name] for column in table.columns
+             if not column.primary_key})
+    session.execute(statement)
+    return len(objs)
+
 class UpdatableDao(BaseDao):
   """A DAO that allows updates to entities.
 
@@ -1,5 +1,6 @@
 from code_constants import BIOBANK_TESTS_SET, SITE_ID_SYSTEM, HEALTHPRO_USERNAME_SYSTEM
 from dao.base_dao import BaseDao, FhirMixin, FhirProperty
+from dao.biobank_reconciliation_dao import BiobankReconciliationDao
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.site_dao import SiteDao
@@ -109,6 +110,10 @@ class BiobankOrderDao(BaseDao):
     inserted_obj = super(BiobankOrderDao, self).insert_with_session(session, obj)
     ParticipantDao().add_missing_hpo_from_site(
         session, inserted_obj.participantId, inserted_obj.finalizedSiteId)
+    biobank_id = (session.query(Participant.biobankId)
+        .filter(Participant.participantId == inserted_obj.participantId)
+        .scalar())
+    BiobankReconciliationDao().update_with_session(session, [biobank_id])
     return inserted_obj
 
   def _validate_model(self, session, obj):
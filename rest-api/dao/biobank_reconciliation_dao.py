@@ -0,0 +1,223 @@
+"""Maintains the biobank_reconciliation table, which holds the rows of the Biobank reconciliation
+reports for each participant and test.
+
+A participant's rows are recalculated from all of their orders and received samples (see
+get_reconciliation_rows) in the same transaction as each new order or sample insert, and by the
+samples import for the participants whose samples it changed; the participant row is locked
+first, so that concurrent recalculations for a participant don't miss each other's changes. The
+nightly reports then select the rows they need by status and time (see
+offline/biobank_samples_pipeline.py) rather than joining every order and sample.
+"""
+import collections
+
+from sqlalchemy import and_
+from sqlalchemy.orm import aliased
+
+from code_constants import KIT_ID_SYSTEM, PMI_OPS_SYSTEM, TRACKING_NUMBER_SYSTEM
+from dao.base_dao import BaseDao
+from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model.biobank_reconciliation import BiobankReconciliation
+from model.biobank_stored_sample import BiobankStoredSample
+from model.hpo import HPO
+from model.participant import Participant
+from model.site import Site
+from participant_enums import BiobankReconciliationStatus
+
+_BATCH_SIZE = 1000
+# The HPO type of orders without a site (or HPO organization type.)
+_UNKNOWN_HPO_TYPE = 'UNKNOWN'
+
+_SourceSite = aliased(Site)
+_SourceSiteHpo = aliased(HPO)
+_FinalizedSite = aliased(Site)
+_FinalizedSiteHpo = aliased(HPO)
+_PmiOpsIdentifier = aliased(BiobankOrderIdentifier)
+_KitIdIdentifier = aliased(BiobankOrderIdentifier)
+_TrackingNumberIdentifier = aliased(BiobankOrderIdentifier)
+
+# One result per ordered sample (and kit ID / tracking number), for orders with a pmi-ops.org ID;
+# client numbers and HPO types are strings, as they appear in the reports.
+_OrderedSampleResult = collections.namedtuple('_OrderedSampleResult', [
+    'biobankId', 'test', 'orderId', 'collected', 'processed', 'finalized',
+    'sourceSiteName', 'sourceSiteConsortium', 'sourceSiteMayolinkClientNumber', 'sourceSiteHpo',
+    'sourceSiteHpoType', 'finalizedSiteName', 'finalizedSiteConsortium',
+    'finalizedSiteMayolinkClientNumber', 'finalizedSiteHpo', 'finalizedSiteHpoType',
+    'finalizedUsername', 'biospecimenKitId', 'fedexTrackingNumber'])
+
+# Fields of BiobankReconciliation holding comma-separated values of the ordered samples.
+_ORDER_VALUE_FIELDS = [('sentOrderId', 'orderId')] + [(field, field) for field in (
+    'sourceSiteName', 'sourceSiteConsortium', 'sourceSiteMayolinkClientNumber', 'sourceSiteHpo',
+    'sourceSiteHpoType', 'finalizedSiteName', 'finalizedSiteConsortium',
+    'finalizedSiteMayolinkClientNumber', 'finalizedSiteHpo', 'finalizedSiteHpoType',
+    'finalizedUsername', 'biospecimenKitId', 'fedexTrackingNumber')]
+
+
+class BiobankReconciliationDao(BaseDao):
+  def __init__(self):
+    super(BiobankReconciliationDao, self).__init__(BiobankReconciliation)
+
+  def get_id(self, obj):
+    return [obj.biobankId, obj.test]
+
+  def update_with_session(self, session, biobank_ids):
+    """Replaces the rows for the participants with the given biobank IDs with rows recalculated
+    from their current orders and samples."""
+    biobank_ids = sorted(set(biobank_id for biobank_id in biobank_ids if biobank_id is not None))
+    if not biobank_ids:
+      return
+    # Lock the participants, so that their rows are rebuilt by one transaction at a time. Their
+    # orders and samples are then read with locking reads, which (unlike plain reads under
+    # REPEATABLE READ) see the latest committed rows, including those written by a transaction
+    # that held the participant locks before this one.
+    (session.query(Participant.participantId)
+        .filter(Participant.biobankId.in_(biobank_ids))
+        .order_by(Participant.biobankId)
+        .with_for_update()
+        .all())
+    rows = get_reconciliation_rows(_get_ordered_samples(session, biobank_ids),
+                                   _get_stored_samples(session, biobank_ids))
+    (session.query(BiobankReconciliation)
+        .filter(BiobankReconciliation.biobankId.in_(biobank_ids))
+        .delete(synchronize_session=False))
+    session.add_all(rows)
+
+  def update(self, biobank_ids):
+    """Updates the rows for the participants with the given biobank IDs, _BATCH_SIZE participants
+    per transaction."""
+    biobank_ids = sorted(set(biobank_id for biobank_id in biobank_ids if biobank_id is not None))
+    for i in xrange(0, len(biobank_ids), _BATCH_SIZE):
+      with self.session() as session:
+        self.update_with_session(session, biobank_ids[i:i + _BATCH_SIZE])
+
+  def rebuild(self):
+    """Recalculates the rows for every participant (e.g. to fill in the table, or to pick up
+    changes to sites.)"""
+    with self.session() as session:
+      biobank_ids = [biobank_id for biobank_id, in session.query(Participant.biobankId)]
+    self.update(biobank_ids)
+
+
+def _get_ordered_samples(session, biobank_ids):
+  query = (session.query(
+      Participant.biobankId.label('biobankId'),
+      BiobankOrderedSample.test.label('test'),
+      _PmiOpsIdentifier.value.label('orderId'),
+      BiobankOrderedSample.collected.label('collected'),
+      BiobankOrderedSample.processed.label('processed'),
+      BiobankOrderedSample.finalized.label('finalized'),
+      _SourceSite.siteName.label('sourceSiteName'),
+      _SourceSite.consortiumName.label('sourceSiteConsortium'),
+      _SourceSite.mayolinkClientNumber.label('sourceSiteMayolinkClientNumber'),
+      _SourceSiteHpo.name.label('sourceSiteHpo'),
+      _SourceSiteHpo.organizationType.label('sourceSiteHpoType'),
+      _FinalizedSite.siteName.label('finalizedSiteName'),
+      _FinalizedSite.consortiumName.label('finalizedSiteConsortium'),
+      _FinalizedSite.mayolinkClientNumber.label('finalizedSiteMayolinkClientNumber'),
+      _FinalizedSiteHpo.name.label('finalizedSiteHpo'),
+      _FinalizedSiteHpo.organizationType.label('finalizedSiteHpoType'),
+      BiobankOrder.finalizedUsername.label('finalizedUsername'),
+      _KitIdIdentifier.value.label('biospecimenKitId'),
+      _TrackingNumberIdentifier.value.label('fedexTrackingNumber'))
+      .select_from(BiobankOrder)
+      .join(Participant, BiobankOrder.participantId == Participant.participantId)
+      .join(_PmiOpsIdentifier,
+            and_(_PmiOpsIdentifier.biobankOrderId == BiobankOrder.biobankOrderId,
+                 _PmiOpsIdentifier.system == PMI_OPS_SYSTEM))
+      .join(BiobankOrderedSample,
+            BiobankOrderedSample.biobankOrderId == BiobankOrder.biobankOrderId)
+      .outerjoin(_SourceSite, BiobankOrder.sourceSiteId == _SourceSite.siteId)
+      .outerjoin(_SourceSiteHpo, _SourceSite.hpoId == _SourceSiteHpo.hpoId)
+      .outerjoin(_FinalizedSite, BiobankOrder.finalizedSiteId == _FinalizedSite.siteId)
+      .outerjoin(_FinalizedSiteHpo, _FinalizedSite.hpoId == _FinalizedSiteHpo.hpoId)
+      .outerjoin(_KitIdIdentifier,
+                 and_(_KitIdIdentifier.biobankOrderId == BiobankOrder.biobankOrderId,
+                      _KitIdIdentifier.system == KIT_ID_SYSTEM))
+      .outerjoin(_TrackingNumberIdentifier,
+                 and_(_TrackingNumberIdentifier.biobankOrderId == BiobankOrder.biobankOrderId,
+                      _TrackingNumberIdentifier.system == TRACKING_NUMBER_SYSTEM))
+      .filter(Participant.biobankId.in_(biobank_ids))
+      .with_for_update(read=True))
+  results = []
+  for result in query:
+    result = _OrderedSampleResult(**result._asdict())
+    results.append(result._replace(
+        sourceSiteMayolinkClientNumber=_to_str(result.sourceSiteMayolinkClientNumber),
+        sourceSiteHpoType=_get_hpo_type(result.sourceSiteHpoType),
+        finalizedSiteMayolinkClientNumber=_to_str(result.finalizedSiteMayolinkClientNumber),
+        finalizedSiteHpoType=_get_hpo_type(result.finalizedSiteHpoType)))
+  return results
+
+
+def _to_str(value):
+  return None if value is None else str(value)
+
+
+def _get_hpo_type(organization_type):
+  return _UNKNOWN_HPO_TYPE if organization_type is None else organization_type.name
+
+
+def _get_stored_samples(session, biobank_ids):
+  return (session.query(BiobankStoredSample)
+      .filter(BiobankStoredSample.biobankId.in_(biobank_ids))
+      .with_for_update(read=True)
+      .all())
+
+
+def get_reconciliation_rows(ordered_samples, stored_samples):
+  """Returns BiobankReconciliations for each (biobank ID, test) with ordered or stored samples.
+
+  Only ordered samples that have been finalized are reported. Stored samples for tests without
+  any ordered samples for the participant are reported on their own; stored samples for tests
+  that have been ordered, but not finalized, are not reported until they are finalized.
+
+  Args:
+    ordered_samples: _OrderedSampleResults for the participants.
+    stored_samples: BiobankStoredSamples for the participants.
+  """
+  ordered_by_key = collections.defaultdict(list)
+  for ordered_sample in ordered_samples:
+    ordered_by_key[(ordered_sample.biobankId, ordered_sample.test)].append(ordered_sample)
+  stored_by_key = collections.defaultdict(list)
+  for stored_sample in stored_samples:
+    stored_by_key[(stored_sample.biobankId, stored_sample.test)].append(stored_sample)
+  rows = []
+  for biobank_id, test in sorted(set(ordered_by_key) | set(stored_by_key)):
+    ordered = ordered_by_key[(biobank_id, test)]
+    finalized = [ordered_sample for ordered_sample in ordered if ordered_sample.finalized]
+    if not finalized and ordered:
+      continue
+    stored = stored_by_key[(biobank_id, test)]
+    row = BiobankReconciliation(
+        biobankId=biobank_id,
+        test=test,
+        sentCount=len(set(ordered_sample.orderId for ordered_sample in finalized)),
+        sentCollectionTime=_max(ordered_sample.collected for ordered_sample in finalized),
+        sentProcessedTime=_max(ordered_sample.processed for ordered_sample in finalized),
+        sentFinalizedTime=_max(ordered_sample.finalized for ordered_sample in finalized),
+        receivedCount=len(set(sample.biobankStoredSampleId for sample in stored)),
+        receivedSampleId=_join(sample.biobankStoredSampleId for sample in stored),
+        receivedTime=_max(sample.confirmed for sample in stored),
+        receivedCreateTime=_max(sample.created for sample in stored))
+    for row_field, result_field in _ORDER_VALUE_FIELDS:
+      setattr(row, row_field, _join(getattr(ordered_sample, result_field)
+                                    for ordered_sample in finalized))
+    row.status = (BiobankReconciliationStatus.RECEIVED if row.sentCount == row.receivedCount
+                  else BiobankReconciliationStatus.MISSING)
+    if row.sentCollectionTime and row.receivedCreateTime:
+      elapsed = row.receivedCreateTime - row.sentCollectionTime
+      # Truncated towards zero, like MySQL's TIMESTAMPDIFF.
+      row.elapsedHours = int(elapsed.total_seconds() / 3600)
+    row.lastTime = _max([row.sentCollectionTime, row.receivedTime])
+    rows.append(row)
+  return rows
+
+
+def _max(values):
+  values = [value for value in values if value is not None]
+  return max(values) if values else None
+
+
+def _join(values):
+  """Returns the distinct values (in order), comma-separated, or None if there are none."""
+  values = sorted(set(value for value in values if value is not None))
+  return ','.join(values) if values else None
@@ -1,9 +1,49 @@
+import clock
+
 from code_constants import BIOBANK_TESTS_SET
-from dao.base_dao import BaseDao
-from model.biobank_stored_sample import BiobankStoredSample
+from dao.base_dao import UpsertableDao
+from dao.biobank_reconciliation_dao import BiobankReconciliationDao
+from model.biobank_stored_sample import BiobankStoredSample, BiobankSamplesFile
+
+
+class SampleUpsertCounts(object):
+  """Numbers of samples inserted, updated, and left unchanged (because they were already stored
+  with the same values) by BiobankStoredSampleDao.upsert_all.
+
+  changed_biobank_ids is the set of biobank IDs of the participants whose samples were inserted or
+  updated (including the previous participant of any sample moved to another participant), whose
+  summaries need to be updated.
+  """
+  def __init__(self, inserted=0, updated=0, unchanged=0):
+    self.inserted = inserted
+    self.updated = updated
+    self.unchanged = unchanged
+    self.changed_biobank_ids = set()
+
+  @property
+  def written(self):
+    return self.inserted + self.updated
+
+  def add(self, other):
+    self.inserted += other.inserted
+    self.updated += other.updated
+    self.unchanged += other.unchanged
+    self.changed_biobank_ids.update(other.changed_biobank_ids)
 
+  def __eq__(self, other):
+    # Only compares the counts.
+    return (self.inserted, self.updated, self.unchanged) == (other.inserted, other.updated,
+                                                             other.unchanged)
 
-class BiobankStoredSampleDao(BaseDao):
+  def __ne__(self, other):
+    return not self == other
+
+  def __repr__(self):
+    return 'SampleUpsertCounts(inserted=%d, updated=%d, unchanged=%d)' % (
+        self.inserted, self.updated, self.unchanged)
+
+
+class BiobankStoredSampleDao(UpsertableDao):
   """Batch operations for updating samples. Individual insert/get operations are testing only."""
   def __init__(self):
     super(BiobankStoredSampleDao, self).__init__(BiobankStoredSample)
@@ -11,19 +51,87 @@ class BiobankStoredSampleDao(BaseDao):
   def get_id(self, obj):
     return obj.biobankStoredSampleId
 
-  def upsert_all(self, sample_generator):
-    """Inserts/updates samples. Raises ValueError for invalid samples."""
-    # TODO(DA-230) Scale this to handle full study data.
-    # SQLAlchemy does not provide batch upserting; individual session.merge() calls as below may be
-    # expensive but cannot be effectively batched, see stackoverflow.com/questions/25955200. If this
-    # proves to be a bottleneck, we can switch to generating "INSERT .. ON DUPLICATE KEY UPDATE".
-    written = 0
+  def insert_with_session(self, session, obj):
+    inserted_obj = super(BiobankStoredSampleDao, self).insert_with_session(session, obj)
+    BiobankReconciliationDao().update_with_session(session, [inserted_obj.biobankId])
+    return inserted_obj
+
+  def upsert_all(self, samples):
+    """Inserts/updates a batch of samples, returning SampleUpsertCounts. Raises ValueError for
+    invalid samples.
+
+    The stored values of the samples are read with one query, and only new and changed samples
+    are written, with one multi-row upsert (see UpsertableDao.upsert_all.) If a sample ID appears
+    more than once, the last sample with that ID is stored.
+
+    Batches may be written in parallel, so the reconciliation rows of the participants in
+    changed_biobank_ids are not updated here; callers should update them (with
+    BiobankReconciliationDao.update) once all of the batches are written.
+    """
+    samples_by_id = {}
+    for sample in samples:
+      if sample.test not in BIOBANK_TESTS_SET:
+        raise ValueError(
+            'Sample %r has invalid test code %r.'
+            % (sample.test, sample.biobankStoredSampleId))
+      samples_by_id[sample.biobankStoredSampleId] = sample
+    counts = SampleUpsertCounts()
+    if not samples_by_id:
+      return counts
     with self.session() as session:
-      for sample in sample_generator:
-        if sample.test not in BIOBANK_TESTS_SET:
-          raise ValueError(
-              'Sample %r has invalid test code %r.'
-              % (sample.test, sample.biobankStoredSampleId))
-        session.merge(sample)
-        written += 1
-    return written
+      stored_values = {
+          row[0]: row[1:] for row in session.query(BiobankStoredSample.biobankStoredSampleId,
+                                                   BiobankStoredSample.biobankId,
+                                                   BiobankStoredSample.test,
+                                                   BiobankStoredSample.confirmed,
+                                                   BiobankStoredSample.created)
+          .filter(BiobankStoredSample.biobankStoredSampleId.in_(samples_by_id.keys()))}
+      changed_samples = []
+      for sample_id, sample in sorted(samples_by_id.iteritems()):
+        values = stored_values.get(sample_id)
+        if values is None:
+          counts.inserted += 1
+        elif values == (sample.biobankId, sample.test, sample.confirmed, sample.created):
+          counts.unchanged += 1
+          continue
+        else:
+          counts.updated += 1
+          counts.changed_biobank_ids.add(values[0])
+        counts.changed_biobank_ids.add(sample.biobankId)
+        changed_samples.append(sample)
+      self.upsert_all_with_session(session, changed_samples)
+    return counts
+
+
+class BiobankSamplesFileDao(UpsertableDao):
+  """Tracks the CSVs whose samples have been imported."""
+  def __init__(self):
+    super(BiobankSamplesFileDao, self).__init__(BiobankSamplesFile)
+
+  def get_id(self, obj):
+    return obj.fileName
+
+  def get_latest(self):
+    """Returns the processed file with the latest timestamp, or None."""
+    with self.session() as session:
+      return (session.query(BiobankSamplesFile)
+          .order_by(BiobankSamplesFile.timestamp.desc())
+          .first())
+
+  def get_processed_file_names(self, file_names):
+    """Returns the set of file_names that have been processed."""
+    if not file_names:
+      return set()
+    with self.session() as session:
+      return set(file_name for file_name, in session.query(BiobankSamplesFile.fileName)
+                 .filter(BiobankSamplesFile.fileName.in_(file_names)))
+
+  def upsert_processed_file(self, file_name, timestamp, counts):
+    """Records that a file's samples were imported, with their SampleUpsertCounts. Replaces any
+    previous record of the file (if it was imported again.)"""
+    self.upsert(BiobankSamplesFile(fileName=file_name,
+                                   timestamp=timestamp,
+                                   processed=clock.CLOCK.now(),
+                                   inserted=counts.inserted,
+                                   updated=counts.updated,
+                                   unchanged=counts.unchanged))
@@ -0,0 +1,160 @@
+"""Live counts of participants by HPO, metric value and participant type.
+
+Unlike the metrics pipeline's buckets, which are recalculated nightly, HpoCounters are updated
+in the same transaction as every change to the participant summary fields they count: DAOs call
+get_counter_keys with the participant's state before and after the change, and pass both lists
+to HpoCounterDao.update_with_session, which adds the differences to the counters. Participants
+without a participant summary are counted with the default values of every field. Like the metrics
+export, the counters exclude participants in the test HPO or with test email addresses.
+"""
+import collections
+
+from sqlalchemy.dialects.mysql import insert as mysql_insert
+
+from code_constants import UNSET
+from dao.base_dao import BaseDao
+from dao.hpo_dao import HPODao
+from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES
+from model.hpo_counter import HpoCounter
+from model.participant import Participant
+from model.participant_summary import ParticipantSummary
+from participant_enums import EnrollmentStatus, TEST_EMAIL_PATTERN, TEST_HPO_NAME
+
+# Participant types, as in the metrics pipeline.
+REGISTERED_PARTICIPANT = 'R'
+FULL_PARTICIPANT = 'F'
+# The metric for the total number of (registered) participants.
+TOTAL_METRIC = ''
+
+# Prefixes of the names of metrics in Metrics API responses for each participant type.
+_PARTICIPANT_KINDS = {REGISTERED_PARTICIPANT: 'Participant', FULL_PARTICIPANT: 'FullParticipant'}
+
+# (metric, participant summary field, value when the field is unset) for each counted field. The
+# metric names and values match the ones in metrics buckets, so the two can be compared.
+COUNTED_FIELDS = ([('enrollmentStatus', 'enrollmentStatus', EnrollmentStatus.INTERESTED),
+                   ('race', 'race', UNSET),
+                   ('physicalMeasurements', 'physicalMeasurementsStatus', UNSET),
+                   ('samplesToIsolateDNA', 'samplesToIsolateDNA', UNSET),
+                   ('numCompletedBaselinePPIModules', 'numCompletedBaselinePPIModules', 0)] +
+                  [(field, field, UNSET) for field in QUESTIONNAIRE_MODULE_FIELD_NAMES])
+
+_RECALCULATE_BATCH_SIZE = 1000
+
+# The suffix matched by the (SQL LIKE) TEST_EMAIL_PATTERN, e.g. "@example.com".
+_TEST_EMAIL_SUFFIX = TEST_EMAIL_PATTERN.lstrip('%').lower()
+
+
+class HpoCounterDao(BaseDao):
+  def __init__(self):
+    super(HpoCounterDao, self).__init__(HpoCounter)
+
+  def get_id(self, obj):
+    return [obj.hpoId, obj.metric, obj.value, obj.participantType]
+
+  def update_with_session(self, session, old_keys, new_keys):
+    """Decrements the counters for old_keys and increments the counters for new_keys (lists of
+    keys from get_counter_keys), skipping the counters that are in both."""
+    deltas = collections.Counter(new_keys)
+    deltas.subtract(old_keys)
+    # Sorting the rows makes concurrent transactions lock the counters in the same order.
+    rows = [{'hpo_id': hpo_id, 'metric': metric, 'value': value,
+             'participant_type': participant_type, 'count': delta}
+            for (hpo_id, metric, value, participant_type), delta in sorted(deltas.iteritems())
+            if delta]
+    if not rows:
+      return
+    table = HpoCounter.__table__
+    if self._database.db_type == 'sqlite':
+      for row in rows:
+        result = session.execute(
+            table.update()
+            .where(table.c.hpo_id == row['hpo_id'])
+            .where(table.c.metric == row['metric'])
+            .where(table.c.value == row['value'])
+            .where(table.c.participant_type == row['participant_type'])
+            .values(count=table.c['count'] + row['count']))
+        if not result.rowcount:
+          session.execute(table.insert().values(row))
+    else:
+      statement = mysql_insert(table).values(rows)
+      session.execute(statement.on_duplicate_key_update(
+          count=table.c['count'] + statement.inserted['count']))
+
+  def recalculate_with_session(self, session):
+    """Replaces all counters with counts of the current participant summaries (and participants
+    without summaries.) Used after bulk updates of participant summaries."""
+    # Lock the counters (and, in MySQL, the gaps between them) before reading the summaries, so
+    # that transactions updating them wait, and add their changes to the recalculated counts,
+    # instead of being overwritten (or, if they read the summaries first, counted twice.)
+    (session.query(HpoCounter.hpoId)
+     .order_by(HpoCounter.hpoId, HpoCounter.metric, HpoCounter.value, HpoCounter.participantType)
+     .with_for_update()
+     .all())
+    counts = collections.Counter()
+    for summary in session.query(ParticipantSummary).yield_per(_RECALCULATE_BATCH_SIZE):
+      counts.update(get_counter_keys(summary.hpoId, summary))
+    participants_without_summaries = (session.query(Participant.hpoId)
+        .outerjoin(ParticipantSummary)
+        .filter(ParticipantSummary.participantId == None)
+        .yield_per(_RECALCULATE_BATCH_SIZE))
+    for hpo_id, in participants_without_summaries:
+      counts.update(get_counter_keys(hpo_id))
+    session.query(HpoCounter).delete()
+    rows = [{'hpo_id': hpo_id, 'metric': metric, 'value': value,
+             'participant_type': participant_type, 'count': count}
+            for (hpo_id, metric, value, participant_type), count in sorted(counts.iteritems())]
+    table = HpoCounter.__table__
+    for i in xrange(0, len(rows), _RECALCULATE_BATCH_SIZE):
+      session.execute(table.insert().values(rows[i:i + _RECALCULATE_BATCH_SIZE]))
+
+  def recalculate(self):
+    with self.session() as session:
+      self.recalculate_with_session(session)
+
+  def get_counts(self):
+    """Returns a dict of HPO ID -> dict of metric name (as in metrics buckets, e.g.
+    "FullParticipant.race.WHITE") -> count, for all non-zero counters."""
+    with self.session() as session:
+      counters = session.query(HpoCounter).filter(HpoCounter.count != 0).all()
+    counts = collections.defaultdict(dict)
+    for counter in counters:
+      name = get_metric_name(counter.metric, counter.value, counter.participantType)
+      counts[counter.hpoId][name] = counter.count
+    return counts
+
+
+def get_counter_keys(hpo_id, summary=None):
+  """Returns a list of the (HPO ID, metric, value, participant type) keys of the counters that a
+  participant with an HPO ID and a participant summary (or None) is counted in."""
+  if _is_test_participant(hpo_id, summary):
+    return []
+  values = []
+  for metric, field_name, unset_value in COUNTED_FIELDS:
+    value = getattr(summary, field_name) if summary else None
+    values.append((metric, str(unset_value if value is None else value)))
+  keys = [(hpo_id, TOTAL_METRIC, '', REGISTERED_PARTICIPANT)]
+  keys.extend((hpo_id, metric, value, REGISTERED_PARTICIPANT) for metric, value in values)
+  if summary and summary.enrollmentStatus == EnrollmentStatus.FULL_PARTICIPANT:
+    keys.extend((hpo_id, metric, value, FULL_PARTICIPANT) for metric, value in values)
+  return keys
+
+
+def _is_test_participant(hpo_id, summary):
+  if summary and summary.email and summary.email.lower().endswith(_TEST_EMAIL_SUFFIX):
+    return True
+  test_hpo = HPODao().get_by_name(TEST_HPO_NAME)
+  return test_hpo is not None and hpo_id == test_hpo.hpoId
+
+
+def get_participant_counter_keys(participant):
+  """Returns get_counter_keys for a participant and its participant summary (if any.)"""
+  return get_counter_keys(participant.hpoId, participant.participantSummary)
+
+
+def get_metric_name(metric, value, participant_type):
+  """Returns the name of a counter's metric in metrics buckets (e.g. "Participant.race.WHITE", or
+  "Participant" for the total.)"""
+  kind = _PARTICIPANT_KINDS[participant_type]
+  if metric == TOTAL_METRIC:
+    return kind
+  return '%s.%s.%s' % (kind, metric, value)
@@ -0,0 +1,94 @@
+"""In-memory metrics cubes, which the Metrics cube API slices and aggregates.
+
+A cube holds the cells of the MetricsCubes with a name in a version (one per HPO), with the HPO ID
+as an extra dimension. The values of every dimension are dictionary-encoded, so each cell is a
+tuple of small integers and a count. Like metrics indexes, cubes are built on first use in each
+instance, and only the cubes for the latest version requested are kept.
+"""
+import collections
+
+from dao.metrics_dao import MetricsCubeDao, decode_cube
+
+# The extra dimension for the HPO ID of each cell (the same as the name of the HPO ID metric.)
+HPO_ID_DIMENSION = 'hpoId'
+
+# (metrics version ID, cube name) -> InMemoryCube
+_CUBE_CACHE = {}
+
+
+class InMemoryCube(object):
+  def __init__(self, cubes):
+    """Builds a cube from a non-empty list of MetricsCubes with the same name and version."""
+    cube_dimensions = decode_cube(cubes[0])[0]
+    # Cubes already broken down by HPO ID don't need it as an extra dimension.
+    self._hpo_id_position = None
+    self.dimensions = list(cube_dimensions)
+    if HPO_ID_DIMENSION not in cube_dimensions:
+      self._hpo_id_position = len(self.dimensions)
+      self.dimensions.append(HPO_ID_DIMENSION)
+    # For each dimension, the list of its values, and a dict of value -> index in that list.
+    self._values = [[] for _ in self.dimensions]
+    self._indexes = [{} for _ in self.dimensions]
+    # (tuple of value indexes, count) for each cell.
+    self._cells = []
+    for cube in cubes:
+      dimensions, counts = decode_cube(cube)
+      if dimensions != cube_dimensions:
+        raise ValueError('Cube %s has different dimensions for HPO %s.' % (cube.name, cube.hpoId))
+      for values, count in counts.iteritems():
+        if self._hpo_id_position is not None:
+          values += (cube.hpoId,)
+        self._cells.append((tuple(self._encode(i, value) for i, value in enumerate(values)),
+                            count))
+
+  def _encode(self, position, value):
+    index = self._indexes[position].get(value)
+    if index is None:
+      index = len(self._values[position])
+      self._values[position].append(value)
+      self._indexes[position][value] = index
+    return index
+
+  def aggregate(self, dimensions=None, filters=None):
+    """Returns a sorted list of (tuple of values for dimensions, count) for each combination of
+    values of dimensions (all of them, if None), summing the counts of the cells that match it.
+
+    If filters (a dict of dimension -> list of values) is set, only the cells with one of the
+    listed values for each dimension in it are counted.
+    """
+    if dimensions is None:
+      dimensions = self.dimensions
+    positions = [self.dimensions.index(dimension) for dimension in dimensions]
+    allowed_indexes = [(self.dimensions.index(dimension),
+                        set(self._indexes[self.dimensions.index(dimension)].get(value)
+                            for value in values))
+                       for dimension, values in (filters or {}).iteritems()]
+    totals = collections.defaultdict(int)
+    for indexes, count in self._cells:
+      if all(indexes[position] in allowed for position, allowed in allowed_indexes):
+        totals[tuple(indexes[position] for position in positions)] += count
+    return sorted((tuple(self._values[position][index]
+                         for position, index in zip(positions, key)), count)
+                  for key, count in totals.iteritems())
+
+
+def get_cube(version_id, name):
+  """Returns the InMemoryCube for a cube in a version (or None if there is no such cube), building
+  it (and dropping the cubes for other versions) if it isn't cached."""
+  key = (version_id, name)
+  cube = _CUBE_CACHE.get(key)
+  if cube is None:
+    cubes = MetricsCubeDao().get_cubes(version_id, name)
+    if not cubes:
+      return None
+    cube = InMemoryCube(cubes)
+    for cached_key in _CUBE_CACHE.keys():
+      if cached_key[0] != version_id:
+        _CUBE_CACHE.pop(cached_key, None)
+    _CUBE_CACHE[key] = cube
+  return cube
+
+
+def clear_cache():
+  """Drops all cached cubes. Used in tests."""
+  _CUBE_CACHE.clear()
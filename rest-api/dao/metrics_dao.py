@@ -1,10 +1,13 @@
 import clock
 import json
 import logging
+import zlib
 
-from model.metrics import MetricsVersion, MetricsBucket
+from model.metrics import MetricsVersion, MetricsBucket, MetricsKeyframe, MetricsExportRun
+from model.metrics import MetricsExportShard, MetricsCachedResponse, MetricsRollup, MetricsCube
 from dao.base_dao import BaseDao, UpsertableDao
 from werkzeug.exceptions import PreconditionFailed
+from sqlalchemy import func
 from sqlalchemy.orm import subqueryload
 from datetime import timedelta
 
@@ -17,6 +20,50 @@ METRICS_LOCK_TIMEOUT = timedelta(hours=24)
 # but we'll keep them around in case we need to poke at them for a few days.)
 _METRICS_EXPIRATION = timedelta(days=3)
 
+_COPY_BUCKETS_SQL = """
+INSERT INTO metrics_bucket (metrics_version_id, date, hpo_id, metrics, keyframe_date)
+SELECT :to_version_id, date, hpo_id, metrics, keyframe_date
+  FROM metrics_bucket
+ WHERE metrics_version_id = :from_version_id
+   AND date <= :through_date
+"""
+
+_COPY_BUCKETS_FOR_DATE_SQL = """
+INSERT INTO metrics_bucket (metrics_version_id, date, hpo_id, metrics, keyframe_date)
+SELECT :to_version_id, :to_date, hpo_id, metrics, keyframe_date
+  FROM metrics_bucket
+ WHERE metrics_version_id = :from_version_id
+   AND date = :from_date
+"""
+
+_COPY_KEYFRAMES_SQL = """
+INSERT INTO metrics_keyframe (metrics_version_id, date, hpo_id, metrics)
+SELECT :to_version_id, date, hpo_id, metrics
+  FROM metrics_keyframe
+ WHERE metrics_version_id = :from_version_id
+   AND date <= :through_date
+"""
+
+_COPY_CUBES_SQL = """
+INSERT INTO metrics_cube (metrics_version_id, name, hpo_id, cells)
+SELECT :to_version_id, name, hpo_id, cells
+  FROM metrics_cube
+ WHERE metrics_version_id = :from_version_id
+"""
+
+# zlib window bits value for reading and writing gzip (rather than zlib) streams.
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# Granularities of metrics; buckets are daily, and rollups are weekly or monthly.
+DAY = 'day'
+WEEK = 'week'
+MONTH = 'month'
+ROLLUP_GRANULARITIES = (WEEK, MONTH)
+# Number of days of buckets read at a time when writing rollups.
+_ROLLUP_DAYS_PER_QUERY = 30
+# Number of rollups written in one statement.
+_ROLLUP_BATCH_SIZE = 100
+
 class MetricsVersionDao(BaseDao):
   def __init__(self):
     super(MetricsVersionDao, self).__init__(MetricsVersion)
@@ -39,7 +86,7 @@ class MetricsVersionDao(BaseDao):
     with self.session() as session:
       return self.get_version_in_progress_with_session(session)
 
-  def set_pipeline_in_progress(self):
+  def set_pipeline_in_progress(self, exported_through=None):
     with self.session() as session:
       running_version = self.get_version_in_progress_with_session(session)
       if running_version:
@@ -51,7 +98,8 @@ class MetricsVersionDao(BaseDao):
         else:
           # If the timeout hasn't elapsed, don't allow a new pipeline to start.
           raise PreconditionFailed('Metrics pipeline is already running.')
-      new_version = MetricsVersion(inProgress=True, dataVersion=SERVING_METRICS_DATA_VERSION)
+      new_version = MetricsVersion(inProgress=True, dataVersion=SERVING_METRICS_DATA_VERSION,
+                                   exportedThrough=exported_through)
       self.insert_with_session(session, new_version)
     return new_version.metricsVersionId
 
@@ -85,6 +133,60 @@ class MetricsVersionDao(BaseDao):
       for version in old_versions:
         session.delete(version)
 
+class MetricsExportRunDao(BaseDao):
+  """Tracks the shards of parallel metrics exports, so that the MetricsPipeline for an export is
+  started exactly once, after all of them are complete (even if export tasks are retried.)"""
+  def __init__(self):
+    super(MetricsExportRunDao, self).__init__(MetricsExportRun)
+
+  def get_id(self, obj):
+    return obj.metricsExportRunId
+
+  def insert_run(self, export_time, file_names):
+    """Inserts a run with an incomplete shard for each of file_names, and deletes old runs.
+
+    Returns:
+      The ID of the new run.
+    """
+    with self.session() as session:
+      old_runs = (session.query(MetricsExportRun)
+          .filter(MetricsExportRun.exportTime < clock.CLOCK.now() - _METRICS_EXPIRATION)
+          .all())
+      for old_run in old_runs:
+        session.delete(old_run)
+      run = MetricsExportRun(exportTime=export_time,
+                             shards=[MetricsExportShard(fileName=file_name)
+                                     for file_name in file_names])
+      self.insert_with_session(session, run)
+    return run.metricsExportRunId
+
+  def set_shard_complete(self, metrics_export_run_id, file_name):
+    with self.session() as session:
+      (session.query(MetricsExportShard)
+          .filter(MetricsExportShard.metricsExportRunId == metrics_export_run_id)
+          .filter(MetricsExportShard.fileName == file_name)
+          .update({MetricsExportShard.complete: True}))
+
+  def claim_pipeline_start(self, metrics_export_run_id):
+    """Returns true if all of the run's shards are complete, marking the pipeline as started; the
+    claim is committed before this returns.
+
+    Every caller gets true once the shards are complete (including a retried task whose earlier
+    attempt claimed the run but then failed to start the pipeline), so the pipeline must be
+    started with an idempotence key for the run.
+    """
+    with self.session() as session:
+      incomplete_count = (session.query(MetricsExportShard)
+          .filter(MetricsExportShard.metricsExportRunId == metrics_export_run_id)
+          .filter(MetricsExportShard.complete == False)
+          .count())
+      if incomplete_count:
+        return False
+      (session.query(MetricsExportRun)
+          .filter(MetricsExportRun.metricsExportRunId == metrics_export_run_id)
+          .update({MetricsExportRun.pipelineStarted: True}))
+      return True
+
 class MetricsBucketDao(UpsertableDao):
 
   def __init__(self):
@@ -93,21 +195,406 @@ class MetricsBucketDao(UpsertableDao):
   def get_id(self, obj):
     return [obj.metricsVersionId, obj.date, obj.hpoId]
 
-  def get_active_buckets(self, start_date=None, end_date=None):
+  def get_active_buckets(self, start_date=None, end_date=None, hpo_ids=None):
+    version = MetricsVersionDao().get_serving_version()
+    if version is None:
+      return None
+    return self.get_version_buckets(version.metricsVersionId, start_date, end_date, hpo_ids)
+
+  def get_active_bucket_diffs(self, start_date=None, end_date=None, hpo_ids=None):
+    """Returns get_version_bucket_diffs for the serving version, or None if there is none."""
+    version = MetricsVersionDao().get_serving_version()
+    if version is None:
+      return None
+    return self.get_version_bucket_diffs(version.metricsVersionId, start_date, end_date, hpo_ids)
+
+  def get_version_buckets(self, version_id, start_date=None, end_date=None, hpo_ids=None):
+    """Returns the buckets in the specified version (optionally between start_date and end_date,
+    inclusive, and for the HPO IDs in hpo_ids), ordered by date and HPO ID."""
     with self.session() as session:
-      version = MetricsVersionDao().get_serving_version_with_session(session)
-      if version is None:
-        return None
-      version_id = version.metricsVersionId
       query = session.query(MetricsBucket).filter(MetricsBucket.metricsVersionId == version_id)
       if start_date:
         query = query.filter(MetricsBucket.date >= start_date)
       if end_date:
         query = query.filter(MetricsBucket.date <= end_date)
-      return query.order_by(MetricsBucket.date).order_by(MetricsBucket.hpoId).all()
+      if hpo_ids is not None:
+        query = query.filter(MetricsBucket.hpoId.in_(hpo_ids))
+      buckets = query.order_by(MetricsBucket.date).order_by(MetricsBucket.hpoId).all()
+      return self._decode_buckets_with_session(session, version_id, buckets)
+
+  def get_version_bucket_diffs(self, version_id, start_date=None, end_date=None, hpo_ids=None):
+    """Returns the buckets from get_version_buckets, with each bucket after the first one for an
+    HPO only containing the metrics that changed since the previous bucket for that HPO (with null
+    for metrics that were removed.)
+
+    Returns:
+      A list of (bucket, date of the previous bucket for the HPO or None) tuples.
+    """
+    previous_buckets = {}
+    results = []
+    for bucket in self.get_version_buckets(version_id, start_date, end_date, hpo_ids):
+      metrics_dict = json.loads(bucket.metrics)
+      previous_date, previous_metrics_dict = previous_buckets.get(bucket.hpoId, (None, None))
+      previous_buckets[bucket.hpoId] = (bucket.date, metrics_dict)
+      if previous_date:
+        bucket = MetricsBucket(metricsVersionId=bucket.metricsVersionId,
+                               date=bucket.date,
+                               hpoId=bucket.hpoId,
+                               metrics=json.dumps(_diff_metrics(previous_metrics_dict,
+                                                                metrics_dict)))
+      results.append((bucket, previous_date))
+    return results
+
+  def get_bucket_metrics(self, version_id, date, hpo_id):
+    """Returns a dict of all the metrics in a bucket, or None if there is no such bucket, and the
+    MetricsKeyframe that the bucket is stored as differences from (or None.)"""
+    with self.session() as session:
+      bucket = self.get_with_session(session, [version_id, date, hpo_id])
+      if not bucket:
+        return None, None
+      metrics_dict = json.loads(bucket.metrics)
+      if not bucket.keyframeDate:
+        return metrics_dict, None
+      keyframe = session.query(MetricsKeyframe).get([version_id, bucket.keyframeDate, hpo_id])
+      return _apply_metrics_diff(json.loads(keyframe.metrics), metrics_dict), keyframe
+
+  def _decode_buckets_with_session(self, session, version_id, buckets):
+    """Replaces any buckets stored as differences from keyframes with (transient) buckets
+    containing all of their metrics."""
+    keyframe_dates = [bucket.keyframeDate for bucket in buckets if bucket.keyframeDate]
+    if not keyframe_dates:
+      return buckets
+    keyframes = (session.query(MetricsKeyframe)
+        .filter(MetricsKeyframe.metricsVersionId == version_id)
+        .filter(MetricsKeyframe.date >= min(keyframe_dates))
+        .filter(MetricsKeyframe.date <= max(keyframe_dates))
+        .all())
+    keyframe_metrics = {(keyframe.date, keyframe.hpoId): json.loads(keyframe.metrics)
+                        for keyframe in keyframes}
+    results = []
+    for bucket in buckets:
+      if bucket.keyframeDate:
+        metrics_dict = _apply_metrics_diff(keyframe_metrics[(bucket.keyframeDate, bucket.hpoId)],
+                                           json.loads(bucket.metrics))
+        bucket = MetricsBucket(metricsVersionId=bucket.metricsVersionId,
+                               date=bucket.date,
+                               hpoId=bucket.hpoId,
+                               metrics=json.dumps(metrics_dict))
+      results.append(bucket)
+    return results
+
+  def get_date_range(self, version_id):
+    """Returns the first and last dates of buckets in the specified version, or (None, None) if it
+    has no buckets."""
+    with self.session() as session:
+      return (session.query(func.min(MetricsBucket.date), func.max(MetricsBucket.date))
+          .filter(MetricsBucket.metricsVersionId == version_id)
+          .one())
+
+  def get_hpo_buckets(self, version_id, start_date, end_date):
+    """Returns the buckets for individual HPOs (excluding cross-HPO buckets) in the specified
+    version between start_date and end_date (inclusive), ordered by date."""
+    with self.session() as session:
+      buckets = (session.query(MetricsBucket)
+          .filter(MetricsBucket.metricsVersionId == version_id)
+          .filter(MetricsBucket.hpoId != '')
+          .filter(MetricsBucket.date >= start_date)
+          .filter(MetricsBucket.date <= end_date)
+          .order_by(MetricsBucket.date, MetricsBucket.hpoId)
+          .all())
+      return self._decode_buckets_with_session(session, version_id, buckets)
+
+  def copy_buckets(self, from_version_id, to_version_id, through_date):
+    """Copies the buckets for one metrics version into another, up to and including through_date.
+
+    Dates after the last date in the source version are filled in with copies of the buckets for
+    that last date. Keyframes are copied along with the buckets. Any buckets and keyframes already
+    in the target version are deleted first, so this can be safely retried.
+
+    Returns:
+      The last date found in the source version, or None if it has no buckets.
+    """
+    with self.session() as session:
+      (session.query(MetricsBucket)
+          .filter(MetricsBucket.metricsVersionId == to_version_id)
+          .delete())
+      (session.query(MetricsKeyframe)
+          .filter(MetricsKeyframe.metricsVersionId == to_version_id)
+          .delete())
+      last_date = (session.query(func.max(MetricsBucket.date))
+          .filter(MetricsBucket.metricsVersionId == from_version_id)
+          .scalar())
+      if last_date is None:
+        return None
+      session.execute(_COPY_BUCKETS_SQL, {'from_version_id': from_version_id,
+                                          'to_version_id': to_version_id,
+                                          'through_date': through_date})
+      session.execute(_COPY_KEYFRAMES_SQL, {'from_version_id': from_version_id,
+                                            'to_version_id': to_version_id,
+                                            'through_date': through_date})
+      date = last_date + timedelta(days=1)
+      while date <= through_date:
+        session.execute(_COPY_BUCKETS_FOR_DATE_SQL, {'from_version_id': from_version_id,
+                                                     'to_version_id': to_version_id,
+                                                     'from_date': last_date,
+                                                     'to_date': date})
+        date += timedelta(days=1)
+      return last_date
+
+  def to_client_json(self, model, previous_date=None):
+    return make_client_json(model.date, model.hpoId, json.loads(model.metrics), previous_date)
+
+def make_client_json(date, hpo_id, entries, previous_date=None):
+  """Returns the Metrics API JSON for a dict of metrics for an HPO ID ('' for all HPOs) on a date
+  (or for the week or month starting on it.)"""
+  facets = {'date': date.isoformat()}
+  if hpo_id:
+    facets['hpoId'] = hpo_id
+  result = {'facets': facets, 'entries': entries}
+  if previous_date:
+    # The entries are changes since the bucket for this HPO on previous_date.
+    result['diffFrom'] = previous_date.isoformat()
+  return result
+
+class MetricsKeyframeDao(UpsertableDao):
+
+  def __init__(self):
+    super(MetricsKeyframeDao, self).__init__(MetricsKeyframe)
+
+  def get_id(self, obj):
+    return [obj.metricsVersionId, obj.date, obj.hpoId]
+
+class MetricsRollupDao(UpsertableDao):
+
+  def __init__(self):
+    super(MetricsRollupDao, self).__init__(MetricsRollup)
+
+  def get_id(self, obj):
+    return [obj.metricsVersionId, obj.granularity, obj.date, obj.hpoId]
+
+  def write_rollups(self, version_id):
+    """Writes the weekly and monthly rollups for the buckets in a version; can be safely retried.
+    """
+    rollups = []
+    for rollup in _generate_rollups(version_id, ROLLUP_GRANULARITIES):
+      rollups.append(rollup)
+      if len(rollups) >= _ROLLUP_BATCH_SIZE:
+        self.upsert_all(rollups)
+        rollups = []
+    self.upsert_all(rollups)
+
+  def get_rollups(self, version_id, granularity):
+    """Returns the rollups with the specified granularity for a version, ordered by date and HPO
+    ID. They are generated from the buckets for versions written before rollups were."""
+    with self.session() as session:
+      rollups = (session.query(MetricsRollup)
+          .filter(MetricsRollup.metricsVersionId == version_id)
+          .filter(MetricsRollup.granularity == granularity)
+          .order_by(MetricsRollup.date, MetricsRollup.hpoId)
+          .all())
+    if rollups:
+      return rollups
+    return sorted(_generate_rollups(version_id, [granularity]),
+                  key=lambda rollup: (rollup.date, rollup.hpoId))
+
+def get_period_start(date, granularity):
+  """Returns the first date of the week (starting on Monday) or month containing date."""
+  if granularity == WEEK:
+    return date - timedelta(days=date.weekday())
+  if granularity == MONTH:
+    return date.replace(day=1)
+  return date
+
+def _generate_rollups(version_id, granularities):
+  """Generates a MetricsRollup for each granularity, HPO ID and period in a version, containing
+  the metrics from the last bucket for the HPO in the period."""
+  bucket_dao = MetricsBucketDao()
+  start_date, end_date = bucket_dao.get_date_range(version_id)
+  if not start_date:
+    return
+  # (granularity, HPO ID) -> the last bucket read for the HPO.
+  last_buckets = {}
+  while start_date <= end_date:
+    query_end_date = min(start_date + timedelta(days=_ROLLUP_DAYS_PER_QUERY - 1), end_date)
+    for bucket in bucket_dao.get_version_buckets(version_id, start_date, query_end_date):
+      for granularity in granularities:
+        key = (granularity, bucket.hpoId)
+        last_bucket = last_buckets.get(key)
+        if last_bucket and (get_period_start(last_bucket.date, granularity) !=
+                            get_period_start(bucket.date, granularity)):
+          yield _make_rollup(granularity, last_bucket)
+        last_buckets[key] = bucket
+    start_date = query_end_date + timedelta(days=1)
+  for (granularity, _), last_bucket in last_buckets.iteritems():
+    yield _make_rollup(granularity, last_bucket)
+
+def _make_rollup(granularity, bucket):
+  return MetricsRollup(metricsVersionId=bucket.metricsVersionId,
+                       granularity=granularity,
+                       date=get_period_start(bucket.date, granularity),
+                       hpoId=bucket.hpoId,
+                       lastDate=bucket.date,
+                       metrics=bucket.metrics)
+
+class MetricsCubeDao(UpsertableDao):
+
+  def __init__(self):
+    super(MetricsCubeDao, self).__init__(MetricsCube)
+
+  def get_id(self, obj):
+    return [obj.metricsVersionId, obj.name, obj.hpoId]
+
+  def get_cubes(self, version_id, name):
+    """Returns the cubes with a name in a version (one per HPO ID), ordered by HPO ID."""
+    with self.session() as session:
+      return (session.query(MetricsCube)
+          .filter(MetricsCube.metricsVersionId == version_id)
+          .filter(MetricsCube.name == name)
+          .order_by(MetricsCube.hpoId)
+          .all())
+
+  def get_cube_dimensions(self, version_id):
+    """Returns a dict of cube name -> list of dimensions for the cubes in a version."""
+    with self.session() as session:
+      names_and_hpo_ids = (session.query(MetricsCube.name, func.min(MetricsCube.hpoId))
+          .filter(MetricsCube.metricsVersionId == version_id)
+          .group_by(MetricsCube.name)
+          .all())
+      result = {}
+      for name, hpo_id in names_and_hpo_ids:
+        cube = self.get_with_session(session, [version_id, name, hpo_id])
+        result[name] = decode_cube(cube)[0]
+      return result
+
+  def copy_cubes(self, from_version_id, to_version_id):
+    """Copies the cubes for one metrics version into another, replacing any cubes already in the
+    target version (so this can be safely retried.)"""
+    with self.session() as session:
+      (session.query(MetricsCube)
+          .filter(MetricsCube.metricsVersionId == to_version_id)
+          .delete())
+      session.execute(_COPY_CUBES_SQL, {'from_version_id': from_version_id,
+                                        'to_version_id': to_version_id})
+
+class MetricsCachedResponseDao(UpsertableDao):
+  """Caches gzip-compressed Metrics API response bodies for each metrics version and set of
+  request parameters. Versions never change once they are complete, so cached responses are
+  valid until the version is deleted (along with them.)"""
+
+  def __init__(self):
+    super(MetricsCachedResponseDao, self).__init__(MetricsCachedResponse)
+
+  def get_id(self, obj):
+    return [obj.metricsVersionId, obj.requestKey]
+
+  def get_serving_response(self, start_date=None, end_date=None, diffs=False):
+    """Returns the gzip-compressed JSON response for the serving metrics version, building and
+    caching it first if it isn't cached."""
+    version = MetricsVersionDao().get_serving_version()
+    if version is None:
+      return _gzip_json_list([])
+    version_id = version.metricsVersionId
+    request_key = '%s|%s|%s' % (start_date.isoformat() if start_date else '',
+                                end_date.isoformat() if end_date else '',
+                                'diffs' if diffs else '')
+    cached_response = self.get([version_id, request_key])
+    if cached_response:
+      return cached_response.response
+    bucket_dao = MetricsBucketDao()
+    if diffs:
+      entries = (bucket_dao.to_client_json(bucket, previous_date) for bucket, previous_date
+                 in bucket_dao.get_version_bucket_diffs(version_id, start_date, end_date))
+    else:
+      entries = (bucket_dao.to_client_json(bucket)
+                 for bucket in bucket_dao.get_version_buckets(version_id, start_date, end_date))
+    response = _gzip_json_list(entries)
+    self.upsert(MetricsCachedResponse(metricsVersionId=version_id,
+                                      requestKey=request_key,
+                                      response=response))
+    return response
+
+def _gzip_json_list(entries):
+  """Returns a gzip-compressed JSON list of entries, compressed as each entry is serialized."""
+  compressor = zlib.compressobj(zlib.Z_DEFAULT_COMPRESSION, zlib.DEFLATED, GZIP_WBITS)
+  parts = [compressor.compress('[')]
+  for i, entry in enumerate(entries):
+    parts.append(compressor.compress((', ' if i else '') + json.dumps(entry)))
+  parts.append(compressor.compress(']'))
+  parts.append(compressor.flush())
+  return ''.join(parts)
+
+def encode_bucket(version_id, date, hpo_id, metrics_dict, keyframe=None):
+  """Returns a MetricsBucket for a dict of metrics; if keyframe is set, the bucket stores the
+  differences from that MetricsKeyframe."""
+  if keyframe:
+    return MetricsBucket(metricsVersionId=version_id,
+                         date=date,
+                         hpoId=hpo_id,
+                         metrics=json.dumps(_diff_metrics(json.loads(keyframe.metrics),
+                                                          metrics_dict)),
+                         keyframeDate=keyframe.date)
+  return MetricsBucket(metricsVersionId=version_id,
+                       date=date,
+                       hpoId=hpo_id,
+                       metrics=json.dumps(metrics_dict))
+
+def encode_buckets(version_id, hpo_id, dates_and_metrics, keyframe_days=None):
+  """Generates the MetricsKeyframes and MetricsBuckets to write for an HPO's metrics.
+
+  Args:
+    version_id: the metrics version to write to.
+    hpo_id: the HPO ID ('' for cross-HPO metrics.)
+    dates_and_metrics: (date, dict of metrics) tuples, in date order.
+    keyframe_days: if set, a keyframe is written for the first date, and for the first date at
+      least this many days after the previous keyframe; buckets store the differences from the
+      latest keyframe. Otherwise, buckets contain all their metrics.
+  """
+  keyframe = None
+  for date, metrics_dict in dates_and_metrics:
+    if keyframe_days and (not keyframe or (date - keyframe.date).days >= keyframe_days):
+      keyframe = MetricsKeyframe(metricsVersionId=version_id,
+                                 date=date,
+                                 hpoId=hpo_id,
+                                 metrics=json.dumps(metrics_dict))
+      yield keyframe
+    yield encode_bucket(version_id, date, hpo_id, metrics_dict, keyframe)
+
+def encode_cube(version_id, name, hpo_id, dimensions, counts):
+  """Returns a MetricsCube for a dict of (value for each dimension) -> count.
+
+  Cells are stored as JSON like {"dimensions": ["race", "ageRange"], "values": [["ASIAN",
+  "WHITE"], ["18-25"]], "cells": [[0, 0, 3], [1, 0, 5]]}; each cell lists the index of its value
+  in "values" for each dimension, followed by its count. Cells with a count of zero are dropped.
+  """
+  values = [sorted(set(key[i] for key, count in counts.iteritems() if count))
+            for i in range(len(dimensions))]
+  indexes = [{value: index for index, value in enumerate(dimension_values)}
+             for dimension_values in values]
+  cells = sorted([indexes[i][value] for i, value in enumerate(key)] + [count]
+                 for key, count in counts.iteritems() if count)
+  return MetricsCube(metricsVersionId=version_id, name=name, hpoId=hpo_id,
+                     cells=json.dumps({'dimensions': dimensions, 'values': values,
+                                       'cells': cells}))
+
+def decode_cube(cube):
+  """Returns (dimensions, dict of (value for each dimension) -> count) for a MetricsCube."""
+  cube_json = json.loads(cube.cells)
+  values = cube_json['values']
+  counts = {tuple(values[i][index] for i, index in enumerate(cell[:-1])): cell[-1]
+            for cell in cube_json['cells']}
+  return cube_json['dimensions'], counts
+
+def _diff_metrics(base_metrics_dict, metrics_dict):
+  diff = {name: count for name, count in metrics_dict.iteritems()
+          if base_metrics_dict.get(name) != count}
+  diff.update({name: None for name in base_metrics_dict if name not in metrics_dict})
+  return diff
 
-  def to_client_json(self, model):
-    facets = {'date': model.date.isoformat()}
-    if model.hpoId:
-      facets['hpoId'] = model.hpoId
-    return {'facets': facets, 'entries': json.loads(model.metrics)}
+def _apply_metrics_diff(base_metrics_dict, diff):
+  metrics_dict = dict(base_metrics_dict)
+  for name, count in diff.iteritems():
+    if count is None:
+      metrics_dict.pop(name, None)
+    else:
+      metrics_dict[name] = count
+  return metrics_dict
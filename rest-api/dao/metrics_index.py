@@ -0,0 +1,91 @@
+"""Column-oriented, in-memory indexes of the weekly and monthly rollups in a metrics version.
+
+The Metrics API selects a few metrics for a few HPOs from these, rather than reading and parsing
+the JSON of every rollup on every request. An index holds the date and HPO ID of each rollup, and
+for each metric name a column with the metric's count in each rollup (or None, where the rollup
+doesn't have the metric.) Indexes are built on first use in each instance; only the indexes for
+the latest version requested are kept.
+"""
+import bisect
+import json
+
+from dao.metrics_dao import MetricsRollupDao
+
+# (metrics version ID, granularity) -> MetricsIndex
+_INDEX_CACHE = {}
+
+
+class MetricsIndex(object):
+  def __init__(self, rollups):
+    """Builds an index from a list of MetricsRollups, ordered by date and HPO ID."""
+    self._dates = []
+    self._hpo_ids = []
+    self._columns = {}
+    for row, rollup in enumerate(rollups):
+      self._dates.append(rollup.date)
+      self._hpo_ids.append(rollup.hpoId)
+      for name, count in json.loads(rollup.metrics).iteritems():
+        column = self._columns.get(name)
+        if column is None:
+          column = [None] * row
+          self._columns[name] = column
+        column.append(count)
+      for column in self._columns.itervalues():
+        if len(column) == row:
+          column.append(None)
+
+  def select(self, metric_prefixes=None, hpo_ids=None, start_date=None, end_date=None):
+    """Generates (date, HPO ID, metrics dict) for each rollup with a date between start_date and
+    end_date (inclusive, if set) and an HPO ID in hpo_ids (if set). The metrics dicts only contain
+    the metrics matching metric_prefixes (if set); see matches_metric_prefixes.
+    """
+    columns = [(name, column) for name, column in self._columns.iteritems()
+               if matches_metric_prefixes(name, metric_prefixes)]
+    first_row = bisect.bisect_left(self._dates, start_date) if start_date else 0
+    end_row = bisect.bisect_right(self._dates, end_date) if end_date else len(self._dates)
+    hpo_id_set = set(hpo_ids) if hpo_ids is not None else None
+    for row in xrange(first_row, end_row):
+      hpo_id = self._hpo_ids[row]
+      if hpo_id_set is not None and hpo_id not in hpo_id_set:
+        continue
+      yield (self._dates[row], hpo_id,
+             {name: column[row] for name, column in columns if column[row] is not None})
+
+
+def get_metrics_index(version_id, granularity):
+  """Returns the MetricsIndex for the rollups with a granularity in a version, building it (and
+  dropping the indexes for other versions) if it isn't cached."""
+  key = (version_id, granularity)
+  index = _INDEX_CACHE.get(key)
+  if index is None:
+    index = MetricsIndex(MetricsRollupDao().get_rollups(version_id, granularity))
+    for cached_key in _INDEX_CACHE.keys():
+      if cached_key[0] != version_id:
+        _INDEX_CACHE.pop(cached_key, None)
+    _INDEX_CACHE[key] = index
+  return index
+
+
+def matches_metric_prefixes(name, metric_prefixes):
+  """Returns true if metric_prefixes is None, or the metric name equals one of the prefixes or
+  starts with one followed by a '.' (so "Participant.ageRange" matches
+  "Participant.ageRange.18-25", but not "Participant.ageRangeOther".)"""
+  if metric_prefixes is None:
+    return True
+  for prefix in metric_prefixes:
+    if name == prefix or name.startswith(prefix + '.'):
+      return True
+  return False
+
+
+def project_metrics(metrics_dict, metric_prefixes):
+  """Returns the metrics in a dict that match metric_prefixes."""
+  if metric_prefixes is None:
+    return metrics_dict
+  return {name: count for name, count in metrics_dict.iteritems()
+          if matches_metric_prefixes(name, metric_prefixes)}
+
+
+def clear_cache():
+  """Drops all cached indexes. Used in tests."""
+  _INDEX_CACHE.clear()
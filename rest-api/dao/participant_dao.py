@@ -1,5 +1,6 @@
 import json
 
+from sqlalchemy import func
 from sqlalchemy.orm.session import make_transient
 from sqlalchemy.orm import joinedload
 from werkzeug.exceptions import BadRequest, Forbidden
@@ -7,6 +8,7 @@ from werkzeug.exceptions import BadRequest, Forbidden
 from api_util import format_json_enum, parse_json_enum, format_json_date
 import clock
 from dao.base_dao import BaseDao, UpdatableDao
+from dao.hpo_counter_dao import HpoCounterDao, get_counter_keys, get_participant_counter_keys
 from dao.hpo_dao import HPODao
 from dao.site_dao import SiteDao
 from model.participant_summary import ParticipantSummary
@@ -53,6 +55,7 @@ class ParticipantDao(UpdatableDao):
     history = ParticipantHistory()
     history.fromdict(obj.asdict(), allow_pk=True)
     session.add(history)
+    HpoCounterDao().update_with_session(session, [], get_counter_keys(obj.hpoId))
     return obj
 
   def insert(self, obj):
@@ -90,6 +93,7 @@ class ParticipantDao(UpdatableDao):
 
   def _do_update(self, session, obj, existing_obj):
     """Updates the associated ParticipantSummary, and extracts HPO ID from the provider link."""
+    old_counter_keys = get_participant_counter_keys(existing_obj)
     obj.lastModified = clock.CLOCK.now()
     obj.signUpTime = existing_obj.signUpTime
     obj.biobankId = existing_obj.biobankId
@@ -123,6 +127,9 @@ class ParticipantDao(UpdatableDao):
       make_transient(summary)
       make_transient(obj)
       obj.participantSummary = summary
+    HpoCounterDao().update_with_session(
+        session, old_counter_keys,
+        get_counter_keys(obj.hpoId, obj.participantSummary or existing_obj.participantSummary))
     self._update_history(session, obj, existing_obj)
     super(ParticipantDao, self)._do_update(session, obj, existing_obj)
 
@@ -172,6 +179,12 @@ class ParticipantDao(UpdatableDao):
               .filter(Participant.biobankId % 100 <= percentage * 100)
               .yield_per(batch_size))
 
+  def get_id_range(self):
+    """Returns the lowest and highest participant IDs, or (None, None) if there are none."""
+    with self.session() as session:
+      return session.query(func.min(Participant.participantId),
+                           func.max(Participant.participantId)).one()
+
   def to_client_json(self, model):
     client_json = {
         'participantId': to_client_participant_id(model.participantId),
@@ -217,12 +230,15 @@ class ParticipantDao(UpdatableDao):
     if participant.hpoId == site.hpoId:
       return
 
+    old_counter_keys = get_participant_counter_keys(participant)
     participant.hpoId = site.hpoId
     participant.providerLink = make_primary_provider_link_for_id(site.hpoId)
     if participant.participantSummary is None:
       raise RuntimeError('No ParticipantSummary available for P%d.' % participant_id)
     participant.participantSummary.hpoId = site.hpoId
     participant.lastModified = clock.CLOCK.now()
+    HpoCounterDao().update_with_session(session, old_counter_keys,
+                                        get_participant_counter_keys(participant))
     # Update the version and add history row
     self._do_update(session, participant, participant)
 
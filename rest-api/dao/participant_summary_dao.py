@@ -11,6 +11,7 @@ from code_constants import PPI_SYSTEM, UNSET, BIOBANK_TESTS
 from dao.base_dao import UpdatableDao
 from dao.database_utils import get_sql_and_params_for_array
 from dao.code_dao import CodeDao
+from dao.hpo_counter_dao import HpoCounterDao, get_counter_keys
 from dao.hpo_dao import HPODao
 from model.participant_summary import ParticipantSummary, WITHDRAWN_PARTICIPANT_FIELDS
 from model.participant_summary import WITHDRAWN_PARTICIPANT_VISIBILITY_TIME
@@ -32,10 +33,10 @@ _CODE_FIELDS = set()
 _fields_lock = threading.RLock()
 
 # Query used to update the enrollment status for all participant summaries after
-# a Biobank samples import.
+# a Biobank samples import. %(table)s is the table (or join) to update.
 _ENROLLMENT_STATUS_SQL = """
     UPDATE
-      participant_summary
+      %(table)s
     SET
       enrollment_status =
         CASE WHEN (consent_for_study_enrollment = :submitted
@@ -65,6 +66,21 @@ _SAMPLE_SQL = """,
 
 _PARTICIPANT_ID_FILTER = " WHERE participant_id = :participant_id"
 
+# A temporary table of the biobank IDs of the participants whose summaries are being updated after
+# a Biobank samples import, in batches of _BIOBANK_ID_BATCH_SIZE.
+_CHANGED_BIOBANK_IDS_TABLE = 'changed_biobank_ids'
+_CREATE_CHANGED_BIOBANK_IDS_SQL = """
+    CREATE TEMPORARY TABLE IF NOT EXISTS %s (biobank_id INTEGER NOT NULL PRIMARY KEY)
+    """ % _CHANGED_BIOBANK_IDS_TABLE
+# In MySQL, the summaries to update are joined to the temporary table, so that only their rows are
+# read (and locked.) SQLite doesn't support joins in UPDATEs, so filters on the biobank IDs instead.
+_CHANGED_BIOBANK_IDS_JOIN = ('participant_summary JOIN %(ids)s'
+                             ' ON %(ids)s.biobank_id = participant_summary.biobank_id'
+                             % {'ids': _CHANGED_BIOBANK_IDS_TABLE})
+_CHANGED_BIOBANK_IDS_FILTER = (' WHERE participant_summary.biobank_id IN'
+                               ' (SELECT biobank_id FROM %s)' % _CHANGED_BIOBANK_IDS_TABLE)
+_BIOBANK_ID_BATCH_SIZE = 1000
+
 def _get_sample_sql_and_params():
   """Gets SQL and params needed to update status and time fields on the participant summary for
   each biobank sample.
@@ -79,6 +95,24 @@ def _get_sample_sql_and_params():
     params[sample_param] = BIOBANK_TESTS[i]
   return sql, params
 
+def get_num_baseline_ppi_modules():
+  return len(config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
+
+def compute_enrollment_status(consent_for_study_enrollment_and_ehr,
+                              num_completed_baseline_ppi_modules,
+                              num_baseline_ppi_modules,
+                              physical_measurements_status,
+                              samples_to_isolate_dna):
+  """Computes enrollment status from the fields it depends on, given the number of baseline PPI
+  modules (from config); has no other dependencies, so it can be used by the metrics pipeline."""
+  if consent_for_study_enrollment_and_ehr:
+    if (num_completed_baseline_ppi_modules == num_baseline_ppi_modules and
+        physical_measurements_status == PhysicalMeasurementsStatus.COMPLETED and
+        samples_to_isolate_dna == SampleStatus.RECEIVED):
+      return EnrollmentStatus.FULL_PARTICIPANT
+    return EnrollmentStatus.MEMBER
+  return EnrollmentStatus.INTERESTED
+
 
 class ParticipantSummaryDao(UpdatableDao):
 
@@ -171,9 +205,79 @@ class ParticipantSummaryDao(UpdatableDao):
       return super(ParticipantSummaryDao, self).make_query_filter(field_name + 'Id', code.codeId)
     return super(ParticipantSummaryDao, self).make_query_filter(field_name, value)
 
-  def update_from_biobank_stored_samples(self, participant_id=None):
+  def update_from_biobank_stored_samples(self, participant_id=None, biobank_ids=None):
     """Rewrites sample-related summary data. Call this after updating BiobankStoredSamples.
-    If participant_id is provided, only that participant will have their summary updated."""
+    If participant_id is provided, only that participant will have their summary updated. If
+    biobank_ids is provided, only the participants with those biobank IDs will have their
+    summaries updated, in batches."""
+    if biobank_ids is not None:
+      self._update_from_biobank_stored_samples_for_biobank_ids(biobank_ids)
+      return
+    sql, params, enrollment_status_sql, enrollment_status_params = (
+        self._get_sample_update_sql_and_params('participant_summary'))
+    # If participant_id is provided, add the participant ID filter to both update statements.
+    if participant_id:
+      sql += _PARTICIPANT_ID_FILTER
+      params['participant_id'] = participant_id
+      enrollment_status_sql += _PARTICIPANT_ID_FILTER
+      enrollment_status_params['participant_id'] = participant_id
+
+    # Keep the HPO counters in step with the summaries: recount a single participant's before and
+    # after state, or recalculate all the counters after updating every summary.
+    counter_dao = HpoCounterDao()
+    with self.session() as session:
+      summary = None
+      if participant_id:
+        summary = self.get_with_session(session, participant_id, for_update=True)
+        old_counter_keys = get_counter_keys(summary.hpoId, summary) if summary else []
+      session.execute(sql, params)
+      session.execute(enrollment_status_sql, enrollment_status_params)
+      if summary:
+        session.refresh(summary)
+        counter_dao.update_with_session(session, old_counter_keys,
+                                        get_counter_keys(summary.hpoId, summary))
+      elif not participant_id:
+        counter_dao.recalculate_with_session(session)
+
+  def _update_from_biobank_stored_samples_for_biobank_ids(self, biobank_ids):
+    """Rewrites sample-related summary data for the participants with the given biobank IDs (e.g.
+    the ones whose samples changed in an import), and updates the HPO counters for them."""
+    biobank_ids = sorted(set(biobank_id for biobank_id in biobank_ids if biobank_id is not None))
+    if self._database.db_type == 'sqlite':
+      table_sql, filter_sql = 'participant_summary', _CHANGED_BIOBANK_IDS_FILTER
+    else:
+      table_sql, filter_sql = _CHANGED_BIOBANK_IDS_JOIN, ''
+    sql, params, enrollment_status_sql, enrollment_status_params = (
+        self._get_sample_update_sql_and_params(table_sql))
+    counter_dao = HpoCounterDao()
+    for i in xrange(0, len(biobank_ids), _BIOBANK_ID_BATCH_SIZE):
+      batch = biobank_ids[i:i + _BIOBANK_ID_BATCH_SIZE]
+      with self.session() as session:
+        session.execute(_CREATE_CHANGED_BIOBANK_IDS_SQL)
+        session.execute('DELETE FROM %s' % _CHANGED_BIOBANK_IDS_TABLE)
+        session.execute('INSERT INTO %s (biobank_id) VALUES (:biobank_id)'
+                        % _CHANGED_BIOBANK_IDS_TABLE,
+                        [{'biobank_id': biobank_id} for biobank_id in batch])
+        summaries = (session.query(ParticipantSummary)
+                     .filter(ParticipantSummary.biobankId.in_(batch))
+                     .with_for_update()
+                     .all())
+        old_counter_keys = [key for summary in summaries
+                            for key in get_counter_keys(summary.hpoId, summary)]
+        session.execute(sql + filter_sql, params)
+        session.execute(enrollment_status_sql + filter_sql, enrollment_status_params)
+        # Reload the updated summaries with one query, rather than refreshing each of them.
+        summaries = (session.query(ParticipantSummary)
+                     .filter(ParticipantSummary.biobankId.in_(batch))
+                     .populate_existing()
+                     .all())
+        counter_dao.update_with_session(session, old_counter_keys,
+                                        [key for summary in summaries
+                                         for key in get_counter_keys(summary.hpoId, summary)])
+
+  def _get_sample_update_sql_and_params(self, table_sql):
+    """Returns the SQL and params for the statements that update the sample fields and then the
+    enrollment statuses of the participant summaries in table_sql (a table or join)."""
     baseline_tests_sql, baseline_tests_params = get_sql_and_params_for_array(
         config.getSettingList(config.BASELINE_SAMPLE_TEST_CODES), 'baseline')
     dna_tests_sql, dna_tests_params = get_sql_and_params_for_array(
@@ -181,7 +285,7 @@ class ParticipantSummaryDao(UpdatableDao):
     sample_sql, sample_params = _get_sample_sql_and_params()
     sql = """
     UPDATE
-      participant_summary
+      %s
     SET
       num_baseline_samples_arrived = (
         SELECT
@@ -197,7 +301,7 @@ class ParticipantSummaryDao(UpdatableDao):
                            WHERE biobank_stored_sample.biobank_id = participant_summary.biobank_id
                            AND biobank_stored_sample.test IN %s)
           THEN :received ELSE :unset END
-      ) %s""" % (baseline_tests_sql, dna_tests_sql, sample_sql)
+      ) %s""" % (table_sql, baseline_tests_sql, dna_tests_sql, sample_sql)
     params = {'received': int(SampleStatus.RECEIVED), 'unset': int(SampleStatus.UNSET)}
     params.update(baseline_tests_params)
     params.update(dna_tests_params)
@@ -209,20 +313,11 @@ class ParticipantSummaryDao(UpdatableDao):
                                 'full_participant': int(EnrollmentStatus.FULL_PARTICIPANT),
                                 'member': int(EnrollmentStatus.MEMBER),
                                 'interested': int(EnrollmentStatus.INTERESTED)}
-    enrollment_status_sql = _ENROLLMENT_STATUS_SQL
-    # If participant_id is provided, add the participant ID filter to both update statements.
-    if participant_id:
-      sql += _PARTICIPANT_ID_FILTER
-      params['participant_id'] = participant_id
-      enrollment_status_sql += _PARTICIPANT_ID_FILTER
-      enrollment_status_params['participant_id'] = participant_id
-
-    with self.session() as session:
-      session.execute(sql, params)
-      session.execute(enrollment_status_sql, enrollment_status_params)
+    enrollment_status_sql = _ENROLLMENT_STATUS_SQL % {'table': table_sql}
+    return sql, params, enrollment_status_sql, enrollment_status_params
 
   def _get_num_baseline_ppi_modules(self):
-    return len(config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS))
+    return get_num_baseline_ppi_modules()
 
   def update_enrollment_status(self, summary):
     """Updates the enrollment status field on the provided participant summary to
@@ -240,13 +335,11 @@ class ParticipantSummaryDao(UpdatableDao):
                                   num_completed_baseline_ppi_modules,
                                   physical_measurements_status,
                                   samples_to_isolate_dna):
-    if consent_for_study_enrollment_and_ehr:
-      if (num_completed_baseline_ppi_modules == self._get_num_baseline_ppi_modules() and
-          physical_measurements_status == PhysicalMeasurementsStatus.COMPLETED and
-          samples_to_isolate_dna == SampleStatus.RECEIVED):
-        return EnrollmentStatus.FULL_PARTICIPANT
-      return EnrollmentStatus.MEMBER
-    return EnrollmentStatus.INTERESTED
+    return compute_enrollment_status(consent_for_study_enrollment_and_ehr,
+                                     num_completed_baseline_ppi_modules,
+                                     self._get_num_baseline_ppi_modules(),
+                                     physical_measurements_status,
+                                     samples_to_isolate_dna)
 
   def to_client_json(self, model):
     result = model.asdict()
@@ -7,6 +7,7 @@ import fhirclient.models.observation
 from fhirclient.models.fhirabstractbase import FHIRValidationError
 from sqlalchemy.orm import subqueryload
 from dao.base_dao import BaseDao
+from dao.hpo_counter_dao import HpoCounterDao, get_participant_counter_keys
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.site_dao import SiteDao
@@ -275,11 +276,14 @@ class PhysicalMeasurementsDao(BaseDao):
     raise_if_withdrawn(participant_summary)
     if (not participant_summary.physicalMeasurementsStatus or
         participant_summary.physicalMeasurementsStatus == PhysicalMeasurementsStatus.UNSET):
+      old_counter_keys = get_participant_counter_keys(participant)
       participant_summary.physicalMeasurementsStatus = PhysicalMeasurementsStatus.COMPLETED
       if not participant_summary.physicalMeasurementsTime:
         participant_summary.physicalMeasurementsTime = created
       participant_summary_dao.update_enrollment_status(participant_summary)
       session.merge(participant_summary)
+      HpoCounterDao().update_with_session(session, old_counter_keys,
+                                          get_participant_counter_keys(participant))
 
   def insert(self, obj):
     if obj.physicalMeasurementsId:
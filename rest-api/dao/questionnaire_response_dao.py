@@ -16,6 +16,7 @@ from code_constants import CABOR_SIGNATURE_QUESTION_CODE
 from config_api import is_config_admin
 from dao.base_dao import BaseDao
 from dao.code_dao import CodeDao
+from dao.hpo_counter_dao import HpoCounterDao, get_counter_keys, get_participant_counter_keys
 from dao.participant_dao import ParticipantDao, raise_if_withdrawn
 from dao.participant_summary_dao import ParticipantSummaryDao
 from dao.questionnaire_dao import QuestionnaireHistoryDao, QuestionnaireQuestionDao
@@ -152,6 +153,7 @@ class QuestionnaireResponseDao(BaseDao):
     # Block on other threads modifying the participant or participant summary.
     participant = ParticipantDao().get_for_update(session, questionnaire_response.participantId)
     participant_summary = participant.participantSummary
+    old_counter_keys = get_participant_counter_keys(participant)
 
     code_ids.extend([concept.codeId for concept in questionnaire_history.concepts])
 
@@ -242,6 +244,9 @@ class QuestionnaireResponseDao(BaseDao):
             % tuple(['present' if part else 'missing' for part in first_last_email]))
       ParticipantSummaryDao().update_enrollment_status(participant_summary)
       session.merge(participant_summary)
+      HpoCounterDao().update_with_session(session, old_counter_keys,
+                                          get_counter_keys(participant_summary.hpoId,
+                                                           participant_summary))
 
   def insert(self, obj):
     if obj.questionnaireResponseId:
@@ -12,6 +12,8 @@ from api.check_ppi_data_api import check_ppi_data
 from api.data_gen_api import DataGenApi
 from api.import_codebook_api import import_codebook
 from api.metrics_api import MetricsApi
+from api.metrics_cube_api import MetricsCubeApi
+from api.metrics_current_counts_api import MetricsCurrentCountsApi
 from api.metrics_fields_api import MetricsFieldsApi
 from api.participant_api import ParticipantApi
 from api.participant_summary_api import ParticipantSummaryApi
@@ -73,6 +75,16 @@ api.add_resource(MetricsApi,
                  endpoint='metrics',
                  methods=['POST'])
 
+api.add_resource(MetricsCubeApi,
+                 PREFIX + 'MetricsCube',
+                 endpoint='metrics_cube',
+                 methods=['POST'])
+
+api.add_resource(MetricsCurrentCountsApi,
+                 PREFIX + 'MetricsCurrentCounts',
+                 endpoint='metrics_current_counts',
+                 methods=['POST'])
+
 api.add_resource(MetricsFieldsApi,
                  PREFIX + 'MetricsFields',
                  endpoint='metrics_fields',
@@ -1,5 +1,5 @@
 from sqlalchemy.orm import relationship
-from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, UnicodeText
+from sqlalchemy import Column, Integer, String, ForeignKey, Boolean, UnicodeText, Index
 
 from model.base import Base
 from model.utils import UTCDateTime
@@ -58,6 +58,9 @@ class BiobankOrder(Base):
   identifiers = relationship('BiobankOrderIdentifier', cascade='all, delete-orphan')
   samples = relationship('BiobankOrderedSample', cascade='all, delete-orphan')
 
+# Covers the first order date lookup in the metrics export.
+Index('biobank_order_participant_created', BiobankOrder.participantId, BiobankOrder.created)
+
 
 class BiobankOrderIdentifier(Base):
   """Arbitrary IDs for a BiobankOrder in other systems.
@@ -0,0 +1,61 @@
+from model.base import Base
+from model.utils import Enum, UTCDateTime
+from participant_enums import BiobankReconciliationStatus
+from sqlalchemy import Column, Integer, String, ForeignKey, Index, UnicodeText
+
+
+class BiobankReconciliation(Base):
+  """The orders and received samples for a participant and test, as listed in the Biobank
+  reconciliation reports.
+
+  Rows are recalculated from all of a participant's orders and samples whenever an order is
+  inserted for them or the samples import changes their samples (see
+  dao/biobank_reconciliation_dao.py), so the nightly reports only have to select rows by status
+  and time. Multiple values (for multiple orders or samples) are comma-separated. Site and HPO
+  values are copied from the sites when the row is recalculated.
+  """
+  __tablename__ = 'biobank_reconciliation'
+  biobankId = Column('biobank_id', Integer, ForeignKey('participant.biobank_id'),
+                     primary_key=True)
+  test = Column('test', String(80), primary_key=True)
+  # RECEIVED if as many samples were received as orders were finalized, otherwise MISSING.
+  status = Column('status', Enum(BiobankReconciliationStatus), nullable=False)
+
+  # Values for the orders whose samples for the test were finalized.
+  sentCount = Column('sent_count', Integer, nullable=False)
+  sentOrderId = Column('sent_order_id', UnicodeText)
+  sentCollectionTime = Column('sent_collection_time', UTCDateTime)
+  sentProcessedTime = Column('sent_processed_time', UTCDateTime)
+  sentFinalizedTime = Column('sent_finalized_time', UTCDateTime)
+  sourceSiteName = Column('source_site_name', UnicodeText)
+  sourceSiteConsortium = Column('source_site_consortium', UnicodeText)
+  sourceSiteMayolinkClientNumber = Column('source_site_mayolink_client_number', UnicodeText)
+  sourceSiteHpo = Column('source_site_hpo', UnicodeText)
+  sourceSiteHpoType = Column('source_site_hpo_type', UnicodeText)
+  finalizedSiteName = Column('finalized_site_name', UnicodeText)
+  finalizedSiteConsortium = Column('finalized_site_consortium', UnicodeText)
+  finalizedSiteMayolinkClientNumber = Column('finalized_site_mayolink_client_number',
+                                             UnicodeText)
+  finalizedSiteHpo = Column('finalized_site_hpo', UnicodeText)
+  finalizedSiteHpoType = Column('finalized_site_hpo_type', UnicodeText)
+  finalizedUsername = Column('finalized_username', UnicodeText)
+  biospecimenKitId = Column('biospecimen_kit_id', UnicodeText)
+  fedexTrackingNumber = Column('fedex_tracking_number', UnicodeText)
+
+  # Values for the received samples.
+  receivedCount = Column('received_count', Integer, nullable=False)
+  receivedSampleId = Column('received_sample_id', UnicodeText)
+  # The latest time a sample was confirmed.
+  receivedTime = Column('received_time', UTCDateTime)
+  # The latest time a sample was created.
+  receivedCreateTime = Column('received_create_time', UTCDateTime)
+
+  # Whole hours from sentCollectionTime to receivedCreateTime.
+  elapsedHours = Column('elapsed_hours', Integer)
+  # The later of sentCollectionTime and receivedTime; the late and missing reports only include
+  # rows where this is recent.
+  lastTime = Column('last_time', UTCDateTime)
+
+Index('biobank_reconciliation_status_last_time', BiobankReconciliation.status,
+      BiobankReconciliation.lastTime)
+Index('biobank_reconciliation_last_time', BiobankReconciliation.lastTime)
@@ -1,6 +1,6 @@
 from model.base import Base
 from model.utils import UTCDateTime
-from sqlalchemy import Column, Integer, String, ForeignKey
+from sqlalchemy import Column, Integer, String, ForeignKey, Index
 
 
 class BiobankStoredSample(Base):
@@ -33,3 +33,27 @@ class BiobankStoredSample(Base):
   # Timestamp when Biobank received / created the sample.
   created = Column('created', UTCDateTime)
 
+# Covers the first sample dates lookups in the metrics export.
+Index('biobank_stored_sample_biobank_test_confirmed', BiobankStoredSample.biobankId,
+      BiobankStoredSample.test, BiobankStoredSample.confirmed)
+
+
+class BiobankSamplesFile(Base):
+  """A CSV uploaded by Biobank whose samples have been imported.
+
+  The samples import records each file it processes, so that it can import every file uploaded
+  since its last run (in the order of the timestamps in their names) rather than only the latest.
+  """
+  __tablename__ = 'biobank_samples_file'
+  # The file's name within the samples bucket.
+  fileName = Column('file_name', String(255), primary_key=True)
+  # The time in the file's name (converted from Central time), when Biobank generated it.
+  timestamp = Column('timestamp', UTCDateTime, nullable=False)
+  # When the file's samples (and the summaries of their participants) were updated.
+  processed = Column('processed', UTCDateTime, nullable=False)
+  # The SampleUpsertCounts for the file's samples.
+  inserted = Column('inserted', Integer, nullable=False)
+  updated = Column('updated', Integer, nullable=False)
+  unchanged = Column('unchanged', Integer, nullable=False)
+
+Index('biobank_samples_file_timestamp', BiobankSamplesFile.timestamp)
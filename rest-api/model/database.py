@@ -6,13 +6,16 @@ from model.base import Base
 # pylint: disable=unused-import
 from model.participant import Participant, ParticipantHistory
 from model.participant_summary import ParticipantSummary
-from model.biobank_stored_sample import BiobankStoredSample
+from model.biobank_stored_sample import BiobankStoredSample, BiobankSamplesFile
 from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model.biobank_reconciliation import BiobankReconciliation
 from model.code import CodeBook, Code, CodeHistory
 from model.hpo import HPO
+from model.hpo_counter import HpoCounter
 from model.log_position import LogPosition
 from model.measurements import PhysicalMeasurements, Measurement
-from model.metrics import MetricsVersion, MetricsBucket
+from model.metrics import MetricsVersion, MetricsBucket, MetricsKeyframe, MetricsExportRun
+from model.metrics import MetricsExportShard, MetricsCachedResponse, MetricsRollup, MetricsCube
 from model.questionnaire import Questionnaire, QuestionnaireHistory, QuestionnaireQuestion
 from model.questionnaire import QuestionnaireConcept
 from model.questionnaire_response import QuestionnaireResponse, QuestionnaireResponseAnswer
@@ -0,0 +1,17 @@
+from model.base import Base
+from sqlalchemy import Column, Integer, String, ForeignKey
+
+class HpoCounter(Base):
+  """The current number of participants for an HPO with a value for a metric, maintained by the
+  DAOs in the same transactions as the participant summary changes they count; see
+  dao/hpo_counter_dao.py.
+  """
+  __tablename__ = 'hpo_counter'
+  hpoId = Column('hpo_id', Integer, ForeignKey('hpo.hpo_id'), primary_key=True)
+  # A field name (e.g. 'race'), or '' for the total number of participants.
+  metric = Column('metric', String(80), primary_key=True)
+  value = Column('value', String(80), primary_key=True)
+  # 'R' for all registered participants, 'F' for full participants only (as in the metrics
+  # pipeline.)
+  participantType = Column('participant_type', String(1), primary_key=True)
+  count = Column('count', Integer, nullable=False)
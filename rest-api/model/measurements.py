@@ -2,6 +2,7 @@ from model.base import Base
 from model.utils import UTCDateTime
 from sqlalchemy.orm import relationship
 from sqlalchemy import Column, Boolean, Integer, BLOB, BIGINT, ForeignKey, String, Float, Table
+from sqlalchemy import Index
 
 measurement_to_qualifier = Table('measurement_to_qualifier', Base.metadata,
     Column('measurement_id', BIGINT, ForeignKey('measurement.measurement_id'), primary_key=True),
@@ -33,6 +34,10 @@ class PhysicalMeasurements(Base):
   logPosition = relationship('LogPosition')
   measurements = relationship('Measurement', cascade='all, delete-orphan')
 
+# Covers the first physical measurements date lookup in the metrics export.
+Index('physical_measurements_participant_created', PhysicalMeasurements.participantId,
+      PhysicalMeasurements.created)
+
 
 class Measurement(Base):
   """An individual measurement; child of PhysicalMeasurements."""
@@ -2,6 +2,7 @@ import clock
 
 from model.base import Base
 from model.utils import UTCDateTime
+from sqlalchemy.dialects.mysql import LONGBLOB
 from sqlalchemy.orm import relationship
 from sqlalchemy import Column, Integer, BLOB, Boolean, Date, String, ForeignKey
 
@@ -18,7 +19,15 @@ class MetricsVersion(Base):
   complete = Column('complete', Boolean, default=False, nullable=False)
   date = Column('date', UTCDateTime, default=clock.CLOCK.now, nullable=False)
   dataVersion = Column('data_version', Integer, nullable=False)
+  # When the data used to generate this version was exported; incremental runs that build on
+  # this version only export participants whose data changed after this time.
+  exportedThrough = Column('exported_through', UTCDateTime)
   buckets = relationship('MetricsBucket', cascade='all, delete-orphan', passive_deletes=True)
+  keyframes = relationship('MetricsKeyframe', cascade='all, delete-orphan', passive_deletes=True)
+  cachedResponses = relationship('MetricsCachedResponse', cascade='all, delete-orphan',
+                                 passive_deletes=True)
+  rollups = relationship('MetricsRollup', cascade='all, delete-orphan', passive_deletes=True)
+  cubes = relationship('MetricsCube', cascade='all, delete-orphan', passive_deletes=True)
 
 
 class MetricsBucket(Base):
@@ -31,3 +40,89 @@ class MetricsBucket(Base):
   date = Column('date', Date, primary_key=True)
   hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
   metrics = Column('metrics', BLOB, nullable=False)
+  # If set, metrics only contains the metrics that differ from the MetricsKeyframe for this
+  # version and HPO ID on this date (with null for metrics missing from this bucket.)
+  keyframeDate = Column('keyframe_date', Date)
+
+
+class MetricsKeyframe(Base):
+  """All the metrics for an HPO ID on a date, which later buckets for the HPO can be stored as
+  differences from; see MetricsBucket.keyframeDate.
+
+  Keyframes are never updated once written, so buckets can be replaced independently.
+  """
+  __tablename__ = 'metrics_keyframe'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  date = Column('date', Date, primary_key=True)
+  hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
+  metrics = Column('metrics', BLOB, nullable=False)
+
+
+class MetricsRollup(Base):
+  """The metrics for an HPO ID for a week or month in a MetricsVersion: a copy of the metrics in
+  the last bucket for the HPO in that period."""
+  __tablename__ = 'metrics_rollup'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  granularity = Column('granularity', String(10), primary_key=True) # 'week' or 'month'
+  # The first date in the period (a Monday for weeks.)
+  date = Column('date', Date, primary_key=True)
+  hpoId = Column('hpo_id', String(20), primary_key=True) # Set to '' for cross-HPO metrics
+  # The date of the bucket the metrics were copied from.
+  lastDate = Column('last_date', Date, nullable=False)
+  metrics = Column('metrics', BLOB, nullable=False)
+
+
+class MetricsCube(Base):
+  """Counts of the participants for an HPO ID in a MetricsVersion (as of the date it was
+  generated) by every combination of values of a set of fields (the cube's dimensions.)
+  """
+  __tablename__ = 'metrics_cube'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  name = Column('name', String(80), primary_key=True)
+  hpoId = Column('hpo_id', String(20), primary_key=True)
+  # JSON containing the dimensions, the values seen for each dimension, and a list of cells with
+  # the index of the value for each dimension and a count; see metrics_dao.encode_cube.
+  cells = Column('cells', BLOB, nullable=False)
+
+
+class MetricsCachedResponse(Base):
+  """A gzip-compressed Metrics API response body for a MetricsVersion and a set of request
+  parameters, so that the buckets don't need to be read and serialized for every request.
+  """
+  __tablename__ = 'metrics_cached_response'
+  metricsVersionId = Column('metrics_version_id', Integer,
+                            ForeignKey('metrics_version.metrics_version_id', ondelete='CASCADE'),
+                            primary_key=True)
+  # The start date, end date and diffs parameters of the request; see MetricsCachedResponseDao.
+  requestKey = Column('request_key', String(80), primary_key=True)
+  response = Column('response', BLOB().with_variant(LONGBLOB(), 'mysql'), nullable=False)
+
+
+class MetricsExportRun(Base):
+  """A run of MetricsExport, which exports a set of CSV files in parallel.
+
+  The MetricsPipeline for the run is started when all of its shards are complete.
+  """
+  __tablename__ = 'metrics_export_run'
+  metricsExportRunId = Column('metrics_export_run_id', Integer, primary_key=True)
+  exportTime = Column('export_time', UTCDateTime, nullable=False)
+  # Set when the MetricsPipeline for this export is started, so that it only starts once.
+  pipelineStarted = Column('pipeline_started', Boolean, default=False, nullable=False)
+  shards = relationship('MetricsExportShard', cascade='all, delete-orphan', passive_deletes=True)
+
+
+class MetricsExportShard(Base):
+  """A CSV file written by a MetricsExportRun, holding one shard of one type of data."""
+  __tablename__ = 'metrics_export_shard'
+  metricsExportRunId = Column('metrics_export_run_id', Integer,
+                              ForeignKey('metrics_export_run.metrics_export_run_id',
+                                         ondelete='CASCADE'),
+                              primary_key=True)
+  fileName = Column('file_name', String(255), primary_key=True)
+  complete = Column('complete', Boolean, default=False, nullable=False)
@@ -0,0 +1,298 @@
+"""Writes and reads Avro object container files for typed table exports.
+
+Unlike CSVs, Avro files carry a schema, so BigQuery (and other clients) load the values with
+their original types instead of re-parsing strings and inferring types. The schema of each export
+is generated from the SQLAlchemy table in model/* (see get_schema):
+* integers (including Enums, stored as their numeric values) are longs;
+* booleans are booleans, and floats are doubles;
+* dates are ints with the "date" logical type (days since 1970-01-01);
+* datetimes (stored in UTC) are longs with the "timestamp-micros" logical type;
+* BLOBs are bytes, and strings and any other types are strings;
+* nullable columns are unions of null and their type.
+
+Each batch of rows passed to AvroFileWriter.write_rows is written as one deflate-compressed
+block, so exports are written as they are fetched from the database. This module only supports
+the subset of Avro needed for these exports; see https://avro.apache.org/docs/1.8.2/spec.html.
+"""
+
+import datetime
+import json
+import os
+import struct
+import zlib
+
+from sqlalchemy import column
+from sqlalchemy.types import BLOB, Boolean, Date, DateTime, Float, Integer, LargeBinary
+from sqlalchemy.types import TypeDecorator
+
+_MAGIC = 'Obj\x01'
+_SYNC_SIZE = 16
+_CODEC = 'deflate'
+_COMPRESS_LEVEL = 6
+_EPOCH = datetime.datetime(1970, 1, 1)
+_EPOCH_ORDINAL = _EPOCH.toordinal()
+# Nullable columns are unions of null and their type, with null first.
+_NULL = 'null'
+_NULL_INDEX = 0
+
+_DATE = {'type': 'int', 'logicalType': 'date'}
+_TIMESTAMP = {'type': 'long', 'logicalType': 'timestamp-micros'}
+
+
+def _get_impl_type(sql_type):
+  # TypeDecorators (Enum, UTCDateTime) are stored as their underlying types.
+  while isinstance(sql_type, TypeDecorator):
+    sql_type = sql_type.impl
+  return sql_type
+
+
+def _get_avro_type(sql_type):
+  sql_type = _get_impl_type(sql_type)
+  if isinstance(sql_type, Boolean):
+    return 'boolean'
+  if isinstance(sql_type, Integer):
+    return 'long'
+  if isinstance(sql_type, Float):
+    return 'double'
+  if isinstance(sql_type, DateTime):
+    return _TIMESTAMP
+  if isinstance(sql_type, Date):
+    return _DATE
+  if isinstance(sql_type, (BLOB, LargeBinary)):
+    return 'bytes'
+  return 'string'
+
+
+def get_schema(table):
+  """Returns the Avro schema (as a dict) for the rows of a SQLAlchemy table."""
+  fields = []
+  for table_column in table.columns:
+    avro_type = _get_avro_type(table_column.type)
+    if table_column.nullable:
+      fields.append({'name': table_column.name, 'type': [_NULL, avro_type], 'default': None})
+    else:
+      fields.append({'name': table_column.name, 'type': avro_type})
+  return {'type': 'record', 'name': table.name, 'fields': fields}
+
+
+def get_result_columns(table):
+  """Returns columns to pass to TextClause.columns() for a query selecting every column of a
+  table, so that the database driver's values are converted to Python types (e.g. datetimes
+  in SQLite, which stores them as strings) but TypeDecorators are not applied."""
+  return [column(table_column.name, _get_impl_type(table_column.type))
+          for table_column in table.columns]
+
+
+class AvroFileWriter(object):
+  """Writes rows to an Avro file, with the same interface as SqlExportFileWriter.
+
+  The header is written when the writer is created; close() must be called after the last rows
+  have been written.
+  """
+  def __init__(self, dest, schema):
+    self._dest = dest
+    self._field_names = [field['name'] for field in schema['fields']]
+    self._encoders = [_get_encoder(field['type']) for field in schema['fields']]
+    self._sync_marker = os.urandom(_SYNC_SIZE)
+    out = [_MAGIC]
+    _write_long(2, out)
+    for key, value in (('avro.schema', json.dumps(schema)), ('avro.codec', _CODEC)):
+      _write_bytes(key, out)
+      _write_bytes(value, out)
+    _write_long(0, out)
+    out.append(self._sync_marker)
+    dest.write(''.join(out))
+
+  def write_header(self, keys):
+    if list(keys) != self._field_names:
+      raise ValueError('Query columns %s do not match the schema fields %s.' %
+                       (list(keys), self._field_names))
+
+  def write_rows(self, results):
+    if not results:
+      return
+    out = []
+    for result in results:
+      for encoder, value in zip(self._encoders, result):
+        encoder(value, out)
+    compressor = zlib.compressobj(_COMPRESS_LEVEL, zlib.DEFLATED, -zlib.MAX_WBITS)
+    data = compressor.compress(''.join(out)) + compressor.flush()
+    block = []
+    _write_long(len(results), block)
+    _write_long(len(data), block)
+    block.append(data)
+    block.append(self._sync_marker)
+    self._dest.write(''.join(block))
+
+  def close(self):
+    # Blocks are complete when they are written; there is no footer.
+    pass
+
+
+def read_avro(input_file):
+  """Yields each record (as a dict) from an Avro file written by AvroFileWriter. The whole file
+  is read into memory, so this is only meant for checking exports (e.g. in tests.)"""
+  data = input_file.read()
+  if not data.startswith(_MAGIC):
+    raise ValueError('Not an Avro file.')
+  pos = len(_MAGIC)
+  metadata = {}
+  count, pos = _read_long(data, pos)
+  while count:
+    for _ in xrange(abs(count)):
+      key, pos = _read_bytes(data, pos)
+      metadata[key], pos = _read_bytes(data, pos)
+    count, pos = _read_long(data, pos)
+  if metadata.get('avro.codec', 'null') not in ('null', _CODEC):
+    raise ValueError('Unsupported codec: %s' % metadata['avro.codec'])
+  schema = json.loads(metadata['avro.schema'])
+  decoders = [(field['name'], _get_decoder(field['type'])) for field in schema['fields']]
+  sync_marker = data[pos:pos + _SYNC_SIZE]
+  pos += _SYNC_SIZE
+  while pos < len(data):
+    count, pos = _read_long(data, pos)
+    size, pos = _read_long(data, pos)
+    block = data[pos:pos + size]
+    pos += size
+    if data[pos:pos + _SYNC_SIZE] != sync_marker:
+      raise ValueError('Invalid sync marker at %d.' % pos)
+    pos += _SYNC_SIZE
+    if metadata.get('avro.codec') == _CODEC:
+      block = zlib.decompress(block, -zlib.MAX_WBITS)
+    block_pos = 0
+    for _ in xrange(count):
+      record = {}
+      for name, decoder in decoders:
+        record[name], block_pos = decoder(block, block_pos)
+      yield record
+
+
+def _get_encoder(avro_type):
+  if isinstance(avro_type, list):
+    value_encoder = _get_encoder(avro_type[1 - _NULL_INDEX])
+    def encode_nullable(value, out):
+      if value is None:
+        _write_long(_NULL_INDEX, out)
+      else:
+        _write_long(1 - _NULL_INDEX, out)
+        value_encoder(value, out)
+    return encode_nullable
+  return _ENCODERS[json.dumps(avro_type, sort_keys=True)]
+
+
+def _get_decoder(avro_type):
+  if isinstance(avro_type, list):
+    value_decoder = _get_decoder(avro_type[1 - _NULL_INDEX])
+    def decode_nullable(data, pos):
+      index, pos = _read_long(data, pos)
+      if index == _NULL_INDEX:
+        return None, pos
+      return value_decoder(data, pos)
+    return decode_nullable
+  return _DECODERS[json.dumps(avro_type, sort_keys=True)]
+
+
+def _write_long(value, out):
+  value = (value << 1) ^ (value >> 63)
+  while value > 0x7f:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+
+
+def _read_long(data, pos):
+  result = 0
+  shift = 0
+  while True:
+    byte = ord(data[pos])
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return (result >> 1) ^ -(result & 1), pos
+    shift += 7
+
+
+def _write_bytes(value, out):
+  _write_long(len(value), out)
+  out.append(value)
+
+
+def _read_bytes(data, pos):
+  size, pos = _read_long(data, pos)
+  return data[pos:pos + size], pos + size
+
+
+def _write_string(value, out):
+  if isinstance(value, unicode):
+    value = value.encode('utf-8')
+  elif not isinstance(value, str):
+    value = str(value)
+  _write_bytes(value, out)
+
+
+def _read_string(data, pos):
+  value, pos = _read_bytes(data, pos)
+  return value.decode('utf-8'), pos
+
+
+def _write_boolean(value, out):
+  out.append('\x01' if value else '\x00')
+
+
+def _read_boolean(data, pos):
+  return data[pos] != '\x00', pos + 1
+
+
+def _write_double(value, out):
+  out.append(struct.pack('<d', value))
+
+
+def _read_double(data, pos):
+  return struct.unpack('<d', data[pos:pos + 8])[0], pos + 8
+
+
+def _write_date(value, out):
+  _write_long(value.toordinal() - _EPOCH_ORDINAL, out)
+
+
+def _read_date(data, pos):
+  days, pos = _read_long(data, pos)
+  return datetime.date.fromordinal(days + _EPOCH_ORDINAL), pos
+
+
+def _write_timestamp(value, out):
+  delta = value - _EPOCH
+  _write_long((delta.days * 86400 + delta.seconds) * 1000000 + delta.microseconds, out)
+
+
+def _read_timestamp(data, pos):
+  micros, pos = _read_long(data, pos)
+  return _EPOCH + datetime.timedelta(microseconds=micros), pos
+
+
+def _write_int(value, out):
+  _write_long(int(value), out)
+
+
+def _write_blob(value, out):
+  # SQLite returns BLOBs as buffers.
+  _write_bytes(str(value), out)
+
+
+_ENCODERS = {json.dumps(avro_type, sort_keys=True): encoder for avro_type, encoder in (
+    ('long', _write_int),
+    ('boolean', _write_boolean),
+    ('double', _write_double),
+    ('bytes', _write_blob),
+    ('string', _write_string),
+    (_DATE, _write_date),
+    (_TIMESTAMP, _write_timestamp))}
+
+_DECODERS = {json.dumps(avro_type, sort_keys=True): decoder for avro_type, decoder in (
+    ('long', _read_long),
+    ('boolean', _read_boolean),
+    ('double', _read_double),
+    ('bytes', _read_bytes),
+    ('string', _read_string),
+    (_DATE, _read_date),
+    (_TIMESTAMP, _read_timestamp))}
@@ -1,33 +1,67 @@
-"""Reads a CSV that Biobank uploads to GCS and upserts to the BiobankStoredSample table.
+"""Reads CSVs that Biobank uploads to GCS and upserts to the BiobankStoredSample table.
 
 Also updates ParticipantSummary data related to samples.
+
+Each CSV is imported by a pipeline of stages connected by bounded queues, so that reading, parsing
+and writing overlap: a reader thread reads the file from GCS (decompressing it if it is
+gzip-compressed) and passes on chunks of lines, a parser thread turns the rows into SampleRows,
+and writer threads (including the calling thread) write batches of them to the database in
+parallel. Concurrent writers' upserts can deadlock in MySQL, so a deadlocked batch is retried (up
+to _MAX_BATCH_ATTEMPTS times.) If any stage fails, the other stages stop and its exception (e.g. a
+DataError) is raised by the import.
+
+Imported files are recorded in the biobank_samples_file table. upsert_from_latest_csv imports the
+latest CSV in the bucket; upsert_from_unprocessed_csvs imports every CSV uploaded since the last
+recorded file, in the order of the timestamps in their names.
 """
 
+import Queue
+import collections
 import csv
 import datetime
 import logging
 import pytz
+import sys
+import threading
+import time
 
 from cloudstorage import cloudstorage_api
+from sqlalchemy.exc import OperationalError
 
 import clock
 import config
 from code_constants import RACE_QUESTION_CODE, PPI_SYSTEM
 from dao import database_factory
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.biobank_reconciliation_dao import BiobankReconciliationDao
+from dao.biobank_stored_sample_dao import BiobankSamplesFileDao, BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import SampleUpsertCounts
 from dao.code_dao import CodeDao
-from dao.database_utils import replace_isodate, parse_datetime, get_sql_and_params_for_array
+from dao.database_utils import replace_isodate, get_sql_and_params_for_array
 from dao.participant_summary_dao import ParticipantSummaryDao
-from model.biobank_stored_sample import BiobankStoredSample
 from model.utils import from_client_biobank_id, get_biobank_id_prefix
-from offline.sql_exporter import SqlExporter, CompositeSqlExportWriter
-from participant_enums import OrganizationType
+from offline.sql_exporter import SqlExporter, read_lines
+from participant_enums import BiobankReconciliationStatus
 
 # Format for dates in output filenames for the reconciliation report.
 _FILENAME_DATE_FORMAT = '%Y-%m-%d'
 # The output of the reconciliation report goes into this subdirectory within the upload bucket.
 _REPORT_SUBDIR = 'reconciliation'
 _BATCH_SIZE = 1000
+# Number of lines the reader passes to the parser at a time.
+_LINES_PER_CHUNK = 1000
+# Maximum number of chunks of lines, and batches of samples, waiting for the next stage.
+_MAX_QUEUED = 4
+# Seconds a stage waits on a queue before checking whether the import has stopped.
+_QUEUE_POLL_SECS = 0.1
+# Put on a queue after the last item (once for each consumer.)
+_END = object()
+# Number of threads writing batches of samples, unless biobank_samples_import_writers is set.
+_DEFAULT_WRITERS = 4
+# MySQL's error code for a transaction rolled back to break a deadlock (ER_LOCK_DEADLOCK).
+_DEADLOCK_ERROR_CODE = 1213
+_MAX_BATCH_ATTEMPTS = 3
+# Seconds to wait before retrying a deadlocked batch, multiplied by the number of attempts so far.
+_DEADLOCK_RETRY_SECS = 0.5
 
 # Biobank provides timestamps without time zone info, which should be in central time (see DA-235).
 _INPUT_TIMESTAMP_FORMAT = '%Y/%m/%d %H:%M:%S'  # like 2016/11/30 14:32:18
@@ -38,10 +72,10 @@ INPUT_CSV_TIME_FORMAT = '%Y-%m-%d-%H-%M-%S'
 _INPUT_CSV_TIME_FORMAT_LENGTH = 18
 _CSV_SUFFIX_LENGTH = 4
 _THIRTY_SIX_HOURS_AGO = datetime.timedelta(hours=36)
+# The late and missing reports include rows whose latest order collection or sample confirmation
+# time is less than 8 days before the report (so at most 7 whole days.)
+_REPORT_PERIOD = datetime.timedelta(days=8)
 _MAX_INPUT_AGE = datetime.timedelta(hours=24)
-_PMI_OPS_SYSTEM = 'https://www.pmi-ops.org'
-_KIT_ID_SYSTEM = 'https://orders.mayomedicallaboratories.com/kit-id'
-_TRACKING_NUMBER_SYSTEM = 'https://orders.mayomedicallaboratories.com/tracking-number'
 
 class DataError(RuntimeError):
   """Bad sample data during import.
@@ -57,9 +91,12 @@ class DataError(RuntimeError):
 
 
 def upsert_from_latest_csv():
-  """Finds the latest CSV & updates/inserts BiobankStoredSamples from its rows."""
+  """Finds the latest CSV & updates/inserts BiobankStoredSamples from its rows.
+
+  Returns SampleUpsertCounts for the samples in the CSV, and the CSV's timestamp.
+  """
   bucket_name = config.getSetting(config.BIOBANK_SAMPLES_BUCKET_NAME)  # raises if missing
-  csv_file, csv_filename = _open_latest_samples_file(bucket_name)
+  csv_filename = _find_latest_samples_csv(bucket_name)
   timestamp = _timestamp_from_filename(csv_filename)
 
   now = clock.CLOCK.now()
@@ -69,10 +106,62 @@ def upsert_from_latest_csv():
         % (csv_filename, timestamp, now),
         external=True)
 
-  csv_reader = csv.DictReader(csv_file, delimiter='\t')
-  written = _upsert_samples_from_csv(csv_reader)
-  ParticipantSummaryDao().update_from_biobank_stored_samples()
-  return written, timestamp
+  counts = _import_samples_csv(bucket_name, csv_filename, timestamp)
+  return counts, timestamp
+
+
+def upsert_from_unprocessed_csvs():
+  """Updates/inserts BiobankStoredSamples from every CSV uploaded since the last processed CSV, in
+  the order of their timestamps. If no CSVs have been processed yet, only the latest is imported.
+
+  Returns SampleUpsertCounts for the samples in all of the imported CSVs, and the timestamp of
+  the latest CSV.
+  """
+  bucket_name = config.getSetting(config.BIOBANK_SAMPLES_BUCKET_NAME)  # raises if missing
+  latest_file = BiobankSamplesFileDao().get_latest()
+  paths_and_timestamps = _find_unprocessed_samples_csvs(bucket_name, latest_file)
+  if not latest_file:
+    paths_and_timestamps = paths_and_timestamps[-1:]
+
+  counts = SampleUpsertCounts()
+  for csv_filename, timestamp in paths_and_timestamps:
+    logging.info('Importing samples CSV %r.', csv_filename)
+    counts.add(_import_samples_csv(bucket_name, csv_filename, timestamp))
+
+  if paths_and_timestamps:
+    timestamp = paths_and_timestamps[-1][1]
+  elif latest_file:
+    timestamp = latest_file.timestamp
+  else:
+    raise DataError('No CSVs in cloud bucket %r.' % bucket_name)
+  now = clock.CLOCK.now()
+  if now - timestamp > _MAX_INPUT_AGE:
+    raise DataError(
+        'Latest input (timestamp %s UTC) is > 24h old (relative to %s UTC).' % (timestamp, now),
+        external=True)
+  return counts, timestamp
+
+
+def _import_samples_csv(bucket_name, csv_filename, timestamp):
+  """Imports the samples in a CSV, updates the summaries of the participants whose samples
+  changed, and records the CSV as processed. Returns SampleUpsertCounts."""
+  with cloudstorage_api.open(csv_filename) as csv_file:
+    counts = _upsert_samples_from_csv(csv_file, writers=_get_writer_count())
+  # Only the summaries and reconciliation rows of participants whose samples changed need to be
+  # updated.
+  ParticipantSummaryDao().update_from_biobank_stored_samples(
+      biobank_ids=counts.changed_biobank_ids)
+  BiobankReconciliationDao().update(counts.changed_biobank_ids)
+  BiobankSamplesFileDao().upsert_processed_file(
+      _get_file_name(bucket_name, csv_filename), timestamp, counts)
+  return counts
+
+
+def _get_writer_count():
+  if database_factory.get_database().db_type == 'sqlite':
+    # In-memory SQLite databases can't be shared between threads; write in the calling thread.
+    return 1
+  return int(config.getSetting(config.BIOBANK_SAMPLES_IMPORT_WRITERS, _DEFAULT_WRITERS))
 
 
 def _timestamp_from_filename(csv_filename):
@@ -89,11 +178,48 @@ def _timestamp_from_filename(csv_filename):
   return _US_CENTRAL.localize(timestamp).astimezone(pytz.utc).replace(tzinfo=None)
 
 
-def _open_latest_samples_file(cloud_bucket_name):
-  """Returns an open stream for the most recently created CSV in the given bucket."""
-  path = _find_latest_samples_csv(cloud_bucket_name)
-  logging.info('Opening latest samples CSV in %r: %r.', cloud_bucket_name, path)
-  return cloudstorage_api.open(path), path
+def _find_unprocessed_samples_csvs(cloud_bucket_name, latest_file):
+  """Returns a list of (full path, timestamp) for the CSVs in the bucket that are newer than the
+  latest processed file (a BiobankSamplesFile, or None), sorted by timestamp.
+
+  Only the top level of the bucket is listed, restricted to names starting with
+  biobank_samples_file_prefix (if set). Since file names end with their timestamps, files with
+  the same prefix sort by time; so if a prefix is set (and the latest processed file has it), the
+  listing starts after the latest processed file's name, and only covers files uploaded since the
+  last import. Otherwise, the whole top level is listed, and older files are skipped by their
+  timestamps (a newer file could have a name that sorts before the latest processed file's.)
+  """
+  prefix = config.getSetting(config.BIOBANK_SAMPLES_FILE_PREFIX, '')
+  marker = None
+  if prefix and latest_file and latest_file.fileName.startswith(prefix):
+    marker = '/%s/%s' % (cloud_bucket_name, latest_file.fileName)
+  # The delimiter excludes subdirectories (such as the reconciliation reports.)
+  bucket_stat_list = cloudstorage_api.listbucket(
+      '/%s/%s' % (cloud_bucket_name, prefix), marker=marker, delimiter='/')
+  paths = [s.filename for s in bucket_stat_list
+           if not s.is_dir and s.filename.lower().endswith('.csv')]
+  processed_file_names = BiobankSamplesFileDao().get_processed_file_names(
+      [_get_file_name(cloud_bucket_name, path) for path in paths])
+  timestamps_and_paths = []
+  for path in paths:
+    if _get_file_name(cloud_bucket_name, path) in processed_file_names:
+      continue
+    try:
+      timestamp = _timestamp_from_filename(path)
+    except DataError, e:
+      logging.warning('Skipping %r: %s', path, e)
+      continue
+    if latest_file and timestamp <= latest_file.timestamp:
+      logging.warning('Skipping %r, which is older than the last processed CSV %r.',
+                      path, latest_file.fileName)
+      continue
+    timestamps_and_paths.append((timestamp, path))
+  return [(path, timestamp) for timestamp, path in sorted(timestamps_and_paths)]
+
+
+def _get_file_name(cloud_bucket_name, path):
+  """Returns the name within the bucket of a file's full path."""
+  return path[len('/%s/' % cloud_bucket_name):]
 
 
 def _find_latest_samples_csv(cloud_bucket_name):
@@ -129,31 +255,156 @@ class _Columns(object):
                    CREATE_DATE])
 
 
-def _upsert_samples_from_csv(csv_reader):
-  """Inserts/updates BiobankStoredSamples from a csv.DictReader."""
-  missing_cols = _Columns.ALL - set(csv_reader.fieldnames)
+# The fields of a BiobankStoredSample parsed from a CSV row; BiobankStoredSampleDao.upsert_all
+# accepts these in place of BiobankStoredSamples.
+SampleRow = collections.namedtuple(
+    'SampleRow', ['biobankStoredSampleId', 'biobankId', 'test', 'confirmed', 'created'])
+
+
+class _ImportState(object):
+  """Shared by the stages of an import: set to stopped if any stage fails (or the writer finishes
+  early), with the first failure's exc_info."""
+  def __init__(self):
+    self.stopped = threading.Event()
+    self.exc_info = None
+
+  def fail(self, exc_info):
+    if self.exc_info is None:
+      self.exc_info = exc_info
+    self.stopped.set()
+
+  def put(self, queue, item):
+    """Puts item on queue, waiting while it is full; returns False if the import stopped."""
+    while not self.stopped.is_set():
+      try:
+        queue.put(item, timeout=_QUEUE_POLL_SECS)
+        return True
+      except Queue.Full:
+        pass
+    return False
+
+  def get_all(self, queue):
+    """Yields items from queue until _END, or until the import stops."""
+    while not self.stopped.is_set():
+      try:
+        item = queue.get(timeout=_QUEUE_POLL_SECS)
+      except Queue.Empty:
+        continue
+      if item is _END:
+        return
+      yield item
+
+
+def _start_stage(state, target, *args):
+  def run():
+    try:
+      target(state, *args)
+    except Exception:  # pylint: disable=broad-except
+      state.fail(sys.exc_info())
+  thread = threading.Thread(target=run)
+  thread.start()
+  return thread
+
+
+def _read_stage(state, csv_file, line_queue):
+  lines = []
+  for line in read_lines(csv_file):
+    lines.append(line)
+    if len(lines) >= _LINES_PER_CHUNK:
+      if not state.put(line_queue, lines):
+        return
+      lines = []
+  if lines and not state.put(line_queue, lines):
+    return
+  state.put(line_queue, _END)
+
+
+def _parse_stage(state, line_queue, batch_queue, biobank_id_prefix, writers):
+  lines = (line for lines in state.get_all(line_queue) for line in lines)
+  csv_reader = csv.DictReader(lines, delimiter='\t')
+  missing_cols = _Columns.ALL - set(csv_reader.fieldnames or [])
   if missing_cols:
     raise DataError(
         'CSV is missing columns %s, had columns %s.' % (missing_cols, csv_reader.fieldnames))
+  samples = []
+  for row in csv_reader:
+    sample = _create_sample_from_row(row, biobank_id_prefix)
+    if sample:
+      samples.append(sample)
+      if len(samples) >= _BATCH_SIZE:
+        if not state.put(batch_queue, samples):
+          return
+        samples = []
+  if state.stopped.is_set():
+    # The reader failed, so the rows are incomplete.
+    return
+  if samples and not state.put(batch_queue, samples):
+    return
+  for _ in xrange(writers):
+    if not state.put(batch_queue, _END):
+      return
+
+
+def _write_stage(state, batch_queue, counts):
   samples_dao = BiobankStoredSampleDao()
-  biobank_id_prefix = get_biobank_id_prefix()
-  written = 0
+  for samples in state.get_all(batch_queue):
+    try:
+      counts.add(_upsert_batch(samples_dao, samples))
+    except ValueError, e:
+      raise DataError(e)
+
+
+def _upsert_batch(samples_dao, samples):
+  """Upserts a batch of samples, retrying it if its transaction is rolled back by a deadlock with
+  another writer's batch. Returns SampleUpsertCounts."""
+  for attempt in xrange(1, _MAX_BATCH_ATTEMPTS + 1):
+    try:
+      return samples_dao.upsert_all(samples)
+    except OperationalError, e:
+      if attempt == _MAX_BATCH_ATTEMPTS or not _is_deadlock(e):
+        raise
+      logging.warning('Deadlock writing a batch of %d samples (attempt %d); retrying.',
+                      len(samples), attempt)
+      time.sleep(_DEADLOCK_RETRY_SECS * attempt)
+
+
+def _is_deadlock(error):
+  args = getattr(error.orig, 'args', None)
+  return bool(args) and args[0] == _DEADLOCK_ERROR_CODE
+
+
+def _upsert_samples_from_csv(csv_file, writers=1):
+  """Inserts/updates BiobankStoredSamples from a tab-separated CSV file, in batches of _BATCH_SIZE
+  (each written with a single statement.) Returns SampleUpsertCounts.
+
+  Reading and parsing the file run in separate threads, while batches are written by this thread
+  and writers - 1 more threads.
+  """
+  state = _ImportState()
+  line_queue = Queue.Queue(_MAX_QUEUED)
+  batch_queue = Queue.Queue(_MAX_QUEUED)
+  # Each writer counts its own batches.
+  writer_counts = [SampleUpsertCounts() for _ in xrange(writers)]
+  threads = [_start_stage(state, _read_stage, csv_file, line_queue),
+             _start_stage(state, _parse_stage, line_queue, batch_queue, get_biobank_id_prefix(),
+                          writers)]
+  threads.extend(_start_stage(state, _write_stage, batch_queue, counts)
+                 for counts in writer_counts[1:])
   try:
-    samples = []
-    for row in csv_reader:
-      sample = _create_sample_from_row(row, biobank_id_prefix)
-      if sample:
-        samples.append(sample)
-        if len(samples) >= _BATCH_SIZE:
-          written += samples_dao.upsert_all(samples)
-          samples = []
-    if samples:
-      written += samples_dao.upsert_all(samples)
-    return written
-  except ValueError, e:
-    raise DataError(e)
-
-def _parse_timestamp(row, key, sample):
+    _write_stage(state, batch_queue, writer_counts[0])
+  except Exception:  # pylint: disable=broad-except
+    # Stops the other stages.
+    state.fail(sys.exc_info())
+  for thread in threads:
+    thread.join()
+  if state.exc_info:
+    raise state.exc_info[0], state.exc_info[1], state.exc_info[2]
+  counts = SampleUpsertCounts()
+  for each_counts in writer_counts:
+    counts.add(each_counts)
+  return counts
+
+def _parse_timestamp(row, key, sample_id, biobank_id):
   str_val = row[key]
   if str_val:
     try:
@@ -161,35 +412,35 @@ def _parse_timestamp(row, key, sample):
     except ValueError, e:
       raise DataError(
           'Sample %r for %r has bad timestamp %r: %s'
-          % (sample.biobankStoredSampleId, sample.biobankId, str_val, e.message))
+          % (sample_id, biobank_id, str_val, e.message))
     # Assume incoming times are in Central time (CST or CDT). Convert to UTC for storage, but drop
     # tzinfo since storage is naive anyway (to make stored/fetched values consistent).
     return _US_CENTRAL.localize(naive).astimezone(pytz.utc).replace(tzinfo=None)
   return None
 
 def _create_sample_from_row(row, biobank_id_prefix):
-  """Creates a new BiobankStoredSample object from a CSV row.
+  """Creates a new SampleRow from a CSV row.
 
   Raises:
     DataError if the row is invalid.
   Returns:
-    A new BiobankStoredSample, or None if the row should be skipped.
+    A new SampleRow, or None if the row should be skipped.
   """
   biobank_id_str = row[_Columns.EXTERNAL_PARTICIPANT_ID]
   if not biobank_id_str.startswith(biobank_id_prefix):
     # This is a biobank sample for another environment. Ignore it.
     return None
-  biobank_id = from_client_biobank_id(biobank_id_str)
-  sample = BiobankStoredSample(
-      biobankStoredSampleId=row[_Columns.SAMPLE_ID],
-      biobankId=biobank_id,
-      test=row[_Columns.TEST_CODE])
   if row[_Columns.PARENT_ID]:
     # Skip child samples.
     return None
-  sample.confirmed = _parse_timestamp(row, _Columns.CONFIRMED_DATE, sample)
-  sample.created = _parse_timestamp(row, _Columns.CREATE_DATE, sample)
-  return sample
+  biobank_id = from_client_biobank_id(biobank_id_str)
+  sample_id = row[_Columns.SAMPLE_ID]
+  return SampleRow(
+      biobankStoredSampleId=sample_id,
+      biobankId=biobank_id,
+      test=row[_Columns.TEST_CODE],
+      confirmed=_parse_timestamp(row, _Columns.CONFIRMED_DATE, sample_id, biobank_id),
+      created=_parse_timestamp(row, _Columns.CREATE_DATE, sample_id, biobank_id))
 
 def write_reconciliation_report(now):
   """Writes order/sample reconciliation reports to GCS."""
@@ -210,35 +461,15 @@ def _query_and_write_reports(exporter, now, path_received, path_late, path_missi
 
   Note that due to syntax differences, the query runs on MySQL only (not SQLite in unit tests).
   """
-  # Gets all sample/order pairs where everything arrived, regardless of timing.
-  received_predicate = lambda result: (result[_RECEIVED_TEST_INDEX] and
-                                        result[_SENT_COUNT_INDEX] == result[_RECEIVED_COUNT_INDEX])
-
-  # Gets orders for which the samples arrived, but they arrived late, within the past 7 days.
-  late_predicate = lambda result: (result[_ELAPSED_HOURS_INDEX] and
-                                    int(result[_ELAPSED_HOURS_INDEX]) >= 24 and
-                                    in_past_week(result, now))
-
-  # Gets samples or orders where something has gone missing within the past 7 days, and if an order
-  # was placed, it was placed at least 36 hours ago.
-  missing_predicate = lambda result: ((result[_SENT_COUNT_INDEX] != result[_RECEIVED_COUNT_INDEX] or
-                                        (result[_SENT_FINALIZED_INDEX] and
-                                         not result[_RECEIVED_TEST_INDEX])) and
-                                       in_past_week(result, now,
-                                                    ordered_before=now - _THIRTY_SIX_HOURS_AGO))
-
-  # Open three files and a database session; run the reconciliation query and pipe the output
-  # to the files, using per-file predicates to filter out results.
-  with exporter.open_writer(path_received, received_predicate) as received_writer, \
-       exporter.open_writer(path_late, late_predicate) as late_writer, \
-       exporter.open_writer(path_missing, missing_predicate) as missing_writer, \
-       database_factory.get_database().session() as session:
-    writer = CompositeSqlExportWriter([received_writer, late_writer, missing_writer])
-    exporter.run_export_with_session(writer, session, replace_isodate(_RECONCILIATION_REPORT_SQL),
-                                     {"biobank_id_prefix": get_biobank_id_prefix(),
-                                      "pmi_ops_system": _PMI_OPS_SYSTEM,
-                                      "kit_id_system": _KIT_ID_SYSTEM,
-                                      "tracking_number_system": _TRACKING_NUMBER_SYSTEM})
+  params = {'biobank_id_prefix': get_biobank_id_prefix(),
+            'received': BiobankReconciliationStatus.RECEIVED.number,
+            'missing': BiobankReconciliationStatus.MISSING.number,
+            'since': now - _REPORT_PERIOD,
+            'ordered_before': now - _THIRTY_SIX_HOURS_AGO}
+  for path, condition in ((path_received, _RECEIVED_CONDITION),
+                          (path_late, _LATE_CONDITION),
+                          (path_missing, _MISSING_CONDITION)):
+    exporter.run_export(path, replace_isodate(_RECONCILIATION_REPORT_SQL % condition), params)
 
   # Now generate the withdrawal report.
   code_dao = CodeDao()
@@ -254,175 +485,60 @@ def _query_and_write_reports(exporter, now, path_received, path_late, path_missi
   params['biobank_id_prefix'] = get_biobank_id_prefix()
   exporter.run_export(path_withdrawals, replace_isodate(withdrawal_sql), params)
 
-# Indexes from the SQL query below; used in predicates.
-_SENT_COUNT_INDEX = 2
-_SENT_COLLECTION_TIME_INDEX = 4
-_SENT_FINALIZED_INDEX = 6
-_RECEIVED_TEST_INDEX = 18
-_RECEIVED_COUNT_INDEX = 19
-# TODO: remove received time once Biobank stops using it (DA-374)
-_RECEIVED_TIME_INDEX = 21
-_SAMPLE_FAMILY_CREATE_TIME_INDEX = 22
-_ELAPSED_HOURS_INDEX = 23
-
-_ORDER_JOINS = """
-      biobank_order
-    INNER JOIN
-      participant
-    ON
-      biobank_order.participant_id = participant.participant_id
-    INNER JOIN
-      biobank_order_identifier
-    ON biobank_order.biobank_order_id = biobank_order_identifier.biobank_order_id
-       AND biobank_order_identifier.system = :pmi_ops_system
-    INNER JOIN
-      biobank_ordered_sample
-    ON
-      biobank_order.biobank_order_id = biobank_ordered_sample.order_id
-    LEFT OUTER JOIN
-      site source_site
-    ON biobank_order.source_site_id = source_site.site_id
-    LEFT OUTER JOIN
-      hpo source_site_hpo
-    ON source_site.hpo_id = source_site_hpo.hpo_id
-    LEFT OUTER JOIN
-      site finalized_site
-    ON biobank_order.finalized_site_id = finalized_site.site_id
-    LEFT OUTER JOIN
-      hpo finalized_site_hpo
-    ON finalized_site.hpo_id = finalized_site_hpo.hpo_id
-"""
-
-_STORED_SAMPLE_JOIN_CRITERIA = """
-      biobank_stored_sample.biobank_id = participant.biobank_id
-      AND biobank_stored_sample.test = biobank_ordered_sample.test
-"""
-
-def _get_hpo_type_sql(hpo_alias):
-  result = '(CASE '
-  for organization_type in OrganizationType:
-    result += "WHEN %s.organization_type = %d THEN '%s' " % (hpo_alias, organization_type.number,
-                                                            organization_type.name)
-  result += "ELSE 'UNKNOWN' END)"
-  return result
-
-# Joins orders and samples, and computes some derived values (elapsed_hours, counts).
-# MySQL does not support FULL OUTER JOIN, so instead we UNION ALL a LEFT OUTER JOIN
-# with a SELECT... WHERE NOT EXISTS (the latter for cases where we have a sample but no matching
-# ordered sample.)
-# Column order should match _*_INDEX constants above.
+# Selects rows of the biobank_reconciliation table (see dao/biobank_reconciliation_dao.py) for
+# participants that haven't withdrawn, with a condition for each report.
 # Biobank ID formatting must match to_client_biobank_id.
-_RECONCILIATION_REPORT_SQL = ("""
+_RECONCILIATION_REPORT_SQL = """
   SELECT
-    CONCAT(:biobank_id_prefix, raw_biobank_id) biobank_id,
-    order_test sent_test,
-    COUNT(DISTINCT biobank_order_id) sent_count,
-    GROUP_CONCAT(DISTINCT biobank_order_id) sent_order_id,
-    ISODATE[MAX(collected)] sent_collection_time,
-    ISODATE[MAX(processed)] sent_processed_time,
-    ISODATE[MAX(finalized)] sent_finalized_time,
-    GROUP_CONCAT(DISTINCT source_site_name) source_site_name,
-    GROUP_CONCAT(DISTINCT source_site_consortium) source_site_consortium,
-    GROUP_CONCAT(DISTINCT source_site_mayolink_client_number) source_site_mayolink_client_number,
-    GROUP_CONCAT(DISTINCT source_site_hpo) source_site_hpo,
-    GROUP_CONCAT(DISTINCT source_site_hpo_type) source_site_hpo_type,
-    GROUP_CONCAT(DISTINCT finalized_site_name) finalized_site_name,
-    GROUP_CONCAT(DISTINCT finalized_site_consortium) finalized_site_consortium,
-    GROUP_CONCAT(DISTINCT finalized_site_mayolink_client_number)
-        finalized_site_mayolink_client_number,
-    GROUP_CONCAT(DISTINCT finalized_site_hpo) finalized_site_hpo,
-    GROUP_CONCAT(DISTINCT finalized_site_hpo_type) finalized_site_hpo_type,
-    GROUP_CONCAT(DISTINCT finalized_username) finalized_username,
-    test received_test,
-    COUNT(DISTINCT biobank_stored_sample_id) received_count,
-    GROUP_CONCAT(DISTINCT biobank_stored_sample_id) received_sample_id,
-    ISODATE[MAX(confirmed)] received_time,
-    ISODATE[MAX(created)] 'Sample Family Create Date',
-    TIMESTAMPDIFF(HOUR, MAX(collected), MAX(created)) elapsed_hours,
-    GROUP_CONCAT(DISTINCT biospecimen_kit_id) biospecimen_kit_id,
-    GROUP_CONCAT(DISTINCT fedex_tracking_number) fedex_tracking_number
+    CONCAT(:biobank_id_prefix, r.biobank_id) biobank_id,
+    CASE WHEN r.sent_count > 0 THEN r.test END sent_test,
+    r.sent_count,
+    r.sent_order_id,
+    ISODATE[r.sent_collection_time] sent_collection_time,
+    ISODATE[r.sent_processed_time] sent_processed_time,
+    ISODATE[r.sent_finalized_time] sent_finalized_time,
+    r.source_site_name,
+    r.source_site_consortium,
+    r.source_site_mayolink_client_number,
+    r.source_site_hpo,
+    r.source_site_hpo_type,
+    r.finalized_site_name,
+    r.finalized_site_consortium,
+    r.finalized_site_mayolink_client_number,
+    r.finalized_site_hpo,
+    r.finalized_site_hpo_type,
+    r.finalized_username,
+    CASE WHEN r.received_count > 0 THEN r.test END received_test,
+    r.received_count,
+    r.received_sample_id,
+    ISODATE[r.received_time] received_time,
+    ISODATE[r.received_create_time] 'Sample Family Create Date',
+    r.elapsed_hours,
+    r.biospecimen_kit_id,
+    r.fedex_tracking_number
   FROM
-   (SELECT
-      participant.biobank_id raw_biobank_id,
-      biobank_order_identifier.value biobank_order_id,
-      source_site.site_name source_site_name,
-      source_site.consortium_name source_site_consortium,
-      source_site.mayolink_client_number source_site_mayolink_client_number,
-      source_site_hpo.name source_site_hpo,
-      """
-      + _get_hpo_type_sql('source_site_hpo') + """ source_site_hpo_type,
-      finalized_site.site_name finalized_site_name,
-      finalized_site.consortium_name finalized_site_consortium,
-      finalized_site.mayolink_client_number finalized_site_mayolink_client_number,
-      finalized_site_hpo.name finalized_site_hpo,
-      """
-      + _get_hpo_type_sql('finalized_site_hpo') + """ finalized_site_hpo_type,
-      biobank_order.finalized_username finalized_username,
-      biobank_ordered_sample.test order_test,
-      biobank_ordered_sample.collected,
-      biobank_ordered_sample.processed,
-      biobank_ordered_sample.finalized,
-      biobank_stored_sample.biobank_stored_sample_id,
-      biobank_stored_sample.test,
-      biobank_stored_sample.confirmed,
-      biobank_stored_sample.created,
-      kit_id_identifier.value biospecimen_kit_id,
-      tracking_number_identifier.value fedex_tracking_number
-    FROM """ + _ORDER_JOINS + """
-    LEFT OUTER JOIN
-      biobank_stored_sample
-    ON """ + _STORED_SAMPLE_JOIN_CRITERIA + """
-    LEFT OUTER JOIN
-      biobank_order_identifier kit_id_identifier
-    ON biobank_order.biobank_order_id = kit_id_identifier.biobank_order_id
-       AND kit_id_identifier.system = :kit_id_system
-    LEFT OUTER JOIN
-      biobank_order_identifier tracking_number_identifier
-    ON biobank_order.biobank_order_id = tracking_number_identifier.biobank_order_id
-       AND tracking_number_identifier.system = :tracking_number_system
-    WHERE
-      participant.withdrawal_time IS NULL
-      AND biobank_ordered_sample.finalized IS NOT NULL
-    UNION ALL
-    SELECT
-      biobank_stored_sample.biobank_id raw_biobank_id,
-      NULL biobank_order_id,
-      NULL source_site_name,
-      NULL source_site_consortium,
-      NULL source_site_mayolink_client_number,
-      NULL source_site_hpo,
-      NULL source_site_hpo_type,
-      NULL finalized_site_name,
-      NULL finalized_site_consortium,
-      NULL finalized_site_mayolink_client_number,
-      NULL finalized_site_hpo,
-      NULL finalized_site_hpo_type,
-      NULL finalized_username,
-      NULL order_test,
-      NULL collected,
-      NULL processed,
-      NULL finalized,
-      biobank_stored_sample.biobank_stored_sample_id,
-      biobank_stored_sample.test,
-      biobank_stored_sample.confirmed,
-      biobank_stored_sample.created,
-      NULL biospecimen_kit_id,
-      NULL fedex_tracking_number
-    FROM
-      biobank_stored_sample
-    WHERE NOT EXISTS (
-      SELECT 0 FROM """ + _ORDER_JOINS + " WHERE " + _STORED_SAMPLE_JOIN_CRITERIA + """
-    ) AND NOT EXISTS (
-      SELECT 0 FROM participant
-       WHERE participant.biobank_id = biobank_stored_sample.biobank_id
-         AND participant.withdrawal_time IS NOT NULL)
-  ) reconciled
-  GROUP BY
-    biobank_id, order_test, test
+    biobank_reconciliation r
+  INNER JOIN
+    participant
+  ON
+    r.biobank_id = participant.biobank_id
+  WHERE
+    participant.withdrawal_time IS NULL
+    AND %s
   ORDER BY
-    ISODATE[MAX(collected)], ISODATE[MAX(confirmed)], GROUP_CONCAT(DISTINCT biobank_order_id),
-    GROUP_CONCAT(DISTINCT biobank_stored_sample_id)
-""")
+    r.sent_collection_time, r.received_time, r.sent_order_id, r.received_sample_id
+"""
+
+# All sample/order pairs where everything arrived, regardless of timing.
+_RECEIVED_CONDITION = 'r.status = :received'
+
+# Orders for which the samples arrived, but they arrived late, within the past 7 days.
+_LATE_CONDITION = 'r.last_time > :since AND r.elapsed_hours >= 24'
+
+# Samples or orders where something has gone missing within the past 7 days, and if an order was
+# placed, it was placed at least 36 hours ago.
+_MISSING_CONDITION = """r.status = :missing AND r.last_time > :since
+    AND (r.sent_collection_time IS NULL OR r.sent_collection_time <= :ordered_before)"""
 
 # Generates a report on participants that have withdrawn in the past 7 days,
 # including their biobank ID, withdrawal time, and whether they are Native American
@@ -444,24 +560,3 @@ _WITHDRAWAL_REPORT_SQL = ("""
     FROM participant
    WHERE participant.withdrawal_time >= :seven_days_ago
 """)
-
-
-def in_past_week(result, now, ordered_before=None):
-  sent_collection_time_str = result[_SENT_COLLECTION_TIME_INDEX]
-  received_time_str = result[_RECEIVED_TIME_INDEX]
-  max_time = None
-  if sent_collection_time_str:
-    max_time = parse_datetime(sent_collection_time_str)
-    if ordered_before and max_time > ordered_before:
-      return False
-  if received_time_str:
-    received_time = parse_datetime(received_time_str)
-    if received_time and max_time:
-      max_time = max(received_time, max_time)
-    else:
-      max_time = received_time
-  if max_time:
-    return (now - max_time).days <= 7
-  return False
-
-
@@ -0,0 +1,66 @@
+"""Reconciliation of the live HPO counters against the output of the metrics pipeline.
+
+The counters are updated whenever a counted participant summary field changes (see
+dao/hpo_counter_dao.py), so any code path that changes the fields without updating the counters
+makes them drift. This compares the counters with the metrics in the last bucket for each HPO in
+the serving metrics version, and logs every metric that differs. Participants who changed after
+the pipeline's export also show up as differences, so this is run soon after the pipeline
+finishes, and only persistent or large differences are worth investigating.
+"""
+import json
+import logging
+
+from dao.hpo_counter_dao import HpoCounterDao, COUNTED_FIELDS, TOTAL_METRIC, get_metric_name
+from dao.hpo_counter_dao import REGISTERED_PARTICIPANT, FULL_PARTICIPANT
+from dao.hpo_dao import HPODao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+
+
+def reconcile_hpo_counters(recalculate=False):
+  """Logs the counted metrics whose counters differ from the serving metrics version's last
+  buckets, and returns the number of them (or None if there is no serving version.)
+
+  If recalculate is true, the counters are then recalculated from the participant summaries.
+  """
+  version = MetricsVersionDao().get_serving_version()
+  if version is None:
+    logging.warning('No serving metrics version to reconcile HPO counters with.')
+    mismatches = None
+  else:
+    mismatches = 0
+    bucket_dao = MetricsBucketDao()
+    last_date = bucket_dao.get_date_range(version.metricsVersionId)[1]
+    buckets = {}
+    if last_date:
+      buckets = {bucket.hpoId: json.loads(bucket.metrics) for bucket in
+                 bucket_dao.get_version_buckets(version.metricsVersionId, last_date, last_date)}
+    hpo_dao = HPODao()
+    counts = {hpo_dao.get(hpo_id).name: hpo_counts
+              for hpo_id, hpo_counts in HpoCounterDao().get_counts().iteritems()}
+    for hpo_id in sorted(set(buckets.keys() + counts.keys()) - set([''])):
+      bucket_metrics = _get_counted_metrics(buckets.get(hpo_id, {}))
+      hpo_counts = counts.get(hpo_id, {})
+      for name in sorted(set(bucket_metrics.keys() + hpo_counts.keys())):
+        bucket_count = bucket_metrics.get(name, 0)
+        counter_count = hpo_counts.get(name, 0)
+        if bucket_count != counter_count:
+          logging.warning('HPO counter for %s %s is %d, but metrics version %d has %d on %s.',
+                          hpo_id, name, counter_count, version.metricsVersionId, bucket_count,
+                          last_date)
+          mismatches += 1
+    logging.info('Reconciled HPO counters with metrics version %d: %d mismatches.',
+                 version.metricsVersionId, mismatches)
+  if recalculate:
+    HpoCounterDao().recalculate()
+    logging.info('Recalculated HPO counters.')
+  return mismatches
+
+
+def _get_counted_metrics(metrics_dict):
+  """Returns the metrics in a bucket that HPO counters count."""
+  names = set([get_metric_name(TOTAL_METRIC, '', REGISTERED_PARTICIPANT)])
+  prefixes = tuple(get_metric_name(metric, '', participant_type)
+                   for metric, _, _ in COUNTED_FIELDS
+                   for participant_type in (REGISTERED_PARTICIPANT, FULL_PARTICIPANT))
+  return {name: count for name, count in metrics_dict.iteritems()
+          if name in names or name.startswith(prefixes)}
@@ -0,0 +1,229 @@
+"""Runs the metrics pipeline on a single machine, outside of App Engine MapReduce.
+
+SummaryPipeline (see metrics_pipeline.py) chains three MapReduces through GCS. This module runs
+the same mapper, combiner and reducer functions against local copies of the shard CSVs written by
+MetricsExport, so that a full metrics recompute can be run (and profiled) on a workstation.
+
+Each stage runs in two phases, both spread over a pool of worker processes:
+
+* Map: every input file is passed to the stage's mapper. Emitted (key, value) pairs are hash
+  partitioned, and every _SPILL_SIZE pairs are sorted (and combined, if the stage has a combiner)
+  and spilled to a run file on disk.
+* Reduce: for every partition, the sorted run files are merged and grouped by key, and each
+  group is passed to the stage's reducer. Reducer output lines are written to one file per
+  partition, which become the input files for the next stage.
+
+The final stage writes MetricsBuckets to the database in batches through MetricsBucketDao,
+exactly as the App Engine pipeline does. Memory use per worker is bounded by _SPILL_SIZE pairs
+during the map phase and by the values of a single key during the reduce phase.
+"""
+
+import heapq
+import itertools
+import logging
+import multiprocessing
+import os
+import shutil
+import tempfile
+import time
+import zlib
+
+from collections import namedtuple
+
+import clock
+import offline.metrics_config
+import singletons
+
+from dao.metrics_dao import MetricsRollupDao, MetricsVersionDao
+from offline.metrics_pipeline import map_csv_to_participant_and_date_metric
+from offline.metrics_pipeline import reduce_participant_data_to_hpo_metric_date_deltas
+from offline.metrics_pipeline import map_hpo_metric_date_deltas_to_hpo_metric_key
+from offline.metrics_pipeline import combine_hpo_metric_date_deltas
+from offline.metrics_pipeline import reduce_hpo_metric_date_deltas_to_all_date_counts
+from offline.metrics_pipeline import map_hpo_metric_date_counts_to_hpo_date_key
+from offline.metrics_pipeline import reduce_hpo_date_metric_counts_to_database_buckets
+from offline.metrics_pipeline import flush_bucket_writes, reset_state_layout
+
+# Number of mapped pairs buffered (per input file) before they are sorted and spilled to disk.
+_SPILL_SIZE = 100000
+_RUN_SUFFIX = '.run'
+_OUTPUT_FILE = 'part-%05d'
+
+_Stage = namedtuple('_Stage', ['name', 'mapper', 'combiner', 'reducer', 'reducer_param_names'])
+
+# These mirror the three MapreducePipelines in SummaryPipeline.
+_STAGES = [
+    _Stage('Process Input CSV', map_csv_to_participant_and_date_metric, None,
+           reduce_participant_data_to_hpo_metric_date_deltas, ['now', 'cubes']),
+    _Stage('Calculate Counts', map_hpo_metric_date_deltas_to_hpo_metric_key,
+           combine_hpo_metric_date_deltas, reduce_hpo_metric_date_deltas_to_all_date_counts,
+           ['now']),
+    _Stage('Write Metrics', map_hpo_metric_date_counts_to_hpo_date_key, None,
+           reduce_hpo_date_metric_counts_to_database_buckets, ['version_id', 'cubes']),
+]
+
+
+def _init_worker():
+  # Worker processes are forked from the parent, which may already hold pooled database
+  # connections; drop the cached database so that each worker opens its own connections.
+  singletons.reset()
+
+
+def _partition(key, num_partitions):
+  return (zlib.crc32(key) & 0xffffffff) % num_partitions
+
+
+def _write_run(run_dir, pairs, combiner):
+  """Sorts (and optionally combines) pairs, and writes them to a new run file."""
+  pairs.sort()
+  fd, path = tempfile.mkstemp(suffix=_RUN_SUFFIX, dir=run_dir)
+  with os.fdopen(fd, 'w') as run_file:
+    for key, group in itertools.groupby(pairs, key=lambda pair: pair[0]):
+      values = [value for _, value in group]
+      if combiner:
+        values = sorted(combiner(key, values, []))
+      for value in values:
+        run_file.write('%s\t%s\n' % (key.encode('string_escape'), value.encode('string_escape')))
+  return path
+
+
+def _read_run(path):
+  with open(path) as run_file:
+    for line in run_file:
+      key, value = line.rstrip('\n').split('\t')
+      yield key.decode('string_escape'), value.decode('string_escape')
+
+
+def _map_file(task):
+  """Maps one input file. Returns a list (one entry per partition) of lists of run files."""
+  mapper, combiner, input_path, run_dir, num_partitions = task
+  buffers = [[] for _ in range(num_partitions)]
+  runs = [[] for _ in range(num_partitions)]
+  buffered = 0
+  with open(input_path) as input_file:
+    for key, value in mapper(input_file):
+      buffers[_partition(key, num_partitions)].append((key, value))
+      buffered += 1
+      if buffered >= _SPILL_SIZE:
+        for partition, pairs in enumerate(buffers):
+          if pairs:
+            runs[partition].append(_write_run(run_dir, pairs, combiner))
+        buffers = [[] for _ in range(num_partitions)]
+        buffered = 0
+  for partition, pairs in enumerate(buffers):
+    if pairs:
+      runs[partition].append(_write_run(run_dir, pairs, combiner))
+  return runs
+
+
+def _reduce_partition(task):
+  """Merges the sorted runs for a partition and passes each key's values to the reducer."""
+  reducer, reducer_params, run_paths, output_path = task
+  with open(output_path, 'w') as output_file:
+    merged = heapq.merge(*[_read_run(path) for path in run_paths])
+    for key, group in itertools.groupby(merged, key=lambda pair: pair[0]):
+      result = reducer(key, [value for _, value in group], **reducer_params)
+      # The last stage writes to the database and doesn't yield anything.
+      if result is not None:
+        for line in result:
+          output_file.write(line)
+  # The last stage buffers buckets, and writes them in batches.
+  flush_bucket_writes()
+  return output_path
+
+
+def _run_stage(map_func, stage, input_paths, stage_dir, num_partitions, params):
+  """Runs a single map / shuffle / reduce stage; returns the paths of its output files."""
+  start_time = time.time()
+  run_dir = os.path.join(stage_dir, 'runs')
+  os.makedirs(run_dir)
+  map_tasks = [(stage.mapper, stage.combiner, path, run_dir, num_partitions)
+               for path in input_paths]
+  partition_runs = [[] for _ in range(num_partitions)]
+  for runs in map_func(_map_file, map_tasks):
+    for partition, paths in enumerate(runs):
+      partition_runs[partition].extend(paths)
+  logging.info('%s: mapped %d files in %.1fs.', stage.name, len(input_paths),
+               time.time() - start_time)
+
+  reducer_params = {name: params[name] for name in stage.reducer_param_names}
+  reduce_tasks = [(stage.reducer, reducer_params, partition_runs[partition],
+                   os.path.join(stage_dir, _OUTPUT_FILE % partition))
+                  for partition in range(num_partitions)]
+  output_paths = map_func(_reduce_partition, reduce_tasks)
+  shutil.rmtree(run_dir)
+  logging.info('%s: completed in %.1fs.', stage.name, time.time() - start_time)
+  return output_paths
+
+
+def run_stages(input_paths, work_dir, params, num_processes=None, num_partitions=None,
+               stages=None):
+  """Runs pipeline stages over local input files, using work_dir for intermediate files.
+
+  Args:
+    input_paths: paths of the files to pass to the first stage's mapper.
+    work_dir: an existing directory used for spilled runs and stage output.
+    params: reducer parameters (now, version_id, cubes) shared by all stages.
+    num_processes: size of the worker pool; if 1, everything runs in this process.
+    num_partitions: number of reduce partitions per stage (defaults to num_processes).
+    stages: the stages to run; defaults to all three metrics pipeline stages.
+  Returns:
+    The output files of the last stage.
+  """
+  num_processes = num_processes or multiprocessing.cpu_count()
+  num_partitions = num_partitions or num_processes
+  # Compile summary fields again, with the current config, on this run.
+  reset_state_layout()
+  pool = None
+  if num_processes > 1:
+    pool = multiprocessing.Pool(num_processes, initializer=_init_worker)
+    map_func = pool.map
+  else:
+    map_func = map
+  try:
+    for i, stage in enumerate(stages or _STAGES):
+      stage_dir = os.path.join(work_dir, 'stage%d' % (i + 1))
+      input_paths = _run_stage(map_func, stage, input_paths, stage_dir, num_partitions, params)
+    return input_paths
+  finally:
+    if pool:
+      pool.close()
+      pool.join()
+
+
+def run_local_pipeline(input_dir, num_processes=None, num_partitions=None, work_dir=None):
+  """Computes metrics buckets from the MetricsExport CSVs in input_dir.
+
+  A new MetricsVersion is created for the run, and marked complete (and old versions deleted)
+  when all buckets and rollups have been written, matching MetricsPipeline, RollUpMetrics and
+  FinalizeMetrics.
+
+  Returns:
+    The ID of the new MetricsVersion.
+  """
+  input_paths = sorted(os.path.join(input_dir, name) for name in os.listdir(input_dir)
+                       if name.endswith('.csv'))
+  if not input_paths:
+    raise ValueError('No CSV files found in %s.' % input_dir)
+  metrics_version_dao = MetricsVersionDao()
+  version_id = metrics_version_dao.set_pipeline_in_progress()
+  params = {'now': clock.CLOCK.now(), 'version_id': version_id,
+            'cubes': offline.metrics_config.get_cubes()}
+  temp_dir = None
+  if not work_dir:
+    work_dir = temp_dir = tempfile.mkdtemp(prefix='metrics_')
+  start_time = time.time()
+  try:
+    run_stages(input_paths, work_dir, params, num_processes, num_partitions)
+    MetricsRollupDao().write_rollups(version_id)
+  except:
+    logging.info('Local pipeline failed; setting current metrics version to incomplete.')
+    metrics_version_dao.set_pipeline_finished(False)
+    raise
+  finally:
+    if temp_dir:
+      shutil.rmtree(temp_dir)
+  metrics_version_dao.set_pipeline_finished(True)
+  metrics_version_dao.delete_old_versions()
+  logging.info('Wrote metrics version %d in %.1fs.', version_id, time.time() - start_time)
+  return version_id
@@ -7,12 +7,14 @@ import json
 import logging
 import traceback
 
+from dao.biobank_reconciliation_dao import BiobankReconciliationDao
 from dao.metrics_dao import MetricsVersionDao
 from flask import Flask, request
 from google.appengine.api import app_identity
 from offline import biobank_samples_pipeline
 from offline.base_pipeline import send_failure_alert
-from offline.table_exporter import TableExporter
+from offline.hpo_counters import reconcile_hpo_counters
+from offline.table_exporter import CSV_FORMAT, TableExporter
 from offline.metrics_export import MetricsExport
 from api_util import EXPORTER
 from werkzeug.exceptions import BadRequest
@@ -60,9 +62,13 @@ def recalculate_metrics():
     return '{"metrics-pipeline-status": "running"}'
   else:
     bucket_name = app_identity.get_default_gcs_bucket_name()
-    logging.info("=========== Starting metrics export ============")
+    # Incremental runs only recalculate metrics for participants that changed since the last run.
+    incremental = request.args.get('incremental', '').lower() == 'true'
+    logging.info("=========== Starting metrics export (incremental = %s) ============",
+                 incremental)
     MetricsExport.start_export_tasks(bucket_name,
-                                     int(config.getSetting(config.METRICS_SHARDS, 1)))
+                                     int(config.getSetting(config.METRICS_SHARDS, 1)),
+                                     incremental=incremental)
     return '{"metrics-pipeline-status": "started"}'
 
 
@@ -72,14 +78,37 @@ def import_biobank_samples():
   # Note that crons always have a 10 minute deadline instead of the normal 60s; additionally our
   # offline service uses basic scaling with has no deadline.
   logging.info('Starting samples import.')
-  written, timestamp = biobank_samples_pipeline.upsert_from_latest_csv()
+  if config.getSetting(config.BIOBANK_SAMPLES_IMPORT_UNPROCESSED, False):
+    counts, timestamp = biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+  else:
+    counts, timestamp = biobank_samples_pipeline.upsert_from_latest_csv()
   logging.info(
-      'Import complete (%d written), generating report.', written)
+      'Import complete (%d inserted, %d updated, %d unchanged), generating report.',
+      counts.inserted, counts.updated, counts.unchanged)
 
   logging.info('Generating reconciliation report.')
   biobank_samples_pipeline.write_reconciliation_report(timestamp)
   logging.info('Generated reconciliation report.')
-  return json.dumps({'written': written})
+  return json.dumps({'written': counts.written, 'inserted': counts.inserted,
+                     'updated': counts.updated, 'unchanged': counts.unchanged})
+
+@api_util.auth_required_cron
+@_alert_on_exceptions
+def rebuild_biobank_reconciliation():
+  # Orders and samples update their participants' rows as they are written; this recalculates
+  # every row, to fill in the table and pick up changes to sites.
+  logging.info('Rebuilding biobank reconciliation.')
+  BiobankReconciliationDao().rebuild()
+  logging.info('Rebuilt biobank reconciliation.')
+  return '{"biobank-reconciliation-status": "rebuilt"}'
+
+@api_util.auth_required_cron
+@_alert_on_exceptions
+def reconcile_hpo_counters_with_metrics():
+  # If recalculate=true, the counters are rebuilt from participant summaries after reconciling.
+  recalculate = request.args.get('recalculate', '').lower() == 'true'
+  mismatches = reconcile_hpo_counters(recalculate=recalculate)
+  return json.dumps({'mismatches': mismatches})
 
 @api_util.auth_required(EXPORTER)
 def export_tables():
@@ -94,7 +123,11 @@ def export_tables():
   directory = resource_json.get('directory')
   if not directory:
     raise BadRequest("directory is required")
-  return json.dumps(TableExporter.export_tables(database, tables, directory))
+  compress = bool(resource_json.get('gzip'))
+  export_format = resource_json.get('format', CSV_FORMAT)
+  snapshot = bool(resource_json.get('snapshot'))
+  return json.dumps(TableExporter.export_tables(database, tables, directory, compress=compress,
+                                                export_format=export_format, snapshot=snapshot))
 
 def _build_pipeline_app():
   """Configure and return the app with non-resource pipeline-triggering endpoints."""
@@ -106,12 +139,24 @@ def _build_pipeline_app():
       view_func=import_biobank_samples,
       methods=['GET'])
 
+  offline_app.add_url_rule(
+      PREFIX + 'BiobankReconciliationRebuild',
+      endpoint='biobankReconciliationRebuild',
+      view_func=rebuild_biobank_reconciliation,
+      methods=['GET'])
+
   offline_app.add_url_rule(
       PREFIX + 'MetricsRecalculate',
       endpoint='metrics_recalc',
       view_func=recalculate_metrics,
       methods=['GET'])
 
+  offline_app.add_url_rule(
+      PREFIX + 'HpoCountersReconcile',
+      endpoint='hpo_counters_reconcile',
+      view_func=reconcile_hpo_counters_with_metrics,
+      methods=['GET'])
+
   offline_app.add_url_rule(
       PREFIX + 'ExportTables',
       endpoint='ExportTables',
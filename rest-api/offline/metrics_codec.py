@@ -0,0 +1,292 @@
+"""Encodings for the records that the metrics pipeline's MapReduce stages exchange.
+
+Every intermediate record (the files written between stages, and the keys and values shuffled
+within a stage) is a tuple of fields, each of which is a string, a date, or an integer; the
+layouts used by the pipeline are defined below (ROW, METRIC_KEY, etc.)
+
+TextCodec produces the original pipe-delimited text, e.g. "PITT|R|race.WHITE|2017-01-01|1".
+
+BinaryCodec produces compact binary records:
+* strings are replaced with their index in a dictionary (passed in with the pipeline parameters,
+  so that it is the same for every shard), encoded as a varint; strings not in the dictionary are
+  written inline as a 0 followed by their length and bytes.
+* dates are encoded as a zigzag varint number of days since 1970-01-01.
+* integers (deltas and counts) are zigzag varints, so small negative numbers stay small.
+* records written to files are prefixed with their length, as a varint.
+
+The codec for a run is chosen when the pipeline starts (see get_codec_params), and read by the
+mappers, combiner and reducers from their MapReduce parameters.
+"""
+
+import csv
+import datetime
+import threading
+
+CODEC_PARAM = 'codec'
+DICTIONARY_PARAM = 'codec_dictionary'
+
+TEXT_CODEC_NAME = 'text'
+BINARY_CODEC_NAME = 'binary'
+
+# Field kinds.
+STRING = 's'
+DATE = 'd'
+INT = 'i'
+
+# hpoId|participant_type|metric|date|delta (or count); written between stages.
+ROW = (STRING, STRING, STRING, DATE, INT)
+# hpoId|participant_type|metric; the key for the second stage's shuffle.
+METRIC_KEY = (STRING, STRING, STRING)
+# date|delta; the value for the second stage's shuffle.
+DATE_DELTA = (DATE, INT)
+# hpoId|date; the key for the third stage's shuffle.
+HPO_DATE_KEY = (STRING, DATE)
+# participant_type|metric|count; the value for the third stage's shuffle.
+METRIC_COUNT = (STRING, STRING, INT)
+# hpoId; the key for the shuffle when the second and third stages are fused.
+HPO_KEY = (STRING,)
+# participant_type|metric|date|delta; the value for the shuffle when the second and third stages
+# are fused.
+METRIC_DATE_DELTA = (STRING, STRING, DATE, INT)
+
+_DELIMITER = '|'
+_EPOCH_ORDINAL = datetime.date(1970, 1, 1).toordinal()
+# Number of bytes read from input files at a time when reading binary records.
+_READ_SIZE = 1024 * 1024
+
+
+class TextCodec(object):
+  """Reads and writes pipe-delimited text records."""
+  name = TEXT_CODEC_NAME
+
+  def encode(self, kinds, values):  # pylint: disable=unused-argument
+    return _DELIMITER.join(str(value) for value in values)
+
+  def decode(self, kinds, data):
+    return _parse_text_fields(kinds, data.split(_DELIMITER))
+
+  def encode_record(self, kinds, values):
+    return self.encode(kinds, values) + '\n'
+
+  def encode_count_runs(self, key, runs):
+    """Returns ROW records for key (hpoId, participant_type, metric) and every date in runs of
+    (first ordinal, last ordinal, count), as generated by metrics_counts."""
+    prefix = self.encode(METRIC_KEY, key) + _DELIMITER
+    parts = []
+    for first_ordinal, last_ordinal, count in runs:
+      suffix = '%s%d\n' % (_DELIMITER, count)
+      parts.append(prefix + (suffix + prefix).join(_get_date_strs(first_ordinal, last_ordinal)) +
+                   suffix)
+    return ''.join(parts)
+
+  def read_records(self, kinds, input_buffer):
+    for fields in csv.reader(input_buffer, delimiter=_DELIMITER):
+      yield _parse_text_fields(kinds, fields)
+
+
+def _parse_text_fields(kinds, fields):
+  return tuple(int(field) if kind == INT else field for kind, field in zip(kinds, fields))
+
+
+class BinaryCodec(object):
+  """Reads and writes dictionary-encoded, length-prefixed binary records."""
+  name = BINARY_CODEC_NAME
+
+  def __init__(self, dictionary):
+    # Parameters come back from JSON as unicode; records are byte strings.
+    self._strings = [value.encode('utf-8') if isinstance(value, unicode) else value
+                     for value in dictionary]
+    # Dictionary IDs start at 1; 0 indicates a string that is written inline.
+    self._string_ids = {value: i + 1 for i, value in enumerate(self._strings)}
+    self._date_cache = {}
+
+  def encode(self, kinds, values):
+    out = []
+    for kind, value in zip(kinds, values):
+      if kind == STRING:
+        string_id = self._string_ids.get(value)
+        if string_id:
+          _write_varint(string_id, out)
+        else:
+          _write_varint(0, out)
+          _write_varint(len(value), out)
+          out.append(value)
+      elif kind == DATE:
+        _write_varint(_zigzag(_date_str_to_days(value)), out)
+      else:
+        _write_varint(_zigzag(int(value)), out)
+    return ''.join(out)
+
+  def decode(self, kinds, data):
+    values = []
+    pos = 0
+    for kind in kinds:
+      if kind == STRING:
+        string_id, pos = _read_varint(data, pos)
+        if string_id:
+          values.append(self._strings[string_id - 1])
+        else:
+          length, pos = _read_varint(data, pos)
+          values.append(data[pos:pos + length])
+          pos += length
+      elif kind == DATE:
+        days, pos = _read_varint(data, pos)
+        values.append(self._days_to_date_str(_unzigzag(days)))
+      else:
+        value, pos = _read_varint(data, pos)
+        values.append(_unzigzag(value))
+    return tuple(values)
+
+  def encode_record(self, kinds, values):
+    data = self.encode(kinds, values)
+    out = []
+    _write_varint(len(data), out)
+    out.append(data)
+    return ''.join(out)
+
+  def encode_count_runs(self, key, runs):
+    """Returns ROW records for key (hpoId, participant_type, metric) and every date in runs of
+    (first ordinal, last ordinal, count), as generated by metrics_counts."""
+    prefix = self.encode(METRIC_KEY, key)
+    out = []
+    for first_ordinal, last_ordinal, count in runs:
+      count_out = []
+      _write_varint(_zigzag(count), count_out)
+      count_data = ''.join(count_out)
+      for ordinal in xrange(first_ordinal, last_ordinal + 1):
+        date_out = [prefix]
+        _write_varint(_zigzag(ordinal - _EPOCH_ORDINAL), date_out)
+        date_out.append(count_data)
+        data = ''.join(date_out)
+        _write_varint(len(data), out)
+        out.append(data)
+    return ''.join(out)
+
+  def read_records(self, kinds, input_buffer):
+    data = ''
+    pos = 0
+    while True:
+      chunk = input_buffer.read(_READ_SIZE)
+      if not chunk:
+        break
+      data = data[pos:] + chunk
+      pos = 0
+      while True:
+        try:
+          length, start = _read_varint(data, pos)
+        except IndexError:
+          break  # The length prefix continues in the next chunk.
+        if start + length > len(data):
+          break
+        yield self.decode(kinds, data[start:start + length])
+        pos = start + length
+    if pos != len(data):
+      raise ValueError('Truncated record at end of input.')
+
+  def _days_to_date_str(self, days):
+    date_str = self._date_cache.get(days)
+    if date_str is None:
+      date_str = datetime.date.fromordinal(days + _EPOCH_ORDINAL).isoformat()
+      self._date_cache[days] = date_str
+    return date_str
+
+
+# ISO date strings for a range of consecutive ordinals, as (first ordinal, date strings), grown as
+# needed; slices of this are joined when encoding runs of text records. Reducers may run in
+# parallel threads, so the ordinal and list are replaced together (under _date_strs_lock.)
+_date_strs = (None, [])
+_date_strs_lock = threading.Lock()
+
+
+def _get_date_strs(first_ordinal, last_ordinal):
+  global _date_strs
+  cached_first_ordinal, date_strs = _date_strs
+  if not _covers(cached_first_ordinal, date_strs, first_ordinal, last_ordinal):
+    with _date_strs_lock:
+      cached_first_ordinal, date_strs = _date_strs
+      if not _covers(cached_first_ordinal, date_strs, first_ordinal, last_ordinal):
+        last_ordinal_needed = last_ordinal
+        if cached_first_ordinal is not None:
+          last_ordinal_needed = max(last_ordinal, cached_first_ordinal + len(date_strs) - 1)
+          cached_first_ordinal = min(first_ordinal, cached_first_ordinal)
+        else:
+          cached_first_ordinal = first_ordinal
+        date_strs = [datetime.date.fromordinal(ordinal).isoformat()
+                     for ordinal in xrange(cached_first_ordinal, last_ordinal_needed + 1)]
+        _date_strs = (cached_first_ordinal, date_strs)
+  start = first_ordinal - cached_first_ordinal
+  return date_strs[start:start + last_ordinal - first_ordinal + 1]
+
+
+def _covers(cached_first_ordinal, date_strs, first_ordinal, last_ordinal):
+  return (cached_first_ordinal is not None and first_ordinal >= cached_first_ordinal and
+          last_ordinal < cached_first_ordinal + len(date_strs))
+
+
+def _date_str_to_days(date_str):
+  return (datetime.date(int(date_str[0:4]), int(date_str[5:7]), int(date_str[8:10])).toordinal() -
+          _EPOCH_ORDINAL)
+
+
+def _write_varint(value, out):
+  while value > 0x7f:
+    out.append(chr((value & 0x7f) | 0x80))
+    value >>= 7
+  out.append(chr(value))
+
+
+def _read_varint(data, pos):
+  """Returns the varint at data[pos], and the position after it."""
+  result = 0
+  shift = 0
+  while True:
+    byte = ord(data[pos])
+    pos += 1
+    result |= (byte & 0x7f) << shift
+    if not byte & 0x80:
+      return result, pos
+    shift += 7
+
+
+def _zigzag(value):
+  return value * 2 if value >= 0 else -value * 2 - 1
+
+
+def _unzigzag(value):
+  return value // 2 if not value & 1 else -(value + 1) // 2
+
+
+TEXT_CODEC = TextCodec()
+
+# The binary codec for the MapReduce currently running in this instance, keyed by MapReduce ID.
+_binary_codec_cache = {}
+
+
+def get_codec_params(codec_name, dictionary):
+  """Returns pipeline parameters selecting the named codec, using the specified dictionary of
+  commonly used strings if it is the binary codec."""
+  if codec_name == TEXT_CODEC_NAME:
+    return {CODEC_PARAM: TEXT_CODEC_NAME}
+  if codec_name == BINARY_CODEC_NAME:
+    return {CODEC_PARAM: BINARY_CODEC_NAME, DICTIONARY_PARAM: list(dictionary)}
+  raise ValueError('Unknown metrics codec: %r' % codec_name)
+
+
+def get_codec(params, cache_key=None):
+  """Returns the codec selected by the specified pipeline parameters.
+
+  Binary codecs are cached by cache_key (if provided), so that the dictionary doesn't need to be
+  rebuilt on every call from the same MapReduce.
+  """
+  codec_name = params.get(CODEC_PARAM, TEXT_CODEC_NAME)
+  if codec_name == TEXT_CODEC_NAME:
+    return TEXT_CODEC
+  if codec_name != BINARY_CODEC_NAME:
+    raise ValueError('Unknown metrics codec: %r' % codec_name)
+  codec = _binary_codec_cache.get(cache_key) if cache_key else None
+  if not codec:
+    codec = BinaryCodec(params[DICTIONARY_PARAM])
+    if cache_key:
+      _binary_codec_cache.clear()
+      _binary_codec_cache[cache_key] = codec
+  return codec
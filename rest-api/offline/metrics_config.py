@@ -6,13 +6,14 @@ from other field values.
 '''
 import config
 import participant_enums
+import re
 
 from census_regions import census_regions
 from code_constants import BASE_VALUES, UNSET
 from code_constants import PPI_SYSTEM
 from dao.code_dao import CodeDao
 from dao.hpo_dao import HPODao
-from dao.participant_summary_dao import ParticipantSummaryDao
+from dao.participant_summary_dao import compute_enrollment_status, get_num_baseline_ppi_modules
 from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES, FIELD_TO_QUESTION_CODE
 from field_mappings import CONSENT_FOR_STUDY_ENROLLMENT_FIELD
 from field_mappings import CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
@@ -55,43 +56,54 @@ class CodeIdFieldDef(FieldDef):
   def __init__(self, name, values_func):
     super(CodeIdFieldDef, self).__init__(name[0:len(name) - 2], values_func, name)
 
+# compile_func is called once per pipeline run, and returns (inputs, func): inputs lists the
+# fields (or earlier summary fields) the summary field depends on, and func computes its value
+# from their values. func must not use config, DAOs or the datastore, so that the pipeline can
+# memoize it and only call it when one of the inputs changes.
 class SummaryFieldDef(object):
-  def __init__(self, name, compute_func, values_func):
+  def __init__(self, name, compile_func, values_func):
     self.name = name
-    self.compute_func = compute_func
+    self.compile_func = compile_func
     self.values_func = values_func
 
-def _biospecimen_summary(summary):
-  '''Summarizes the two biospecimen statuses into one.'''
-  samples = summary.get(BIOSPECIMEN_SAMPLES_METRIC, UNSET)
-  order = summary.get(BIOSPECIMEN_METRIC, UNSET)
-  if samples != UNSET:
-    return samples
-  return order
-
-def _consent_for_study_enrollment_and_ehr(summary):
-  '''True when both the study and EHR have been consented to.'''
-  consent_for_study = summary.get(CONSENT_FOR_STUDY_ENROLLMENT_FIELD, UNSET)
-  consent_for_ehr = summary.get(CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD, UNSET)
-  if consent_for_study == SUBMITTED_VALUE and consent_for_ehr == SUBMITTED_VALUE:
-    return SUBMITTED_VALUE
-  return UNSET
+def _compile_biospecimen_summary():
+  def biospecimen_summary(samples, order):
+    '''Summarizes the two biospecimen statuses into one.'''
+    if samples != UNSET:
+      return samples
+    return order
+  return [BIOSPECIMEN_SAMPLES_METRIC, BIOSPECIMEN_METRIC], biospecimen_summary
+
+def _compile_consent_for_study_enrollment_and_ehr():
+  def consent_for_study_enrollment_and_ehr(consent_for_study, consent_for_ehr):
+    '''True when both the study and EHR have been consented to.'''
+    if consent_for_study == SUBMITTED_VALUE and consent_for_ehr == SUBMITTED_VALUE:
+      return SUBMITTED_VALUE
+    return UNSET
+  return ([CONSENT_FOR_STUDY_ENROLLMENT_FIELD, CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD],
+          consent_for_study_enrollment_and_ehr)
 
 def _get_baseline_ppi_module_fields():
   return config.getSettingList(config.BASELINE_PPI_QUESTIONNAIRE_FIELDS, [])
 
-def _num_completed_baseline_ppi_modules(summary):
-  baseline_ppi_module_fields = _get_baseline_ppi_module_fields()
-  return sum(1 for field in baseline_ppi_module_fields if summary.get(field) == SUBMITTED_VALUE)
-
-def _enrollment_status(summary):
-  ps_dao = ParticipantSummaryDao()
-  consent = summary.get(CONSENT_FOR_STUDY_ENROLLMENT_AND_EHR_METRIC) == SUBMITTED_VALUE
-  num_completed_baseline_ppi_modules = summary.get(NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC)
-  physical_measurements = PhysicalMeasurementsStatus(summary.get(PHYSICAL_MEASUREMENTS_METRIC))
-  samples_to_isolate_dna = SampleStatus(summary.get(SAMPLES_TO_ISOLATE_DNA_METRIC))
-  return ps_dao.calculate_enrollment_status(consent, num_completed_baseline_ppi_modules,
-                                            physical_measurements, samples_to_isolate_dna)
+def _compile_num_completed_baseline_ppi_modules():
+  def num_completed_baseline_ppi_modules(*statuses):
+    return sum(1 for status in statuses if status == SUBMITTED_VALUE)
+  # Baseline modules that aren't questionnaire module fields never count as completed.
+  return ([field for field in _get_baseline_ppi_module_fields()
+           if field in QUESTIONNAIRE_MODULE_FIELD_NAMES], num_completed_baseline_ppi_modules)
+
+def _compile_enrollment_status():
+  num_baseline_ppi_modules = get_num_baseline_ppi_modules()
+  def enrollment_status(consent, num_completed_baseline_ppi_modules, physical_measurements,
+                        samples_to_isolate_dna):
+    return compute_enrollment_status(consent == SUBMITTED_VALUE,
+                                     num_completed_baseline_ppi_modules,
+                                     num_baseline_ppi_modules,
+                                     PhysicalMeasurementsStatus(physical_measurements),
+                                     SampleStatus(samples_to_isolate_dna))
+  return ([CONSENT_FOR_STUDY_ENROLLMENT_AND_EHR_METRIC, NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC,
+           PHYSICAL_MEASUREMENTS_METRIC, SAMPLES_TO_ISOLATE_DNA_METRIC], enrollment_status)
 
 def _get_hpo_ids():
   return [hpo.name for hpo in HPODao().get_all()]
@@ -175,21 +187,28 @@ CONFIG = {
        QUESTIONNAIRE_MODULE_FIELD_NAMES]
     + [CodeIdFieldDef(fieldname, _get_answer_values_func(question_code)) for
        fieldname, question_code in ANSWER_FIELD_TO_QUESTION_CODE.iteritems()],
-  # These fields are computed using the first provided function in the definition,
+  # These fields are computed using the function returned by compile_func in the definition,
   # based on the state of other fields.
   'summary_fields': [
-    SummaryFieldDef(BIOSPECIMEN_SUMMARY_METRIC, _biospecimen_summary,
+    SummaryFieldDef(BIOSPECIMEN_SUMMARY_METRIC, _compile_biospecimen_summary,
                     _get_biospecimen_summary_values),
     SummaryFieldDef(CONSENT_FOR_STUDY_ENROLLMENT_AND_EHR_METRIC,
-                    _consent_for_study_enrollment_and_ehr,
+                    _compile_consent_for_study_enrollment_and_ehr,
                     _get_submission_statuses),
-    SummaryFieldDef(NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC, _num_completed_baseline_ppi_modules,
+    SummaryFieldDef(NUM_COMPLETED_BASELINE_PPI_MODULES_METRIC,
+                    _compile_num_completed_baseline_ppi_modules,
                     _get_completed_baseline_ppi_modules_values),
-    SummaryFieldDef(ENROLLMENT_STATUS_METRIC, _enrollment_status,
+    SummaryFieldDef(ENROLLMENT_STATUS_METRIC, _compile_enrollment_status,
                     _get_enrollment_statuses)
   ]
 }
 
+# Cubes written by the metrics pipeline unless the metrics_cubes config setting is set: each cube
+# counts participants by every combination of the values of its fields. None are written by
+# default, since they add work and output to every run; they are enabled with e.g.
+# {"raceByAgeRangeByEnrollmentStatus": ["race", "ageRange", "enrollmentStatus"]}.
+DEFAULT_CUBES = {}
+
 PARTICIPANT_SUMMARY_FIELD_TO_METRIC_FIELD = {f.participant_summary_field: f.name
                                              for f in CONFIG['fields']
                                              if f.participant_summary_field}
@@ -212,3 +231,17 @@ def get_fields():
 
 def get_config():
   return CONFIG
+
+def get_cubes():
+  """Returns a dict of cube name -> list of the fields (dimensions) the cube counts participants
+  by, checking that cube names are alphanumeric and every dimension is a field in the config."""
+  cubes = config.getSettingJson(config.METRICS_CUBES, DEFAULT_CUBES)
+  conf = get_config()
+  field_names = set(field.name for field in conf['fields'] + conf['summary_fields'])
+  for name, dimensions in cubes.iteritems():
+    if not re.match(r'^\w+$', name):
+      raise config.InvalidConfigException('Invalid metrics cube name: %s' % name)
+    if not dimensions or any(dimension not in field_names for dimension in dimensions):
+      raise config.InvalidConfigException('Invalid dimensions for metrics cube %s: %s'
+                                          % (name, dimensions))
+  return cubes
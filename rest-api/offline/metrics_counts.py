@@ -0,0 +1,158 @@
+"""Expands per-date metric deltas into daily counts, for the second stage of the metrics pipeline.
+
+Given a map of date string -> delta for one HPO + participant type + metric, the count for every
+date is the running total of the deltas up to that date. Counts are generated for every date
+from the first delta through the end date (the date the pipeline runs), except that:
+
+* a date with a delta is skipped if the count on that date is not positive;
+* dates after the last delta are only generated if the final count is positive.
+
+The pure Python generators walk the dates one at a time. When NumPy is available, the same
+results are computed by scattering the deltas into an array indexed by day, taking a cumulative
+sum, and selecting the dates to output with a mask. Consecutive dates with the same count are
+returned as runs, which the metrics codecs can encode in bulk; this is much faster for keys with
+long histories. Both implementations must produce identical output (see
+tools/benchmark_metrics_counts.py).
+"""
+
+import datetime
+
+try:
+  import numpy
+except ImportError:
+  numpy = None
+
+_ONE_DAY = datetime.timedelta(days=1)
+# Caches of date strings <-> ordinals; the number of distinct dates in a run is small.
+_date_str_to_ordinal_cache = {}
+_ordinal_to_date_str_cache = {}
+
+
+def numpy_available():
+  return numpy is not None
+
+
+def daily_counts(delta_map, end_date):
+  """Generates (date string, count) for each date until end_date (see module comments)."""
+  last_date = None
+  count = 0
+  for date_str, delta in sorted(delta_map.items()):
+    date = _parse_date(date_str)
+    if date > end_date:
+      # Ignore any data after the current run date.
+      break
+    # Yield results for all the dates in between
+    if last_date:
+      middle_date = last_date + _ONE_DAY
+      while middle_date < date:
+        yield middle_date.isoformat(), count
+        middle_date = middle_date + _ONE_DAY
+    count += delta
+    if count > 0:
+      yield date_str, count
+    last_date = date
+  # Yield results up until today.
+  if count > 0 and last_date:
+    last_date = last_date + _ONE_DAY
+    while last_date <= end_date:
+      yield last_date.isoformat(), count
+      last_date = last_date + _ONE_DAY
+
+
+def daily_changes(delta_map, end_date):
+  """Generates (date string, change) for each date until end_date on which the running total of
+  the deltas is non-zero. Used by incremental runs, where deltas are changes to counts."""
+  last_date = None
+  change = 0
+  for date_str, delta in sorted(delta_map.items()):
+    date = _parse_date(date_str)
+    if date > end_date:
+      break
+    if last_date and change:
+      middle_date = last_date + _ONE_DAY
+      while middle_date < date:
+        yield middle_date.isoformat(), change
+        middle_date = middle_date + _ONE_DAY
+    change += delta
+    if change:
+      yield date_str, change
+    last_date = date
+  if change and last_date:
+    last_date = last_date + _ONE_DAY
+    while last_date <= end_date:
+      yield last_date.isoformat(), change
+      last_date = last_date + _ONE_DAY
+
+
+def daily_count_runs_numpy(delta_map, end_date, changes=False):
+  """Computes the output of daily_counts (or daily_changes, if changes is set) with NumPy.
+
+  Returns:
+    A list of (first ordinal, last ordinal, count) tuples, one for each run of consecutive dates
+    with the same count; expand_runs turns these back into (date string, count) pairs.
+  """
+  end_ordinal = end_date.toordinal()
+  ordinals = []
+  deltas = []
+  for date_str, delta in delta_map.iteritems():
+    ordinal = _date_str_to_ordinal(date_str)
+    if ordinal <= end_ordinal:
+      ordinals.append(ordinal)
+      deltas.append(delta)
+  if not ordinals:
+    return []
+  first_ordinal = min(ordinals)
+  if changes or sum(deltas) > 0:
+    last_ordinal = end_ordinal
+  else:
+    last_ordinal = max(ordinals)
+
+  # Dates in delta_map are unique, so the deltas can be assigned rather than accumulated.
+  offsets = numpy.array(ordinals, dtype=numpy.int64) - first_ordinal
+  daily_deltas = numpy.zeros(last_ordinal - first_ordinal + 1, dtype=numpy.int64)
+  daily_deltas[offsets] = deltas
+  counts = numpy.cumsum(daily_deltas)
+  if changes:
+    mask = counts != 0
+  else:
+    mask = numpy.ones(len(counts), dtype=bool)
+    mask[offsets] = counts[offsets] > 0
+  indices = numpy.flatnonzero(mask)
+  if not len(indices):
+    return []
+  values = counts[indices]
+  # A new run starts wherever there is a gap in the output dates or the count changes.
+  run_starts = numpy.flatnonzero(numpy.concatenate((
+      [True], (numpy.diff(indices) != 1) | (numpy.diff(values) != 0))))
+  run_ends = numpy.concatenate((run_starts[1:], [len(indices)])) - 1
+  return zip((indices[run_starts] + first_ordinal).tolist(),
+             (indices[run_ends] + first_ordinal).tolist(),
+             values[run_starts].tolist())
+
+
+def expand_runs(runs):
+  """Generates (date string, count) for each date in runs from daily_count_runs_numpy."""
+  for first_ordinal, last_ordinal, count in runs:
+    for ordinal in xrange(first_ordinal, last_ordinal + 1):
+      yield _ordinal_to_date_str(ordinal), count
+
+
+def _parse_date(date_str):
+  return datetime.date.fromordinal(_date_str_to_ordinal(date_str))
+
+
+def _date_str_to_ordinal(date_str):
+  ordinal = _date_str_to_ordinal_cache.get(date_str)
+  if ordinal is None:
+    ordinal = datetime.date(int(date_str[0:4]), int(date_str[5:7]),
+                            int(date_str[8:10])).toordinal()
+    _date_str_to_ordinal_cache[date_str] = ordinal
+  return ordinal
+
+
+def _ordinal_to_date_str(ordinal):
+  date_str = _ordinal_to_date_str_cache.get(ordinal)
+  if date_str is None:
+    date_str = datetime.date.fromordinal(ordinal).isoformat()
+    _ordinal_to_date_str_cache[ordinal] = date_str
+  return date_str
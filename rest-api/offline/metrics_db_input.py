@@ -0,0 +1,123 @@
+"""Input for the metrics pipeline's first MapReduce, read straight from the database.
+
+When the metrics_read_from_database config setting is true, MetricsExport doesn't export CSVs to
+GCS; instead, the first MR of the metrics pipeline uses ParticipantIdRangeInputReader, which
+divides the range of participant IDs among the shards. For each range of IDs handed to the
+mapper, the participant, HPO ID history and answer queries from metrics_export.py are run
+against server-side cursors, and the rows are passed to the same functions that map the exported
+CSVs. This takes the serial chain of export tasks, and parsing the CSVs they write, off the
+critical path of a metrics run.
+"""
+
+from mapreduce import context
+from mapreduce import errors
+from mapreduce import input_readers
+from sqlalchemy import text
+
+from dao import database_factory
+from dao.participant_dao import ParticipantDao
+from offline.metrics_export import get_participant_sql, get_hpo_id_sql, get_answer_sql
+from offline.metrics_pipeline import map_participants, map_hpo_ids, map_answers
+
+# Number of participant ID ranges handed to the mapper per shard; each range is read (and can be
+# retried) independently.
+_RANGES_PER_SHARD = 20
+# Number of rows fetched from a cursor at a time.
+_BATCH_SIZE = 1000
+
+# The queries run for each participant ID range, and the functions that map their rows.
+_QUERIES = [(get_participant_sql, map_participants),
+            (get_hpo_id_sql, map_hpo_ids),
+            (get_answer_sql, map_answers)]
+
+
+class ParticipantIdRangeInputReader(input_readers.InputReader):
+  """Yields (first participant ID, last participant ID) ranges, inclusive, for the mapper."""
+  RANGES_PARAM = 'participant_id_ranges'
+
+  def __init__(self, participant_id_ranges):
+    super(ParticipantIdRangeInputReader, self).__init__()
+    self._participant_id_ranges = [tuple(id_range) for id_range in participant_id_ranges]
+
+  def next(self):
+    if not self._participant_id_ranges:
+      raise StopIteration()
+    return self._participant_id_ranges.pop(0)
+
+  @classmethod
+  def from_json(cls, input_shard_state):
+    return cls(input_shard_state[cls.RANGES_PARAM])
+
+  def to_json(self):
+    return {self.RANGES_PARAM: [list(id_range) for id_range in self._participant_id_ranges]}
+
+  @classmethod
+  def validate(cls, mapper_spec):
+    if mapper_spec.input_reader_class() != cls:
+      raise errors.BadReaderParamsError('Input reader class mismatch')
+
+  @classmethod
+  def split_input(cls, mapper_spec):
+    """Returns a reader for each shard, each with a contiguous part of the participant IDs."""
+    num_shards = mapper_spec.shard_count
+    id_ranges = split_participant_id_range(ParticipantDao().get_id_range(),
+                                           num_shards * _RANGES_PER_SHARD)
+    shard_size = (len(id_ranges) + num_shards - 1) // num_shards
+    readers = [cls(id_ranges[i:i + shard_size]) for i in xrange(0, len(id_ranges), shard_size)]
+    return readers or [cls([])]
+
+  def __str__(self):
+    if not self._participant_id_ranges:
+      return 'ParticipantIdRangeInputReader(empty)'
+    return 'ParticipantIdRangeInputReader(%d-%d)' % (self._participant_id_ranges[0][0],
+                                                     self._participant_id_ranges[-1][1])
+
+
+def split_participant_id_range(id_range, num_ranges):
+  """Divides (lowest ID, highest ID) into up to num_ranges contiguous, inclusive ranges."""
+  first_id, last_id = id_range
+  if first_id is None:
+    return []
+  num_ids = last_id - first_id + 1
+  num_ranges = min(num_ranges, num_ids)
+  bounds = [first_id + num_ids * i // num_ranges for i in xrange(num_ranges + 1)]
+  return [(bounds[i], bounds[i + 1] - 1) for i in xrange(num_ranges)]
+
+
+def map_participant_id_range_to_participant_and_date_metric(participant_id_range):
+  """Takes a (first participant ID, last participant ID) range. Emits (participantId, date|metric)
+  tuples for the participants in it, as map_csv_to_participant_and_date_metric does for exported
+  CSVs.
+  """
+  # Set for incremental runs, which only read participants whose data changed since then (or
+  # who moved into a new age range up to the time of this export, until.)
+  mapper_params = context.get().mapreduce_spec.mapper.params
+  since = mapper_params.get('since')
+  for get_sql, map_rows in _QUERIES:
+    sql, params = get_sql(None, None, since, participant_id_range,
+                          until=mapper_params.get('until'))
+    for result in map_rows(_read_rows(sql, params)):
+      yield result
+
+
+def _read_rows(sql, params):
+  """Generates the rows for a query, with values converted to strings as they would appear in the
+  exported CSVs."""
+  with database_factory.make_server_cursor_database().session() as session:
+    cursor = session.execute(text(sql), params=params)
+    try:
+      rows = cursor.fetchmany(_BATCH_SIZE)
+      while rows:
+        for row in rows:
+          yield [_to_csv_value(value) for value in row]
+        rows = cursor.fetchmany(_BATCH_SIZE)
+    finally:
+      cursor.close()
+
+
+def _to_csv_value(value):
+  if value is None:
+    return ''
+  if isinstance(value, unicode):
+    return value.encode('utf-8')
+  return str(value)
@@ -2,18 +2,24 @@ from google.appengine.ext import deferred
 
 import clock
 import config
+import logging
+import pipeline
+
+from datetime import timedelta
+from dateutil.relativedelta import relativedelta
 
 from offline.sql_exporter import SqlExporter
 from dao.code_dao import CodeDao
 from dao.hpo_dao import HPODao
 from dao.database_utils import replace_isodate, get_sql_and_params_for_array
+from dao.metrics_dao import MetricsVersionDao, MetricsExportRunDao
 from model.base import get_column_name
 from model.participant_summary import ParticipantSummary
 from code_constants import PPI_SYSTEM, UNMAPPED, RACE_QUESTION_CODE, EHR_CONSENT_QUESTION_CODE
 from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES
 from offline.metrics_config import ANSWER_FIELD_TO_QUESTION_CODE
 from offline.metrics_pipeline import MetricsPipeline
-from participant_enums import TEST_HPO_NAME, TEST_EMAIL_PATTERN
+from participant_enums import AGE_BUCKET_LOWER_BOUNDS, TEST_HPO_NAME, TEST_EMAIL_PATTERN
 
 # TODO: filter out participants that have withdrawn in here
 
@@ -21,44 +27,66 @@ _PARTICIPANTS_CSV = 'participants_%d.csv'
 _HPO_IDS_CSV = 'hpo_ids_%d.csv'
 _ANSWERS_CSV = 'answers_%d.csv'
 _ALL_CSVS = [_PARTICIPANTS_CSV, _HPO_IDS_CSV, _ANSWERS_CSV]
+# The MetricsExport methods that export each type of CSV.
+_EXPORT_METHODNAMES = {_PARTICIPANTS_CSV: '_export_participants',
+                       _HPO_IDS_CSV: '_export_hpo_ids',
+                       _ANSWERS_CSV: '_export_answers'}
+# Number of shards exported at once, unless overridden with the metrics_export_concurrency config
+# setting.
+_DEFAULT_EXPORT_CONCURRENCY = 4
 
 _QUEUE_NAME = 'metrics-pipeline'
 
+# The first dates of orders, samples and physical measurements are each aggregated in a derived
+# table over the shard, and joined to participants once, rather than looked up with a subquery per
+# participant.
 _PARTICIPANT_SQL_TEMPLATE = """
 SELECT p.participant_id, ps.date_of_birth date_of_birth,
-  (SELECT ISODATE[MIN(bo.created)] FROM biobank_order bo
-    WHERE bo.participant_id = p.participant_id) first_order_date,
-  (SELECT ISODATE[MIN(bs.confirmed)] FROM biobank_stored_sample bs
-    WHERE bs.biobank_id = p.biobank_id) first_samples_arrived_date,
-  (SELECT ISODATE[MIN(pm.created)] FROM physical_measurements pm
-    WHERE pm.participant_id = p.participant_id) first_physical_measurements_date,
-  (SELECT ISODATE[MIN(bss.confirmed)] FROM biobank_stored_sample bss
-    WHERE bss.biobank_id = p.biobank_id
-      AND bss.test IN {}) first_samples_to_isolate_dna_date, {}
-  FROM participant p, participant_summary ps
- WHERE p.participant_id = ps.participant_id
-   AND p.participant_id % :num_shards = :shard_number
+  ISODATE[bo.first_order_date] first_order_date,
+  ISODATE[bs.first_samples_arrived_date] first_samples_arrived_date,
+  ISODATE[pm.first_physical_measurements_date] first_physical_measurements_date,
+  ISODATE[bs.first_samples_to_isolate_dna_date] first_samples_to_isolate_dna_date,
+  {modules_sql}
+  FROM participant p
+  JOIN participant_summary ps ON ps.participant_id = p.participant_id
+  LEFT OUTER JOIN
+    (SELECT bo.participant_id, MIN(bo.created) first_order_date
+       FROM biobank_order bo
+      WHERE {order_shard_sql}
+      GROUP BY bo.participant_id) bo ON bo.participant_id = p.participant_id
+  LEFT OUTER JOIN
+    (SELECT bs_p.participant_id, MIN(bs.confirmed) first_samples_arrived_date,
+            MIN(CASE WHEN bs.test IN {dna_tests_sql} THEN bs.confirmed END)
+              first_samples_to_isolate_dna_date
+       FROM biobank_stored_sample bs
+       JOIN participant bs_p ON bs_p.biobank_id = bs.biobank_id
+      WHERE {sample_shard_sql}
+      GROUP BY bs_p.participant_id) bs ON bs.participant_id = p.participant_id
+  LEFT OUTER JOIN
+    (SELECT pm.participant_id, MIN(pm.created) first_physical_measurements_date
+       FROM physical_measurements pm
+      WHERE {measurements_shard_sql}
+      GROUP BY pm.participant_id) pm ON pm.participant_id = p.participant_id
+ WHERE {participant_shard_sql}
    AND p.hpo_id != :test_hpo_id
-   AND NOT ps.email LIKE :test_email_pattern
+   AND NOT ps.email LIKE :test_email_pattern {changed_sql}
 """
 
-# Find HPO ID changes in participant history.
+# Find HPO ID changes in participant history: versions with no previous version, or whose
+# previous version had a different HPO ID.
 _HPO_ID_QUERY = """
 SELECT ph.participant_id participant_id, hpo.name hpo,
        ISODATE[ph.last_modified] last_modified
-  FROM participant_history ph, hpo
- WHERE ph.participant_id % :num_shards = :shard_number
-   AND ph.hpo_id = hpo.hpo_id
+  FROM participant_history ph
+  JOIN hpo ON hpo.hpo_id = ph.hpo_id
+  LEFT OUTER JOIN participant_history ph_prev
+    ON ph_prev.participant_id = ph.participant_id
+   AND ph_prev.version = ph.version - 1
+  LEFT OUTER JOIN participant_summary ps ON ps.participant_id = ph.participant_id
+ WHERE {shard_sql}
    AND NOT ph.hpo_id = :test_hpo_id
-   AND NOT EXISTS
-    (SELECT * FROM participant_history ph_prev
-      WHERE ph_prev.participant_id = ph.participant_id
-        AND ph_prev.version = ph.version - 1
-        AND ph_prev.hpo_id = ph.hpo_id)
-   AND NOT EXISTS
-    (SELECT * FROM participant_summary ps
-      WHERE ps.participant_id = ph.participant_id
-        AND ps.email LIKE :test_email_pattern)
+   AND (ph_prev.participant_id IS NULL OR ph_prev.hpo_id != ph.hpo_id)
+   AND (ps.participant_id IS NULL OR NOT ps.email LIKE :test_email_pattern) {changed_sql}
 """
 
 _ANSWER_QUERY = """
@@ -73,37 +101,117 @@ SELECT qr.participant_id participant_id, ISODATE[qr.created] start_time,
    AND qra.question_id = qq.questionnaire_question_id
    AND qq.code_id = qc.code_id
    AND qq.code_id in ({})
-   AND qr.participant_id % :num_shards = :shard_number
+   AND {}
    AND qr.participant_id = p.participant_id
    AND p.hpo_id != :test_hpo_id
    AND NOT EXISTS
     (SELECT * FROM participant_summary ps
       WHERE ps.participant_id = p.participant_id
-        AND ps.email LIKE :test_email_pattern)
+        AND ps.email LIKE :test_email_pattern) {}
  ORDER BY qr.participant_id, qr.created, qc.value
 """
 
-def _get_params(num_shards, shard_number):
+# For incremental exports, restricts output to participants with data created or modified since
+# the last export, or who moved into a new age range since then (see _get_age_range_sql). Other
+# changes to data stored only in participant_summary (like date of birth) are not detected here.
+_CHANGED_PARTICIPANTS_FILTER = """
+   AND {participant_id_column} IN
+    (SELECT changed_ph.participant_id FROM participant_history changed_ph
+      WHERE changed_ph.last_modified > :since
+     UNION
+     SELECT changed_qr.participant_id FROM questionnaire_response changed_qr
+      WHERE changed_qr.created > :since
+     UNION
+     SELECT changed_bo.participant_id FROM biobank_order changed_bo
+      WHERE changed_bo.created > :since
+     UNION
+     SELECT changed_pm.participant_id FROM physical_measurements changed_pm
+      WHERE changed_pm.created > :since
+     UNION
+     SELECT changed_p.participant_id FROM participant changed_p, biobank_stored_sample changed_bs
+      WHERE changed_p.biobank_id = changed_bs.biobank_id
+        AND (changed_bs.confirmed > :since OR changed_bs.created > :since)
+     UNION
+     SELECT changed_ps.participant_id FROM participant_summary changed_ps
+      WHERE {age_range_sql})
+"""
+
+# The age range lower bounds (other than 0) that participants can reach after they're created.
+_AGE_RANGE_BOUNDS = AGE_BUCKET_LOWER_BOUNDS[1:]
+
+def _get_params(num_shards, shard_number, since=None, participant_id_range=None, until=None):
   test_hpo = HPODao().get_by_name(TEST_HPO_NAME)
-  return {'num_shards': num_shards,
-          'shard_number': shard_number,
-          'test_hpo_id': test_hpo.hpoId,
-          'test_email_pattern': TEST_EMAIL_PATTERN}
+  params = {'test_hpo_id': test_hpo.hpoId,
+            'test_email_pattern': TEST_EMAIL_PATTERN}
+  if participant_id_range:
+    params['start_participant_id'], params['end_participant_id'] = participant_id_range
+  else:
+    params['num_shards'] = num_shards
+    params['shard_number'] = shard_number
+  if since:
+    params['since'] = since
+    params.update(_get_age_range_params(since, until or clock.CLOCK.now()))
+  return params
+
+def _get_age_range_sql():
+  """Matches participants who turned one of the _AGE_RANGE_BOUNDS ages after the day of the last
+  export (since) and up to the day of this one (until.) Their age range metrics change then
+  without any of their data changing, and the days copied from the last version's buckets don't
+  reflect that.
+
+  The date of birth ranges include an extra day at the end, for people born on February 29th;
+  matching participants whose age range didn't change only costs exporting them.
+  """
+  return ' OR '.join('changed_ps.date_of_birth BETWEEN :dob_start_{0} AND :dob_end_{0}'.format(i)
+                     for i in xrange(len(_AGE_RANGE_BOUNDS)))
+
+def _get_age_range_params(since, until):
+  params = {}
+  for i, age in enumerate(_AGE_RANGE_BOUNDS):
+    params['dob_start_%d' % i] = since.date() - relativedelta(years=age)
+    params['dob_end_%d' % i] = until.date() - relativedelta(years=age) + timedelta(days=1)
+  return params
+
+def _get_shard_filter(participant_id_column, participant_id_range=None):
+  """Restricts output to a shard of participants: those whose IDs are in participant_id_range
+  (inclusive) if set, or otherwise those whose IDs are shard_number modulo num_shards."""
+  if participant_id_range:
+    return '{} BETWEEN :start_participant_id AND :end_participant_id'.format(participant_id_column)
+  return '{} % :num_shards = :shard_number'.format(participant_id_column)
 
-def _get_participant_sql(num_shards, shard_number):
+def _get_changed_participants_filter(participant_id_column, since):
+  if not since:
+    return ''
+  return _CHANGED_PARTICIPANTS_FILTER.format(participant_id_column=participant_id_column,
+                                             age_range_sql=_get_age_range_sql())
+
+def get_participant_sql(num_shards, shard_number, since=None, participant_id_range=None,
+                        until=None):
   module_time_fields = ['ISODATE[ps.{0}] {0}'.format(get_column_name(ParticipantSummary,
                                                             field_name + 'Time'))
                         for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES]
   modules_sql = ', '.join(module_time_fields)
   dna_tests_sql, params = get_sql_and_params_for_array(
         config.getSettingList(config.DNA_SAMPLE_TEST_CODES), 'dna')
-  params.update(_get_params(num_shards, shard_number))
-  return replace_isodate(_PARTICIPANT_SQL_TEMPLATE.format(dna_tests_sql, modules_sql)), params
+  params.update(_get_params(num_shards, shard_number, since, participant_id_range, until))
+  sql = _PARTICIPANT_SQL_TEMPLATE.format(
+      modules_sql=modules_sql,
+      dna_tests_sql=dna_tests_sql,
+      order_shard_sql=_get_shard_filter('bo.participant_id', participant_id_range),
+      sample_shard_sql=_get_shard_filter('bs_p.participant_id', participant_id_range),
+      measurements_shard_sql=_get_shard_filter('pm.participant_id', participant_id_range),
+      participant_shard_sql=_get_shard_filter('p.participant_id', participant_id_range),
+      changed_sql=_get_changed_participants_filter('p.participant_id', since))
+  return replace_isodate(sql), params
 
-def _get_hpo_id_sql(num_shards, shard_number):
-  return replace_isodate(_HPO_ID_QUERY), _get_params(num_shards, shard_number)
+def get_hpo_id_sql(num_shards, shard_number, since=None, participant_id_range=None, until=None):
+  sql = _HPO_ID_QUERY.format(
+      shard_sql=_get_shard_filter('ph.participant_id', participant_id_range),
+      changed_sql=_get_changed_participants_filter('ph.participant_id', since))
+  return (replace_isodate(sql),
+          _get_params(num_shards, shard_number, since, participant_id_range, until))
 
-def _get_answer_sql(num_shards, shard_number):
+def get_answer_sql(num_shards, shard_number, since=None, participant_id_range=None, until=None):
   code_dao = CodeDao()
   code_ids = []
   question_codes = list(ANSWER_FIELD_TO_QUESTION_CODE.values())
@@ -112,85 +220,160 @@ def _get_answer_sql(num_shards, shard_number):
   for code_value in question_codes:
     code = code_dao.get_code(PPI_SYSTEM, code_value)
     code_ids.append(str(code.codeId))
-  params = _get_params(num_shards, shard_number)
+  params = _get_params(num_shards, shard_number, since, participant_id_range, until)
   params['unmapped'] = UNMAPPED
-  return replace_isodate(_ANSWER_QUERY.format((','.join(code_ids)))), params
+  shard_sql = _get_shard_filter('qr.participant_id', participant_id_range)
+  changed_sql = _get_changed_participants_filter('qr.participant_id', since)
+  return (replace_isodate(_ANSWER_QUERY.format(','.join(code_ids), shard_sql, changed_sql)),
+          params)
+
+def _make_exporter(bucket_name):
+  """Returns a SqlExporter for metrics CSVs, which are gzip-compressed if metrics_export_gzip is
+  set (the pipeline reads either.)"""
+  return SqlExporter(bucket_name, compress=config.getSetting(config.METRICS_EXPORT_GZIP, False))
 
 class MetricsExport(object):
   """Exports data from the database needed to generate metrics.
 
-  Exports are performed in a chain of tasks, each of which can run for up to 10 minutes.
-  A configurable number of shards allows each data set being exported to be broken up into pieces
-  that can complete in time; sharded output also makes MapReduce on the result run faster.
+  Exports are performed in tasks, each of which exports one shard of one data set, and can run
+  for up to 10 minutes. A configurable number of shards allows each data set being exported to be
+  broken up into pieces that can complete in time; sharded output also makes MapReduce on the
+  result run faster. The shards are divided among a number of chains of tasks that run in
+  parallel (set by the metrics_export_concurrency config setting, to limit the load on the
+  database.) Each export is recorded in a MetricsExportRun, with a row for each of its shards
+  that is marked complete when the shard's file has been written.
+
+  Incremental exports only include participants whose data changed since the export for the
+  currently serving metrics version; the pipeline then updates that version's buckets rather than
+  recalculating them all. export_params is passed along the chain of tasks, holding the time the
+  export started (export_time) and, for incremental exports, the base version's ID and export
+  time (base_version_id and since).
 
-  When the last task is done, the MapReduce pipeline for metrics is kicked off.
+  When the last shard is complete, the MapReduce pipeline for metrics is kicked off; its
+  idempotence key (derived from the export run) ensures that this happens only once, even if
+  tasks are retried.
+
+  If the metrics_read_from_database config setting is true, no CSVs are exported: the pipeline is
+  started right away, and its first MapReduce reads the same rows straight from the database,
+  sharded by participant ID range (see metrics_db_input.py).
   """
 
   @classmethod
-  def _export_participants(self, bucket_name, filename_prefix, num_shards, shard_number):
-    sql, params = _get_participant_sql(num_shards, shard_number)
-    SqlExporter(bucket_name).run_export(filename_prefix + _PARTICIPANTS_CSV % shard_number,
-                                        sql, params)
+  def _export_participants(self, bucket_name, filename_prefix, num_shards, shard_number,
+                           export_params):
+    sql, params = get_participant_sql(num_shards, shard_number, export_params.get('since'),
+                                      until=export_params.get('export_time'))
+    _make_exporter(bucket_name).run_export(filename_prefix + _PARTICIPANTS_CSV % shard_number,
+                                           sql, params)
 
   @classmethod
-  def _export_hpo_ids(self, bucket_name, filename_prefix, num_shards, shard_number):
-    sql, params = _get_hpo_id_sql(num_shards, shard_number)
-    SqlExporter(bucket_name).run_export(filename_prefix + _HPO_IDS_CSV % shard_number,
-                                        sql, params)
+  def _export_hpo_ids(self, bucket_name, filename_prefix, num_shards, shard_number,
+                      export_params):
+    sql, params = get_hpo_id_sql(num_shards, shard_number, export_params.get('since'),
+                                 until=export_params.get('export_time'))
+    _make_exporter(bucket_name).run_export(filename_prefix + _HPO_IDS_CSV % shard_number,
+                                           sql, params)
 
   @classmethod
-  def _export_answers(self, bucket_name, filename_prefix, num_shards, shard_number):
-    sql, params = _get_answer_sql(num_shards, shard_number)
-    SqlExporter(bucket_name).run_export(filename_prefix + _ANSWERS_CSV % shard_number,
-                                        sql, params)
+  def _export_answers(self, bucket_name, filename_prefix, num_shards, shard_number,
+                      export_params):
+    sql, params = get_answer_sql(num_shards, shard_number, export_params.get('since'),
+                                 until=export_params.get('export_time'))
+    _make_exporter(bucket_name).run_export(filename_prefix + _ANSWERS_CSV % shard_number,
+                                           sql, params)
 
   @staticmethod
-  def start_export_tasks(bucket_name, num_shards):
-    """Entry point to exporting data for use by the metrics pipeline. Begins the export of
-    the first shard of the participant data."""
-    filename_prefix = '%s/' % clock.CLOCK.now().isoformat()
-    deferred.defer(MetricsExport._start_participant_export, bucket_name, filename_prefix,
-                    num_shards, 0)
+  def start_export_tasks(bucket_name, num_shards, incremental=False):
+    """Entry point to exporting data for use by the metrics pipeline. Starts the chains of tasks
+    that export the shards of the data.
 
-  @staticmethod
-  def _start_export(bucket_name, filename_prefix, num_shards, shard_number, export_methodname,
-                    next_shard_methodname, next_type_methodname, finish_methodname=None):
-    getattr(MetricsExport, export_methodname)(bucket_name, filename_prefix,
-                                              num_shards, shard_number)
-    shard_number += 1
-    if shard_number == num_shards:
-      if next_type_methodname:
-        deferred.defer(getattr(MetricsExport, next_type_methodname), bucket_name, filename_prefix,
-                        num_shards, 0)
+    If incremental is set and there is a serving metrics version with a known export time, only
+    participants whose data changed since then are exported; otherwise everything is.
+    """
+    now = clock.CLOCK.now()
+    filename_prefix = '%s/' % now.isoformat()
+    export_params = {'export_time': now}
+    if incremental:
+      base_version = MetricsVersionDao().get_serving_version()
+      if base_version and base_version.exportedThrough:
+        logging.info('Exporting participants changed since %s for metrics version %d.',
+                     base_version.exportedThrough, base_version.metricsVersionId)
+        export_params['since'] = base_version.exportedThrough
+        export_params['base_version_id'] = base_version.metricsVersionId
       else:
-        getattr(MetricsExport, finish_methodname)(bucket_name, filename_prefix, num_shards)
-    else:
-      deferred.defer(getattr(MetricsExport, next_shard_methodname), bucket_name, filename_prefix,
-                      num_shards, shard_number)
-
+        logging.info('No metrics version to update incrementally; exporting all participants.')
+    if config.getSetting(config.METRICS_READ_FROM_DATABASE, False):
+      logging.info('Skipping export; the metrics pipeline will read from the database.')
+      export_params['read_from_database'] = True
+      MetricsExport._start_metrics_pipeline(bucket_name, filename_prefix, num_shards,
+                                            export_params)
+      return
+    shards = [(csv_filename, shard_number) for csv_filename in _ALL_CSVS
+              for shard_number in range(0, num_shards)]
+    export_params['metrics_export_run_id'] = MetricsExportRunDao().insert_run(
+        now, [filename_prefix + csv_filename % shard_number
+              for csv_filename, shard_number in shards])
+    # At least one chain is needed for the export to finish.
+    concurrency = max(1, min(len(shards), int(config.getSetting(config.METRICS_EXPORT_CONCURRENCY,
+                                                                _DEFAULT_EXPORT_CONCURRENCY))))
+    # Each task chain exports every concurrency-th shard, one at a time.
+    for i in range(0, concurrency):
+      deferred.defer(MetricsExport._export_shards, bucket_name, filename_prefix, num_shards,
+                     shards[i::concurrency], export_params)
 
   @classmethod
-  def _start_participant_export(cls, bucket_name, filename_prefix, num_shards, shard_number):
-    MetricsExport._start_export(bucket_name, filename_prefix, num_shards, shard_number,
-                                '_export_participants', '_start_participant_export',
-                                '_start_hpo_id_export')
+  def _export_shards(cls, bucket_name, filename_prefix, num_shards, shards, export_params):
+    """Exports the first of shards (a list of (CSV filename, shard number) pairs), and defers a
+    task to export the rest. After the last one, starts the metrics pipeline if every other shard
+    of the export is complete too.
+
+    Exporting a shard overwrites any file left by an earlier attempt, so tasks can be retried.
+    """
+    csv_filename, shard_number = shards[0]
+    getattr(MetricsExport, _EXPORT_METHODNAMES[csv_filename])(bucket_name, filename_prefix,
+                                                              num_shards, shard_number,
+                                                              export_params)
+    MetricsExportRunDao().set_shard_complete(export_params['metrics_export_run_id'],
+                                             filename_prefix + csv_filename % shard_number)
+    if len(shards) > 1:
+      deferred.defer(MetricsExport._export_shards, bucket_name, filename_prefix, num_shards,
+                     shards[1:], export_params)
+    else:
+      MetricsExport._finish_export(bucket_name, filename_prefix, num_shards, export_params)
 
   @classmethod
-  def _start_hpo_id_export(cls, bucket_name, filename_prefix, num_shards, shard_number):
-    MetricsExport._start_export(bucket_name, filename_prefix, num_shards, shard_number,
-                                '_export_hpo_ids', '_start_hpo_id_export',
-                                '_start_answers_export')
-  @classmethod
-  def _start_answers_export(cls, bucket_name, filename_prefix, num_shards, shard_number):
-    MetricsExport._start_export(bucket_name, filename_prefix, num_shards, shard_number,
-                                '_export_answers', '_start_answers_export', None,
-                                '_start_metrics_pipeline')
+  def _finish_export(cls, bucket_name, filename_prefix, num_shards, export_params):
+    metrics_export_run_id = export_params['metrics_export_run_id']
+    # The claim is committed before the pipeline is started; if starting it fails, the retried
+    # task claims the run again, and the idempotence key keeps it from being started twice.
+    if MetricsExportRunDao().claim_pipeline_start(metrics_export_run_id):
+      MetricsExport._start_metrics_pipeline(
+          bucket_name, filename_prefix, num_shards, export_params,
+          idempotence_key=_get_pipeline_idempotence_key(export_params))
+    else:
+      logging.info('Metrics export %d still in progress.', metrics_export_run_id)
 
   @classmethod
-  def _start_metrics_pipeline(cls, bucket_name, filename_prefix, num_shards):
+  def _start_metrics_pipeline(cls, bucket_name, filename_prefix, num_shards, export_params=None,
+                              idempotence_key=''):
+    export_params = export_params or {}
     input_files = []
-    for csv_filename in _ALL_CSVS:
-      input_files.extend([filename_prefix + csv_filename % shard for shard
-                          in range(0, num_shards)])
-    pipeline = MetricsPipeline(bucket_name, clock.CLOCK.now(), input_files)
-    pipeline.start(queue_name=_QUEUE_NAME)
+    read_from_database = export_params.get('read_from_database', False)
+    if not read_from_database:
+      for csv_filename in _ALL_CSVS:
+        input_files.extend([filename_prefix + csv_filename % shard for shard
+                            in range(0, num_shards)])
+    metrics_pipeline = MetricsPipeline(bucket_name, clock.CLOCK.now(), input_files,
+                                       exported_through=export_params.get('export_time'),
+                                       base_version_id=export_params.get('base_version_id'),
+                                       read_from_database=read_from_database)
+    try:
+      metrics_pipeline.start(idempotence_key=idempotence_key, queue_name=_QUEUE_NAME)
+    except pipeline.PipelineExistsError:
+      logging.info('Metrics pipeline %s was already started.', idempotence_key)
+
+def _get_pipeline_idempotence_key(export_params):
+  """Returns the pipeline ID for an export run. The export time is included, since run IDs can be
+  reused if the database is recreated."""
+  return 'metrics-export-%d-%s' % (export_params['metrics_export_run_id'],
+                                   export_params['export_time'].strftime('%Y%m%d%H%M%S'))
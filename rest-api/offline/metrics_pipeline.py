@@ -3,7 +3,9 @@
 This pipeline consists of three MapReduces chained together.
 
 The first MR reads in three sets of CSV files sharded by participant ID,
-generated by our metrics export code:
+generated by our metrics export code (or, when the metrics_read_from_database config setting is
+true, the same rows read straight from the database by participant ID range; see
+metrics_db_input.py):
 
 participants_<shard>.csv = ['date_of_birth', 'first_order_date', 'first_samples_arrived_date',
                             'first_physical_measurements_date',
@@ -46,21 +48,67 @@ is created at the beginning of each run.  At the end of the run its 'completed'
 property is set to true.  For every MetricsBucket that is created by this
 pipeline, its parent is set to the current MetricsVersion.
 
+When the metrics_fused_stages config setting is true, full runs replace the second and third MRs
+with a single MR keyed by HPO: its reducer calculates the counts for every metric for an HPO and
+assembles them into buckets in memory, so the counts are never written to or read from GCS. The
+cross-HPO buckets are then computed by summing the HPO buckets for each date (SumCrossHpoBuckets,
+which starts a child pipeline for each range of dates), rather than by emitting every count twice.
+Incremental runs always use three MRs.
+
+When the metrics_bucket_keyframe_days config setting is also set, full runs with fused stages
+store each HPO's metrics (and the cross-HPO metrics) as a MetricsKeyframe for the first date and
+every metrics_bucket_keyframe_days days after that, with each bucket holding only the metrics
+that differ from the latest keyframe. Consecutive buckets rarely differ by more than a few
+metrics, so this is much smaller than writing every bucket in full. MetricsBucketDao reconstructs
+the full buckets when they are read. Incremental runs copy the keyframes along with the buckets,
+and write any buckets they change as differences from the same keyframes.
+
+The records passed between (and shuffled within) the MRs are encoded by a codec from
+metrics_codec.py; the default text codec produces the pipe-delimited strings shown above, while
+the binary codec (selected with the metrics_codec config setting) produces compact
+dictionary-encoded records, reducing shuffle and GCS I/O. The codec is fixed in the parameters
+for each run.
+
+Cubes
+
+The first MR also counts each participant in a cell of every configured cube (see get_cubes in
+metrics_config.py), which holds the participant's values on today's date for the cube's
+dimensions. It emits hpoId|C|cube:value,value...|date|1 records, dated today, which are summed by
+the second MR like any other deltas. The third MR (or the fused MR) writes them to a MetricsCube
+for each HPO and cube, rather than to buckets. Incremental runs copy the base version's cubes,
+and emit -1 records for each changed participant's old cells; the summed changes are then added
+to the base version's cubes.
+
 The metrics to be collected are specified in the METRICS_CONFIGS dict.  In
 addition to the fields specified there, for every entity, a synthetic 'total'
 metric is generated.  This is to record the total number of entities over time.
 
+Incremental runs
+
+In incremental mode, MetricsExport only exports participants whose data changed after the
+high-water mark (exportedThrough) of the currently serving MetricsVersion (the "base" version), or
+whose age range changed after it.
+The buckets of the base version are first copied into the new version. The first MR then emits
+each changed participant's deltas computed from all of their current data, together with negated
+deltas computed from only the data that was present as of the high-water mark; the second MR sums
+these into net count changes per HPO, metric and date; and the third MR adds those changes to the
+base version's buckets and writes the results into the new version. Data which is timestamped
+before the high-water mark but was written after it (e.g. samples which Biobank confirmed before
+the last run but uploaded after it) is not accounted for, so full runs should still be scheduled
+periodically to correct for any drift.
+
 """
 
 import collections
-import copy
+import itertools
 import json
 import logging
 import pipeline
 
 import config
-import csv
+import offline.metrics_codec
 import offline.metrics_config
+import offline.metrics_counts
 import offline.sql_exporter
 
 from cloudstorage import cloudstorage_api
@@ -74,17 +122,21 @@ from dateutil.relativedelta import relativedelta
 from census_regions import census_regions
 from code_constants import UNSET, RACE_QUESTION_CODE, PPI_SYSTEM, EHR_CONSENT_QUESTION_CODE
 from code_constants import CONSENT_PERMISSION_YES_CODE
-from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from dao.metrics_dao import MetricsBucketDao, MetricsKeyframeDao, MetricsVersionDao
+from dao.metrics_dao import MetricsCachedResponseDao, MetricsRollupDao, MetricsCubeDao
+from dao.metrics_dao import encode_bucket, encode_buckets, encode_cube, decode_cube
 from field_mappings import QUESTION_CODE_TO_FIELD, FieldType, QUESTIONNAIRE_MODULE_FIELD_NAMES
 from field_mappings import CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
-from model.metrics import MetricsBucket
+from model.metrics import MetricsKeyframe, MetricsCube
+from offline.metrics_codec import ROW, METRIC_KEY, DATE_DELTA, HPO_DATE_KEY, METRIC_COUNT
+from offline.metrics_codec import HPO_KEY, METRIC_DATE_DELTA
 from mapreduce.lib.input_reader._gcs import GCSInputReader
 from offline.base_pipeline import BasePipeline
 from metrics_config import BIOSPECIMEN_METRIC, BIOSPECIMEN_SAMPLES_METRIC, HPO_ID_METRIC
 from metrics_config import PHYSICAL_MEASUREMENTS_METRIC, AGE_RANGE_METRIC, CENSUS_REGION_METRIC
 from metrics_config import SPECIMEN_COLLECTED_VALUE, RACE_METRIC, ENROLLMENT_STATUS_METRIC
 from metrics_config import SAMPLES_ARRIVED_VALUE, SUBMITTED_VALUE, PARTICIPANT_KIND
-from metrics_config import HPO_ID_FIELDS, ANSWER_FIELDS, get_participant_fields, get_fieldnames
+from metrics_config import HPO_ID_FIELDS, ANSWER_FIELDS, get_participant_fields
 from metrics_config import transform_participant_summary_field, SAMPLES_TO_ISOLATE_DNA_METRIC
 from metrics_config import FULL_PARTICIPANT_KIND, EHR_CONSENT_ANSWER_METRIC
 from participant_enums import get_bucketed_age, get_race, PhysicalMeasurementsStatus, SampleStatus
@@ -99,17 +151,91 @@ DATE_OF_BIRTH_PREFIX = "DOB"
 
 TOTAL_SENTINEL = '__total_sentinel__'
 _NUM_SHARDS = '_NUM_SHARDS'
+# Parameters for incremental runs; see module comments.
+_SINCE = 'since'
+_UNTIL = 'until'
+_BASE_VERSION_ID = 'base_version_id'
+_BASE_LAST_DATE = 'base_last_date'
+# If true (and NumPy is available), daily counts are computed with NumPy.
+_USE_NUMPY = 'use_numpy'
+# Number of metrics buckets each reducer shard buffers before writing them in one statement.
+_BUCKET_BATCH_SIZE = 100
+_BUCKET_POOL = 'metrics_bucket_pool'
+# If true, full runs calculate counts and write buckets in a single MapReduce keyed by HPO.
+_FUSED_STAGES = 'fused_stages'
+# If set, fused stages write buckets as differences from keyframes written every this many days.
+_KEYFRAME_DAYS = 'keyframe_days'
+# Number of days of buckets read at a time when summing them into cross-HPO buckets.
+_CROSS_HPO_DAYS_PER_QUERY = 30
+# Number of days of cross-HPO buckets summed by each child pipeline of SumCrossHpoBuckets, rounded
+# up to a multiple of keyframe_days (if set) so that every range starts with a keyframe.
+_CROSS_HPO_DAYS_PER_SHARD = 360
+# If true, the first MR reads its input from the database rather than from exported CSVs.
+_READ_FROM_DATABASE = 'read_from_database'
+# Dict of cube name -> list of dimensions for the cubes to write; see module comments.
+_CUBES = 'cubes'
 
 # Participant type constants
 _REGISTERED_PARTICIPANT = 'R'
 _FULL_PARTICIPANT = 'F'
+# Used in place of a participant type for counts of cube cells.
+_CUBE = 'C'
 
 def default_params():
   """These can be used in a snapshot to ensure they stay the same across
   all instances of a MapReduce pipeline, even if datastore changes"""
-  return {
-        _NUM_SHARDS: int(config.getSetting(config.METRICS_SHARDS, 1))
+  params = {
+        _NUM_SHARDS: int(config.getSetting(config.METRICS_SHARDS, 1)),
+        _USE_NUMPY: bool(config.getSetting(config.METRICS_USE_NUMPY, True)),
+        _FUSED_STAGES: bool(config.getSetting(config.METRICS_FUSED_STAGES, False)),
+        _KEYFRAME_DAYS: int(config.getSetting(config.METRICS_BUCKET_KEYFRAME_DAYS, 0)),
+        _CUBES: offline.metrics_config.get_cubes()
     }
+  codec_name = config.getSetting(config.METRICS_CODEC, offline.metrics_codec.TEXT_CODEC_NAME)
+  dictionary = None
+  if codec_name == offline.metrics_codec.BINARY_CODEC_NAME:
+    dictionary = _get_codec_dictionary()
+  params.update(offline.metrics_codec.get_codec_params(codec_name, dictionary))
+  return params
+
+def _get_codec_params(params):
+  return {k: v for k, v in params.iteritems()
+          if k in (offline.metrics_codec.CODEC_PARAM, offline.metrics_codec.DICTIONARY_PARAM)}
+
+def _get_codec_dictionary():
+  """Returns the HPO IDs, participant types, and metrics that appear in intermediate records, for
+  dictionary encoding by the binary codec."""
+  strings = [_REGISTERED_PARTICIPANT, _FULL_PARTICIPANT, _CUBE, '*', UNSET, PARTICIPANT_KIND]
+  for field in offline.metrics_config.get_fields():
+    field_name = field['name'][len(PARTICIPANT_KIND) + 1:]
+    for value in field['values']:
+      if field_name == HPO_ID_METRIC:
+        strings.append(value)
+      strings.append(make_metric(field_name, value))
+  # Remove duplicates, keeping the first occurrence.
+  dictionary = []
+  seen = set()
+  for string in strings:
+    if string not in seen:
+      seen.add(string)
+      dictionary.append(string)
+  return dictionary
+
+def _get_codec():
+  """Returns the codec for intermediate records selected for the running MapReduce."""
+  ctx = context.get()
+  if not ctx:
+    # Called outside of App Engine MapReduce (e.g. by local_metrics_pipeline).
+    return offline.metrics_codec.TEXT_CODEC
+  return offline.metrics_codec.get_codec(ctx.mapreduce_spec.mapper.params, ctx.mapreduce_id)
+
+def _use_numpy():
+  if not offline.metrics_counts.numpy_available():
+    return False
+  ctx = context.get()
+  if not ctx:
+    return True
+  return ctx.mapreduce_spec.mapper.params.get(_USE_NUMPY, True)
 
 def get_config():
   return offline.metrics_config.get_config()
@@ -125,24 +251,51 @@ PIPELINE_METRICS_DATA_VERSION = 1
 class BlobKeys(base_handler.PipelineBase):
   """A generator for the mapper params for the second MapReduce pipeline, containing the blob
      keys produced by the first pipeline."""
-  def run(self, bucket_name, keys, now, version_id):
+  def run(self, bucket_name, keys, now, version_id, codec_params=None):
     start_index = len(bucket_name) + 2
-    return {'input_reader': {GCSInputReader.BUCKET_NAME_PARAM: bucket_name,
-                             GCSInputReader.OBJECT_NAMES_PARAM: [k[start_index:] for k in keys]},
-            'now': now,
-            'version_id': version_id}
+    params = {'input_reader': {GCSInputReader.BUCKET_NAME_PARAM: bucket_name,
+                               GCSInputReader.OBJECT_NAMES_PARAM: [k[start_index:] for k in keys]},
+              'now': now,
+              'version_id': version_id}
+    params.update(codec_params or {})
+    return params
 
 class MetricsPipeline(BasePipeline):
   def run(self, *args, **kwargs):  # pylint: disable=unused-argument
     bucket_name = args[0]
     now = args[1]
     input_files = args[2]
+    # The time the export started; new data after this will be picked up by the next
+    # incremental run.
+    exported_through = kwargs.get('exported_through')
+    # If set, only participants that changed since this version's export were exported, and
+    # this version's buckets are updated with their changes.
+    base_version_id = kwargs.get('base_version_id')
     mapper_params = default_params()
-    version_id = MetricsVersionDao().set_pipeline_in_progress()
+    mapper_params[_READ_FROM_DATABASE] = kwargs.get('read_from_database', False)
+    metrics_version_dao = MetricsVersionDao()
+    version_id = metrics_version_dao.set_pipeline_in_progress(exported_through=exported_through)
+    if base_version_id:
+      base_version = metrics_version_dao.get(base_version_id)
+      mapper_params[_SINCE] = base_version.exportedThrough
+      mapper_params[_UNTIL] = exported_through
+      mapper_params[_BASE_VERSION_ID] = base_version_id
+      base_last_date = MetricsBucketDao().copy_buckets(base_version_id, version_id, now.date())
+      mapper_params[_BASE_LAST_DATE] = base_last_date and base_last_date.isoformat()
+      cube_dao = MetricsCubeDao()
+      cube_dao.copy_cubes(base_version_id, version_id)
+      # Changes can only be applied to cubes that are in the base version, with the same
+      # dimensions; cubes added to the config are written by the next full run.
+      base_cube_dimensions = cube_dao.get_cube_dimensions(base_version_id)
+      mapper_params[_CUBES] = {name: dimensions
+                               for name, dimensions in mapper_params[_CUBES].iteritems()
+                               if base_cube_dimensions.get(name) == dimensions}
     future = yield SummaryPipeline(bucket_name, now, input_files, version_id, mapper_params)
+    future = yield RollUpMetrics(future, version_id)
     # Pass future to FinalizeMetrics to ensure it doesn't start running until SummaryPipeline
-    # completes
-    yield FinalizeMetrics(future, bucket_name, input_files)
+    # and RollUpMetrics complete
+    future = yield FinalizeMetrics(future, bucket_name, input_files)
+    yield CacheMetricsResponses(future)
 
   def handle_pipeline_failure(self):
     logging.info("Pipeline failed; setting current metrics version to incomplete.")
@@ -159,6 +312,33 @@ class FinalizeMetrics(pipeline.Pipeline):
       cloudstorage_api.delete('/' + bucket_name + '/' + input_file)
 
 
+class RollUpMetrics(pipeline.Pipeline):
+  def run(self, future, version_id):  # pylint: disable=unused-argument
+    MetricsRollupDao().write_rollups(version_id)
+
+
+class CacheMetricsResponses(pipeline.Pipeline):
+  def run(self, future):  # pylint: disable=unused-argument
+    if config.getSetting(config.METRICS_CACHE_RESPONSES, False):
+      # Cache the response for requests for all dates, so that it doesn't need to be built while
+      # a client waits.
+      MetricsCachedResponseDao().get_serving_response()
+
+
+class SumCrossHpoBuckets(pipeline.Pipeline):
+  def run(self, future, version_id, keyframe_days=None):  # pylint: disable=unused-argument
+    for start_date, end_date in _get_cross_hpo_date_ranges(version_id, keyframe_days):
+      yield SumCrossHpoBucketsForDates(version_id, start_date.strftime(DATE_FORMAT),
+                                       end_date.strftime(DATE_FORMAT), keyframe_days)
+
+
+class SumCrossHpoBucketsForDates(pipeline.Pipeline):
+  def run(self, version_id, start_date_str, end_date_str, keyframe_days=None):
+    sum_cross_hpo_buckets(version_id, keyframe_days,
+                          datetime.strptime(start_date_str, DATE_FORMAT).date(),
+                          datetime.strptime(end_date_str, DATE_FORMAT).date())
+
+
 class SummaryPipeline(pipeline.Pipeline):
   def run(self, bucket_name, now, input_files, version_id, parent_params=None):
     logging.info('======= Starting Metrics Pipeline')
@@ -173,39 +353,104 @@ class SummaryPipeline(pipeline.Pipeline):
     if parent_params:
       mapper_params.update(parent_params)
 
+    if mapper_params.get(_READ_FROM_DATABASE):
+      # Participant ID ranges are assigned to shards when the MR starts.
+      mapper_params['input_reader'] = {}
+      input_name = 'Process Database Rows'
+      input_mapper_spec = ('offline.metrics_db_input.'
+                           'map_participant_id_range_to_participant_and_date_metric')
+      input_reader_spec = 'offline.metrics_db_input.ParticipantIdRangeInputReader'
+    else:
+      input_name = 'Process Input CSV'
+      input_mapper_spec = 'offline.metrics_pipeline.map_csv_to_participant_and_date_metric'
+      input_reader_spec = 'mapreduce.input_readers.GoogleCloudStorageInputReader'
+
     num_shards = mapper_params[_NUM_SHARDS]
+    codec_params = _get_codec_params(mapper_params)
+    since = mapper_params.get(_SINCE)
+    if since:
+      deltas_reducer_spec = ('offline.metrics_pipeline.'
+                             'reduce_participant_data_to_hpo_metric_date_delta_changes')
+      counts_reducer_spec = ('offline.metrics_pipeline.'
+                             'reduce_hpo_metric_date_deltas_to_all_date_count_changes')
+      buckets_reducer_spec = ('offline.metrics_pipeline.'
+                              'reduce_hpo_date_metric_count_changes_to_database_buckets')
+    else:
+      deltas_reducer_spec = ('offline.metrics_pipeline.'
+                             'reduce_participant_data_to_hpo_metric_date_deltas')
+      counts_reducer_spec = ('offline.metrics_pipeline.'
+                             'reduce_hpo_metric_date_deltas_to_all_date_counts')
+      buckets_reducer_spec = ('offline.metrics_pipeline.'
+                              'reduce_hpo_date_metric_counts_to_database_buckets')
+    deltas_reducer_params = {
+        'now': now,
+        _SINCE: since,
+        _CUBES: mapper_params.get(_CUBES),
+        'output_writer': {
+            'bucket_name': bucket_name,
+            'content_type': 'text/plain'
+        }
+    }
+    deltas_reducer_params.update(codec_params)
+    counts_reducer_params = {
+        'now': now,
+        _USE_NUMPY: mapper_params.get(_USE_NUMPY, True),
+        'output_writer': {
+            'bucket_name': bucket_name,
+            'content_type': 'text/plain',
+        }
+    }
+    counts_reducer_params.update(codec_params)
+    buckets_reducer_params = {
+        'version_id': version_id,
+        _BASE_VERSION_ID: mapper_params.get(_BASE_VERSION_ID),
+        _BASE_LAST_DATE: mapper_params.get(_BASE_LAST_DATE),
+        _CUBES: mapper_params.get(_CUBES)
+    }
+    buckets_reducer_params.update(codec_params)
     # Chain together three map reduces; see module comments
     blob_key_1 = (yield mapreduce_pipeline.MapreducePipeline(
-        'Process Input CSV',
-        mapper_spec='offline.metrics_pipeline.map_csv_to_participant_and_date_metric',
-        input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
+        input_name,
+        mapper_spec=input_mapper_spec,
+        input_reader_spec=input_reader_spec,
         output_writer_spec='mapreduce.output_writers.GoogleCloudStorageOutputWriter',
         mapper_params=mapper_params,
-        reducer_spec='offline.metrics_pipeline.reduce_participant_data_to_hpo_metric_date_deltas',
-        reducer_params={
-            'now': now,
-            'output_writer': {
-                'bucket_name': bucket_name,
-                'content_type': 'text/plain'
-            }
-        },
+        reducer_spec=deltas_reducer_spec,
+        reducer_params=deltas_reducer_params,
         shards=num_shards))
 
+    if mapper_params.get(_FUSED_STAGES) and not since:
+      # Calculate counts and write buckets for each HPO in one MR, then sum them up into
+      # cross-HPO buckets.
+      fused_reducer_params = {
+          'now': now,
+          'version_id': version_id,
+          _USE_NUMPY: mapper_params.get(_USE_NUMPY, True),
+          _KEYFRAME_DAYS: mapper_params.get(_KEYFRAME_DAYS),
+          _CUBES: mapper_params.get(_CUBES)
+      }
+      fused_reducer_params.update(codec_params)
+      future = yield mapreduce_pipeline.MapreducePipeline(
+          'Calculate Counts and Write Metrics',
+          mapper_spec='offline.metrics_pipeline.map_hpo_metric_date_deltas_to_hpo_key',
+          input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
+          mapper_params=(yield BlobKeys(bucket_name, blob_key_1, now, version_id, codec_params)),
+          combiner_spec='offline.metrics_pipeline.combine_hpo_metric_date_deltas_by_hpo',
+          reducer_spec='offline.metrics_pipeline.reduce_hpo_metric_date_deltas_to_database_buckets',
+          reducer_params=fused_reducer_params,
+          shards=num_shards)
+      yield SumCrossHpoBuckets(future, version_id, mapper_params.get(_KEYFRAME_DAYS))
+      return
+
     blob_key_2 = (yield mapreduce_pipeline.MapreducePipeline(
         'Calculate Counts',
         mapper_spec='offline.metrics_pipeline.map_hpo_metric_date_deltas_to_hpo_metric_key',
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
         output_writer_spec='mapreduce.output_writers.GoogleCloudStorageOutputWriter',
-        mapper_params=(yield BlobKeys(bucket_name, blob_key_1, now, version_id)),
+        mapper_params=(yield BlobKeys(bucket_name, blob_key_1, now, version_id, codec_params)),
         combiner_spec='offline.metrics_pipeline.combine_hpo_metric_date_deltas',
-        reducer_spec='offline.metrics_pipeline.reduce_hpo_metric_date_deltas_to_all_date_counts',
-        reducer_params={
-            'now': now,
-            'output_writer': {
-                'bucket_name': bucket_name,
-                'content_type': 'text/plain',
-            }
-        },
+        reducer_spec=counts_reducer_spec,
+        reducer_params=counts_reducer_params,
         shards=num_shards))
     # TODO(danrodney):
     # We need to find a way to delete data written above (DA-167)
@@ -213,17 +458,15 @@ class SummaryPipeline(pipeline.Pipeline):
         'Write Metrics',
         mapper_spec='offline.metrics_pipeline.map_hpo_metric_date_counts_to_hpo_date_key',
         input_reader_spec='mapreduce.input_readers.GoogleCloudStorageInputReader',
-        mapper_params=(yield BlobKeys(bucket_name, blob_key_2, now, version_id)),
-        reducer_spec='offline.metrics_pipeline.reduce_hpo_date_metric_counts_to_database_buckets',
-        reducer_params={
-            'version_id': version_id
-        },
+        mapper_params=(yield BlobKeys(bucket_name, blob_key_2, now, version_id, codec_params)),
+        reducer_spec=buckets_reducer_spec,
+        reducer_params=buckets_reducer_params,
         shards=num_shards)
 
 def map_csv_to_participant_and_date_metric(csv_buffer):
   """Takes a CSV file as input. Emits (participantId, date|metric) tuples.
   """
-  reader = csv.reader(csv_buffer, delimiter=offline.sql_exporter.DELIMITER)
+  reader = offline.sql_exporter.make_csv_reader(csv_buffer)
   headers = reader.next()
 
   # It's not clear if we have access to the filename which would indicate what type of data
@@ -353,16 +596,16 @@ def parse_tuple(row):
   return tuple(row.split('|'))
 
 def map_result_key(hpo_id, participant_type, k, v):
-  return make_tuple(hpo_id, participant_type, make_metric(k, v))
+  return (hpo_id, participant_type, make_metric(k, v))
 
-def sum_deltas(values, delta_map):
+def sum_deltas(values, delta_map, codec):
   for value in values:
-    (date, delta) = parse_tuple(value)
+    (date, delta) = codec.decode(DATE_DELTA, value)
     old_delta = delta_map.get(date)
     if old_delta:
-      delta_map[date] = old_delta + int(delta)
+      delta_map[date] = old_delta + delta
     else:
-      delta_map[date] = int(delta)
+      delta_map[date] = delta
 
 def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
   creation_date = dates_and_metrics[0][0].date()
@@ -382,45 +625,98 @@ def _add_age_range_metrics(dates_and_metrics, date_of_birth, now):
     date = date + year
   return start_age_range
 
-def _update_summary_fields(summary_fields, new_state):
-  for summary_field in summary_fields:
-    new_state[summary_field.name] = summary_field.compute_func(new_state)
+class _StateLayout(object):
+  """Assigns every field of a participant's state an index in a list of values: the metrics
+  fields from the config, then TOTAL_SENTINEL, then the summary fields.
 
-def _process_metric(metrics_fields, summary_fields, metric, new_state):
+  Summary fields are compiled when the layout is created (once per pipeline run, see
+  _get_state_layout), and their values memoized by the values of their inputs.
+  """
+
+  def __init__(self, conf, cache_key):
+    self.conf = conf
+    self.cache_key = cache_key
+    self.names = ([f.name for f in conf['fields']] + [TOTAL_SENTINEL] +
+                  [f.name for f in conf['summary_fields']])
+    self.indexes = {name: i for i, name in enumerate(self.names)}
+    self.num_metrics_fields = len(conf['fields'])
+    self.hpo_id_index = self.indexes[HPO_ID_METRIC]
+    self.age_range_index = self.indexes[AGE_RANGE_METRIC]
+    self.enrollment_status_index = self.indexes[ENROLLMENT_STATUS_METRIC]
+    # (index, input indexes, set of input indexes, func, memo) for each summary field, in order.
+    self.summary_fields = []
+    for summary_field in conf['summary_fields']:
+      index = self.indexes[summary_field.name]
+      inputs, func = summary_field.compile_func()
+      input_indexes = tuple(self.indexes.get(name, index) for name in inputs)
+      if any(input_index >= index for input_index in input_indexes):
+        raise ValueError('Summary field %s depends on fields that are not computed before it: %s'
+                         % (summary_field.name, inputs))
+      self.summary_fields.append((index, input_indexes, frozenset(input_indexes), func, {}))
+
+  def initial_values(self):
+    return ([UNSET] * self.num_metrics_fields + [1] +
+            [None] * (len(self.names) - self.num_metrics_fields - 1))
+
+_state_layout = None
+
+def _get_state_layout():
+  """Returns the state layout for the current MapReduce, creating it if needed."""
+  global _state_layout
+  conf = get_config()
+  ctx = context.get()
+  cache_key = ctx.mapreduce_id if ctx else None
+  if not _state_layout or _state_layout.conf is not conf or _state_layout.cache_key != cache_key:
+    _state_layout = _StateLayout(conf, cache_key)
+  return _state_layout
+
+def reset_state_layout():
+  """Discards the state layout used outside of MapReduce, so that summary fields are compiled
+  again (with the current config) on the next run."""
+  global _state_layout
+  _state_layout = None
+
+def _update_summary_fields(layout, values, changes):
+  """Recomputes the summary fields with inputs in changes, a list of (index, old value) pairs for
+  fields that have changed; changed summary fields are appended to it. If changes is None, all
+  summary fields are computed."""
+  changed_indexes = set(index for index, _ in changes) if changes is not None else None
+  for index, input_indexes, input_index_set, func, memo in layout.summary_fields:
+    if changed_indexes is not None and changed_indexes.isdisjoint(input_index_set):
+      continue
+    input_values = tuple([values[input_index] for input_index in input_indexes])
+    try:
+      value = memo[input_values]
+    except KeyError:
+      value = memo[input_values] = func(*input_values)
+    if changes is None:
+      values[index] = value
+    elif value != values[index]:
+      changes.append((index, values[index]))
+      changed_indexes.add(index)
+      values[index] = value
+
+def _process_metric(layout, metric, values):
+  """Applies metric to values; returns a list of (index, old value) pairs for the fields that
+  changed as a result (including summary fields), empty if nothing changed."""
   metric_name, value = parse_metric(metric)
-  something_changed = False
   if metric_name == EHR_CONSENT_ANSWER_METRIC:
     metric_name = CONSENT_FOR_ELECTRONIC_HEALTH_RECORDS_FIELD
     if value == CONSENT_PERMISSION_YES_CODE:
       value = str(QuestionnaireStatus.SUBMITTED)
     else:
       value = str(QuestionnaireStatus.SUBMITTED_NO_CONSENT)
-  if metric_name in metrics_fields:
-    if new_state[metric_name] != value:
-      new_state[metric_name] = value
-      something_changed = True
-
-  if something_changed:
-    _update_summary_fields(summary_fields, new_state)
-  return something_changed
-
-def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_values, now=None):
-  """Input:
-
-  reducer_key - participant ID
-  reducer_values - strings of the form date|metric, or DOB|date_of_birth.
-
-  Sorts everything by date, and emits hpoId|participant_type|metric|date|delta strings representing
-  increments or decrements of metrics based on this participant.
-  """
-  #pylint: disable=unused-argument
-  metrics_conf = get_config()
-  metric_fields = get_fieldnames()
-  summary_fields = metrics_conf['summary_fields']
-  last_state = {}
-  last_hpo_id = None
+  index = layout.indexes.get(metric_name)
+  if index is None or index >= layout.num_metrics_fields or values[index] == value:
+    return []
+  changes = [(index, values[index])]
+  values[index] = value
+  _update_summary_fields(layout, values, changes)
+  return changes
+
+def _parse_participant_data(reducer_values):
+  """Returns (dates_and_metrics, date_of_birth) for date|metric or DOB|date_of_birth strings."""
   dates_and_metrics = []
-
   date_of_birth = None
   for reducer_value in reducer_values:
     t = parse_tuple(reducer_value)
@@ -428,15 +724,26 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
       date_of_birth = datetime.strptime(t[1], DATE_FORMAT).date()
     else:
       dates_and_metrics.append((parse_datetime(t[0]), t[1]))
+  return dates_and_metrics, date_of_birth
+
+def _get_participant_deltas(dates_and_metrics, date_of_birth, now, cubes=None, cube_date=None):
+  """Sorts a participant's (datetime, metric) pairs by date, and generates
+  ((hpoId, participant_type, metric), date, delta) tuples representing increments or decrements of
+  metrics based on this participant.
 
+  For each cube in cubes (a dict of cube name -> dimensions), a 1 delta on cube_date is also
+  generated for the cube cell matching the participant's final state.
+  """
   if not dates_and_metrics:
     return
 
+  layout = _get_state_layout()
+  names = layout.names
+
   # Sort the dates and metrics, date first then metric.
   dates_and_metrics = sorted(dates_and_metrics)
 
-  initial_state = {f.name: UNSET for f in metrics_conf['fields']}
-  initial_state[TOTAL_SENTINEL] = 1
+  values = layout.initial_values()
   last_hpo_id = UNSET
   # Look for the starting HPO, update the initial state with it, and remove it from
   # the list of date-and-metrics pairs.
@@ -445,83 +752,152 @@ def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_value
     metric_name, value = parse_metric(metric)
     if metric_name == HPO_ID_METRIC:
       last_hpo_id = value
-      initial_state[HPO_ID_METRIC] = last_hpo_id
+      values[layout.hpo_id_index] = last_hpo_id
       break
 
   # If we know the participant's date of birth, and a starting age range
   # and entries for when it changes over time.
   if date_of_birth:
-    initial_state[AGE_RANGE_METRIC] = _add_age_range_metrics(dates_and_metrics, date_of_birth, now)
+    values[layout.age_range_index] = _add_age_range_metrics(dates_and_metrics, date_of_birth, now)
     # Re-sort with the new entries for age range changes.
     dates_and_metrics = sorted(dates_and_metrics)
 
   # Run summary functions on the initial state.
-  _update_summary_fields(summary_fields, initial_state)
+  _update_summary_fields(layout, values, None)
 
   # Emit 1 values for the initial state before any metrics change.
   initial_date = dates_and_metrics[0][0]
-  for k, v in initial_state.iteritems():
-    yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k, v),
-                              initial_date.date().isoformat(), '1')
+  for name, v in zip(names, values):
+    yield (map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, name, v),
+           initial_date.date().isoformat(), 1)
 
-  last_state = initial_state
   full_participant = False
-  # Loop through all the metric changes for the participant.
+  # Loop through all the metric changes for the participant; values is updated in place.
   for dt, metric in dates_and_metrics:
-    date = dt.date()
-    new_state = copy.deepcopy(last_state)
-
-    if not _process_metric(metric_fields, summary_fields, metric, new_state):
+    changes = _process_metric(layout, metric, values)
+    if not changes:
       continue  # No changes so there's nothing to do.
-    hpo_id = new_state.get(HPO_ID_METRIC)
-    hpo_change = last_hpo_id != hpo_id
+    hpo_id = values[layout.hpo_id_index]
+    if last_hpo_id != hpo_id:
+      # If the HPO has changed, we need deltas for all fields.
+      old_values = list(values)
+      for index, old_val in changes:
+        old_values[index] = old_val
+      changes = zip(range(len(names)), old_values)
 
     last_full_participant = full_participant
-    for k, v in new_state.iteritems():
-      # Output a delta for this field if it is either the first value we have,
-      # or if it has changed. In the case that one of the facets has changed,
-      # we need deltas for all fields.
-      old_val = last_state and last_state.get(k, None)
-      if hpo_change or v != old_val:
-        formatted_date = date.isoformat()
-        if (k == ENROLLMENT_STATUS_METRIC and v == EnrollmentStatus.FULL_PARTICIPANT and
-            not full_participant):
-          full_participant = True
-          # Emit 1 values for the current state for all fields for the full participant type.
-          for k2, v2 in new_state.iteritems():
-            yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k2, v2),
-                                      formatted_date, '1')
-        yield reduce_result_value(map_result_key(hpo_id, _REGISTERED_PARTICIPANT, k, v),
-                                  formatted_date, '1')
-        if last_full_participant:
-          yield reduce_result_value(map_result_key(hpo_id, _FULL_PARTICIPANT, k, v), formatted_date,
-                                    '1')
-        if last_state:
-          # If the value changed, output -1 delta for the old value.
-          yield reduce_result_value(map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT,
-                                                   k, old_val),
-                                    formatted_date, '-1')
-          if last_full_participant:
-            yield reduce_result_value(map_result_key(last_hpo_id, _FULL_PARTICIPANT, k, old_val),
-                                      formatted_date, '-1')
-
-    last_state = new_state
+    formatted_date = dt.date().isoformat()
+    for index, old_val in changes:
+      k = names[index]
+      v = values[index]
+      if (index == layout.enrollment_status_index and v == EnrollmentStatus.FULL_PARTICIPANT and
+          not full_participant):
+        full_participant = True
+        # Emit 1 values for the current state for all fields for the full participant type.
+        for k2, v2 in zip(names, values):
+          yield (map_result_key(hpo_id, _FULL_PARTICIPANT, k2, v2), formatted_date, 1)
+      yield (map_result_key(hpo_id, _REGISTERED_PARTICIPANT, k, v), formatted_date, 1)
+      if last_full_participant:
+        yield (map_result_key(hpo_id, _FULL_PARTICIPANT, k, v), formatted_date, 1)
+      # Output a -1 delta for the old value.
+      yield (map_result_key(last_hpo_id, _REGISTERED_PARTICIPANT, k, old_val), formatted_date, -1)
+      if last_full_participant:
+        yield (map_result_key(last_hpo_id, _FULL_PARTICIPANT, k, old_val), formatted_date, -1)
+
     last_hpo_id = hpo_id
 
+  if cubes:
+    for name, dimensions in sorted(cubes.iteritems()):
+      cell_key = _make_cube_cell_key(name, [values[layout.indexes[dimension]]
+                                            for dimension in dimensions])
+      yield (values[layout.hpo_id_index], _CUBE, cell_key), cube_date, 1
+
+def _make_cube_cell_key(name, values):
+  """Returns the metric key used for the counts of a cube cell, e.g. "raceByAgeRange:WHITE,18-25".
+  (Values can't contain commas.)"""
+  return '%s:%s' % (name, ','.join(str(value) for value in values))
+
+def _parse_cube_cell_key(cell_key):
+  """Returns (cube name, tuple of values) for a key from _make_cube_cell_key."""
+  name, _, values = cell_key.partition(':')
+  return name, tuple(values.split(','))
+
+def _get_cubes(cubes=None):
+  """Returns the cubes to write for the running MapReduce, unless cubes is passed in."""
+  if cubes is not None:
+    return cubes
+  ctx = context.get()
+  return (ctx and ctx.mapreduce_spec.mapper.params.get(_CUBES)) or {}
+
+def _write_cubes(version_id, hpo_id, cube_counts, cubes, base_version_id=None):
+  """Writes the cubes for an HPO, given a dict of cube name -> cell values -> count. If
+  base_version_id is set, the counts are changes to add to the cubes in that version."""
+  pool = _get_bucket_pool()
+  cube_dao = MetricsCubeDao()
+  for name, counts in cube_counts.iteritems():
+    if base_version_id:
+      changes = counts
+      base_cube = cube_dao.get([base_version_id, name, hpo_id])
+      counts = decode_cube(base_cube)[1] if base_cube else {}
+      for values, change in changes.iteritems():
+        counts[values] = counts.get(values, 0) + change
+    pool.append(encode_cube(version_id, name, hpo_id, cubes[name], counts))
+
+def reduce_participant_data_to_hpo_metric_date_deltas(reducer_key, reducer_values, now=None,
+                                                       cubes=None):
+  """Input:
+
+  reducer_key - participant ID
+  reducer_values - strings of the form date|metric, or DOB|date_of_birth.
+
+  Sorts everything by date, and emits hpoId|participant_type|metric|date|delta strings representing
+  increments or decrements of metrics based on this participant, and hpoId|C|cube cell|date|1
+  strings for the cells of each cube matching the participant's state on today's date.
+  """
+  #pylint: disable=unused-argument
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  codec = _get_codec()
+  dates_and_metrics, date_of_birth = _parse_participant_data(reducer_values)
+  for key, date_str, delta in _get_participant_deltas(dates_and_metrics, date_of_birth, now,
+                                                      _get_cubes(cubes), now.date().isoformat()):
+    yield codec.encode_record(ROW, key + (date_str, delta))
+
+def reduce_participant_data_to_hpo_metric_date_delta_changes(reducer_key, reducer_values,
+                                                             now=None, since=None, cubes=None):
+  """Incremental version of reduce_participant_data_to_hpo_metric_date_deltas.
+
+  Emits hpoId|participant_type|metric|date|delta strings for all of the participant's data, along
+  with negated deltas for the data the participant had as of the previous run (since), which is
+  what that run's buckets reflect. Summed up, these are the changes to make to those buckets.
+  """
+  #pylint: disable=unused-argument
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  since = since or context.get().mapreduce_spec.mapper.params.get(_SINCE)
+  cubes = _get_cubes(cubes)
+  # Cube cells for both the old and new states are counted on today's date, so that the changes
+  # for the participant are a decrement for the old cell and an increment for the new one.
+  cube_date = now.date().isoformat()
+  codec = _get_codec()
+  dates_and_metrics, date_of_birth = _parse_participant_data(reducer_values)
+  for key, date_str, delta in _get_participant_deltas(dates_and_metrics, date_of_birth, now,
+                                                      cubes, cube_date):
+    yield codec.encode_record(ROW, key + (date_str, delta))
+  old_dates_and_metrics = [(dt, metric) for dt, metric in dates_and_metrics if dt <= since]
+  for key, date_str, delta in _get_participant_deltas(old_dates_and_metrics, date_of_birth,
+                                                      since, cubes, cube_date):
+    yield codec.encode_record(ROW, key + (date_str, -delta))
+
 def map_hpo_metric_date_deltas_to_hpo_metric_key(row_buffer):
   """Emits (hpoId|participant_type|metric, date|delta) pairs for reducing
 
-     row_buffer: buffer containing hpoId|participant_type|metric|date|delta lines
+     row_buffer: buffer containing hpoId|participant_type|metric|date|delta records
   """
-  reader = csv.reader(row_buffer, delimiter='|')
-  for line in reader:
-    hpo_id = line[0]
-    participant_type = line[1]
-    metric_key = line[2]
-    date_str = line[3]
-    delta = line[4]
+  codec = _get_codec()
+  for row in codec.read_records(ROW, row_buffer):
+    (hpo_id, participant_type, metric_key, date_str, delta) = row
     # Yield HPO ID|participant_type|metric -> date|delta
-    yield (make_tuple(hpo_id, participant_type, metric_key), make_tuple(date_str, delta))
+    yield (codec.encode(METRIC_KEY, (hpo_id, participant_type, metric_key)),
+           codec.encode(DATE_DELTA, (date_str, delta)))
 
 def combine_hpo_metric_date_deltas(key, new_values, old_values):  # pylint: disable=unused-argument
   """ Combines deltas generated for users into a single delta per date
@@ -530,13 +906,14 @@ def combine_hpo_metric_date_deltas(key, new_values, old_values):  # pylint: disa
      new_values: list of date|delta strings (one per participant + type + metric + date + hpoId)
      old_values: list of date|delta strings (one per type + metric + date + hpoId)
   """
+  codec = _get_codec()
   delta_map = {}
   for old_value in old_values:
-    (date, delta) = parse_tuple(old_value)
-    delta_map[date] = int(delta)
-  sum_deltas(new_values, delta_map)
+    (date, delta) = codec.decode(DATE_DELTA, old_value)
+    delta_map[date] = delta
+  sum_deltas(new_values, delta_map, codec)
   for date, delta in delta_map.iteritems():
-    yield make_tuple(date, str(delta))
+    yield codec.encode(DATE_DELTA, (date, delta))
 
 def reduce_hpo_metric_date_deltas_to_all_date_counts(reducer_key, reducer_values, now=None):
   """Emits hpoId|participant_type|metric|date|count for each date until today.
@@ -545,83 +922,353 @@ def reduce_hpo_metric_date_deltas_to_all_date_counts(reducer_key, reducer_values
     reducer_values: list of date|delta strings
     now: use to set the clock for testing
   """
+  codec = _get_codec()
+  key = codec.decode(METRIC_KEY, reducer_key)
   delta_map = {}
-  sum_deltas(reducer_values, delta_map)
-  # Walk over the deltas by date
-  last_date = None
-  count = 0
-  one_day = timedelta(days=1)
+  sum_deltas(reducer_values, delta_map, codec)
   now = now or context.get().mapreduce_spec.mapper.params.get('now')
-  for date_str, delta in sorted(delta_map.items()):
-    date = datetime.strptime(date_str, DATE_FORMAT).date()
-    if date > now.date():
-      # Ignore any data after the current run date.
-      break
-    # Yield results for all the dates in between
-    if last_date:
-      middle_date = last_date + one_day
-      while middle_date < date:
-        yield reduce_result_value(reducer_key, middle_date.isoformat(), count)
-        middle_date = middle_date + one_day
-    count += delta
-    if count > 0:
-      yield reduce_result_value(reducer_key, date_str, count)
-    last_date = date
-  # Yield results up until today.
-  if count > 0 and last_date:
-    last_date = last_date + one_day
-    while last_date <= now.date():
-      yield reduce_result_value(reducer_key, last_date.isoformat(), count)
-      last_date = last_date + one_day
-
-def reduce_result_value(reducer_key, date_str, count):
-  return reducer_key + '|' + date_str + '|' + str(count) + '\n'
+  if _use_numpy():
+    runs = offline.metrics_counts.daily_count_runs_numpy(delta_map, now.date())
+    # Emit all the records for this key at once.
+    if runs:
+      yield codec.encode_count_runs(key, runs)
+  else:
+    for date_and_count in offline.metrics_counts.daily_counts(delta_map, now.date()):
+      yield codec.encode_record(ROW, key + date_and_count)
+
+def reduce_hpo_metric_date_deltas_to_all_date_count_changes(reducer_key, reducer_values,
+                                                            now=None):
+  """Incremental version of reduce_hpo_metric_date_deltas_to_all_date_counts.
+
+  Emits hpoId|participant_type|metric|date|change for each date until today on which the
+  count differs from the previous run's; dates where the changes cancel out are skipped.
+  Args:
+    reducer_key: hpoId|participant_type|metric
+    reducer_values: list of date|delta strings
+    now: use to set the clock for testing
+  """
+  codec = _get_codec()
+  key = codec.decode(METRIC_KEY, reducer_key)
+  delta_map = {}
+  sum_deltas(reducer_values, delta_map, codec)
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  if _use_numpy():
+    runs = offline.metrics_counts.daily_count_runs_numpy(delta_map, now.date(), changes=True)
+    if runs:
+      yield codec.encode_count_runs(key, runs)
+  else:
+    for date_and_change in offline.metrics_counts.daily_changes(delta_map, now.date()):
+      yield codec.encode_record(ROW, key + date_and_change)
 
 def map_hpo_metric_date_counts_to_hpo_date_key(row_buffer):
-  """Emits (hpoId|date, participant_type|metric|count) pairs for reducing ('*' for cross-HPO counts)
+  """Emits (hpoId|date, participant_type|metric|count) pairs for reducing ('*' for cross-HPO counts,
+  other than cube cells; cubes are only written for each HPO.)
   Args:
-     row_buffer: buffer containing hpoId|participant_type|metric|date|count lines
+     row_buffer: buffer containing hpoId|participant_type|metric|date|count records
   """
-  reader = csv.reader(row_buffer, delimiter='|')
-  for line in reader:
-    hpo_id = line[0]
-    participant_type = line[1]
-    metric_key = line[2]
-    date_str = line[3]
-    count = line[4]
+  codec = _get_codec()
+  for row in codec.read_records(ROW, row_buffer):
+    (hpo_id, participant_type, metric_key, date_str, count) = row
+    metric_count = codec.encode(METRIC_COUNT, (participant_type, metric_key, count))
     # Yield HPO ID + date -> metric + count
-    yield (make_tuple(hpo_id, date_str), make_tuple(participant_type, metric_key, count))
+    yield (codec.encode(HPO_DATE_KEY, (hpo_id, date_str)), metric_count)
+    if participant_type == _CUBE:
+      continue
     # Yield '*' + date -> metric + count (for all HPO counts)
-    yield (make_tuple('*', date_str), make_tuple(participant_type, metric_key, count))
+    yield (codec.encode(HPO_DATE_KEY, ('*', date_str)), metric_count)
 
-def reduce_hpo_date_metric_counts_to_database_buckets(reducer_key, reducer_values, version_id=None):
-  """Emits a metrics bucket with counts for metrics for a given hpoId + date to SQL
+def reduce_hpo_date_metric_counts_to_database_buckets(reducer_key, reducer_values, version_id=None,
+                                                      cubes=None):
+  """Emits a metrics bucket with counts for metrics for a given hpoId + date to SQL, along with the
+  HPO's cubes (if there are counts for cube cells, which are only on today's date.)
   Args:
      reducer_key: hpoId|date ('*' for hpoId for cross-HPO counts)
      reducer_values: list of participant_type|metric|count strings
   """
+  codec = _get_codec()
   metrics_dict = collections.defaultdict(lambda: 0)
-  (hpo_id, date_str) = parse_tuple(reducer_key)
+  cube_counts = collections.defaultdict(dict)
+  (hpo_id, date_str) = codec.decode(HPO_DATE_KEY, reducer_key)
   if hpo_id == '*':
     hpo_id = ''
   date = datetime.strptime(date_str, DATE_FORMAT)
   for reducer_value in reducer_values:
-    (participant_type, metric_key, count) = parse_tuple(reducer_value)
-    if metric_key == PARTICIPANT_KIND:
-      if participant_type == _REGISTERED_PARTICIPANT:
-        metrics_dict[metric_key] += int(count)
-    else:
-      kind = FULL_PARTICIPANT_KIND if participant_type == _FULL_PARTICIPANT else PARTICIPANT_KIND
-      metrics_dict['%s.%s' % (kind, metric_key)] += int(count)
+    (participant_type, metric_key, count) = codec.decode(METRIC_COUNT, reducer_value)
+    if participant_type == _CUBE:
+      name, values = _parse_cube_cell_key(metric_key)
+      cube_counts[name][values] = count
+      continue
+    metric_name = _get_bucket_metric_name(participant_type, metric_key)
+    if metric_name:
+      metrics_dict[metric_name] += count
 
   version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
-  bucket = MetricsBucket(metricsVersionId=version_id,
-                         date=date,
-                         hpoId=hpo_id,
-                         metrics=json.dumps(metrics_dict))
+  if cube_counts:
+    _write_cubes(version_id, hpo_id, cube_counts, _get_cubes(cubes))
+  bucket = encode_bucket(version_id, date, hpo_id, metrics_dict)
   # Use upsert here; when reducer shards retry, we will just replace any metrics bucket that was
   # written before, rather than failing.
-  MetricsBucketDao().upsert(bucket)
+  _get_bucket_pool().append(bucket)
+
+def reduce_hpo_date_metric_count_changes_to_database_buckets(reducer_key, reducer_values,
+                                                             version_id=None,
+                                                             base_version_id=None,
+                                                             base_last_date=None,
+                                                             cubes=None):
+  """Incremental version of reduce_hpo_date_metric_counts_to_database_buckets.
+
+  Adds count changes for a given hpoId + date to the corresponding bucket from the base version,
+  and writes the result to the new version. (For dates after the last date in the base version,
+  the base version's bucket for that last date is used.) Metrics whose counts drop to zero are
+  removed, and the bucket is deleted if it has no metrics left. If the base version's bucket is
+  stored as differences from a keyframe, so is the new bucket (using the copy of the keyframe in
+  the new version.) Changes to cube cell counts are likewise added to the HPO's cubes from the
+  base version.
+  Args:
+     reducer_key: hpoId|date ('*' for hpoId for cross-HPO counts)
+     reducer_values: list of participant_type|metric|change strings
+  """
+  codec = _get_codec()
+  (hpo_id, date_str) = codec.decode(HPO_DATE_KEY, reducer_key)
+  if hpo_id == '*':
+    hpo_id = ''
+  version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
+  base_version_id = (base_version_id or
+                     context.get().mapreduce_spec.mapper.params.get(_BASE_VERSION_ID))
+  base_last_date = (base_last_date or
+                    context.get().mapreduce_spec.mapper.params.get(_BASE_LAST_DATE))
+  date = datetime.strptime(date_str, DATE_FORMAT).date()
+  base_date = date
+  if base_last_date:
+    base_date = min(date, datetime.strptime(base_last_date, DATE_FORMAT).date())
+
+  # Always start from the base version's bucket rather than the one copied into the new version,
+  # so that reducer shard retries don't apply the same changes twice.
+  dao = MetricsBucketDao()
+  base_metrics_dict, keyframe = dao.get_bucket_metrics(base_version_id, base_date, hpo_id)
+  metrics_dict = collections.defaultdict(lambda: 0)
+  if base_metrics_dict:
+    metrics_dict.update(base_metrics_dict)
+  cube_changes = collections.defaultdict(dict)
+  for reducer_value in reducer_values:
+    (participant_type, metric_key, change) = codec.decode(METRIC_COUNT, reducer_value)
+    if participant_type == _CUBE:
+      name, values = _parse_cube_cell_key(metric_key)
+      cube_changes[name][values] = change
+      continue
+    metric_name = _get_bucket_metric_name(participant_type, metric_key)
+    if not metric_name:
+      continue
+    metrics_dict[metric_name] += change
+    if not metrics_dict[metric_name]:
+      del metrics_dict[metric_name]
+
+  if cube_changes:
+    _write_cubes(version_id, hpo_id, cube_changes, _get_cubes(cubes), base_version_id)
+  if metrics_dict:
+    _get_bucket_pool().append(encode_bucket(version_id, date, hpo_id, metrics_dict, keyframe))
+  else:
+    with dao.session() as session:
+      existing_bucket = dao.get_with_session(session, [version_id, date, hpo_id])
+      if existing_bucket:
+        session.delete(existing_bucket)
+
+def _get_bucket_metric_name(participant_type, metric_key):
+  """Returns the name of a metric in bucket JSON (e.g. FullParticipant.race.white), or None if
+  the metric is not written to buckets (the total for full participants.)"""
+  if metric_key == PARTICIPANT_KIND:
+    if participant_type != _REGISTERED_PARTICIPANT:
+      return None
+    return metric_key
+  kind = FULL_PARTICIPANT_KIND if participant_type == _FULL_PARTICIPANT else PARTICIPANT_KIND
+  return '%s.%s' % (kind, metric_key)
+
+def map_hpo_metric_date_deltas_to_hpo_key(row_buffer):
+  """Emits (hpoId, participant_type|metric|date|delta) pairs for reducing, when the second and
+  third MRs are fused.
+
+     row_buffer: buffer containing hpoId|participant_type|metric|date|delta records
+  """
+  codec = _get_codec()
+  for row in codec.read_records(ROW, row_buffer):
+    yield codec.encode(HPO_KEY, row[:1]), codec.encode(METRIC_DATE_DELTA, row[1:])
+
+def _sum_metric_date_deltas(values, delta_maps, codec):
+  """Adds participant_type|metric|date|delta values to delta_maps, a dict of
+  (participant_type, metric) -> date -> delta."""
+  for value in values:
+    (participant_type, metric_key, date_str, delta) = codec.decode(METRIC_DATE_DELTA, value)
+    delta_map = delta_maps[(participant_type, metric_key)]
+    delta_map[date_str] = delta_map.get(date_str, 0) + delta
+
+def combine_hpo_metric_date_deltas_by_hpo(key, new_values, old_values):
+  """Combines deltas generated for users into a single delta per metric and date.
+  Args:
+     key: hpoId (unused)
+     new_values: list of participant_type|metric|date|delta strings
+     old_values: list of already combined participant_type|metric|date|delta strings
+  """
+  #pylint: disable=unused-argument
+  codec = _get_codec()
+  delta_maps = collections.defaultdict(dict)
+  _sum_metric_date_deltas(old_values, delta_maps, codec)
+  _sum_metric_date_deltas(new_values, delta_maps, codec)
+  for (participant_type, metric_key), delta_map in delta_maps.iteritems():
+    for date_str, delta in delta_map.iteritems():
+      yield codec.encode(METRIC_DATE_DELTA, (participant_type, metric_key, date_str, delta))
+
+def reduce_hpo_metric_date_deltas_to_database_buckets(reducer_key, reducer_values, now=None,
+                                                      version_id=None, keyframe_days=None,
+                                                      cubes=None):
+  """Writes metrics buckets for an HPO for each date until today; replaces the second and third
+  MRs for full runs when they are fused.
+
+  Counts for each metric are calculated as in reduce_hpo_metric_date_deltas_to_all_date_counts,
+  and assembled into a bucket per date in memory, rather than being written to GCS and grouped
+  by HPO + date in another MR. Cross-HPO buckets are written afterwards by SumCrossHpoBuckets.
+  The HPO's cubes are written from the deltas for cube cells, which are all on today's date.
+  Args:
+    reducer_key: hpoId
+    reducer_values: list of participant_type|metric|date|delta strings
+    now: use to set the clock for testing
+    version_id: the metrics version to write buckets for
+    keyframe_days: if set, buckets are written as differences from keyframes (see module comments)
+    cubes: dict of cube name -> dimensions for the cubes to write
+  """
+  codec = _get_codec()
+  (hpo_id,) = codec.decode(HPO_KEY, reducer_key)
+  now = now or context.get().mapreduce_spec.mapper.params.get('now')
+  version_id = version_id or context.get().mapreduce_spec.mapper.params.get('version_id')
+  keyframe_days = (keyframe_days or
+                   context.get().mapreduce_spec.mapper.params.get(_KEYFRAME_DAYS))
+  delta_maps = collections.defaultdict(dict)
+  _sum_metric_date_deltas(reducer_values, delta_maps, codec)
+
+  # date -> metric name -> count, for every date with counts for any metric.
+  date_metrics = collections.defaultdict(lambda: collections.defaultdict(lambda: 0))
+  cube_counts = collections.defaultdict(dict)
+  for (participant_type, metric_key), delta_map in delta_maps.iteritems():
+    if participant_type == _CUBE:
+      name, values = _parse_cube_cell_key(metric_key)
+      cube_counts[name][values] = sum(delta_map.itervalues())
+      continue
+    if _use_numpy():
+      counts = offline.metrics_counts.expand_runs(
+          offline.metrics_counts.daily_count_runs_numpy(delta_map, now.date()))
+    else:
+      counts = offline.metrics_counts.daily_counts(delta_map, now.date())
+    metric_name = _get_bucket_metric_name(participant_type, metric_key)
+    for date_str, count in counts:
+      metrics_dict = date_metrics[date_str]
+      if metric_name:
+        metrics_dict[metric_name] += count
+
+  if cube_counts:
+    _write_cubes(version_id, hpo_id, cube_counts, _get_cubes(cubes))
+  pool = _get_bucket_pool()
+  dates_and_metrics = ((datetime.strptime(date_str, DATE_FORMAT).date(), date_metrics[date_str])
+                       for date_str in sorted(date_metrics))
+  for bucket in encode_buckets(version_id, hpo_id, dates_and_metrics, keyframe_days):
+    pool.append(bucket)
+
+def sum_cross_hpo_buckets(version_id, keyframe_days=None, start_date=None, end_date=None):
+  """Writes a cross-HPO bucket for every date in a metrics version (or between start_date and
+  end_date, inclusive), with the sum of the counts in the buckets for each HPO on that date. If
+  keyframe_days is set, the buckets are written as differences from keyframes (see module
+  comments), starting with a keyframe for the first date."""
+  if not start_date:
+    start_date, end_date = MetricsBucketDao().get_date_range(version_id)
+    if not start_date:
+      return
+  pool = _MetricsBucketPool()
+  dates_and_metrics = _sum_hpo_buckets(version_id, start_date, end_date)
+  for bucket in encode_buckets(version_id, '', dates_and_metrics, keyframe_days):
+    pool.append(bucket)
+  pool.flush()
+
+def _get_cross_hpo_date_ranges(version_id, keyframe_days=None):
+  """Returns (start date, end date) for each range of dates in a metrics version for which
+  SumCrossHpoBuckets starts a child pipeline. The HPO buckets cover every date from the first date
+  in the version, so the keyframes written for each range are the ones that would be written for
+  the whole version."""
+  start_date, end_date = MetricsBucketDao().get_date_range(version_id)
+  if not start_date:
+    return []
+  days_per_shard = _CROSS_HPO_DAYS_PER_SHARD
+  if keyframe_days:
+    days_per_shard += -days_per_shard % keyframe_days
+  date_ranges = []
+  while start_date <= end_date:
+    range_end_date = min(start_date + timedelta(days=days_per_shard - 1), end_date)
+    date_ranges.append((start_date, range_end_date))
+    start_date = range_end_date + timedelta(days=1)
+  return date_ranges
+
+def _sum_hpo_buckets(version_id, start_date, end_date):
+  """Generates (date, dict of metrics summed over every HPO) for every date in a version between
+  start_date and end_date (inclusive.)"""
+  dao = MetricsBucketDao()
+  while start_date <= end_date:
+    query_end_date = min(start_date + timedelta(days=_CROSS_HPO_DAYS_PER_QUERY - 1), end_date)
+    buckets = dao.get_hpo_buckets(version_id, start_date, query_end_date)
+    for date, date_buckets in itertools.groupby(buckets, key=lambda bucket: bucket.date):
+      metrics_dict = collections.defaultdict(lambda: 0)
+      for bucket in date_buckets:
+        for metric_name, count in json.loads(bucket.metrics).iteritems():
+          metrics_dict[metric_name] += count
+      yield date, metrics_dict
+    start_date = query_end_date + timedelta(days=1)
+
+class _MetricsBucketPool(context.Pool):
+  """Buffers the metrics buckets (and keyframes and cubes) written by a reducer shard, and upserts
+  them in batches.
+
+  MapReduce flushes the pool at the end of every slice, before the slice is marked as done; if
+  the slice is retried, its buckets are just written again.
+  """
+
+  def __init__(self):
+    self._buckets = []
+    self._keyframes = []
+    self._cubes = []
+
+  def append(self, bucket):
+    if isinstance(bucket, MetricsKeyframe):
+      self._keyframes.append(bucket)
+    elif isinstance(bucket, MetricsCube):
+      self._cubes.append(bucket)
+    else:
+      self._buckets.append(bucket)
+    if len(self._buckets) + len(self._keyframes) + len(self._cubes) >= _BUCKET_BATCH_SIZE:
+      self.flush()
+
+  def flush(self):
+    if self._keyframes:
+      MetricsKeyframeDao().upsert_all(self._keyframes)
+      self._keyframes = []
+    if self._buckets:
+      MetricsBucketDao().upsert_all(self._buckets)
+      self._buckets = []
+    if self._cubes:
+      MetricsCubeDao().upsert_all(self._cubes)
+      self._cubes = []
+
+# Used outside of MapReduce (by the local pipeline), which flushes it with flush_bucket_writes().
+_local_bucket_pool = _MetricsBucketPool()
+
+def _get_bucket_pool():
+  ctx = context.get()
+  if not ctx:
+    return _local_bucket_pool
+  pool = ctx.get_pool(_BUCKET_POOL)
+  if not pool:
+    pool = _MetricsBucketPool()
+    ctx.register_pool(_BUCKET_POOL, pool)
+  return pool
+
+def flush_bucket_writes():
+  """Writes any metrics buckets buffered outside of MapReduce."""
+  _local_bucket_pool.flush()
 
 def parse_metric(metric):
   return metric.split('.')
@@ -1,15 +1,27 @@
+import config
 import contextlib
 import csv
+import gzip
 import logging
+import zlib
 
 from dao import database_factory
 from cloudstorage import cloudstorage_api
+from offline.avro_writer import AvroFileWriter, get_result_columns, get_schema
 from sqlalchemy import text
 from unicode_csv import UnicodeWriter
 
-# Delimiter used in CSVs written (use this when reading them back out).
+# Delimiter used in CSVs written (use this when reading them back out, or use make_csv_reader.)
 DELIMITER = ','
-_BATCH_SIZE = 1000
+# Number of rows fetched from the database at a time, unless sql_export_batch_size is set.
+_DEFAULT_BATCH_SIZE = 1000
+# zlib level for compressed exports; higher levels are much slower for little gain on CSVs.
+_COMPRESS_LEVEL = 6
+# Compressed exports are detected by the magic number at the start of gzip files.
+_GZIP_MAGIC = '\x1f\x8b'
+_GZIP_WBITS = 16 + zlib.MAX_WBITS
+# Bytes read at a time from exported files.
+_READ_SIZE = 1024 * 1024
 
 class SqlExportFileWriter(object):
   """Writes rows to a CSV file, optionally filtering on a predicate."""
@@ -43,30 +55,61 @@ class CompositeSqlExportWriter(object):
       writer.write_rows(results)
 
 class SqlExporter(object):
-  """Executes a SQL query, fetches results in batches, and writes output to a CSV in GCS."""
-  def __init__(self, bucket_name, use_unicode=False):
+  """Executes a SQL query, fetches results in batches, and writes output to a CSV in GCS.
+
+  If compress is set, the CSV is gzip-compressed as it is written; make_csv_reader reads both
+  compressed and uncompressed exports. run_avro_export writes an Avro file instead, with types
+  from a SQLAlchemy table; see avro_writer.py.
+  """
+  def __init__(self, bucket_name, use_unicode=False, compress=False, batch_size=None):
     self._bucket_name = bucket_name
     self._use_unicode = use_unicode
+    self._compress = compress
+    self._batch_size = batch_size or int(config.getSetting(config.SQL_EXPORT_BATCH_SIZE,
+                                                           _DEFAULT_BATCH_SIZE))
 
-  def run_export(self, file_name, sql, query_params=None):
+  def run_export(self, file_name, sql, query_params=None, session=None):
+    """Exports the results of sql to a CSV, in a new session unless one is passed in."""
     with self.open_writer(file_name) as writer:
-      self.run_export_with_writer(writer, sql, query_params)
+      self.run_export_with_writer(writer, sql, query_params, session=session)
+
+  def run_avro_export(self, file_name, table, sql, query_params=None, session=None):
+    """Exports the results of a query selecting every column of a SQLAlchemy table (in the same
+    order) to an Avro file. Each batch of rows fetched is written as a block."""
+    gcs_path = '/%s/%s' % (self._bucket_name, file_name)
+    logging.info('Exporting data to %s...', gcs_path)
+    with cloudstorage_api.open(gcs_path, mode='w') as dest:
+      writer = AvroFileWriter(dest, get_schema(table))
+      self.run_export_with_writer(writer, sql, query_params, columns=get_result_columns(table),
+                                  session=session)
+      writer.close()
+    logging.info('Export to %s complete.', gcs_path)
 
-  def run_export_with_writer(self, writer, sql, query_params):
+  def run_export_with_writer(self, writer, sql, query_params, columns=None, session=None):
+    if session is not None:
+      self.run_export_with_session(writer, session, sql, query_params=query_params,
+                                   columns=columns)
+      return
     with database_factory.make_server_cursor_database().session() as session:
-      self.run_export_with_session(writer, session, sql, query_params=query_params)
+      self.run_export_with_session(writer, session, sql, query_params=query_params,
+                                   columns=columns)
 
-  def run_export_with_session(self, writer, session, sql, query_params=None):
+  def run_export_with_session(self, writer, session, sql, query_params=None, columns=None):
+    """Writes the results of sql to writer. If columns (a list of sqlalchemy.column) is set,
+    the values of those columns are converted to their types' Python values."""
     # Each query from AppEngine standard environment must finish in 60 seconds.
     # If we start running into trouble with that, we'll either
     # need to break the SQL up into pages, or (more likely) switch to cloud SQL export.
-    cursor = session.execute(text(sql), params=query_params)
+    statement = text(sql)
+    if columns:
+      statement = statement.columns(*columns)
+    cursor = session.execute(statement, params=query_params)
     try:
       writer.write_header(cursor.keys())
-      results = cursor.fetchmany(_BATCH_SIZE)
+      results = cursor.fetchmany(self._batch_size)
       while results:
         writer.write_rows(results)
-        results = cursor.fetchmany(_BATCH_SIZE)
+        results = cursor.fetchmany(self._batch_size)
     finally:
       cursor.close()
 
@@ -75,6 +118,43 @@ class SqlExporter(object):
     gcs_path = '/%s/%s' % (self._bucket_name, file_name)
     logging.info('Exporting data to %s...', gcs_path)
     with cloudstorage_api.open(gcs_path, mode='w') as dest:
-      writer = SqlExportFileWriter(dest, predicate, use_unicode=self._use_unicode)
-      yield writer
+      if self._compress:
+        # Rows are compressed as they are written, so the whole file is never held in memory.
+        with gzip.GzipFile(fileobj=dest, mode='wb', compresslevel=_COMPRESS_LEVEL) as gzip_dest:
+          yield SqlExportFileWriter(gzip_dest, predicate, use_unicode=self._use_unicode)
+      else:
+        yield SqlExportFileWriter(dest, predicate, use_unicode=self._use_unicode)
     logging.info('Export to %s complete.', gcs_path)
+
+
+def make_csv_reader(input_file):
+  """Returns a csv.reader for a file written by SqlExporter, decompressing it as it is read if
+  it was compressed."""
+  return csv.reader(read_lines(input_file), delimiter=DELIMITER)
+
+
+def _read_chunks(input_file):
+  chunk = input_file.read(_READ_SIZE)
+  if not chunk.startswith(_GZIP_MAGIC):
+    while chunk:
+      yield chunk
+      chunk = input_file.read(_READ_SIZE)
+    return
+  decompressor = zlib.decompressobj(_GZIP_WBITS)
+  while chunk:
+    yield decompressor.decompress(chunk)
+    chunk = input_file.read(_READ_SIZE)
+  yield decompressor.flush()
+
+
+def read_lines(input_file):
+  """Yields the lines of a file (with their line endings), decompressing it as it is read if it
+  is gzip-compressed."""
+  partial_line = ''
+  for chunk in _read_chunks(input_file):
+    lines = (partial_line + chunk).split('\n')
+    partial_line = lines.pop()
+    for line in lines:
+      yield line + '\n'
+  if partial_line:
+    yield partial_line
@@ -1,29 +1,214 @@
+import Queue
+import clock
+import config
+import json
+import logging
 import re
+import sys
+import threading
 
+from cloudstorage import cloudstorage_api
+from dao import database_factory
 from google.appengine.api import app_identity
 from google.appengine.ext import deferred
+from model.base import Base
+# Imported so that every table in the schema is in Base.metadata.
+import model.database  # pylint: disable=unused-import
 from offline.sql_exporter import SqlExporter
+from sqlalchemy import Integer
 from werkzeug.exceptions import BadRequest
 
 _TABLE_PATTERN = re.compile("^[A-Za-z0-9_]+$")
 
+CSV_FORMAT = 'csv'
+AVRO_FORMAT = 'avro'
+EXPORT_FORMATS = (CSV_FORMAT, AVRO_FORMAT)
+
+# Tables with more rows than this (unless table_export_rows_per_part is set) are exported in parts.
+_DEFAULT_ROWS_PER_PART = 1000000
+# Number of threads (each with its own database connection) exporting a snapshot, unless
+# table_export_snapshot_workers is set.
+_DEFAULT_SNAPSHOT_WORKERS = 4
+MANIFEST_FILE_NAME = 'manifest.json'
+
 class TableExporter(object):
   """API that exports data from our database to UTF-8 CSV files in GCS.
 
   Used instead of Cloud SQL export because it handles newlines and null characters in a way that
   other CSV clients (e.g. BigQuery, Google Sheets) can actually understand.
+
+  Tables in the RDR schema can also be exported to Avro files, which keep the types of the
+  columns (from the models in model/*) so that loading them doesn't need to parse or infer them.
+
+  Large RDR tables with an integer primary key are split into ranges of primary key values of
+  roughly equal size (based on the minimum, maximum and count of the keys), which are exported
+  in parallel by separate tasks to part files in a directory named after the table. The last part
+  to finish writes a manifest listing all the parts to that directory.
+
+  In snapshot mode, a single task exports all the tables (and their parts) with a pool of worker
+  threads, each reading from its own transaction. The workers' transactions start with consistent
+  snapshots while another connection holds read locks on the tables (blocking writes to them for
+  that moment), so every worker reads the same state of every table. A manifest listing the files
+  for each table is written to the export directory when they are all complete.
   """
 
   @classmethod
-  def _export_csv(cls, bucket_name, database, directory, table_name):
+  def _export_table(cls, bucket_name, database, directory, table_name, compress=False,
+                    export_format=CSV_FORMAT, partition_column=None):
     assert _TABLE_PATTERN.match(table_name)
     assert _TABLE_PATTERN.match(database)
-    SqlExporter(bucket_name, use_unicode=True).run_export('%s/%s.csv' % (directory, table_name),
-                                                          'SELECT * FROM %s.%s' %
-                                                          (database, table_name))
+    ranges = None
+    if partition_column:
+      assert _TABLE_PATTERN.match(partition_column)
+      ranges = _get_part_ranges(database, table_name, partition_column)
+    extension = _get_extension(export_format, compress)
+    if not ranges:
+      cls._export_file(bucket_name, database, table_name, export_format, compress,
+                       '%s/%s%s' % (directory, table_name, extension))
+      return
+    logging.info('Exporting %s.%s in %d parts.', database, table_name, len(ranges))
+    for part in xrange(len(ranges)):
+      deferred.defer(cls._export_part, bucket_name, database, directory, table_name, compress,
+                     export_format, partition_column, ranges, part)
+
+  @classmethod
+  def _export_part(cls, bucket_name, database, directory, table_name, compress, export_format,
+                   partition_column, ranges, part):
+    """Exports the rows of a table in ranges[part], a (start, end) range of partition_column
+    values; then, if every part has been exported, writes the table's manifest."""
+    start, end = ranges[part]
+    part_names = _get_part_names(directory, table_name, export_format, compress, len(ranges))
+    where, query_params = _get_range_condition(partition_column, start, end)
+    cls._export_file(bucket_name, database, table_name, export_format, compress, part_names[part],
+                     where=where, query_params=query_params)
+    prefix = '/%s/%s/%s/' % (bucket_name, directory, table_name)
+    exported_paths = set(stat.filename for stat in cloudstorage_api.listbucket(prefix))
+    if all('/%s/%s' % (bucket_name, name) in exported_paths for name in part_names):
+      # Parts finishing at the same time may both write the (identical) manifest.
+      manifest = {'database': database,
+                  'table': table_name,
+                  'format': export_format,
+                  'compressed': compress or export_format == AVRO_FORMAT,
+                  'partitionColumn': partition_column,
+                  'parts': [{'uri': 'gs://%s/%s' % (bucket_name, name), 'start': start,
+                             'end': end}
+                            for name, (start, end) in zip(part_names, ranges)]}
+      with cloudstorage_api.open(prefix + MANIFEST_FILE_NAME, mode='w') as dest:
+        dest.write(json.dumps(manifest, indent=2, sort_keys=True))
+      logging.info('Wrote manifest for %d parts of %s.%s.', len(ranges), database, table_name)
+
+  @classmethod
+  def _export_snapshot(cls, bucket_name, database, directory, table_names, compress,
+                       export_format, partition_columns):
+    """Exports tables (in parts, for tables with a column in partition_columns) from a single
+    consistent snapshot of the database."""
+    assert _TABLE_PATTERN.match(database)
+    # (table name, file name, where clause, query parameters) for each file to export.
+    files = []
+    for table_name in table_names:
+      assert _TABLE_PATTERN.match(table_name)
+      partition_column = partition_columns.get(table_name)
+      ranges = None
+      if partition_column:
+        assert _TABLE_PATTERN.match(partition_column)
+        ranges = _get_part_ranges(database, table_name, partition_column)
+      if not ranges:
+        files.append((table_name, '%s/%s%s' % (directory, table_name,
+                                               _get_extension(export_format, compress)), '', None))
+        continue
+      # The ranges are planned before the snapshot starts, so the last one has no end.
+      ranges[-1][1] = None
+      part_names = _get_part_names(directory, table_name, export_format, compress, len(ranges))
+      for part_name, (start, end) in zip(part_names, ranges):
+        files.append((table_name, part_name) + _get_range_condition(partition_column, start, end))
+
+    snapshot_database = database_factory.make_server_cursor_database()
+    if snapshot_database.db_type == 'sqlite':
+      # SQLite doesn't support snapshots or table locks, or sharing in-memory databases between
+      # threads; export everything from one transaction in this thread.
+      num_workers = 0
+    else:
+      num_workers = min(len(files), int(config.getSetting(config.TABLE_EXPORT_SNAPSHOT_WORKERS,
+                                                          _DEFAULT_SNAPSHOT_WORKERS)))
+    sessions = [snapshot_database.make_session() for _ in xrange(max(num_workers, 1))]
+    try:
+      snapshot_time = clock.CLOCK.now()
+      if num_workers:
+        _start_snapshots(database, table_names, sessions)
+      queue = Queue.Queue()
+      for file_info in files:
+        queue.put(file_info)
+      def export_files(session, errors):
+        try:
+          while not errors:
+            try:
+              table_name, file_name, where, query_params = queue.get_nowait()
+            except Queue.Empty:
+              return
+            cls._export_file(bucket_name, database, table_name, export_format, compress,
+                             file_name, where=where, query_params=query_params, session=session)
+        except Exception:  # pylint: disable=broad-except
+          errors.append(sys.exc_info())
+      errors = []
+      if num_workers:
+        threads = [threading.Thread(target=export_files, args=(session, errors))
+                   for session in sessions]
+        for thread in threads:
+          thread.start()
+        for thread in threads:
+          thread.join()
+      else:
+        export_files(sessions[0], errors)
+      if errors:
+        # Re-raise the first failure, so that the task is retried.
+        raise errors[0][0], errors[0][1], errors[0][2]
+    finally:
+      for session in sessions:
+        session.rollback()
+        session.close()
+
+    manifest = {'database': database,
+                'format': export_format,
+                'compressed': compress or export_format == AVRO_FORMAT,
+                'snapshotTime': snapshot_time.isoformat(),
+                'tables': {table_name: [] for table_name in table_names}}
+    for table_name, file_name, _, _ in files:
+      manifest['tables'][table_name].append('gs://%s/%s' % (bucket_name, file_name))
+    with cloudstorage_api.open('/%s/%s/%s' % (bucket_name, directory, MANIFEST_FILE_NAME),
+                               mode='w') as dest:
+      dest.write(json.dumps(manifest, indent=2, sort_keys=True))
+    logging.info('Exported a snapshot of %d tables in %d files.', len(table_names), len(files))
+
+  @classmethod
+  def _export_file(cls, bucket_name, database, table_name, export_format, compress, file_name,
+                   where='', query_params=None, session=None):
+    if export_format == AVRO_FORMAT:
+      table = Base.metadata.tables[table_name]
+      # Columns are selected by name, since their order in the database may differ from the
+      # model.
+      sql = 'SELECT %s FROM %s.%s %s' % (', '.join(column.name for column in table.columns),
+                                         database, table_name, where)
+      SqlExporter(bucket_name).run_avro_export(file_name, table, sql, query_params=query_params,
+                                               session=session)
+    else:
+      SqlExporter(bucket_name, use_unicode=True, compress=compress).run_export(
+          file_name, 'SELECT * FROM %s.%s %s' % (database, table_name, where),
+          query_params=query_params, session=session)
 
   @staticmethod
-  def export_tables(database, tables, directory):
+  def export_tables(database, tables, directory, compress=False, export_format=CSV_FORMAT,
+                    snapshot=False):
+    """Starts tasks exporting tables to files in GCS.
+
+    In CSV format, if compress is set, the CSVs are gzip-compressed (and named <table>.csv.gz.)
+    Avro files (named <table>.avro) are always compressed, and are only supported for the RDR
+    database. Tables exported in parts are written to <table>/part-00000.csv etc. instead.
+
+    If snapshot is set, all the tables are exported from the same consistent snapshot by a single
+    task, which writes manifest.json to the directory when it is done.
+    """
+    if export_format not in EXPORT_FORMATS:
+      raise BadRequest("Invalid format: %s" % export_format)
     app_id = app_identity.get_application_id()
     # Determine what GCS bucket to write to based on the environment and database.
     if app_id == 'None':
@@ -37,6 +222,91 @@ class TableExporter(object):
     for table_name in tables:
       if not _TABLE_PATTERN.match(table_name):
         raise BadRequest("Invalid table name: %s" % table_name)
+      if export_format == AVRO_FORMAT and (database != 'rdr' or
+                                           table_name not in Base.metadata.tables):
+        raise BadRequest("Avro export is not supported for table: %s.%s" % (database, table_name))
+    # Only tables in the RDR schema have models to find their primary keys in.
+    partition_columns = {}
+    if database == 'rdr':
+      partition_columns = {table_name: get_partition_column(table_name) for table_name in tables}
+    if snapshot:
+      deferred.defer(TableExporter._export_snapshot, bucket_name, database, directory, tables,
+                     compress, export_format, partition_columns)
+      return {'destination': 'gs://%s/%s' % (bucket_name, directory)}
     for table_name in tables:
-      deferred.defer(TableExporter._export_csv, bucket_name, database, directory, table_name)
-    return {'destination': 'gs://%s/%s' % (bucket_name, directory)}
\ No newline at end of file
+      deferred.defer(TableExporter._export_table, bucket_name, database, directory, table_name,
+                     compress, export_format, partition_columns.get(table_name))
+    return {'destination': 'gs://%s/%s' % (bucket_name, directory)}
+
+
+def get_partition_column(table_name):
+  """Returns the name of the primary key column of an RDR table, if it has a single integer
+  primary key column; or None if the table can't be exported in parts."""
+  table = Base.metadata.tables.get(table_name)
+  if table is None:
+    return None
+  primary_key_columns = list(table.primary_key.columns)
+  if len(primary_key_columns) != 1 or not isinstance(primary_key_columns[0].type, Integer):
+    return None
+  return primary_key_columns[0].name
+
+
+def get_part_ranges(min_value, max_value, count, rows_per_part):
+  """Returns a list of [start, end) ranges that split values from min_value to max_value into
+  parts of about rows_per_part of the count values (assuming they are evenly distributed), or
+  None if they fit in one part."""
+  if not count or count <= rows_per_part:
+    return None
+  num_parts = (count + rows_per_part - 1) // rows_per_part
+  width = max((max_value - min_value + num_parts) // num_parts, 1)
+  ranges = []
+  start = min_value
+  while start <= max_value:
+    ranges.append([start, min(start + width, max_value + 1)])
+    start += width
+  return ranges
+
+
+def _get_part_ranges(database, table_name, partition_column):
+  with database_factory.get_database().session() as session:
+    min_value, max_value, count = session.execute(
+        'SELECT MIN(%s), MAX(%s), COUNT(*) FROM %s.%s' % (partition_column, partition_column,
+                                                          database, table_name)).fetchone()
+  rows_per_part = int(config.getSetting(config.TABLE_EXPORT_ROWS_PER_PART,
+                                        _DEFAULT_ROWS_PER_PART))
+  return get_part_ranges(min_value, max_value, count, rows_per_part)
+
+
+def _start_snapshots(database, table_names, sessions):
+  """Starts a transaction with a consistent snapshot in each session, while holding read locks
+  on the tables, so that no writes to them are committed between the snapshots."""
+  with database_factory.get_database().session() as lock_session:
+    lock_session.execute('LOCK TABLES %s' % ', '.join('%s.%s READ' % (database, table_name)
+                                                      for table_name in table_names))
+    try:
+      for session in sessions:
+        session.execute('SET TRANSACTION ISOLATION LEVEL REPEATABLE READ')
+        session.execute('START TRANSACTION WITH CONSISTENT SNAPSHOT')
+    finally:
+      lock_session.execute('UNLOCK TABLES')
+
+
+def _get_range_condition(partition_column, start, end):
+  """Returns a where clause and query parameters for rows with partition_column values in
+  [start, end), or from start on if end is None."""
+  if end is None:
+    return 'WHERE %s >= :start' % partition_column, {'start': start}
+  return ('WHERE %s >= :start AND %s < :end' % (partition_column, partition_column),
+          {'start': start, 'end': end})
+
+
+def _get_extension(export_format, compress):
+  if export_format == AVRO_FORMAT:
+    return '.avro'
+  return '.csv.gz' if compress else '.csv'
+
+
+def _get_part_names(directory, table_name, export_format, compress, num_parts):
+  extension = _get_extension(export_format, compress)
+  return ['%s/%s/part-%05d%s' % (directory, table_name, part, extension)
+          for part in xrange(num_parts)]
@@ -37,6 +37,11 @@ class SampleStatus(messages.Enum):
   UNSET = 0
   RECEIVED = 1
 
+class BiobankReconciliationStatus(messages.Enum):
+  """Whether the samples received for a participant and test match the finalized orders"""
+  RECEIVED = 1
+  MISSING = 2
+
 # These race values are derived from one or more answers to the race/ethnicity question
 # in questionnaire responses.
 class Race(messages.Enum):
@@ -100,8 +105,10 @@ class SuspensionStatus(messages.Enum):
 
 
 # The lower bounds of the age buckets.
-_AGE_LB = [0, 18, 26, 36, 46, 56, 66, 76, 86]
-AGE_BUCKETS = ['{}-{}'.format(b, e) for b, e in zip(_AGE_LB, [a - 1 for a in _AGE_LB[1:]] + [''])]
+AGE_BUCKET_LOWER_BOUNDS = [0, 18, 26, 36, 46, 56, 66, 76, 86]
+AGE_BUCKETS = ['{}-{}'.format(b, e) for b, e in zip(AGE_BUCKET_LOWER_BOUNDS,
+                                                    [a - 1 for a in AGE_BUCKET_LOWER_BOUNDS[1:]] +
+                                                    [''])]
 
 def extract_bucketed_age(participant_hist_obj):
   if participant_hist_obj.date_of_birth:
@@ -114,7 +121,8 @@ def get_bucketed_age(date_of_birth, today):
   if not date_of_birth:
     return UNSET
   age = relativedelta(today, date_of_birth).years
-  for begin, end in zip(_AGE_LB, [age_lb - 1 for age_lb in _AGE_LB[1:]] + ['']):
+  for begin, end in zip(AGE_BUCKET_LOWER_BOUNDS,
+                        [age_lb - 1 for age_lb in AGE_BUCKET_LOWER_BOUNDS[1:]] + ['']):
     if (age >= begin) and (not end or age <= end):
       return str(begin) + '-' + str(end)
 
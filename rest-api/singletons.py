@@ -11,10 +11,15 @@ HPO_CACHE_INDEX = 1
 SITE_CACHE_INDEX = 2
 SQL_DATABASE_INDEX = 3
 
-def reset_for_tests():
+def reset():
+  """Clears every cached singleton; e.g. in a forked worker process, which must not share the
+  parent's database connections."""
   with singletons_lock:
     singletons_map.clear()
 
+def reset_for_tests():
+  reset()
+
 def _get(cache_index):
   existing_pair = singletons_map.get(cache_index)
   if existing_pair and (existing_pair[1] is None or existing_pair[1] >= CLOCK.now()):
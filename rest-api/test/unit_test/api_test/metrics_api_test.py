@@ -1,7 +1,14 @@
+import config
+import dao.metrics_index
 import datetime
+import httplib
+import json
+import main
+import zlib
 
 from model.metrics import MetricsBucket
-from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao, MetricsCachedResponseDao
+from dao.metrics_dao import MetricsRollupDao, GZIP_WBITS, MONTH, WEEK, get_period_start
 
 from test.unit_test.unit_test_util import FlaskTestBase
 
@@ -9,6 +16,7 @@ class MetricsApiTest(FlaskTestBase):
 
   def setUp(self):
     super(MetricsApiTest, self).setUp()
+    dao.metrics_index.clear_cache()
     self.version_dao = MetricsVersionDao()
     self.bucket_dao = MetricsBucketDao()
     self.today = datetime.date.today()
@@ -67,3 +75,82 @@ class MetricsApiTest(FlaskTestBase):
                        self.expected_bucket_3], response)
     response = self.send_post('Metrics', { 'end_date': self.today.isoformat() })
     self.assertEquals([self.expected_bucket_1, self.expected_bucket_2], response)
+
+  def test_get_metrics_with_buckets_and_diffs(self):
+    self.setup_buckets()
+    response = self.send_post('Metrics', { 'diffs': True })
+    self.assertEquals([self.expected_bucket_1, self.expected_bucket_2,
+                       {'facets': {'date': self.tomorrow.isoformat()},
+                        'entries': {'x': None, 'y': 'c'},
+                        'diffFrom': self.today.isoformat()}], response)
+    response = self.send_post('Metrics', { 'start_date': self.tomorrow.isoformat(),
+                                           'diffs': True })
+    self.assertEquals([self.expected_bucket_3], response)
+
+  def test_get_metrics_projected(self):
+    self.setup_buckets()
+    response = self.send_post('Metrics', { 'metrics': ['y'], 'hpo_ids': [''] })
+    self.assertEquals([{'facets': {'date': self.today.isoformat()}, 'entries': {}},
+                       self.expected_bucket_3], response)
+    response = self.send_post('Metrics', { 'hpo_ids': ['PITT'], 'diffs': True })
+    self.assertEquals([self.expected_bucket_2], response)
+    response = self.send_post('Metrics', { 'metrics': ['x'], 'hpo_ids': [] })
+    self.assertEquals([], response)
+
+  def test_get_metrics_by_week_and_month(self):
+    self.setup_buckets()
+    MetricsRollupDao().write_rollups(1)
+    for granularity in (WEEK, MONTH):
+      today_start = get_period_start(self.today, granularity)
+      tomorrow_start = get_period_start(self.tomorrow, granularity)
+      # Each period has the metrics from its last bucket.
+      expected = []
+      if today_start != tomorrow_start:
+        expected.append({'facets': {'date': today_start.isoformat()}, 'entries': {'x': 'a'}})
+      expected.append({'facets': {'date': tomorrow_start.isoformat()}, 'entries': {'y': 'c'}})
+      response = self.send_post('Metrics', { 'granularity': granularity, 'hpo_ids': [''],
+                                             'start_date': self.today.isoformat() })
+      self.assertEquals(expected, response)
+      response = self.send_post('Metrics', { 'granularity': granularity, 'metrics': ['x'],
+                                             'hpo_ids': ['PITT'] })
+      self.assertEquals([{'facets': {'date': today_start.isoformat(), 'hpoId': 'PITT'},
+                          'entries': {'x': 'b'}}], response)
+
+  def test_get_metrics_invalid_parameters(self):
+    self.send_post('Metrics', { 'granularity': 'year' }, expected_status=httplib.BAD_REQUEST)
+    self.send_post('Metrics', { 'granularity': WEEK, 'diffs': True },
+                   expected_status=httplib.BAD_REQUEST)
+    self.send_post('Metrics', { 'metrics': 'x' }, expected_status=httplib.BAD_REQUEST)
+    self.send_post('Metrics', { 'hpo_ids': [1] }, expected_status=httplib.BAD_REQUEST)
+
+  def test_get_metrics_cached(self):
+    config.override_setting(config.METRICS_CACHE_RESPONSES, [True])
+    response = self.send_post('Metrics')
+    self.assertEquals([], response)
+    self.setup_buckets()
+    response = self.send_post('Metrics')
+    self.assertEquals([self.expected_bucket_1, self.expected_bucket_2,
+                       self.expected_bucket_3], response)
+    response = self.send_post('Metrics', { 'start_date': self.tomorrow.isoformat() })
+    self.assertEquals([self.expected_bucket_3], response)
+    response = self.send_post('Metrics', { 'end_date': self.today.isoformat(), 'diffs': True })
+    self.assertEquals([self.expected_bucket_1, self.expected_bucket_2], response)
+    cached_response = MetricsCachedResponseDao().get([1, '|%s|diffs' % self.today.isoformat()])
+    self.assertEquals([self.expected_bucket_1, self.expected_bucket_2],
+                      json.loads(zlib.decompress(cached_response.response, GZIP_WBITS)))
+
+    # Responses are served from the cache, without reading the buckets again.
+    self.bucket_dao.upsert(MetricsBucket(metricsVersionId=1, date=self.tomorrow, hpoId='',
+                                         metrics='{ "y": "d" }'))
+    response = self.send_post('Metrics', { 'start_date': self.tomorrow.isoformat() })
+    self.assertEquals([self.expected_bucket_3], response)
+    response = self._app.open(main.PREFIX + 'Metrics', method='POST',
+                              data=json.dumps({ 'start_date': self.tomorrow.isoformat() }),
+                              content_type='application/json',
+                              headers={'Accept-Encoding': 'gzip'})
+    self.assertEquals('gzip', response.headers['Content-Encoding'])
+    self.assertEquals([self.expected_bucket_3],
+                      json.loads(zlib.decompress(response.data, GZIP_WBITS)))
+    # Other requests see the change.
+    response = self.send_post('Metrics', { 'end_date': self.tomorrow.isoformat() })
+    self.assertEquals({'y': 'd'}, response[2]['entries'])
@@ -0,0 +1,62 @@
+import dao.metrics_cube
+import httplib
+
+from dao.metrics_dao import MetricsCubeDao, MetricsVersionDao, encode_cube
+from test.unit_test.unit_test_util import FlaskTestBase
+
+DIMENSIONS = ['race', 'ageRange']
+
+
+class MetricsCubeApiTest(FlaskTestBase):
+
+  def setUp(self):
+    super(MetricsCubeApiTest, self).setUp()
+    dao.metrics_cube.clear_cache()
+    self.version_dao = MetricsVersionDao()
+
+  def setup_cubes(self):
+    self.version_dao.set_pipeline_in_progress()
+    MetricsCubeDao().upsert_all([
+        encode_cube(1, 'raceByAge', 'AZ_TUCSON', DIMENSIONS, {('WHITE', '18-25'): 1,
+                                                              ('ASIAN', '26-35'): 2}),
+        encode_cube(1, 'raceByAge', 'PITT', DIMENSIONS, {('WHITE', '18-25'): 3})])
+    self.version_dao.set_pipeline_finished(True)
+
+  def test_get_cube_not_found(self):
+    self.send_post('MetricsCube', {'cube': 'raceByAge'}, expected_status=httplib.NOT_FOUND)
+    self.setup_cubes()
+    self.send_post('MetricsCube', {'cube': 'other'}, expected_status=httplib.NOT_FOUND)
+
+  def test_get_cube(self):
+    self.setup_cubes()
+    response = self.send_post('MetricsCube', {'cube': 'raceByAge'})
+    self.assertEquals({'cube': 'raceByAge',
+                       'dimensions': ['race', 'ageRange', 'hpoId'],
+                       'cells': [
+                           {'facets': {'race': 'ASIAN', 'ageRange': '26-35', 'hpoId': 'AZ_TUCSON'},
+                            'count': 2},
+                           {'facets': {'race': 'WHITE', 'ageRange': '18-25', 'hpoId': 'AZ_TUCSON'},
+                            'count': 1},
+                           {'facets': {'race': 'WHITE', 'ageRange': '18-25', 'hpoId': 'PITT'},
+                            'count': 3}]},
+                      response)
+
+  def test_get_cube_dimensions_and_filters(self):
+    self.setup_cubes()
+    response = self.send_post('MetricsCube', {'cube': 'raceByAge', 'dimensions': ['race'],
+                                              'filters': {'ageRange': ['18-25', '26-35']}})
+    self.assertEquals([{'facets': {'race': 'ASIAN'}, 'count': 2},
+                       {'facets': {'race': 'WHITE'}, 'count': 4}], response['cells'])
+    response = self.send_post('MetricsCube', {'cube': 'raceByAge', 'dimensions': [],
+                                              'filters': {'hpoId': ['PITT']}})
+    self.assertEquals([{'facets': {}, 'count': 3}], response['cells'])
+
+  def test_get_cube_invalid_parameters(self):
+    self.setup_cubes()
+    self.send_post('MetricsCube', {}, expected_status=httplib.BAD_REQUEST)
+    self.send_post('MetricsCube', {'cube': 'raceByAge', 'dimensions': ['state']},
+                   expected_status=httplib.BAD_REQUEST)
+    self.send_post('MetricsCube', {'cube': 'raceByAge', 'filters': {'race': 'WHITE'}},
+                   expected_status=httplib.BAD_REQUEST)
+    self.send_post('MetricsCube', {'cube': 'raceByAge', 'filters': {'state': ['VA']}},
+                   expected_status=httplib.BAD_REQUEST)
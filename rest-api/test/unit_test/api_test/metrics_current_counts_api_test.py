@@ -0,0 +1,34 @@
+import datetime
+import httplib
+
+from clock import FakeClock
+from test.unit_test.unit_test_util import FlaskTestBase
+
+TIME = datetime.datetime(2017, 11, 2, 10, 0)
+CONSENT_METRIC = 'Participant.consentForStudyEnrollment'
+
+
+class MetricsCurrentCountsApiTest(FlaskTestBase):
+
+  def test_current_counts(self):
+    with FakeClock(TIME):
+      self.assertEquals([{'facets': {'date': '2017-11-02'}, 'entries': {}}],
+                        self.send_post('MetricsCurrentCounts', {}))
+      participant_id = self.create_participant()
+      self.create_participant()
+      self.send_consent(participant_id)
+      response = self.send_post('MetricsCurrentCounts', {'metrics': [CONSENT_METRIC]})
+    entries = {CONSENT_METRIC + '.SUBMITTED': 1, CONSENT_METRIC + '.UNSET': 1}
+    self.assertEquals([{'facets': {'date': '2017-11-02'}, 'entries': entries},
+                       {'facets': {'date': '2017-11-02', 'hpoId': 'UNSET'}, 'entries': entries}],
+                      response)
+
+    response = self.send_post('MetricsCurrentCounts', {'metrics': ['Participant'],
+                                                       'hpo_ids': ['UNSET']})
+    self.assertEquals(1, len(response))
+    self.assertEquals(2, response[0]['entries']['Participant'])
+    self.assertEquals(1, response[0]['entries'][CONSENT_METRIC + '.SUBMITTED'])
+
+  def test_current_counts_invalid_parameters(self):
+    self.send_post('MetricsCurrentCounts', {'metrics': 'Participant'},
+                   expected_status=httplib.BAD_REQUEST)
@@ -0,0 +1,115 @@
+import datetime
+
+from code_constants import BIOBANK_TESTS, KIT_ID_SYSTEM, PMI_OPS_SYSTEM
+from dao.biobank_order_dao import BiobankOrderDao
+from dao.biobank_reconciliation_dao import BiobankReconciliationDao
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.participant_dao import ParticipantDao
+from dao.participant_summary_dao import ParticipantSummaryDao
+from model.biobank_order import BiobankOrder, BiobankOrderIdentifier, BiobankOrderedSample
+from model.biobank_stored_sample import BiobankStoredSample
+from model.participant import Participant
+from participant_enums import BiobankReconciliationStatus
+from unit_test_util import SqlTestBase
+
+_TIME = datetime.datetime(2017, 11, 1, 12, 0, 0)
+
+
+class BiobankReconciliationDaoTest(SqlTestBase):
+  def setUp(self):
+    super(BiobankReconciliationDaoTest, self).setUp()
+    self.participant = Participant(participantId=123, biobankId=555)
+    ParticipantDao().insert(self.participant)
+    ParticipantSummaryDao().insert(self.participant_summary(self.participant))
+    self.dao = BiobankReconciliationDao()
+    self.sample_dao = BiobankStoredSampleDao()
+
+  def _insert_order(self, order_id, tests, finalized_tests):
+    BiobankOrderDao().insert(BiobankOrder(
+        biobankOrderId=order_id,
+        participantId=self.participant.participantId,
+        sourceSiteId=1,
+        finalizedSiteId=1,
+        finalizedUsername='bob@pmi-ops.org',
+        created=_TIME,
+        identifiers=[BiobankOrderIdentifier(system=PMI_OPS_SYSTEM, value='O%s' % order_id),
+                     BiobankOrderIdentifier(system=KIT_ID_SYSTEM, value='kit%s' % order_id)],
+        samples=[BiobankOrderedSample(
+            biobankOrderId=order_id,
+            test=test,
+            description=u'test',
+            processingRequired=False,
+            collected=_TIME,
+            processed=_TIME,
+            finalized=_TIME if test in finalized_tests else None) for test in tests]))
+
+  def _make_sample(self, sample_id, test, confirmed):
+    return BiobankStoredSample(biobankStoredSampleId=sample_id,
+                               biobankId=self.participant.biobankId,
+                               test=test,
+                               confirmed=confirmed,
+                               created=confirmed - datetime.timedelta(hours=1))
+
+  def _get_rows(self):
+    return {row.test: row for row in self.dao.get_all()}
+
+  def test_order_then_samples(self):
+    self._insert_order('1', BIOBANK_TESTS[:2], BIOBANK_TESTS[:2])
+    rows = self._get_rows()
+    self.assertEquals(set(BIOBANK_TESTS[:2]), set(rows))
+    row = rows[BIOBANK_TESTS[0]]
+    self.assertEquals(BiobankReconciliationStatus.MISSING, row.status)
+    self.assertEquals((1, 0), (row.sentCount, row.receivedCount))
+    self.assertEquals('O1', row.sentOrderId)
+    self.assertEquals('kit1', row.biospecimenKitId)
+    self.assertEquals('Monroeville Urgent Care Center', row.sourceSiteName)
+    self.assertEquals('7035769', row.finalizedSiteMayolinkClientNumber)
+    self.assertEquals(('PITT', 'HPO'), (row.sourceSiteHpo, row.sourceSiteHpoType))
+    self.assertEquals(_TIME, row.lastTime)
+    self.assertIsNone(row.elapsedHours)
+
+    confirmed = _TIME + datetime.timedelta(hours=26)
+    self.sample_dao.insert(self._make_sample('s1', BIOBANK_TESTS[0], confirmed))
+    row = self._get_rows()[BIOBANK_TESTS[0]]
+    self.assertEquals(BiobankReconciliationStatus.RECEIVED, row.status)
+    self.assertEquals((1, 1), (row.sentCount, row.receivedCount))
+    self.assertEquals('s1', row.receivedSampleId)
+    self.assertEquals(25, row.elapsedHours)
+    self.assertEquals(confirmed, row.lastTime)
+
+    # A second order for the same test is missing a sample.
+    self._insert_order('2', BIOBANK_TESTS[:1], BIOBANK_TESTS[:1])
+    row = self._get_rows()[BIOBANK_TESTS[0]]
+    self.assertEquals(BiobankReconciliationStatus.MISSING, row.status)
+    self.assertEquals((2, 1), (row.sentCount, row.receivedCount))
+    self.assertEquals('O1,O2', row.sentOrderId)
+
+  def test_samples_without_finalized_orders(self):
+    self._insert_order('1', BIOBANK_TESTS[:1], [])
+    self.sample_dao.insert(self._make_sample('s1', BIOBANK_TESTS[0], _TIME))
+    self.sample_dao.insert(self._make_sample('s2', BIOBANK_TESTS[1], _TIME))
+    # Samples for an order that hasn't been finalized aren't reported.
+    rows = self._get_rows()
+    self.assertEquals([BIOBANK_TESTS[1]], rows.keys())
+    row = rows[BIOBANK_TESTS[1]]
+    self.assertEquals(BiobankReconciliationStatus.MISSING, row.status)
+    self.assertEquals((0, 1), (row.sentCount, row.receivedCount))
+    self.assertIsNone(row.sentOrderId)
+
+  def test_update_after_upsert_all(self):
+    self._insert_order('1', BIOBANK_TESTS[:1], BIOBANK_TESTS[:1])
+    counts = self.sample_dao.upsert_all([self._make_sample('s1', BIOBANK_TESTS[0], _TIME)])
+    # Rows are only updated by the caller, once all batches are written.
+    self.assertEquals(0, self._get_rows()[BIOBANK_TESTS[0]].receivedCount)
+    self.dao.update(counts.changed_biobank_ids)
+    self.assertEquals(1, self._get_rows()[BIOBANK_TESTS[0]].receivedCount)
+
+  def test_rebuild(self):
+    self._insert_order('1', BIOBANK_TESTS[:2], BIOBANK_TESTS[:2])
+    self.sample_dao.insert(self._make_sample('s1', BIOBANK_TESTS[0], _TIME))
+    expected = {test: row.asdict() for test, row in self._get_rows().iteritems()}
+    with self.dao.session() as session:
+      session.execute('DELETE FROM biobank_reconciliation')
+    self.dao.rebuild()
+    self.assertEquals(expected,
+                      {test: row.asdict() for test, row in self._get_rows().iteritems()})
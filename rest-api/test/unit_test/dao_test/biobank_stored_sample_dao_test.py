@@ -1,5 +1,6 @@
 import clock
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+import datetime
+from dao.biobank_stored_sample_dao import BiobankStoredSampleDao, SampleUpsertCounts
 from model.biobank_stored_sample import BiobankStoredSample
 from model.participant import Participant
 from dao.participant_dao import ParticipantDao
@@ -27,3 +28,32 @@ class BiobankStoredSampleDaoTest(SqlTestBase):
     fetched = self.dao.get(sample_id)
     self.assertEquals(test_code, created.test)
     self.assertEquals(test_code, fetched.test)
+
+  def test_upsert_all_counts(self):
+    confirmed = datetime.datetime(2017, 1, 2, 3, 4, 5)
+    def make_sample(sample_id, test='1ED04', confirmed_time=confirmed):
+      return BiobankStoredSample(biobankStoredSampleId=sample_id,
+                                 biobankId=self.participant.biobankId, test=test,
+                                 confirmed=confirmed_time)
+    self.assertEquals(SampleUpsertCounts(inserted=2),
+                      self.dao.upsert_all([make_sample('a'), make_sample('b')]))
+    counts = self.dao.upsert_all([
+        make_sample('a'),
+        make_sample('b', confirmed_time=confirmed + datetime.timedelta(hours=1)),
+        make_sample('c', test='1SAL'),
+        # The last sample with an ID is stored.
+        make_sample('c', test='1ED10')])
+    self.assertEquals(SampleUpsertCounts(inserted=1, updated=1, unchanged=1), counts)
+    self.assertEquals({self.participant.biobankId}, counts.changed_biobank_ids)
+    self.assertEquals(2, counts.written)
+    self.assertEquals(3, self.dao.count())
+    self.assertEquals(confirmed, self.dao.get('a').confirmed)
+    self.assertEquals(confirmed + datetime.timedelta(hours=1), self.dao.get('b').confirmed)
+    self.assertEquals('1ED10', self.dao.get('c').test)
+
+  def test_upsert_all_invalid_test(self):
+    with self.assertRaises(ValueError):
+      self.dao.upsert_all([BiobankStoredSample(biobankStoredSampleId='a',
+                                               biobankId=self.participant.biobankId,
+                                               test='NOT_A_TEST')])
+    self.assertEquals(0, self.dao.count())
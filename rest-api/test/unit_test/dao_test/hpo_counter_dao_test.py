@@ -0,0 +1,104 @@
+from dao.hpo_counter_dao import HpoCounterDao, FULL_PARTICIPANT, get_counter_keys, get_metric_name
+from dao.hpo_dao import HPODao
+from dao.participant_dao import ParticipantDao, make_primary_provider_link_for_name
+from dao.participant_summary_dao import ParticipantSummaryDao
+from model.hpo import HPO
+from model.participant import Participant
+from participant_enums import EnrollmentStatus, Race, UNSET_HPO_ID, TEST_HPO_NAME
+from unit_test_util import SqlTestBase, PITT_HPO_ID, random_ids
+
+
+class HpoCounterDaoTest(SqlTestBase):
+
+  def setUp(self):
+    super(HpoCounterDaoTest, self).setUp()
+    self.dao = HpoCounterDao()
+    self.participant_dao = ParticipantDao()
+
+  def test_get_counter_keys(self):
+    keys = get_counter_keys(PITT_HPO_ID)
+    self.assertIn((PITT_HPO_ID, '', '', 'R'), keys)
+    self.assertIn((PITT_HPO_ID, 'race', 'UNSET', 'R'), keys)
+    self.assertIn((PITT_HPO_ID, 'enrollmentStatus', 'INTERESTED', 'R'), keys)
+    self.assertIn((PITT_HPO_ID, 'numCompletedBaselinePPIModules', '0', 'R'), keys)
+    self.assertFalse([key for key in keys if key[3] == FULL_PARTICIPANT])
+
+    summary = self._participant_summary_with_defaults(
+        participantId=1, biobankId=2, hpoId=PITT_HPO_ID, race=Race.WHITE,
+        enrollmentStatus=EnrollmentStatus.FULL_PARTICIPANT)
+    keys = get_counter_keys(PITT_HPO_ID, summary)
+    self.assertIn((PITT_HPO_ID, 'race', 'WHITE', 'R'), keys)
+    self.assertIn((PITT_HPO_ID, 'race', 'WHITE', 'F'), keys)
+    self.assertIn((PITT_HPO_ID, 'enrollmentStatus', 'FULL_PARTICIPANT', 'F'), keys)
+    self.assertNotIn((PITT_HPO_ID, '', '', 'F'), keys)
+
+  def test_get_counter_keys_test_participants(self):
+    test_hpo_id = PITT_HPO_ID + 1
+    HPODao().insert(HPO(hpoId=test_hpo_id, name=TEST_HPO_NAME))
+    self.assertEquals([], get_counter_keys(test_hpo_id))
+    summary = self._participant_summary_with_defaults(
+        participantId=1, biobankId=2, hpoId=PITT_HPO_ID, email='bob@EXAMPLE.com')
+    self.assertEquals([], get_counter_keys(PITT_HPO_ID, summary))
+    summary.email = 'bob@example.com.au'
+    self.assertTrue(get_counter_keys(PITT_HPO_ID, summary))
+
+  def test_get_metric_name(self):
+    self.assertEquals('Participant', get_metric_name('', '', 'R'))
+    self.assertEquals('Participant.race.WHITE', get_metric_name('race', 'WHITE', 'R'))
+    self.assertEquals('FullParticipant.race.WHITE', get_metric_name('race', 'WHITE', 'F'))
+
+  def test_update_with_session(self):
+    old_keys = [(PITT_HPO_ID, 'race', 'UNSET', 'R')]
+    new_keys = [(PITT_HPO_ID, 'race', 'WHITE', 'R')]
+    with self.dao.session() as session:
+      self.dao.update_with_session(session, [], old_keys * 2)
+      self.dao.update_with_session(session, old_keys, new_keys)
+      self.dao.update_with_session(session, new_keys, new_keys)
+    self.assertEquals({PITT_HPO_ID: {'Participant.race.UNSET': 1, 'Participant.race.WHITE': 1}},
+                      self.dao.get_counts())
+
+  def test_participant_changes_update_counters(self):
+    participant = Participant()
+    with random_ids([1, 2]):
+      self.participant_dao.insert(participant)
+    counts = self.dao.get_counts()
+    self.assertEquals([UNSET_HPO_ID], counts.keys())
+    self.assertEquals(1, counts[UNSET_HPO_ID]['Participant'])
+    self.assertEquals(1, counts[UNSET_HPO_ID]['Participant.race.UNSET'])
+
+    participant.providerLink = make_primary_provider_link_for_name('PITT')
+    self.participant_dao.update(participant)
+    counts = self.dao.get_counts()
+    self.assertEquals([PITT_HPO_ID], counts.keys())
+    self.assertEquals(1, counts[PITT_HPO_ID]['Participant'])
+
+  def test_recalculate(self):
+    with random_ids([1, 2, 3, 4]):
+      self.participant_dao.insert(Participant())
+      self.participant_dao.insert(Participant())
+    # Inserting summaries directly doesn't update the counters.
+    ParticipantSummaryDao().insert(self._participant_summary_with_defaults(
+        participantId=3, biobankId=4, race=Race.WHITE, firstName='Bob', lastName='Jones',
+        email='bob@gmail.com'))
+    self.assertEquals(2, self.dao.get_counts()[UNSET_HPO_ID]['Participant.race.UNSET'])
+    self.dao.recalculate()
+    counts = self.dao.get_counts()[UNSET_HPO_ID]
+    self.assertEquals(2, counts['Participant'])
+    self.assertEquals(1, counts['Participant.race.UNSET'])
+    self.assertEquals(1, counts['Participant.race.WHITE'])
+
+  def test_recalculate_excludes_test_participants(self):
+    test_hpo_id = PITT_HPO_ID + 1
+    HPODao().insert(HPO(hpoId=test_hpo_id, name=TEST_HPO_NAME))
+    with random_ids([1, 2, 3, 4, 5, 6]):
+      self.participant_dao.insert(Participant())
+      self.participant_dao.insert(Participant(
+          providerLink=make_primary_provider_link_for_name(TEST_HPO_NAME)))
+      self.participant_dao.insert(Participant())
+    ParticipantSummaryDao().insert(self._participant_summary_with_defaults(
+        participantId=5, biobankId=6, firstName='Bob', lastName='Jones',
+        email='bob@example.com'))
+    self.dao.recalculate()
+    counts = self.dao.get_counts()
+    self.assertEquals([UNSET_HPO_ID], counts.keys())
+    self.assertEquals(1, counts[UNSET_HPO_ID]['Participant'])
@@ -0,0 +1,39 @@
+from dao.metrics_cube import InMemoryCube
+from dao.metrics_dao import encode_cube
+from unit_test_util import TestBase
+
+PITT = 'PITT'
+AZ_TUCSON = 'AZ_TUCSON'
+DIMENSIONS = ['race', 'ageRange']
+
+
+class InMemoryCubeTest(TestBase):
+
+  def setUp(self):
+    super(InMemoryCubeTest, self).setUp()
+    self.cube = InMemoryCube([
+        encode_cube(1, 'raceByAge', AZ_TUCSON, DIMENSIONS, {('WHITE', '18-25'): 1,
+                                                            ('ASIAN', '26-35'): 2}),
+        encode_cube(1, 'raceByAge', PITT, DIMENSIONS, {('WHITE', '18-25'): 3,
+                                                       ('WHITE', '26-35'): 4})])
+
+  def test_aggregate_all_dimensions(self):
+    self.assertEquals(['race', 'ageRange', 'hpoId'], self.cube.dimensions)
+    self.assertEquals([(('ASIAN', '26-35', AZ_TUCSON), 2),
+                       (('WHITE', '18-25', AZ_TUCSON), 1),
+                       (('WHITE', '18-25', PITT), 3),
+                       (('WHITE', '26-35', PITT), 4)],
+                      self.cube.aggregate())
+
+  def test_aggregate_some_dimensions(self):
+    self.assertEquals([(('ASIAN',), 2), (('WHITE',), 8)], self.cube.aggregate(['race']))
+    self.assertEquals([(('18-25', 'WHITE'), 4), (('26-35', 'ASIAN'), 2), (('26-35', 'WHITE'), 4)],
+                      self.cube.aggregate(['ageRange', 'race']))
+    self.assertEquals([((), 10)], self.cube.aggregate([]))
+
+  def test_aggregate_with_filters(self):
+    self.assertEquals([(('18-25',), 3), (('26-35',), 4)],
+                      self.cube.aggregate(['ageRange'], {'hpoId': [PITT]}))
+    self.assertEquals([((AZ_TUCSON,), 1), ((PITT,), 7)],
+                      self.cube.aggregate(['hpoId'], {'race': ['WHITE', 'OTHER']}))
+    self.assertEquals([], self.cube.aggregate(['hpoId'], {'race': ['OTHER']}))
@@ -1,8 +1,12 @@
 import datetime
+import json
 
 from clock import FakeClock
 from model.metrics import MetricsVersion, MetricsBucket
 from dao.metrics_dao import MetricsVersionDao, MetricsBucketDao, SERVING_METRICS_DATA_VERSION
+from dao.metrics_dao import MetricsExportRunDao, MetricsKeyframeDao, MetricsRollupDao
+from dao.metrics_dao import MONTH, WEEK, encode_buckets, get_period_start
+from dao.metrics_dao import MetricsCubeDao, encode_cube, decode_cube
 from unit_test_util import SqlTestBase
 from sqlalchemy.exc import IntegrityError
 from werkzeug.exceptions import PreconditionFailed
@@ -137,6 +141,210 @@ class MetricsDaoTest(SqlTestBase):
     self.assertEquals(metrics_bucket_2.asdict(),
                       self.metrics_bucket_dao.get([1, datetime.date.today(), PITT]).asdict())
 
+  def test_upsert_all_buckets(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    day_1 = datetime.date(2016, 1, 1)
+    day_2 = datetime.date(2016, 1, 2)
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_1, hpoId=PITT,
+                                                 metrics='foo'))
+    # Replaces the existing bucket, and inserts the others.
+    self.metrics_bucket_dao.upsert_all([
+        MetricsBucket(metricsVersionId=1, date=day_1, hpoId=PITT, metrics='bar'),
+        MetricsBucket(metricsVersionId=1, date=day_1, hpoId='', metrics='baz'),
+        MetricsBucket(metricsVersionId=1, date=day_2, hpoId=PITT, metrics='qux')])
+    self.metrics_bucket_dao.upsert_all([])
+
+    with self.metrics_bucket_dao.session() as session:
+      buckets = (session.query(MetricsBucket)
+          .order_by(MetricsBucket.date, MetricsBucket.hpoId)
+          .all())
+      self.assertEquals([(day_1, '', 'baz'), (day_1, PITT, 'bar'), (day_2, PITT, 'qux')],
+                        [(b.date, b.hpoId, b.metrics) for b in buckets])
+
+  def test_get_date_range_and_hpo_buckets(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    self.assertEquals((None, None), tuple(self.metrics_bucket_dao.get_date_range(1)))
+    day_1 = datetime.date(2016, 1, 1)
+    day_2 = datetime.date(2016, 1, 2)
+    day_3 = datetime.date(2016, 1, 3)
+    self.metrics_bucket_dao.upsert_all([
+        MetricsBucket(metricsVersionId=1, date=day_1, hpoId=PITT, metrics='foo'),
+        MetricsBucket(metricsVersionId=1, date=day_2, hpoId='', metrics='bar'),
+        MetricsBucket(metricsVersionId=1, date=day_2, hpoId=PITT, metrics='baz'),
+        MetricsBucket(metricsVersionId=1, date=day_3, hpoId=PITT, metrics='qux')])
+    self.assertEquals((day_1, day_3), tuple(self.metrics_bucket_dao.get_date_range(1)))
+    self.assertEquals([(day_2, PITT, 'baz'), (day_3, PITT, 'qux')],
+                      [(b.date, b.hpoId, b.metrics)
+                       for b in self.metrics_bucket_dao.get_hpo_buckets(1, day_2, day_3)])
+
+  def test_copy_buckets(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress(exported_through=TIME)
+      self.metrics_version_dao.set_pipeline_finished(True)
+    day_1 = datetime.date(2016, 1, 1)
+    day_2 = datetime.date(2016, 1, 2)
+    day_3 = datetime.date(2016, 1, 3)
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_1, hpoId='',
+                                                 metrics='foo'))
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_2, hpoId='',
+                                                 metrics='bar'))
+    self.metrics_bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=day_2, hpoId=PITT,
+                                                 metrics='baz'))
+    with FakeClock(TIME_4):
+      self.metrics_version_dao.set_pipeline_in_progress(exported_through=TIME_4)
+    self.assertEquals(TIME_4, self.metrics_version_dao.get(2).exportedThrough)
+    # Copying again replaces the previous copy.
+    self.assertEquals(day_2, self.metrics_bucket_dao.copy_buckets(1, 2, day_3))
+    self.assertEquals(day_2, self.metrics_bucket_dao.copy_buckets(1, 2, day_3))
+
+    with self.metrics_bucket_dao.session() as session:
+      buckets = (session.query(MetricsBucket)
+          .filter(MetricsBucket.metricsVersionId == 2)
+          .order_by(MetricsBucket.date, MetricsBucket.hpoId)
+          .all())
+      self.assertEquals([(day_1, '', 'foo'), (day_2, '', 'bar'), (day_2, PITT, 'baz'),
+                         (day_3, '', 'bar'), (day_3, PITT, 'baz')],
+                        [(b.date, b.hpoId, b.metrics) for b in buckets])
+
+  def _insert_keyframe_buckets(self, version_id, hpo_id, dates_and_metrics, keyframe_days):
+    encoded = list(encode_buckets(version_id, hpo_id, dates_and_metrics, keyframe_days))
+    MetricsKeyframeDao().upsert_all([obj for obj in encoded if not isinstance(obj, MetricsBucket)])
+    self.metrics_bucket_dao.upsert_all([obj for obj in encoded if isinstance(obj, MetricsBucket)])
+    return encoded
+
+  def test_keyframe_buckets(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    days = [datetime.date(2016, 1, i) for i in range(1, 5)]
+    pitt_metrics = [{'a': 1, 'b': 2}, {'a': 1, 'b': 3}, {'b': 3, 'c': 0}, {'a': 5}]
+    encoded = self._insert_keyframe_buckets(1, PITT, zip(days, pitt_metrics), 2)
+    # Keyframes are written on the first day and two days later.
+    self.assertEquals([days[0], days[2]],
+                      [obj.date for obj in encoded if not isinstance(obj, MetricsBucket)])
+    self.assertEquals([{}, {'b': 3}, {}, {'a': 5, 'b': None, 'c': None}],
+                      [json.loads(obj.metrics) for obj in encoded
+                       if isinstance(obj, MetricsBucket)])
+    self._insert_keyframe_buckets(1, '', [(days[0], {'a': 7})], None)
+
+    self.assertEquals([(days[0], '', {'a': 7}), (days[0], PITT, pitt_metrics[0])] +
+                      [(day, PITT, metrics) for day, metrics in zip(days, pitt_metrics)][1:],
+                      [(b.date, b.hpoId, json.loads(b.metrics))
+                       for b in self.metrics_bucket_dao.get_version_buckets(1)])
+    self.assertEquals([(days[1], pitt_metrics[1]), (days[2], pitt_metrics[2])],
+                      [(b.date, json.loads(b.metrics))
+                       for b in self.metrics_bucket_dao.get_hpo_buckets(1, days[1], days[2])])
+    metrics_dict, keyframe = self.metrics_bucket_dao.get_bucket_metrics(1, days[3], PITT)
+    self.assertEquals(pitt_metrics[3], metrics_dict)
+    self.assertEquals(days[2], keyframe.date)
+    self.assertEquals(({'a': 7}, None), self.metrics_bucket_dao.get_bucket_metrics(1, days[0], ''))
+    self.assertEquals((None, None), self.metrics_bucket_dao.get_bucket_metrics(1, days[1], ''))
+
+    # Keyframes are copied along with the buckets.
+    with FakeClock(TIME_4):
+      self.metrics_version_dao.set_pipeline_finished(True)
+      self.metrics_version_dao.set_pipeline_in_progress()
+    self.assertEquals(days[3], self.metrics_bucket_dao.copy_buckets(1, 2, days[3]))
+    self.assertEquals([(b.date, b.hpoId, json.loads(b.metrics))
+                       for b in self.metrics_bucket_dao.get_version_buckets(1)],
+                      [(b.date, b.hpoId, json.loads(b.metrics))
+                       for b in self.metrics_bucket_dao.get_version_buckets(2)])
+
+  def test_get_active_bucket_diffs(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    days = [datetime.date(2016, 1, i) for i in range(1, 4)]
+    self._insert_keyframe_buckets(1, PITT, zip(days, [{'a': 1}, {'a': 2}, {'b': 1}]), 2)
+    self._insert_keyframe_buckets(1, '', [(days[0], {'a': 1}), (days[2], {'a': 1})], None)
+    with FakeClock(TIME_2):
+      self.metrics_version_dao.set_pipeline_finished(True)
+    self.assertEquals([{'facets': {'date': '2016-01-01'}, 'entries': {'a': 1}},
+                       {'facets': {'date': '2016-01-01', 'hpoId': PITT}, 'entries': {'a': 1}},
+                       {'facets': {'date': '2016-01-02', 'hpoId': PITT}, 'entries': {'a': 2},
+                        'diffFrom': '2016-01-01'},
+                       {'facets': {'date': '2016-01-03'}, 'entries': {},
+                        'diffFrom': '2016-01-01'},
+                       {'facets': {'date': '2016-01-03', 'hpoId': PITT},
+                        'entries': {'a': None, 'b': 1}, 'diffFrom': '2016-01-02'}],
+                      [self.metrics_bucket_dao.to_client_json(bucket, previous_date)
+                       for bucket, previous_date
+                       in self.metrics_bucket_dao.get_active_bucket_diffs()])
+    # The first bucket in the range for each HPO contains all of its metrics.
+    self.assertEquals([(days[1], PITT, {'a': 2}, None), (days[2], '', {'a': 1}, None),
+                       (days[2], PITT, {'a': None, 'b': 1}, days[1])],
+                      [(bucket.date, bucket.hpoId, json.loads(bucket.metrics), previous_date)
+                       for bucket, previous_date
+                       in self.metrics_bucket_dao.get_active_bucket_diffs(start_date=days[1])])
+
+  def test_get_period_start(self):
+    # 2016-01-06 is a Wednesday.
+    day = datetime.date(2016, 1, 6)
+    self.assertEquals(datetime.date(2016, 1, 4), get_period_start(day, WEEK))
+    self.assertEquals(datetime.date(2016, 1, 4), get_period_start(datetime.date(2016, 1, 4), WEEK))
+    self.assertEquals(datetime.date(2016, 1, 1), get_period_start(day, MONTH))
+
+  def test_write_and_get_rollups(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    rollup_dao = MetricsRollupDao()
+    self.assertEquals([], rollup_dao.get_rollups(1, WEEK))
+    jan_1, jan_2, jan_3, jan_4 = [datetime.date(2016, 1, i) for i in range(1, 5)]
+    feb_2 = datetime.date(2016, 2, 2)
+    self._insert_keyframe_buckets(1, PITT, [(jan_1, {'a': 1}), (jan_3, {'a': 2}),
+                                            (jan_4, {'a': 3}), (feb_2, {'a': 4})], 2)
+    self._insert_keyframe_buckets(1, '', [(jan_2, {'a': 1})], None)
+    expected_weeks = [(datetime.date(2015, 12, 28), '', jan_2, {'a': 1}),
+                      (datetime.date(2015, 12, 28), PITT, jan_3, {'a': 2}),
+                      (jan_4, PITT, jan_4, {'a': 3}),
+                      (datetime.date(2016, 2, 1), PITT, feb_2, {'a': 4})]
+    expected_months = [(jan_1, '', jan_2, {'a': 1}),
+                       (jan_1, PITT, jan_4, {'a': 3}),
+                       (datetime.date(2016, 2, 1), PITT, feb_2, {'a': 4})]
+    get_rollups = lambda granularity: [(r.date, r.hpoId, r.lastDate, json.loads(r.metrics))
+                                       for r in rollup_dao.get_rollups(1, granularity)]
+    # Rollups are generated from the buckets until they are written.
+    self.assertEquals(expected_weeks, get_rollups(WEEK))
+    self.assertEquals(0, len(rollup_dao.get_all()))
+    rollup_dao.write_rollups(1)
+    # Writing rollups again (e.g. when the pipeline stage is retried) replaces them.
+    rollup_dao.write_rollups(1)
+    self.assertEquals(7, len(rollup_dao.get_all()))
+    self.assertEquals(expected_weeks, get_rollups(WEEK))
+    self.assertEquals(expected_months, get_rollups(MONTH))
+    self.assertEquals([(jan_1, PITT, {'a': 1})],
+                      [(b.date, b.hpoId, json.loads(b.metrics)) for b
+                       in self.metrics_bucket_dao.get_version_buckets(1, end_date=jan_2,
+                                                                      hpo_ids=[PITT])])
+
+  def test_encode_and_copy_cubes(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    cube_dao = MetricsCubeDao()
+    counts = {('WHITE', '18-25'): 3, ('ASIAN', '18-25'): 5, ('ASIAN', '26-35'): 0}
+    cube = encode_cube(1, 'raceByAge', PITT, ['race', 'ageRange'], counts)
+    # Values are dictionary-encoded, and cells with no participants are dropped.
+    self.assertEquals({'dimensions': ['race', 'ageRange'],
+                       'values': [['ASIAN', 'WHITE'], ['18-25']],
+                       'cells': [[0, 0, 5], [1, 0, 3]]}, json.loads(cube.cells))
+    cube_dao.upsert_all([cube, encode_cube(1, 'raceByAge', '', ['race', 'ageRange'], {})])
+    self.assertEquals({'raceByAge': ['race', 'ageRange']}, cube_dao.get_cube_dimensions(1))
+    with FakeClock(TIME_4):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    cube_dao.copy_cubes(1, 2)
+    # Copying again replaces the copied cubes.
+    cube_dao.copy_cubes(1, 2)
+    self.assertEquals([('', {}), (PITT, {('WHITE', '18-25'): 3, ('ASIAN', '18-25'): 5})],
+                      [(c.hpoId, decode_cube(c)[1]) for c in cube_dao.get_cubes(2, 'raceByAge')])
+
+  def test_copy_buckets_no_buckets(self):
+    with FakeClock(TIME):
+      self.metrics_version_dao.set_pipeline_in_progress()
+      self.metrics_version_dao.set_pipeline_finished(True)
+    with FakeClock(TIME_4):
+      self.metrics_version_dao.set_pipeline_in_progress()
+    self.assertIsNone(self.metrics_bucket_dao.copy_buckets(1, 2, datetime.date(2016, 1, 4)))
+
   def test_delete_old_metrics(self):
     with FakeClock(TIME):
       self.metrics_version_dao.set_pipeline_in_progress()
@@ -161,3 +369,28 @@ class MetricsDaoTest(SqlTestBase):
     with FakeClock(TIME_5):
       self.metrics_version_dao.delete_old_versions()
       self.assertIsNone(self.metrics_version_dao.get_with_children(1))
+
+  def test_export_run_claim_pipeline_start(self):
+    dao = MetricsExportRunDao()
+    with FakeClock(TIME):
+      run_id = dao.insert_run(TIME, ['a_0.csv', 'a_1.csv'])
+    self.assertFalse(dao.claim_pipeline_start(run_id))
+    dao.set_shard_complete(run_id, 'a_0.csv')
+    # Completing a shard again (as a retried task would) is harmless.
+    dao.set_shard_complete(run_id, 'a_0.csv')
+    self.assertFalse(dao.claim_pipeline_start(run_id))
+    self.assertFalse(dao.get(run_id).pipelineStarted)
+    dao.set_shard_complete(run_id, 'a_1.csv')
+    self.assertTrue(dao.claim_pipeline_start(run_id))
+    self.assertTrue(dao.get(run_id).pipelineStarted)
+    # Claiming again (as a retried task would) also succeeds; the pipeline start is idempotent.
+    self.assertTrue(dao.claim_pipeline_start(run_id))
+
+  def test_insert_export_run_deletes_old_runs(self):
+    dao = MetricsExportRunDao()
+    with FakeClock(TIME):
+      run_id = dao.insert_run(TIME, ['a_0.csv'])
+    with FakeClock(TIME_5):
+      run_id_2 = dao.insert_run(TIME_5, ['b_0.csv'])
+    self.assertIsNone(dao.get(run_id))
+    self.assertEquals(TIME_5, dao.get(run_id_2).exportTime)
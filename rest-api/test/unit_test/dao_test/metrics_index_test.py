@@ -0,0 +1,53 @@
+import datetime
+import json
+
+from dao.metrics_index import MetricsIndex, matches_metric_prefixes, project_metrics
+from model.metrics import MetricsRollup
+from unit_test_util import TestBase
+
+WEEK_1 = datetime.date(2016, 1, 4)
+WEEK_2 = datetime.date(2016, 1, 11)
+WEEK_3 = datetime.date(2016, 1, 18)
+PITT = 'PITT'
+
+
+def _rollup(date, hpo_id, metrics):
+  return MetricsRollup(metricsVersionId=1, granularity='week', date=date, hpoId=hpo_id,
+                       lastDate=date, metrics=json.dumps(metrics))
+
+
+class MetricsIndexTest(TestBase):
+
+  def setUp(self):
+    super(MetricsIndexTest, self).setUp()
+    self.index = MetricsIndex([
+        _rollup(WEEK_1, '', {'Participant': 2, 'Participant.race.WHITE': 1}),
+        _rollup(WEEK_1, PITT, {'Participant': 1}),
+        _rollup(WEEK_2, PITT, {'Participant': 2, 'Participant.raceOther': 1}),
+        _rollup(WEEK_3, '', {'Participant.race.WHITE': 3})])
+
+  def test_select_all(self):
+    self.assertEquals([(WEEK_1, '', {'Participant': 2, 'Participant.race.WHITE': 1}),
+                       (WEEK_1, PITT, {'Participant': 1}),
+                       (WEEK_2, PITT, {'Participant': 2, 'Participant.raceOther': 1}),
+                       (WEEK_3, '', {'Participant.race.WHITE': 3})],
+                      list(self.index.select()))
+
+  def test_select_metrics_hpo_ids_and_dates(self):
+    self.assertEquals([(WEEK_1, '', {'Participant.race.WHITE': 1}),
+                       (WEEK_3, '', {'Participant.race.WHITE': 3})],
+                      list(self.index.select(['Participant.race'], [''])))
+    self.assertEquals([(WEEK_2, PITT, {'Participant': 2, 'Participant.raceOther': 1})],
+                      list(self.index.select(['Participant'], [PITT], WEEK_2, WEEK_2)))
+    self.assertEquals([(WEEK_2, PITT, {'Participant.raceOther': 1}),
+                       (WEEK_3, '', {})],
+                      list(self.index.select(['Participant.raceOther'],
+                                             start_date=WEEK_1 + datetime.timedelta(days=1))))
+    self.assertEquals([], list(self.index.select(hpo_ids=[])))
+
+  def test_matches_metric_prefixes(self):
+    self.assertTrue(matches_metric_prefixes('Participant.race.WHITE', None))
+    self.assertTrue(matches_metric_prefixes('Participant.race.WHITE', ['Participant.race']))
+    self.assertTrue(matches_metric_prefixes('Participant.race', ['Participant.race']))
+    self.assertFalse(matches_metric_prefixes('Participant.raceOther', ['Participant.race']))
+    self.assertEquals({'a.b': 1, 'c': 3}, project_metrics({'a.b': 1, 'ab': 2, 'c': 3}, ['a', 'c']))
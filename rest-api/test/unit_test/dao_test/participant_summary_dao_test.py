@@ -1,5 +1,6 @@
 import datetime
 import json
+import mock
 from base64 import urlsafe_b64encode, urlsafe_b64decode
 
 from query import Query, Operator, FieldFilter, OrderBy
@@ -217,6 +218,30 @@ class ParticipantSummaryDaoTest(NdbTestBase):
     self.assertEquals(self.dao.get(p_mixed_samples.participantId).numBaselineSamplesArrived, 1)
     self.assertEquals(self.dao.get(p_no_samples.participantId).numBaselineSamplesArrived, 0)
 
+  def test_update_from_samples_for_biobank_ids(self):
+    baseline_tests = ['BASELINE1', 'BASELINE2']
+    config.override_setting(config.BASELINE_SAMPLE_TEST_CODES, baseline_tests)
+    self.dao.update_from_biobank_stored_samples(biobank_ids=[])  # safe noop
+
+    p_changed = self._insert(Participant(participantId=1, biobankId=11))
+    p_unchanged = self._insert(Participant(participantId=2, biobankId=22))
+    sample_dao = BiobankStoredSampleDao()
+    sample_dao.insert(BiobankStoredSample(
+        biobankStoredSampleId='11111', biobankId=p_changed.biobankId, test=baseline_tests[0]))
+    sample_dao.insert(BiobankStoredSample(
+        biobankStoredSampleId='22222', biobankId=p_unchanged.biobankId, test=baseline_tests[0]))
+
+    # Biobank IDs without participants are ignored.
+    self.dao.update_from_biobank_stored_samples(biobank_ids=[p_changed.biobankId, 99])
+    self.assertEquals(self.dao.get(p_changed.participantId).numBaselineSamplesArrived, 1)
+    self.assertEquals(self.dao.get(p_unchanged.participantId).numBaselineSamplesArrived, 0)
+
+    with mock.patch('dao.participant_summary_dao._BIOBANK_ID_BATCH_SIZE', 1):
+      self.dao.update_from_biobank_stored_samples(
+          biobank_ids=[p_changed.biobankId, p_unchanged.biobankId])
+    self.assertEquals(self.dao.get(p_changed.participantId).numBaselineSamplesArrived, 1)
+    self.assertEquals(self.dao.get(p_unchanged.participantId).numBaselineSamplesArrived, 1)
+
   def test_calculate_enrollment_status(self):
     self.assertEquals(EnrollmentStatus.FULL_PARTICIPANT,
                       self.dao.calculate_enrollment_status(True,
@@ -3,7 +3,7 @@ import datetime
 import clock
 from clock import FakeClock
 from code_constants import BIOBANK_TESTS, RACE_QUESTION_CODE, RACE_WHITE_CODE, RACE_AIAN_CODE
-from code_constants import PPI_SYSTEM
+from code_constants import KIT_ID_SYSTEM, PPI_SYSTEM, TRACKING_NUMBER_SYSTEM
 from concepts import Concept
 from model.code import CodeType
 from dao import database_utils
@@ -18,7 +18,6 @@ from model.biobank_stored_sample import BiobankStoredSample
 from model.utils import to_client_biobank_id, to_client_participant_id
 from model.participant import Participant
 from participant_enums import WithdrawalStatus
-from offline.biobank_samples_pipeline import _KIT_ID_SYSTEM, _TRACKING_NUMBER_SYSTEM
 
 # Expected names for the reconciliation_data columns in output CSVs.
 _CSV_COLUMN_NAMES = (
@@ -96,9 +95,9 @@ class MySqlReconciliationTest(FlaskTestBase):
     order.identifiers.append(id_1)
     order.identifiers.append(id_2)
     if kit_id:
-      order.identifiers.append(BiobankOrderIdentifier(system=_KIT_ID_SYSTEM, value=kit_id))
+      order.identifiers.append(BiobankOrderIdentifier(system=KIT_ID_SYSTEM, value=kit_id))
     if tracking_number:
-      order.identifiers.append(BiobankOrderIdentifier(system=_TRACKING_NUMBER_SYSTEM,
+      order.identifiers.append(BiobankOrderIdentifier(system=TRACKING_NUMBER_SYSTEM,
                                                       value=tracking_number))
     for test_code in tests:
       finalized_time = order_time
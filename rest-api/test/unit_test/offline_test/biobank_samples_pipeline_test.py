@@ -1,15 +1,21 @@
+import StringIO
 import csv
+import gzip
+import itertools
+import mock
 import random
 import pytz
 import datetime
 import time
 
 from cloudstorage import cloudstorage_api  # stubbed by testbed
+from sqlalchemy.exc import OperationalError
 
 import clock
 import config
 from code_constants import BIOBANK_TESTS
-from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import BiobankSamplesFileDao, BiobankStoredSampleDao
+from dao.biobank_stored_sample_dao import SampleUpsertCounts
 from dao.participant_dao import ParticipantDao
 from dao.participant_summary_dao import ParticipantSummaryDao
 from offline import biobank_samples_pipeline
@@ -64,6 +70,96 @@ class BiobankSamplesPipelineTest(CloudStorageSqlTestBase, NdbTestBase):
     self._check_summary(participant_ids[0], test1, '2016-11-29T12:19:32')
     self._check_summary(participant_ids[1], test2, '2016-11-29T12:38:58')
     self._check_summary(participant_ids[2], test3, '2016-11-29T12:41:26')
+    processed_file = BiobankSamplesFileDao().get_latest()
+    self.assertEquals(input_filename, processed_file.fileName)
+    self.assertEquals(3, processed_file.inserted)
+
+  def _csv_filename(self, age, prefix='cloud'):
+    return prefix + '%s.csv' % self._naive_utc_to_naive_central(clock.CLOCK.now() - age).strftime(
+        biobank_samples_pipeline.INPUT_CSV_TIME_FORMAT)
+
+  def _set_processed_file(self, file_name):
+    BiobankSamplesFileDao().upsert_processed_file(
+        file_name, biobank_samples_pipeline._timestamp_from_filename(file_name),
+        SampleUpsertCounts())
+
+  def test_unprocessed_csvs_imported_in_order(self):
+    biobank_ids = self._insert_participants()
+    test1, test2, test3 = random.sample(_BASELINE_TESTS, 3)
+    processed_filename = self._csv_filename(datetime.timedelta(hours=3))
+    self._set_processed_file(processed_filename)
+    self._write_cloud_csv(processed_filename, 'already processed')
+    # Written out of order; the newer file's samples should be imported last.
+    newer_filename = self._csv_filename(datetime.timedelta(hours=1))
+    self._write_cloud_csv(newer_filename, test_data.open_biobank_samples(
+        *biobank_ids, test1=test3, test2=test3, test3=test3).read())
+    older_filename = self._csv_filename(datetime.timedelta(hours=2))
+    self._write_cloud_csv(older_filename, test_data.open_biobank_samples(
+        *biobank_ids, test1=test1, test2=test2, test3=test3).read())
+    self._write_cloud_csv('%s/report.csv' % biobank_samples_pipeline._REPORT_SUBDIR, 'report')
+
+    counts, timestamp = biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+
+    self.assertEquals(SampleUpsertCounts(inserted=3, updated=2, unchanged=1), counts)
+    self.assertEquals(biobank_samples_pipeline._timestamp_from_filename(newer_filename), timestamp)
+    self.assertEquals([test3] * 3, [sample.test for sample in BiobankStoredSampleDao().get_all()])
+    files_dao = BiobankSamplesFileDao()
+    self.assertEquals(newer_filename, files_dao.get_latest().fileName)
+    self.assertEquals(set([processed_filename, older_filename, newer_filename]),
+                      files_dao.get_processed_file_names([processed_filename, older_filename,
+                                                          newer_filename, 'other.csv']))
+
+    # Nothing new to import.
+    counts, _ = biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+    self.assertEquals(SampleUpsertCounts(), counts)
+
+  def test_unprocessed_csvs_with_different_prefixes(self):
+    biobank_ids = self._insert_participants()
+    processed_filename = self._csv_filename(datetime.timedelta(hours=2), prefix='cloud')
+    self._set_processed_file(processed_filename)
+    # A newer file whose name sorts before the last processed file's.
+    newer_filename = self._csv_filename(datetime.timedelta(hours=1), prefix='Inventory')
+    self._write_cloud_csv(newer_filename, test_data.open_biobank_samples(*biobank_ids).read())
+    counts, _ = biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+    self.assertEquals(3, counts.inserted)
+    self.assertEquals(newer_filename, BiobankSamplesFileDao().get_latest().fileName)
+
+  def test_unprocessed_csvs_with_prefix_listed_after_latest(self):
+    config.override_setting(config.BIOBANK_SAMPLES_FILE_PREFIX, ['cloud'])
+    processed_filename = self._csv_filename(datetime.timedelta(hours=2))
+    self._set_processed_file(processed_filename)
+    newer_filename = self._csv_filename(datetime.timedelta(hours=1))
+    self._write_cloud_csv(processed_filename, 'already processed')
+    self._write_cloud_csv(newer_filename, 'new')
+    self._write_cloud_csv(self._csv_filename(datetime.timedelta(hours=1), prefix='Inventory'),
+                          'other prefix')
+    latest_file = BiobankSamplesFileDao().get_latest()
+    with mock.patch('offline.biobank_samples_pipeline.cloudstorage_api.listbucket',
+                    wraps=cloudstorage_api.listbucket) as mock_listbucket:
+      self.assertEquals([newer_filename], [
+          biobank_samples_pipeline._get_file_name(_FAKE_BUCKET, path) for path, _
+          in biobank_samples_pipeline._find_unprocessed_samples_csvs(_FAKE_BUCKET, latest_file)])
+    mock_listbucket.assert_called_once_with('/%s/cloud' % _FAKE_BUCKET,
+                                            marker='/%s/%s' % (_FAKE_BUCKET, processed_filename),
+                                            delimiter='/')
+
+  def test_unprocessed_csvs_first_run_imports_latest(self):
+    biobank_ids = self._insert_participants()
+    self._write_cloud_csv(self._csv_filename(datetime.timedelta(hours=2)), 'not imported')
+    latest_filename = self._csv_filename(datetime.timedelta(hours=1))
+    self._write_cloud_csv(latest_filename, test_data.open_biobank_samples(*biobank_ids).read())
+    counts, _ = biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+    self.assertEquals(3, counts.inserted)
+    self.assertEquals(latest_filename, BiobankSamplesFileDao().get_latest().fileName)
+
+  def test_unprocessed_csvs_too_old(self):
+    biobank_ids = self._insert_participants()
+    self._write_cloud_csv(self._csv_filename(datetime.timedelta(hours=25)),
+                          test_data.open_biobank_samples(*biobank_ids).read())
+    with self.assertRaises(biobank_samples_pipeline.DataError):
+      biobank_samples_pipeline.upsert_from_unprocessed_csvs()
+    # The samples are still imported.
+    self.assertEquals(3, BiobankStoredSampleDao().count())
 
   def test_old_csv_not_imported(self):
     now = clock.CLOCK.now()
@@ -139,9 +235,68 @@ class BiobankSamplesPipelineTest(CloudStorageSqlTestBase, NdbTestBase):
 
   def test_column_missing(self):
     with open(test_data.data_path('biobank_samples_missing_field.csv')) as samples_file:
-      reader = csv.DictReader(samples_file, delimiter='\t')
       with self.assertRaises(biobank_samples_pipeline.DataError):
-        biobank_samples_pipeline._upsert_samples_from_csv(reader)
+        biobank_samples_pipeline._upsert_samples_from_csv(samples_file)
+
+  def _insert_participants(self):
+    return [self.participant_dao.insert(Participant()).biobankId for _ in xrange(3)]
+
+  @mock.patch('offline.biobank_samples_pipeline._LINES_PER_CHUNK', 1)
+  @mock.patch('offline.biobank_samples_pipeline._BATCH_SIZE', 1)
+  def test_upsert_gzipped_csv_in_batches(self):
+    samples_file = test_data.open_biobank_samples(*self._insert_participants())
+    compressed_file = StringIO.StringIO()
+    with gzip.GzipFile(fileobj=compressed_file, mode='wb') as gzip_file:
+      gzip_file.write(samples_file.read())
+    compressed_file.seek(0)
+    counts = biobank_samples_pipeline._upsert_samples_from_csv(compressed_file)
+    self.assertEquals(3, counts.inserted)
+    self.assertEquals(3, BiobankStoredSampleDao().count())
+
+  @mock.patch('offline.biobank_samples_pipeline._DEADLOCK_RETRY_SECS', 0)
+  @mock.patch('offline.biobank_samples_pipeline._LINES_PER_CHUNK', 1)
+  @mock.patch('offline.biobank_samples_pipeline._BATCH_SIZE', 1)
+  def test_deadlocked_batch_retried(self):
+    samples_file = test_data.open_biobank_samples(*self._insert_participants())
+    upsert_all = BiobankStoredSampleDao.upsert_all
+    call_numbers = itertools.count()
+    calls = []
+    def deadlock_first_batch(dao, samples):
+      calls.append(samples)
+      if next(call_numbers) == 0:
+        raise OperationalError('INSERT INTO biobank_stored_sample ...', {},
+                               Exception(1213, 'Deadlock found when trying to get lock'))
+      return upsert_all(dao, samples)
+    with mock.patch.object(BiobankStoredSampleDao, 'upsert_all', autospec=True,
+                           side_effect=deadlock_first_batch):
+      counts = biobank_samples_pipeline._upsert_samples_from_csv(samples_file)
+    self.assertEquals(3, counts.inserted)
+    self.assertEquals(3, BiobankStoredSampleDao().count())
+    # The deadlocked batch was written again.
+    self.assertEquals(4, len(calls))
+    self.assertEquals(2, calls.count(calls[0]))
+
+  @mock.patch('offline.biobank_samples_pipeline._DEADLOCK_RETRY_SECS', 0)
+  def test_other_database_errors_not_retried(self):
+    samples_file = test_data.open_biobank_samples(*self._insert_participants())
+    error = OperationalError('INSERT INTO biobank_stored_sample ...', {},
+                             Exception(2006, 'MySQL server has gone away'))
+    with mock.patch.object(BiobankStoredSampleDao, 'upsert_all',
+                           side_effect=error) as mock_upsert_all:
+      with self.assertRaises(OperationalError):
+        biobank_samples_pipeline._upsert_samples_from_csv(samples_file)
+    self.assertEquals(1, mock_upsert_all.call_count)
+
+  @mock.patch('offline.biobank_samples_pipeline._LINES_PER_CHUNK', 1)
+  @mock.patch('offline.biobank_samples_pipeline._BATCH_SIZE', 1)
+  def test_invalid_row_stops_import(self):
+    lines = test_data.open_biobank_samples(*self._insert_participants()).read().splitlines(True)
+    header = lines[0].rstrip('\n').split('\t')
+    values = lines[-1].rstrip('\n').split('\t')
+    values[header.index(biobank_samples_pipeline._Columns.CONFIRMED_DATE)] = '2016 11 19'
+    lines[-1] = '\t'.join(values) + '\n'
+    with self.assertRaises(biobank_samples_pipeline.DataError):
+      biobank_samples_pipeline._upsert_samples_from_csv(StringIO.StringIO(''.join(lines)))
 
   def test_get_reconciliation_report_paths(self):
     dt = datetime.datetime(2016, 12, 22, 18, 30, 45)
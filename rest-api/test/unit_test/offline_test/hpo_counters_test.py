@@ -0,0 +1,42 @@
+import datetime
+import json
+
+from dao.hpo_counter_dao import HpoCounterDao
+from dao.metrics_dao import MetricsBucketDao, MetricsVersionDao
+from model.metrics import MetricsBucket
+from offline.hpo_counters import reconcile_hpo_counters
+from unit_test_util import SqlTestBase, PITT_HPO_ID
+
+DATE = datetime.date(2017, 11, 1)
+
+
+class HpoCountersTest(SqlTestBase):
+
+  def setUp(self):
+    super(HpoCountersTest, self).setUp()
+    self.counter_dao = HpoCounterDao()
+
+  def test_reconcile_without_version(self):
+    self.assertIsNone(reconcile_hpo_counters())
+
+  def test_reconcile(self):
+    version_dao = MetricsVersionDao()
+    version_dao.set_pipeline_in_progress()
+    bucket_dao = MetricsBucketDao()
+    bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=DATE - datetime.timedelta(days=1),
+                                    hpoId='PITT', metrics=json.dumps({'Participant': 5})))
+    bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=DATE, hpoId='PITT',
+                                    metrics=json.dumps({'Participant': 2,
+                                                        'Participant.race.UNSET': 1,
+                                                        'Participant.ageRange.UNSET': 1})))
+    bucket_dao.insert(MetricsBucket(metricsVersionId=1, date=DATE, hpoId='',
+                                    metrics=json.dumps({'Participant': 2})))
+    version_dao.set_pipeline_finished(True)
+    with self.counter_dao.session() as session:
+      self.counter_dao.update_with_session(session, [], [(PITT_HPO_ID, '', '', 'R'),
+                                                         (PITT_HPO_ID, 'race', 'UNSET', 'R'),
+                                                         (PITT_HPO_ID, 'race', 'WHITE', 'R')])
+    # The total and Participant.race.WHITE differ; ageRange isn't counted.
+    self.assertEquals(2, reconcile_hpo_counters())
+    self.assertEquals(2, reconcile_hpo_counters(recalculate=True))
+    self.assertEquals({}, self.counter_dao.get_counts())
@@ -0,0 +1,79 @@
+import datetime
+import os
+import shutil
+import tempfile
+
+import offline.local_metrics_pipeline
+
+from offline.local_metrics_pipeline import run_stages, _STAGES
+from unit_test_util import TestBase
+
+_NOW = datetime.datetime(2017, 1, 4)
+
+
+class LocalMetricsPipelineTest(TestBase):
+
+  def setUp(self):
+    super(LocalMetricsPipelineTest, self).setUp()
+    self.work_dir = tempfile.mkdtemp()
+    self.input_dir = tempfile.mkdtemp()
+
+  def tearDown(self):
+    shutil.rmtree(self.work_dir)
+    shutil.rmtree(self.input_dir)
+    super(LocalMetricsPipelineTest, self).tearDown()
+
+  def _write_input(self, name, lines):
+    path = os.path.join(self.input_dir, name)
+    with open(path, 'w') as f:
+      f.write(''.join(line + '\n' for line in lines))
+    return path
+
+  def _run_count_stage(self, input_paths, num_partitions):
+    output_paths = run_stages(input_paths, self.work_dir, {'now': _NOW}, num_processes=1,
+                              num_partitions=num_partitions, stages=[_STAGES[1]])
+    self.assertEquals(num_partitions, len(output_paths))
+    lines = []
+    for path in output_paths:
+      with open(path) as f:
+        lines.extend(f.read().splitlines())
+    return sorted(lines)
+
+  def test_count_stage(self):
+    input_1 = self._write_input('deltas_1', [
+        'PITT|R|Participant|2017-01-01|1',
+        'PITT|R|Participant.race.WHITE|2017-01-01|1',
+        'PITT|R|Participant.race.WHITE|2017-01-03|-1',
+    ])
+    input_2 = self._write_input('deltas_2', [
+        'PITT|R|Participant|2017-01-02|1',
+        'PITT|R|Participant.race.UNSET|2017-01-03|1',
+        # After "now"; ignored.
+        'PITT|R|Participant.race.UNSET|2017-01-05|1',
+    ])
+    expected = sorted([
+        'PITT|R|Participant|2017-01-01|1',
+        'PITT|R|Participant|2017-01-02|2',
+        'PITT|R|Participant|2017-01-03|2',
+        'PITT|R|Participant|2017-01-04|2',
+        'PITT|R|Participant.race.WHITE|2017-01-01|1',
+        'PITT|R|Participant.race.WHITE|2017-01-02|1',
+        'PITT|R|Participant.race.UNSET|2017-01-03|1',
+        'PITT|R|Participant.race.UNSET|2017-01-04|1',
+    ])
+    self.assertEquals(expected, self._run_count_stage([input_1, input_2], 3))
+
+  def test_count_stage_with_spills(self):
+    offline.local_metrics_pipeline._SPILL_SIZE = 2
+    try:
+      input_1 = self._write_input('deltas_1', [
+          'PITT|R|Participant|2017-01-03|1',
+          'PITT|R|Participant|2017-01-03|1',
+          'PITT|R|Participant|2017-01-04|1',
+          'PITT|R|Participant|2017-01-04|-1',
+          'PITT|R|Participant|2017-01-04|1',
+      ])
+      self.assertEquals(['PITT|R|Participant|2017-01-03|2', 'PITT|R|Participant|2017-01-04|3'],
+                        self._run_count_stage([input_1], 1))
+    finally:
+      offline.local_metrics_pipeline._SPILL_SIZE = 100000
@@ -2,6 +2,7 @@ import clock
 import mock
 
 import config
+from dao.biobank_stored_sample_dao import SampleUpsertCounts
 from offline import main
 from test.unit_test.unit_test_util import TestBase
 
@@ -22,7 +23,7 @@ class MainTest(TestBase):
       self, mock_send_mail, mock_get_app_id, mock_check_cron, mock_upsert):
     mock_get_app_id.return_value = 'all-of-us-rdr-unittests'
     # The return value should be unused, but it clarifies errors to have a realistic value.
-    mock_upsert.return_value = 25, clock.CLOCK.now()
+    mock_upsert.return_value = SampleUpsertCounts(inserted=25), clock.CLOCK.now()
     mock_upsert.side_effect = ValueError('should be thrown for test')
     with self.assertRaises(ValueError):
       main.import_biobank_samples()
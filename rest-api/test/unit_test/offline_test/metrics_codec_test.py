@@ -0,0 +1,83 @@
+import StringIO
+import datetime
+import threading
+
+import offline.metrics_codec
+
+from offline.metrics_codec import BinaryCodec, TEXT_CODEC, ROW, DATE_DELTA, METRIC_COUNT
+from offline.metrics_codec import get_codec, get_codec_params
+from unit_test_util import TestBase
+
+_DICTIONARY = ['R', 'F', '*', 'PITT', 'race.WHITE']
+
+_ROWS = [
+    ('PITT', 'R', 'race.WHITE', '2017-01-01', 1),
+    ('PITT', 'F', 'race.WHITE', '2017-01-02', -1),
+    ('AZ_TUCSON', 'R', 'state.PIIState_VA', '1969-12-31', 123456789),
+    ('*', 'R', 'Participant', '2017-12-31', 0),
+]
+
+
+class MetricsCodecTest(TestBase):
+
+  def test_text_codec_matches_pipe_delimited_format(self):
+    self.assertEquals('PITT|R|race.WHITE|2017-01-01|1\n',
+                      TEXT_CODEC.encode_record(ROW, _ROWS[0]))
+    self.assertEquals('2017-01-02|-1', TEXT_CODEC.encode(DATE_DELTA, ('2017-01-02', -1)))
+    self.assertEquals(('R', 'race.WHITE', 42), TEXT_CODEC.decode(METRIC_COUNT, 'R|race.WHITE|42'))
+
+  def test_round_trip(self):
+    for codec in (TEXT_CODEC, BinaryCodec(_DICTIONARY)):
+      for row in _ROWS:
+        self.assertEquals(row, codec.decode(ROW, codec.encode(ROW, row)))
+      records = ''.join(codec.encode_record(ROW, row) for row in _ROWS)
+      self.assertEquals(_ROWS, list(codec.read_records(ROW, StringIO.StringIO(records))))
+
+  def test_binary_codec_is_smaller(self):
+    codec = BinaryCodec(_DICTIONARY)
+    text_size = len(''.join(TEXT_CODEC.encode_record(ROW, row) for row in _ROWS))
+    binary_size = len(''.join(codec.encode_record(ROW, row) for row in _ROWS))
+    self.assertLess(binary_size, text_size)
+    # Strings in the dictionary take up one byte.
+    self.assertEquals(1, len(codec.encode(('s',), ('PITT',))))
+
+  def test_binary_read_records_across_chunks(self):
+    codec = BinaryCodec(_DICTIONARY)
+    rows = _ROWS * 50
+    records = ''.join(codec.encode_record(ROW, row) for row in rows)
+    offline.metrics_codec._READ_SIZE = 7
+    try:
+      self.assertEquals(rows, list(codec.read_records(ROW, StringIO.StringIO(records))))
+      with self.assertRaises(ValueError):
+        list(codec.read_records(ROW, StringIO.StringIO(records[:-1])))
+    finally:
+      offline.metrics_codec._READ_SIZE = 1024 * 1024
+
+  def test_text_encode_count_runs_in_parallel(self):
+    first_ordinal = datetime.date(2017, 1, 1).toordinal()
+    errors = []
+    def encode_runs(offset):
+      for i in xrange(200):
+        ordinal = first_ordinal + ((i * 37 + offset) % 500) - 250
+        expected = ''.join('PITT|R|Participant|%s|3\n' % datetime.date.fromordinal(o).isoformat()
+                           for o in xrange(ordinal, ordinal + 5))
+        actual = TEXT_CODEC.encode_count_runs(('PITT', 'R', 'Participant'),
+                                              [(ordinal, ordinal + 4, 3)])
+        if actual != expected:
+          errors.append(actual)
+    threads = [threading.Thread(target=encode_runs, args=(offset,)) for offset in xrange(8)]
+    for thread in threads:
+      thread.start()
+    for thread in threads:
+      thread.join()
+    self.assertEquals([], errors)
+
+  def test_get_codec(self):
+    self.assertIs(TEXT_CODEC, get_codec({}))
+    self.assertIs(TEXT_CODEC, get_codec(get_codec_params('text', None)))
+    params = get_codec_params('binary', [u'PITT'])
+    codec = get_codec(params, 'mr1')
+    self.assertIs(codec, get_codec(params, 'mr1'))
+    self.assertEquals(('PITT',), codec.decode(('s',), codec.encode(('s',), ('PITT',))))
+    with self.assertRaises(ValueError):
+      get_codec_params('zip', None)
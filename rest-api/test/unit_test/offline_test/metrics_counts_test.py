@@ -0,0 +1,57 @@
+import datetime
+import random
+import unittest
+
+from offline.metrics_codec import BinaryCodec, TEXT_CODEC, ROW
+from offline.metrics_counts import daily_counts, daily_changes, daily_count_runs_numpy
+from offline.metrics_counts import expand_runs, numpy_available
+from unit_test_util import TestBase
+
+_END_DATE = datetime.date(2017, 1, 5)
+
+
+class MetricsCountsTest(TestBase):
+
+  def test_daily_counts(self):
+    delta_map = {'2017-01-01': 1, '2017-01-03': -1, '2017-01-04': 2, '2017-01-06': 5}
+    self.assertEquals([('2017-01-01', 1), ('2017-01-02', 1), ('2017-01-04', 2),
+                       ('2017-01-05', 2)],
+                      list(daily_counts(delta_map, _END_DATE)))
+
+  def test_daily_counts_final_count_zero(self):
+    delta_map = {'2017-01-01': 1, '2017-01-02': 0, '2017-01-04': -1}
+    # Dates between deltas are output even when their count is zero; nothing is output after the
+    # last delta.
+    self.assertEquals([('2017-01-01', 1), ('2017-01-02', 1), ('2017-01-03', 1)],
+                      list(daily_counts(delta_map, _END_DATE)))
+
+  def test_daily_changes(self):
+    delta_map = {'2017-01-01': 1, '2017-01-02': -1, '2017-01-04': -1}
+    self.assertEquals([('2017-01-01', 1), ('2017-01-04', -1), ('2017-01-05', -1)],
+                      list(daily_changes(delta_map, _END_DATE)))
+
+  @unittest.skipIf(not numpy_available(), 'NumPy is not installed')
+  def test_numpy_matches_python(self):
+    rand = random.Random(17)
+    start = datetime.date(2016, 12, 1).toordinal()
+    for _ in range(200):
+      delta_map = {}
+      for _ in range(rand.randint(0, 10)):
+        date = datetime.date.fromordinal(start + rand.randint(0, 45))
+        delta_map[date.isoformat()] = rand.randint(-3, 3)
+      self.assertEquals(list(daily_counts(delta_map, _END_DATE)),
+                        list(expand_runs(daily_count_runs_numpy(delta_map, _END_DATE))))
+      self.assertEquals(list(daily_changes(delta_map, _END_DATE)),
+                        list(expand_runs(daily_count_runs_numpy(delta_map, _END_DATE,
+                                                                changes=True))))
+
+  @unittest.skipIf(not numpy_available(), 'NumPy is not installed')
+  def test_encode_count_runs(self):
+    key = ('PITT', 'R', 'Participant')
+    delta_map = {'2016-12-30': 2, '2017-01-02': -1, '2017-01-03': 3}
+    runs = daily_count_runs_numpy(delta_map, _END_DATE)
+    self.assertEquals(3, len(runs))
+    for codec in (TEXT_CODEC, BinaryCodec(['PITT', 'Participant'])):
+      self.assertEquals(''.join(codec.encode_record(ROW, key + date_and_count)
+                                for date_and_count in daily_counts(delta_map, _END_DATE)),
+                        codec.encode_count_runs(key, runs))
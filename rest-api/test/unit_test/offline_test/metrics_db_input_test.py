@@ -0,0 +1,19 @@
+from offline.metrics_db_input import split_participant_id_range
+from unit_test_util import TestBase
+
+
+class MetricsDbInputTest(TestBase):
+
+  def test_split_participant_id_range(self):
+    self.assertEquals([(1, 3), (4, 6), (7, 10)], split_participant_id_range((1, 10), 3))
+    self.assertEquals([(5, 5)], split_participant_id_range((5, 5), 4))
+    self.assertEquals([(1, 1), (2, 2)], split_participant_id_range((1, 2), 20))
+    self.assertEquals([], split_participant_id_range((None, None), 3))
+
+  def test_split_participant_id_range_covers_all_ids(self):
+    ranges = split_participant_id_range((100000000, 999999999), 40)
+    self.assertEquals(40, len(ranges))
+    self.assertEquals(100000000, ranges[0][0])
+    self.assertEquals(999999999, ranges[-1][1])
+    for (_, last_id), (next_first_id, _) in zip(ranges, ranges[1:]):
+      self.assertEquals(last_id + 1, next_first_id)
@@ -1,8 +1,16 @@
+import config
 import datetime
 import json
+import mock
+import offline.local_metrics_pipeline
 import offline.metrics_export
+import os
+import shutil
+import tempfile
+import zlib
 
 from clock import FakeClock
+from cloudstorage import cloudstorage_api
 from code_constants import PPI_SYSTEM, CONSENT_PERMISSION_YES_CODE, CONSENT_PERMISSION_NO_CODE
 from code_constants import GENDER_IDENTITY_QUESTION_CODE, EHR_CONSENT_QUESTION_CODE
 from code_constants import RACE_QUESTION_CODE, STATE_QUESTION_CODE, RACE_WHITE_CODE
@@ -14,12 +22,16 @@ from model.code import CodeType
 from model.hpo import HPO
 from dao.biobank_stored_sample_dao import BiobankStoredSampleDao
 from dao.hpo_dao import HPODao
-from dao.metrics_dao import MetricsVersionDao, SERVING_METRICS_DATA_VERSION
+from dao.metrics_dao import MetricsVersionDao, MetricsExportRunDao, SERVING_METRICS_DATA_VERSION
+from dao.metrics_dao import MetricsBucketDao, MetricsKeyframeDao, MetricsCachedResponseDao
+from dao.metrics_dao import MetricsRollupDao, GZIP_WBITS, MONTH, get_period_start
+from dao.metrics_dao import MetricsCubeDao, decode_cube
 from dao.participant_dao import ParticipantDao, make_primary_provider_link_for_name
-from model.metrics import MetricsVersion
+from model.metrics import MetricsVersion, MetricsKeyframe
 from model.participant import Participant
 from offline.metrics_config import ANSWER_FIELD_TO_QUESTION_CODE
 from offline.metrics_config import get_participant_fields, HPO_ID_FIELDS, ANSWER_FIELDS
+from offline.local_metrics_pipeline import run_local_pipeline
 from offline.metrics_export import MetricsExport, _HPO_IDS_CSV, _PARTICIPANTS_CSV, _ANSWERS_CSV
 from offline_test.gcs_utils import assertCsvContents
 from test_data import load_biobank_order_json, load_measurement_json
@@ -33,6 +45,7 @@ TIME_2 = datetime.datetime(2016, 1, 2)
 TIME_3 = datetime.datetime(2016, 1, 3)
 TIME_4 = datetime.datetime(2016, 1, 4)
 TIME_FORMAT = '%Y-%m-%dT%H:%M:%SZ'
+_CUBES = {'raceByAgeRangeByEnrollmentStatus': ['race', 'ageRange', 'enrollmentStatus']}
 
 
 class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
@@ -48,6 +61,7 @@ class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
     offline.metrics_export._QUEUE_NAME = 'default'
     self.taskqueue.FlushQueue('default')
     self.maxDiff = None
+    config.override_setting(config.METRICS_CUBES, _CUBES)
 
   def tearDown(self):
     super(MetricsExportTest, self).tearDown()
@@ -233,7 +247,8 @@ class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
         inProgress=False,
         complete=True,
         date=TIME_4,
-        dataVersion=SERVING_METRICS_DATA_VERSION)
+        dataVersion=SERVING_METRICS_DATA_VERSION,
+        exportedThrough=TIME_3)
     self.assertEquals(expected_version.asdict(), metrics_version.asdict())
 
     buckets = MetricsVersionDao().get_with_children(
@@ -661,6 +676,323 @@ class MetricsExportTest(CloudStorageSqlTestBase, FlaskTestBase):
     # There is a biobank order on 1/4, but it gets ignored since it's after the run date.
     self.assertBucket(bucket_map, TIME_4, '')
 
+  def _run_metrics(self, export_time, pipeline_time, incremental=False):
+    with FakeClock(export_time):
+      MetricsExport.start_export_tasks(BUCKET_NAME, 2, incremental=incremental)
+      run_deferred_tasks(self)
+    with FakeClock(pipeline_time):
+      test_support.execute_until_empty(self.taskqueue)
+    return MetricsVersionDao().get_serving_version()
+
+  def _get_nonzero_bucket_metrics(self, metrics_version_id):
+    buckets = MetricsBucketDao().get_version_buckets(metrics_version_id)
+    bucket_metrics = {}
+    for bucket in buckets:
+      metrics = {k: v for k, v in json.loads(bucket.metrics).iteritems() if v}
+      if metrics:
+        bucket_metrics['%s|%s' % (bucket.date.isoformat(), bucket.hpoId)] = metrics
+    return bucket_metrics
+
+  def _get_nonzero_cube_counts(self, metrics_version_id):
+    cube_dao = MetricsCubeDao()
+    cube_counts = {}
+    for name in cube_dao.get_cube_dimensions(metrics_version_id):
+      for cube in cube_dao.get_cubes(metrics_version_id, name):
+        counts = {','.join(values): count for values, count in decode_cube(cube)[1].iteritems()}
+        if counts:
+          cube_counts['%s|%s' % (name, cube.hpoId)] = counts
+    return cube_counts
+
+  def test_metrics_cubes_match_bucket_metrics(self):
+    self._create_data()
+    version = self._run_metrics(TIME_4, TIME_4)
+    version_id = version.metricsVersionId
+    cube_dao = MetricsCubeDao()
+    dimensions = ['race', 'ageRange', 'enrollmentStatus']
+    self.assertEquals({'raceByAgeRangeByEnrollmentStatus': dimensions},
+                      cube_dao.get_cube_dimensions(version_id))
+    cubes = cube_dao.get_cubes(version_id, 'raceByAgeRangeByEnrollmentStatus')
+    self.assertTrue(cubes)
+    buckets = {bucket.hpoId: json.loads(bucket.metrics) for bucket
+               in MetricsBucketDao().get_version_buckets(version_id, TIME_4.date(), TIME_4.date())}
+    # Summing the cells of each HPO's cube over all but one dimension gives the counts for that
+    # dimension in the HPO's bucket for the day the cube was written.
+    for cube in cubes:
+      bucket_metrics = buckets[cube.hpoId]
+      counts = decode_cube(cube)[1]
+      self.assertEquals(bucket_metrics['Participant'], sum(counts.values()))
+      for i, dimension in enumerate(dimensions):
+        dimension_counts = {}
+        for values, count in counts.iteritems():
+          metric_name = 'Participant.%s.%s' % (dimension, values[i])
+          dimension_counts[metric_name] = dimension_counts.get(metric_name, 0) + count
+        for metric_name, count in dimension_counts.iteritems():
+          self.assertEquals(bucket_metrics[metric_name], count)
+
+  def test_no_metrics_cubes_by_default(self):
+    del config.CONFIG_OVERRIDES[config.METRICS_CUBES]
+    self._create_data()
+    version = self._run_metrics(TIME_4, TIME_4)
+    self.assertEquals({}, MetricsCubeDao().get_cube_dimensions(version.metricsVersionId))
+
+  def test_incremental_metrics_match_full_metrics(self):
+    self._create_data()
+    with FakeClock(TIME):
+      # This participant doesn't change after the first run, so only shows up in the incremental
+      # run via the buckets copied from it.
+      ParticipantDao().insert(Participant(participantId=5, biobankId=6,
+                              providerLink=make_primary_provider_link_for_name('PITT')))
+      self.send_consent('P5', email='alice@gmail.com')
+      # Nor does this one, who turns 18 (moving into a new age range) on 1/3; they are exported
+      # by the incremental run for that.
+      ParticipantDao().insert(Participant(participantId=6, biobankId=7,
+                              providerLink=make_primary_provider_link_for_name('PITT')))
+      self.send_consent('P6', email='carol@gmail.com')
+    with ParticipantDao().session() as session:
+      session.execute('UPDATE participant_summary SET date_of_birth = :date_of_birth '
+                      'WHERE participant_id = 6', {'date_of_birth': datetime.date(1998, 1, 3)})
+
+    # Only data up to the end of 1/2 is included in the first run.
+    base_time = TIME_2 + datetime.timedelta(hours=12)
+    base_version = self._run_metrics(base_time, base_time)
+    self.assertEquals(base_time, base_version.exportedThrough)
+
+    incremental_version = self._run_metrics(TIME_4, TIME_4, incremental=True)
+    self.assertNotEquals(base_version.metricsVersionId, incremental_version.metricsVersionId)
+    self.assertEquals(TIME_4, incremental_version.exportedThrough)
+    # Only the participants that changed after the first run are exported.
+    prefix = TIME_4.isoformat() + '/'
+    assertCsvContents(self, BUCKET_NAME, prefix + _HPO_IDS_CSV % 1, [
+        HPO_ID_FIELDS, ['1', 'AZ_TUCSON', TIME.strftime(TIME_FORMAT)],
+        ['1', 'PITT', TIME_3.strftime(TIME_FORMAT)]
+    ])
+    assertCsvContents(self, BUCKET_NAME, prefix + _HPO_IDS_CSV % 0, [
+        HPO_ID_FIELDS, ['2', 'UNSET', TIME.strftime(TIME_FORMAT)],
+        ['2', 'PITT', TIME_3.strftime(TIME_FORMAT)], ['6', 'PITT', TIME.strftime(TIME_FORMAT)]
+    ])
+
+    full_time = TIME_4 + datetime.timedelta(hours=1)
+    full_version = self._run_metrics(full_time, full_time)
+    self.assertNotEquals(incremental_version.metricsVersionId, full_version.metricsVersionId)
+    full_metrics = self._get_nonzero_bucket_metrics(full_version.metricsVersionId)
+    self.assertTrue(full_metrics)
+    self.assertEquals(pretty(full_metrics),
+                      pretty(self._get_nonzero_bucket_metrics(
+                          incremental_version.metricsVersionId)))
+    full_cube_counts = self._get_nonzero_cube_counts(full_version.metricsVersionId)
+    self.assertTrue(full_cube_counts)
+    self.assertEquals(pretty(full_cube_counts),
+                      pretty(self._get_nonzero_cube_counts(incremental_version.metricsVersionId)))
+
+  def test_binary_codec_metrics_match_text_codec_metrics(self):
+    self._create_data()
+    text_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_CODEC, ['binary'])
+    full_time = TIME_4 + datetime.timedelta(hours=1)
+    binary_version = self._run_metrics(full_time, full_time)
+    self.assertNotEquals(text_version.metricsVersionId, binary_version.metricsVersionId)
+    text_metrics = self._get_nonzero_bucket_metrics(text_version.metricsVersionId)
+    self.assertTrue(text_metrics)
+    self.assertEquals(pretty(text_metrics),
+                      pretty(self._get_nonzero_bucket_metrics(binary_version.metricsVersionId)))
+
+  def test_fused_stages_metrics_match_three_stage_metrics(self):
+    self._create_data()
+    three_stage_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_FUSED_STAGES, [True])
+    fused_time = TIME_4 + datetime.timedelta(hours=1)
+    fused_version = self._run_metrics(fused_time, fused_time)
+    self.assertNotEquals(three_stage_version.metricsVersionId, fused_version.metricsVersionId)
+    three_stage_metrics = self._get_bucket_metrics(three_stage_version.metricsVersionId)
+    self.assertTrue(three_stage_metrics)
+    self.assertEquals(pretty(three_stage_metrics),
+                      pretty(self._get_bucket_metrics(fused_version.metricsVersionId)))
+    three_stage_cube_counts = self._get_nonzero_cube_counts(three_stage_version.metricsVersionId)
+    self.assertTrue(three_stage_cube_counts)
+    self.assertEquals(pretty(three_stage_cube_counts),
+                      pretty(self._get_nonzero_cube_counts(fused_version.metricsVersionId)))
+
+  def test_keyframe_bucket_metrics_match_full_bucket_metrics(self):
+    self._create_data()
+    full_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_FUSED_STAGES, [True])
+    config.override_setting(config.METRICS_BUCKET_KEYFRAME_DAYS, [2])
+    keyframe_time = TIME_4 + datetime.timedelta(hours=1)
+    keyframe_version = self._run_metrics(keyframe_time, keyframe_time)
+    self.assertNotEquals(full_version.metricsVersionId, keyframe_version.metricsVersionId)
+    with MetricsKeyframeDao().session() as session:
+      self.assertTrue(session.query(MetricsKeyframe)
+                      .filter(MetricsKeyframe.metricsVersionId == keyframe_version.metricsVersionId)
+                      .count())
+    full_metrics = self._get_bucket_metrics(full_version.metricsVersionId)
+    self.assertTrue(full_metrics)
+    self.assertEquals(pretty(full_metrics),
+                      pretty(self._get_bucket_metrics(keyframe_version.metricsVersionId)))
+
+  @mock.patch('offline.metrics_pipeline._CROSS_HPO_DAYS_PER_SHARD', 1)
+  def test_sharded_cross_hpo_metrics_match_three_stage_metrics(self):
+    self._create_data()
+    three_stage_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_FUSED_STAGES, [True])
+    fused_time = TIME_4 + datetime.timedelta(hours=1)
+    fused_version = self._run_metrics(fused_time, fused_time)
+    three_stage_metrics = self._get_bucket_metrics(three_stage_version.metricsVersionId)
+    self.assertTrue(three_stage_metrics)
+    self.assertEquals(pretty(three_stage_metrics),
+                      pretty(self._get_bucket_metrics(fused_version.metricsVersionId)))
+
+  @mock.patch('offline.metrics_pipeline._CROSS_HPO_DAYS_PER_SHARD', 3)
+  def test_sharded_cross_hpo_keyframe_metrics_match_full_metrics(self):
+    self._create_data()
+    full_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_FUSED_STAGES, [True])
+    config.override_setting(config.METRICS_BUCKET_KEYFRAME_DAYS, [2])
+    keyframe_time = TIME_4 + datetime.timedelta(hours=1)
+    keyframe_version = self._run_metrics(keyframe_time, keyframe_time)
+    full_metrics = self._get_bucket_metrics(full_version.metricsVersionId)
+    self.assertTrue(full_metrics)
+    self.assertEquals(pretty(full_metrics),
+                      pretty(self._get_bucket_metrics(keyframe_version.metricsVersionId)))
+
+  def test_incremental_metrics_from_keyframe_buckets_match_full_metrics(self):
+    self._create_data()
+    config.override_setting(config.METRICS_FUSED_STAGES, [True])
+    config.override_setting(config.METRICS_BUCKET_KEYFRAME_DAYS, [2])
+    base_time = TIME_2 + datetime.timedelta(hours=12)
+    self._run_metrics(base_time, base_time)
+    incremental_version = self._run_metrics(TIME_4, TIME_4, incremental=True)
+    full_time = TIME_4 + datetime.timedelta(hours=1)
+    full_version = self._run_metrics(full_time, full_time)
+    full_metrics = self._get_nonzero_bucket_metrics(full_version.metricsVersionId)
+    self.assertTrue(full_metrics)
+    self.assertEquals(pretty(full_metrics),
+                      pretty(self._get_nonzero_bucket_metrics(
+                          incremental_version.metricsVersionId)))
+
+  def test_cache_metrics_responses(self):
+    self._create_data()
+    config.override_setting(config.METRICS_CACHE_RESPONSES, [True])
+    version = self._run_metrics(TIME_4, TIME_4)
+    # The response for all dates is cached when the pipeline finishes.
+    cached_response = MetricsCachedResponseDao().get([version.metricsVersionId, '||'])
+    bucket_dao = MetricsBucketDao()
+    self.assertEquals([bucket_dao.to_client_json(bucket)
+                       for bucket in bucket_dao.get_version_buckets(version.metricsVersionId)],
+                      json.loads(zlib.decompress(cached_response.response, GZIP_WBITS)))
+
+  def test_rollup_metrics(self):
+    self._create_data()
+    version = self._run_metrics(TIME_4, TIME_4)
+    version_id = version.metricsVersionId
+    # Monthly rollups are written with the metrics from the last bucket for each month.
+    last_buckets = {}
+    for bucket in MetricsBucketDao().get_version_buckets(version_id):
+      last_buckets[(get_period_start(bucket.date, MONTH), bucket.hpoId)] = bucket
+    self.assertTrue(last_buckets)
+    rollups = MetricsRollupDao().get_rollups(version_id, MONTH)
+    self.assertEquals(sorted(last_buckets.keys()),
+                      [(rollup.date, rollup.hpoId) for rollup in rollups])
+    for rollup in rollups:
+      last_bucket = last_buckets[(rollup.date, rollup.hpoId)]
+      self.assertEquals(last_bucket.date, rollup.lastDate)
+      self.assertEquals(json.loads(last_bucket.metrics), json.loads(rollup.metrics))
+
+  def test_export_concurrency_metrics_match_default_metrics(self):
+    self._create_data()
+    default_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_EXPORT_CONCURRENCY, [1])
+    serial_time = TIME_4 + datetime.timedelta(hours=1)
+    serial_version = self._run_metrics(serial_time, serial_time)
+    self.assertNotEquals(default_version.metricsVersionId, serial_version.metricsVersionId)
+    export_run_dao = MetricsExportRunDao()
+    for metrics_export_run_id in (1, 2):
+      self.assertTrue(export_run_dao.get(metrics_export_run_id).pipelineStarted)
+    default_metrics = self._get_bucket_metrics(default_version.metricsVersionId)
+    self.assertTrue(default_metrics)
+    self.assertEquals(pretty(default_metrics),
+                      pretty(self._get_bucket_metrics(serial_version.metricsVersionId)))
+
+  def test_local_pipeline_metrics_match_mapreduce_metrics(self):
+    self._create_data()
+    input_dir = tempfile.mkdtemp()
+    try:
+      with FakeClock(TIME_4):
+        MetricsExport.start_export_tasks(BUCKET_NAME, 2)
+        run_deferred_tasks(self)
+      # Copy the exported CSVs before the MapReduce pipeline deletes them.
+      for stat in cloudstorage_api.listbucket('/%s/%s/' % (BUCKET_NAME, TIME_4.isoformat())):
+        with cloudstorage_api.open(stat.filename) as cloud_file:
+          with open(os.path.join(input_dir, os.path.basename(stat.filename)), 'w') as local_file:
+            local_file.write(cloud_file.read())
+      with FakeClock(TIME_4):
+        test_support.execute_until_empty(self.taskqueue)
+      mapreduce_version = MetricsVersionDao().get_serving_version()
+      mapreduce_metrics = self._get_nonzero_bucket_metrics(mapreduce_version.metricsVersionId)
+      self.assertTrue(mapreduce_metrics)
+      # Spill every few pairs, into more partitions than there are shards, so that every stage's
+      # map output is split up and merged again.
+      offline.local_metrics_pipeline._SPILL_SIZE = 5
+      try:
+        with FakeClock(TIME_4):
+          local_version_id = run_local_pipeline(input_dir, num_processes=1, num_partitions=3)
+      finally:
+        offline.local_metrics_pipeline._SPILL_SIZE = 100000
+    finally:
+      shutil.rmtree(input_dir)
+    self.assertNotEquals(mapreduce_version.metricsVersionId, local_version_id)
+    self.assertEquals(pretty(mapreduce_metrics),
+                      pretty(self._get_nonzero_bucket_metrics(local_version_id)))
+
+  def test_zero_export_concurrency_exports_serially(self):
+    self._create_data()
+    config.override_setting(config.METRICS_EXPORT_CONCURRENCY, [0])
+    version = self._run_metrics(TIME_4, TIME_4)
+    self.assertTrue(version)
+    self.assertTrue(MetricsExportRunDao().get(1).pipelineStarted)
+
+  def test_finish_export_starts_pipeline_once(self):
+    self._create_data()
+    version = self._run_metrics(TIME_4, TIME_4)
+    # A retried task finishing the export again doesn't start another pipeline.
+    MetricsExport._finish_export(BUCKET_NAME, TIME_4.isoformat() + '/', 2,
+                                 {'export_time': TIME_4, 'metrics_export_run_id': 1})
+    self.assertEquals([], self.taskqueue.GetTasks('default'))
+    self.assertEquals(version.metricsVersionId,
+                      MetricsVersionDao().get_serving_version().metricsVersionId)
+
+  def test_database_input_metrics_match_csv_metrics(self):
+    self._create_data()
+    csv_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_READ_FROM_DATABASE, [True])
+    database_time = TIME_4 + datetime.timedelta(hours=1)
+    database_version = self._run_metrics(database_time, database_time)
+    self.assertNotEquals(csv_version.metricsVersionId, database_version.metricsVersionId)
+    self.assertEquals(database_time, database_version.exportedThrough)
+    # Nothing is exported for the run that reads from the database.
+    self.assertEquals([], list(cloudstorage_api.listbucket(
+        '/%s/%s/' % (BUCKET_NAME, database_time.isoformat()))))
+    csv_metrics = self._get_bucket_metrics(csv_version.metricsVersionId)
+    self.assertTrue(csv_metrics)
+    self.assertEquals(pretty(csv_metrics),
+                      pretty(self._get_bucket_metrics(database_version.metricsVersionId)))
+
+  def test_gzip_export_metrics_match_csv_metrics(self):
+    self._create_data()
+    csv_version = self._run_metrics(TIME_4, TIME_4)
+    config.override_setting(config.METRICS_EXPORT_GZIP, [True])
+    gzip_time = TIME_4 + datetime.timedelta(hours=1)
+    gzip_version = self._run_metrics(gzip_time, gzip_time)
+    self.assertNotEquals(csv_version.metricsVersionId, gzip_version.metricsVersionId)
+    csv_metrics = self._get_bucket_metrics(csv_version.metricsVersionId)
+    self.assertTrue(csv_metrics)
+    self.assertEquals(pretty(csv_metrics),
+                      pretty(self._get_bucket_metrics(gzip_version.metricsVersionId)))
+
+  def _get_bucket_metrics(self, metrics_version_id):
+    buckets = MetricsBucketDao().get_version_buckets(metrics_version_id)
+    return {'%s|%s' % (bucket.date.isoformat(), bucket.hpoId): json.loads(bucket.metrics)
+            for bucket in buckets}
+
   def assertBucket(self, bucket_map, dt, hpoId, metrics=None):
     bucket = bucket_map.get((dt.date(), hpoId))
     if metrics:
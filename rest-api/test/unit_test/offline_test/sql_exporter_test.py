@@ -1,10 +1,20 @@
-from offline.sql_exporter import SqlExporter
-from participant_enums import UNSET_HPO_ID
+import datetime
+import mock
+
+from clock import FakeClock
+from cloudstorage import cloudstorage_api
+from dao.participant_dao import ParticipantDao
+from model.hpo import HPO
+from model.participant import Participant
+from offline.avro_writer import read_avro
+from offline.sql_exporter import SqlExporter, make_csv_reader
+from participant_enums import OrganizationType, UNSET_HPO_ID, WithdrawalStatus
 from offline_test.gcs_utils import assertCsvContents
 from unit_test_util import CloudStorageSqlTestBase, PITT_HPO_ID
 
 _BUCKET_NAME = 'pmi-drc-biobank-test.appspot.com'
 _FILE_NAME = 'hpo_ids.csv'
+_AVRO_FILE_NAME = 'table.avro'
 
 class SqlExporterTest(CloudStorageSqlTestBase):
   def testHpoExport_withoutRows(self):
@@ -19,3 +29,61 @@ class SqlExporterTest(CloudStorageSqlTestBase):
     assertCsvContents(self, _BUCKET_NAME, _FILE_NAME, [['id', 'name'],
                                                      [str(UNSET_HPO_ID), 'UNSET'],
                                                      [str(PITT_HPO_ID), 'PITT']])
+
+  def testHpoExport_compressed(self):
+    SqlExporter(_BUCKET_NAME, compress=True, batch_size=1).run_export(
+        _FILE_NAME, 'SELECT hpo_id id, name name FROM hpo ORDER BY hpo_id')
+    with cloudstorage_api.open('/%s/%s' % (_BUCKET_NAME, _FILE_NAME)) as output:
+      self.assertEquals('\x1f\x8b', output.read(2))
+    with cloudstorage_api.open('/%s/%s' % (_BUCKET_NAME, _FILE_NAME)) as output:
+      self.assertEquals([['id', 'name'],
+                         [str(UNSET_HPO_ID), 'UNSET'],
+                         [str(PITT_HPO_ID), 'PITT']],
+                        list(make_csv_reader(output)))
+
+  def testMakeCsvReader_splitsLinesAcrossReads(self):
+    for compress in (False, True):
+      SqlExporter(_BUCKET_NAME, compress=compress).run_export(
+          _FILE_NAME, 'SELECT hpo_id id, name name FROM hpo ORDER BY hpo_id')
+      with cloudstorage_api.open('/%s/%s' % (_BUCKET_NAME, _FILE_NAME)) as output:
+        with mock.patch('offline.sql_exporter._READ_SIZE', 3):
+          self.assertEquals([['id', 'name'],
+                             [str(UNSET_HPO_ID), 'UNSET'],
+                             [str(PITT_HPO_ID), 'PITT']],
+                            list(make_csv_reader(output)))
+
+  def testAvroExport_hpos(self):
+    SqlExporter(_BUCKET_NAME, batch_size=1).run_avro_export(
+        _AVRO_FILE_NAME, HPO.__table__,
+        'SELECT hpo_id, name, display_name, organization_type FROM hpo ORDER BY hpo_id')
+    with cloudstorage_api.open('/%s/%s' % (_BUCKET_NAME, _AVRO_FILE_NAME)) as output:
+      self.assertEquals([{'hpo_id': UNSET_HPO_ID, 'name': 'UNSET', 'display_name': None,
+                          'organization_type': int(OrganizationType.UNSET)},
+                         {'hpo_id': PITT_HPO_ID, 'name': 'PITT', 'display_name': None,
+                          'organization_type': int(OrganizationType.HPO)}],
+                        list(read_avro(output)))
+
+  def testAvroExport_keepsTypes(self):
+    sign_up_time = datetime.datetime(2017, 1, 2, 3, 4, 5, 678000)
+    with FakeClock(sign_up_time):
+      ParticipantDao().insert(Participant(participantId=1, biobankId=2, clientId=u'caf\xe9'))
+    table = Participant.__table__
+    SqlExporter(_BUCKET_NAME).run_avro_export(
+        _AVRO_FILE_NAME, table,
+        'SELECT %s FROM participant' % ', '.join(column.name for column in table.columns))
+    with cloudstorage_api.open('/%s/%s' % (_BUCKET_NAME, _AVRO_FILE_NAME)) as output:
+      records = list(read_avro(output))
+    self.assertEquals(1, len(records))
+    record = records[0]
+    self.assertEquals(1, record['participant_id'])
+    self.assertEquals(2, record['biobank_id'])
+    self.assertEquals(sign_up_time, record['sign_up_time'])
+    self.assertEquals(sign_up_time, record['last_modified'])
+    self.assertEquals(u'caf\xe9', record['client_id'])
+    self.assertEquals(int(WithdrawalStatus.NOT_WITHDRAWN), record['withdrawal_status'])
+    self.assertIsNone(record['withdrawal_time'])
+
+  def testAvroExport_columnsMustMatchTable(self):
+    with self.assertRaises(ValueError):
+      SqlExporter(_BUCKET_NAME).run_avro_export(_AVRO_FILE_NAME, HPO.__table__,
+                                                'SELECT hpo_id, name FROM hpo')
@@ -0,0 +1,112 @@
+import config
+import json
+import mock
+
+from cloudstorage import cloudstorage_api
+from offline.avro_writer import read_avro
+from offline.table_exporter import TableExporter, AVRO_FORMAT, CSV_FORMAT, MANIFEST_FILE_NAME
+from offline.table_exporter import get_part_ranges, get_partition_column
+from offline_test.gcs_utils import assertCsvContents
+from participant_enums import UNSET_HPO_ID
+from unit_test_util import CloudStorageSqlTestBase, PITT_HPO_ID
+
+_BUCKET_NAME = 'pmi-drc-biobank-test.appspot.com'
+# SQLite's name for the test database.
+_DATABASE = 'main'
+
+
+def _run_deferred(function, *args):
+  function(*args)
+
+
+class TableExporterTest(CloudStorageSqlTestBase):
+  def _export(self, compress=False, export_format=CSV_FORMAT, partition_column='hpo_id'):
+    with mock.patch('offline.table_exporter.deferred.defer', side_effect=_run_deferred):
+      TableExporter._export_table(_BUCKET_NAME, _DATABASE, 'export', 'hpo', compress,
+                                  export_format, partition_column)
+
+  def _read_manifest(self):
+    with cloudstorage_api.open('/%s/export/hpo/%s' % (_BUCKET_NAME, MANIFEST_FILE_NAME)) as f:
+      return json.loads(f.read())
+
+  def test_get_partition_column(self):
+    self.assertEquals('participant_id', get_partition_column('participant'))
+    self.assertEquals('hpo_id', get_partition_column('hpo'))
+    # Composite and string primary keys can't be split into ranges.
+    self.assertIsNone(get_partition_column('metrics_bucket'))
+    self.assertIsNone(get_partition_column('biobank_stored_sample'))
+    self.assertIsNone(get_partition_column('no_such_table'))
+
+  def test_get_part_ranges(self):
+    self.assertIsNone(get_part_ranges(None, None, 0, 10))
+    self.assertIsNone(get_part_ranges(1, 100, 10, 10))
+    self.assertEquals([[1, 51], [51, 101]], get_part_ranges(1, 100, 20, 10))
+    self.assertEquals([[1, 35], [35, 69], [69, 101]], get_part_ranges(1, 100, 21, 10))
+    # Every part has at least one value.
+    self.assertEquals([[5, 6], [6, 7]], get_part_ranges(5, 6, 2, 1))
+
+  def test_small_table_exported_to_one_file(self):
+    self._export()
+    assertCsvContents(self, _BUCKET_NAME, 'export/hpo.csv',
+                      [['hpo_id', 'name', 'display_name', 'organization_type'],
+                       [str(UNSET_HPO_ID), 'UNSET', '', '0'],
+                       [str(PITT_HPO_ID), 'PITT', '', '1']])
+    self.assertEquals([], list(cloudstorage_api.listbucket('/%s/export/hpo/' % _BUCKET_NAME)))
+
+  def test_large_table_exported_in_parts(self):
+    config.override_setting(config.TABLE_EXPORT_ROWS_PER_PART, [1])
+    self._export()
+    manifest = self._read_manifest()
+    self.assertEquals('hpo_id', manifest['partitionColumn'])
+    self.assertEquals(['gs://%s/export/hpo/part-00000.csv' % _BUCKET_NAME,
+                       'gs://%s/export/hpo/part-00001.csv' % _BUCKET_NAME],
+                      [part['uri'] for part in manifest['parts']])
+    self.assertEquals([[UNSET_HPO_ID, PITT_HPO_ID], [PITT_HPO_ID, PITT_HPO_ID + 1]],
+                      [[part['start'], part['end']] for part in manifest['parts']])
+    header = ['hpo_id', 'name', 'display_name', 'organization_type']
+    assertCsvContents(self, _BUCKET_NAME, 'export/hpo/part-00000.csv',
+                      [header, [str(UNSET_HPO_ID), 'UNSET', '', '0']])
+    assertCsvContents(self, _BUCKET_NAME, 'export/hpo/part-00001.csv',
+                      [header, [str(PITT_HPO_ID), 'PITT', '', '1']])
+
+  def test_large_table_exported_in_avro_parts(self):
+    config.override_setting(config.TABLE_EXPORT_ROWS_PER_PART, [1])
+    self._export(export_format=AVRO_FORMAT)
+    records = []
+    for part in self._read_manifest()['parts']:
+      with cloudstorage_api.open(part['uri'][len('gs:/'):]) as f:
+        records.extend(read_avro(f))
+    self.assertEquals([UNSET_HPO_ID, PITT_HPO_ID], [record['hpo_id'] for record in records])
+
+  def test_table_without_partition_column_exported_to_one_file(self):
+    config.override_setting(config.TABLE_EXPORT_ROWS_PER_PART, [1])
+    self._export(compress=True, partition_column=None)
+    with cloudstorage_api.open('/%s/export/hpo.csv.gz' % _BUCKET_NAME) as f:
+      self.assertEquals('\x1f\x8b', f.read(2))
+
+  def test_snapshot_export(self):
+    config.override_setting(config.TABLE_EXPORT_ROWS_PER_PART, [1])
+    TableExporter._export_snapshot(_BUCKET_NAME, _DATABASE, 'export', ['hpo', 'site'], False,
+                                   CSV_FORMAT, {'hpo': 'hpo_id', 'site': None})
+    with cloudstorage_api.open('/%s/export/%s' % (_BUCKET_NAME, MANIFEST_FILE_NAME)) as f:
+      manifest = json.loads(f.read())
+    self.assertEquals({'hpo': ['gs://%s/export/hpo/part-00000.csv' % _BUCKET_NAME,
+                               'gs://%s/export/hpo/part-00001.csv' % _BUCKET_NAME],
+                       'site': ['gs://%s/export/site.csv' % _BUCKET_NAME]},
+                      manifest['tables'])
+    header = ['hpo_id', 'name', 'display_name', 'organization_type']
+    assertCsvContents(self, _BUCKET_NAME, 'export/hpo/part-00000.csv',
+                      [header, [str(UNSET_HPO_ID), 'UNSET', '', '0']])
+    assertCsvContents(self, _BUCKET_NAME, 'export/hpo/part-00001.csv',
+                      [header, [str(PITT_HPO_ID), 'PITT', '', '1']])
+
+  def test_export_tables_snapshot_starts_one_task(self):
+    with mock.patch('offline.table_exporter.app_identity') as mock_app_identity, \
+        mock.patch('offline.table_exporter.deferred.defer') as mock_defer:
+      mock_app_identity.get_application_id.return_value = 'None'
+      mock_app_identity.get_default_gcs_bucket_name.return_value = _BUCKET_NAME
+      TableExporter.export_tables('rdr', ['hpo', 'participant', 'code'], 'export', snapshot=True)
+    mock_defer.assert_called_once_with(
+        TableExporter._export_snapshot, _BUCKET_NAME, 'rdr', 'export',
+        ['hpo', 'participant', 'code'], False, CSV_FORMAT,
+        {'hpo': 'hpo_id', 'participant': 'participant_id', 'code': 'code_id'})
@@ -0,0 +1,88 @@
+"""Benchmarks the pure Python and NumPy implementations of daily metrics counts.
+
+Generates synthetic date -> delta maps for a number of HPO / metric keys, expands each into daily
+count records (as the second stage of the metrics pipeline does) with both implementations,
+including encoding them as text records, checks that the output is identical, and reports the time
+taken by each.
+
+Key distributions:
+  sparse: a few deltas per key, spread over the whole history (most dates are filled in)
+  dense: a delta on most dates
+  skewed: a mix of a few keys with many deltas and many keys with few, as with popular and rare
+    metric values
+
+Usage:
+  tools/benchmark_metrics_counts.sh [--keys 2000] [--days 1500] [--distribution skewed]
+"""
+
+import datetime
+import logging
+import random
+import time
+
+from main_util import get_parser, configure_logging
+from offline.metrics_codec import TEXT_CODEC, ROW
+from offline.metrics_counts import daily_counts, daily_count_runs_numpy, numpy_available
+
+_DISTRIBUTIONS = ['sparse', 'dense', 'skewed']
+_KEY = ('PITT', 'R', 'Participant.race.WHITE')
+
+
+def _make_delta_maps(num_keys, num_days, distribution, end_date, seed):
+  rand = random.Random(seed)
+  start_ordinal = end_date.toordinal() - num_days + 1
+  delta_maps = []
+  for i in range(num_keys):
+    if distribution == 'sparse':
+      num_deltas = rand.randint(1, 10)
+    elif distribution == 'dense':
+      num_deltas = num_days
+    else:
+      num_deltas = num_days if i % 50 == 0 else rand.randint(1, 20)
+    delta_map = {}
+    for _ in range(num_deltas):
+      date = datetime.date.fromordinal(start_ordinal + rand.randint(0, num_days - 1))
+      delta_map[date.isoformat()] = delta_map.get(date.isoformat(), 0) + rand.randint(-1, 3)
+    delta_maps.append(delta_map)
+  return delta_maps
+
+
+def _time_python(delta_maps, end_date):
+  start_time = time.time()
+  output = [''.join(TEXT_CODEC.encode_record(ROW, _KEY + date_and_count)
+                    for date_and_count in daily_counts(delta_map, end_date))
+            for delta_map in delta_maps]
+  return time.time() - start_time, output
+
+
+def _time_numpy(delta_maps, end_date):
+  start_time = time.time()
+  output = [TEXT_CODEC.encode_count_runs(_KEY, daily_count_runs_numpy(delta_map, end_date))
+            for delta_map in delta_maps]
+  return time.time() - start_time, output
+
+
+def main(args):
+  if not numpy_available():
+    raise RuntimeError('NumPy is not installed.')
+  end_date = datetime.date.today()
+  delta_maps = _make_delta_maps(args.keys, args.days, args.distribution, end_date, args.seed)
+  logging.info('Generated %d keys with %d deltas over %d days (%s).', args.keys,
+               sum(len(delta_map) for delta_map in delta_maps), args.days, args.distribution)
+  python_time, python_output = _time_python(delta_maps, end_date)
+  numpy_time, numpy_output = _time_numpy(delta_maps, end_date)
+  if python_output != numpy_output:
+    raise AssertionError('NumPy output does not match Python output.')
+  num_records = sum(output.count('\n') for output in python_output)
+  logging.info('Python: %.2fs, NumPy: %.2fs for %d records (%.1fx speedup).', python_time,
+               numpy_time, num_records, python_time / max(numpy_time, 1e-9))
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--keys', help='Number of HPO / metric keys', type=int, default=2000)
+  parser.add_argument('--days', help='Number of days of history', type=int, default=1500)
+  parser.add_argument('--distribution', help='Distribution of deltas across keys',
+                      choices=_DISTRIBUTIONS, default='skewed')
+  parser.add_argument('--seed', help='Random seed', type=int, default=1)
+  main(parser.parse_args())
@@ -0,0 +1,7 @@
+#!/bin/bash -e
+
+# Benchmarks the Python and NumPy implementations of daily metrics counts on synthetic data.
+# Any arguments are passed through to tools/benchmark_metrics_counts.py.
+
+source tools/set_path.sh
+python tools/benchmark_metrics_counts.py "$@"
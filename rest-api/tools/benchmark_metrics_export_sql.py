@@ -0,0 +1,214 @@
+"""Benchmarks the metrics export's participant and HPO ID queries against the versions that used
+correlated subqueries (a MIN() subquery per participant for orders, samples and physical
+measurements, and NOT EXISTS lookups of the previous participant_history version.)
+
+Creates the schema in an empty scratch database (never point this at a real RDR database), fills
+it with synthetic participants, HPO changes, biobank orders, stored samples and physical
+measurements, and runs one shard of each query both ways: the old queries without the indexes
+added for the export, then the current queries with them. Query plans and run times are logged,
+and the results of the two versions are checked to be identical.
+
+Usage:
+  tools/benchmark_metrics_export_sql.sh --db_connection_string <SCRATCH DB> \
+      [--participants 1000000] [--num_shards 10] [--shard_number 0]
+"""
+
+import datetime
+import logging
+import random
+import time
+
+import config
+
+from dao import database_factory
+from dao.database_utils import replace_isodate, get_sql_and_params_for_array
+from main_util import get_parser, configure_logging
+from model.base import Base, get_column_name
+from model.biobank_order import BiobankOrder
+from model.biobank_stored_sample import BiobankStoredSample
+from model.hpo import HPO
+from model.log_position import LogPosition
+from model.measurements import PhysicalMeasurements
+from model.participant import Participant, ParticipantHistory
+from model.participant_summary import ParticipantSummary
+from offline.metrics_export import get_participant_sql, get_hpo_id_sql
+from field_mappings import QUESTIONNAIRE_MODULE_FIELD_NAMES
+from participant_enums import TEST_HPO_NAME, WithdrawalStatus, SuspensionStatus
+from sqlalchemy import text
+
+_HPO_NAMES = [TEST_HPO_NAME, 'UNSET', 'PITT', 'COLUMBIA', 'AZ_TUCSON', 'TRANS_AM']
+_DNA_TESTS = ['1ED10', '1SAL']
+_TESTS = _DNA_TESTS + ['1ED04', '1SST8', '1PST8', '1HEP4', '1UR10']
+_BATCH_SIZE = 10000
+_START_TIME = datetime.datetime(2017, 1, 1)
+
+# The queries as they were before the derived table rewrite.
+_OLD_PARTICIPANT_SQL_TEMPLATE = """
+SELECT p.participant_id, ps.date_of_birth date_of_birth,
+  (SELECT ISODATE[MIN(bo.created)] FROM biobank_order bo
+    WHERE bo.participant_id = p.participant_id) first_order_date,
+  (SELECT ISODATE[MIN(bs.confirmed)] FROM biobank_stored_sample bs
+    WHERE bs.biobank_id = p.biobank_id) first_samples_arrived_date,
+  (SELECT ISODATE[MIN(pm.created)] FROM physical_measurements pm
+    WHERE pm.participant_id = p.participant_id) first_physical_measurements_date,
+  (SELECT ISODATE[MIN(bss.confirmed)] FROM biobank_stored_sample bss
+    WHERE bss.biobank_id = p.biobank_id
+      AND bss.test IN {}) first_samples_to_isolate_dna_date, {}
+  FROM participant p, participant_summary ps
+ WHERE p.participant_id = ps.participant_id
+   AND p.participant_id % :num_shards = :shard_number
+   AND p.hpo_id != :test_hpo_id
+   AND NOT ps.email LIKE :test_email_pattern
+"""
+
+_OLD_HPO_ID_QUERY = """
+SELECT ph.participant_id participant_id, hpo.name hpo,
+       ISODATE[ph.last_modified] last_modified
+  FROM participant_history ph, hpo
+ WHERE ph.participant_id % :num_shards = :shard_number
+   AND ph.hpo_id = hpo.hpo_id
+   AND NOT ph.hpo_id = :test_hpo_id
+   AND NOT EXISTS
+    (SELECT * FROM participant_history ph_prev
+      WHERE ph_prev.participant_id = ph.participant_id
+        AND ph_prev.version = ph.version - 1
+        AND ph_prev.hpo_id = ph.hpo_id)
+   AND NOT EXISTS
+    (SELECT * FROM participant_summary ps
+      WHERE ps.participant_id = ph.participant_id
+        AND ps.email LIKE :test_email_pattern)
+"""
+
+_EXPORT_INDEXES = ['biobank_order_participant_created',
+                   'physical_measurements_participant_created',
+                   'biobank_stored_sample_biobank_test_confirmed']
+
+
+def _get_old_participant_sql():
+  modules_sql = ', '.join('ISODATE[ps.{0}] {0}'.format(get_column_name(ParticipantSummary,
+                                                                       field_name + 'Time'))
+                          for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES)
+  dna_tests_sql, _ = get_sql_and_params_for_array(_DNA_TESTS, 'dna')
+  return replace_isodate(_OLD_PARTICIPANT_SQL_TEMPLATE.format(dna_tests_sql, modules_sql))
+
+
+def _random_time(rand):
+  return _START_TIME + datetime.timedelta(seconds=rand.randint(0, 600 * 24 * 3600))
+
+
+def _insert_rows(engine, table, rows):
+  for i in range(0, len(rows), _BATCH_SIZE):
+    engine.execute(table.insert(), rows[i:i + _BATCH_SIZE])
+
+
+def _generate_data(engine, num_participants, seed):
+  rand = random.Random(seed)
+  _insert_rows(engine, HPO.__table__, [{'hpo_id': i, 'name': name}
+                                       for i, name in enumerate(_HPO_NAMES)])
+  _insert_rows(engine, LogPosition.__table__, [{'log_position_id': 1}])
+  participant_ids = rand.sample(xrange(100000000, 1000000000), num_participants)
+  for start in range(0, num_participants, _BATCH_SIZE):
+    participants, history, summaries, orders, samples, measurements = [], [], [], [], [], []
+    for participant_id in participant_ids[start:start + _BATCH_SIZE]:
+      biobank_id = participant_id
+      sign_up_time = _random_time(rand)
+      # Some participants change HPO after signing up.
+      hpo_ids = [rand.randint(1, len(_HPO_NAMES) - 1) for _ in range(rand.choice([1, 1, 2, 3]))]
+      for version, hpo_id in enumerate(hpo_ids, 1):
+        history.append({'participant_id': participant_id, 'version': version,
+                        'biobank_id': biobank_id, 'hpo_id': hpo_id,
+                        'last_modified': sign_up_time + datetime.timedelta(days=version),
+                        'sign_up_time': sign_up_time,
+                        'withdrawal_status': WithdrawalStatus.NOT_WITHDRAWN,
+                        'suspension_status': SuspensionStatus.NOT_SUSPENDED})
+      participants.append(dict(history[-1]))
+      summary = {'participant_id': participant_id, 'biobank_id': biobank_id,
+                 'first_name': 'Bob', 'last_name': 'Jones', 'hpo_id': hpo_ids[-1],
+                 'email': ('%d@example.com' if rand.random() < 0.01 else '%d@gmail.com')
+                          % participant_id,
+                 'date_of_birth': datetime.date(rand.randint(1930, 1999), 1, 1),
+                 'withdrawal_status': WithdrawalStatus.NOT_WITHDRAWN,
+                 'suspension_status': SuspensionStatus.NOT_SUSPENDED}
+      for field_name in QUESTIONNAIRE_MODULE_FIELD_NAMES:
+        if rand.random() < 0.5:
+          summary[get_column_name(ParticipantSummary, field_name + 'Time')] = (
+              _random_time(rand))
+      summaries.append(summary)
+      for i in range(rand.choice([0, 0, 1, 1, 2])):
+        orders.append({'biobank_order_id': '%d-%d' % (participant_id, i),
+                       'participant_id': participant_id, 'log_position_id': 1,
+                       'created': _random_time(rand)})
+        for test in rand.sample(_TESTS, 4):
+          samples.append({'biobank_stored_sample_id': '%d-%d-%s' % (participant_id, i, test),
+                          'biobank_id': biobank_id, 'test': test,
+                          'confirmed': _random_time(rand) if rand.random() < 0.9 else None,
+                          'created': _random_time(rand)})
+        # There are at most two physical measurements per participant.
+        measurements.append({'physical_measurements_id': start * 2 + len(measurements) + 1,
+                             'participant_id': participant_id, 'created': _random_time(rand),
+                             'resource': '{}', 'final': True, 'log_position_id': 1})
+    _insert_rows(engine, Participant.__table__, participants)
+    _insert_rows(engine, ParticipantHistory.__table__, history)
+    _insert_rows(engine, ParticipantSummary.__table__, summaries)
+    _insert_rows(engine, BiobankOrder.__table__, orders)
+    _insert_rows(engine, BiobankStoredSample.__table__, samples)
+    _insert_rows(engine, PhysicalMeasurements.__table__, measurements)
+    logging.info('Inserted %d of %d participants.', min(start + _BATCH_SIZE, num_participants),
+                 num_participants)
+
+
+def _run_query(engine, name, sql, params):
+  explain = 'EXPLAIN QUERY PLAN ' if engine.dialect.name == 'sqlite' else 'EXPLAIN '
+  plan = engine.execute(text(explain + sql), params).fetchall()
+  logging.info('%s plan:\n%s', name, '\n'.join(str(tuple(row)) for row in plan))
+  start_time = time.time()
+  rows = sorted(tuple(row) for row in engine.execute(text(sql), params).fetchall())
+  elapsed = time.time() - start_time
+  logging.info('%s: %d rows in %.2fs.', name, len(rows), elapsed)
+  return rows, elapsed
+
+
+def main(args):
+  config.override_setting(config.DNA_SAMPLE_TEST_CODES, _DNA_TESTS)
+  engine = database_factory.get_database().get_engine()
+  if engine.has_table(Participant.__tablename__):
+    raise ValueError('The database is not empty; use a scratch database.')
+  Base.metadata.create_all(engine)
+  export_indexes = [index for table in Base.metadata.tables.values() for index in table.indexes
+                    if index.name in _EXPORT_INDEXES]
+  for index in export_indexes:
+    index.drop(engine)
+  start_time = time.time()
+  _generate_data(engine, args.participants, args.seed)
+  logging.info('Generated data in %.1fs.', time.time() - start_time)
+
+  new_participant_sql, participant_params = get_participant_sql(args.num_shards,
+                                                                args.shard_number)
+  new_hpo_id_sql, hpo_id_params = get_hpo_id_sql(args.num_shards, args.shard_number)
+  old_participant_rows, old_participant_time = _run_query(
+      engine, 'Old participant query', _get_old_participant_sql(), participant_params)
+  old_hpo_id_rows, old_hpo_id_time = _run_query(
+      engine, 'Old HPO ID query', replace_isodate(_OLD_HPO_ID_QUERY), hpo_id_params)
+  for index in export_indexes:
+    index.create(engine)
+  new_participant_rows, new_participant_time = _run_query(
+      engine, 'New participant query', new_participant_sql, participant_params)
+  new_hpo_id_rows, new_hpo_id_time = _run_query(
+      engine, 'New HPO ID query', new_hpo_id_sql, hpo_id_params)
+  if old_participant_rows != new_participant_rows:
+    raise AssertionError('Participant query results do not match.')
+  if old_hpo_id_rows != new_hpo_id_rows:
+    raise AssertionError('HPO ID query results do not match.')
+  logging.info('Shard %d of %d for %d participants: participants %.2fs -> %.2fs, '
+               'HPO IDs %.2fs -> %.2fs.', args.shard_number, args.num_shards, args.participants,
+               old_participant_time, new_participant_time, old_hpo_id_time, new_hpo_id_time)
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--participants', help='Number of synthetic participants', type=int,
+                      default=1000000)
+  parser.add_argument('--num_shards', help='Number of export shards', type=int, default=10)
+  parser.add_argument('--shard_number', help='Shard to export', type=int, default=0)
+  parser.add_argument('--seed', help='Random seed', type=int, default=1)
+  main(parser.parse_args())
@@ -0,0 +1,23 @@
+#!/bin/bash -e
+
+# Benchmarks the metrics export SQL against the correlated subquery versions it replaced, on
+# synthetic data in an empty scratch database. Other arguments are passed through to
+# tools/benchmark_metrics_export_sql.py.
+
+USAGE="tools/benchmark_metrics_export_sql.sh --db_connection_string <SCRATCH DB> [--participants 1000000] [--num_shards 10] [--shard_number 0]"
+while true; do
+  case "$1" in
+    --db_connection_string) export DB_CONNECTION_STRING=$2; shift 2;;
+    -- ) shift; break ;;
+    * ) break ;;
+  esac
+done
+
+if [ -z "${DB_CONNECTION_STRING}" ]
+then
+  echo "Usage: $USAGE"
+  exit 1
+fi
+
+source tools/set_path.sh
+python tools/benchmark_metrics_export_sql.py "$@"
@@ -0,0 +1,43 @@
+"""Runs the metrics pipeline locally against MetricsExport CSVs, writing buckets to the database.
+
+Input CSVs can be copied down from the metrics export in GCS, e.g.:
+  gsutil -m cp gs://<bucket>/<export timestamp>/*.csv /tmp/metrics_input/
+
+Config settings used by the pipeline (e.g. baseline_ppi_questionnaire_fields) are read from the
+JSON config file provided with --config, rather than from Datastore.
+
+Usage:
+  tools/run_metrics_locally.sh --input_dir /tmp/metrics_input --config config/base_config.json \
+      [--num_processes 16]
+"""
+
+import json
+import logging
+
+import config
+
+from main_util import get_parser, configure_logging
+from offline.local_metrics_pipeline import run_local_pipeline
+
+
+def main(args):
+  with open(args.config) as config_file:
+    for key, value in json.load(config_file).iteritems():
+      config.override_setting(key, value)
+  version_id = run_local_pipeline(args.input_dir, num_processes=args.num_processes,
+                                  num_partitions=args.num_partitions, work_dir=args.work_dir)
+  logging.info('Metrics version %d is now serving.', version_id)
+
+if __name__ == '__main__':
+  configure_logging()
+  parser = get_parser()
+  parser.add_argument('--input_dir', help='Directory containing metrics export CSVs',
+                      required=True)
+  parser.add_argument('--config', help='JSON config file with pipeline settings', required=True)
+  parser.add_argument('--num_processes', help='Number of worker processes (defaults to CPUs)',
+                      type=int)
+  parser.add_argument('--num_partitions', help='Number of reduce partitions per stage',
+                      type=int)
+  parser.add_argument('--work_dir', help='Directory for intermediate files (kept after the run)')
+
+  main(parser.parse_args())
@@ -0,0 +1,48 @@
+#!/bin/bash -e
+
+# Runs the metrics pipeline locally against MetricsExport CSVs in a local directory.
+
+USAGE="tools/run_metrics_locally.sh --input_dir <DIR> --config <CONFIG_JSON> [--num_processes <N>] [--account <ACCOUNT> --project <PROJECT> [--creds_account <ACCOUNT>]]"
+while true; do
+  case "$1" in
+    --account) ACCOUNT=$2; shift 2;;
+    --creds_account) CREDS_ACCOUNT=$2; shift 2;;
+    --project) PROJECT=$2; shift 2;;
+    --input_dir) INPUT_DIR=$2; shift 2;;
+    --config) CONFIG=$2; shift 2;;
+    --num_processes) NUM_PROCESSES="--num_processes $2"; shift 2;;
+    -- ) shift; break ;;
+    * ) break ;;
+  esac
+done
+
+if [ -z "${INPUT_DIR}" ] || [ -z "${CONFIG}" ]
+then
+  echo "Usage: $USAGE"
+  exit 1
+fi
+
+if [ "${PROJECT}" ]
+then
+  if [ -z "${ACCOUNT}" ]
+  then
+    echo "Usage: $USAGE"
+    exit 1
+  fi
+  if [ -z "${CREDS_ACCOUNT}" ]
+  then
+    CREDS_ACCOUNT="${ACCOUNT}"
+  fi
+  source tools/auth_setup.sh
+  run_cloud_sql_proxy
+  set_db_connection_string
+else
+  if [ -z "${DB_CONNECTION_STRING}" ]
+  then
+    source tools/setup_local_vars.sh
+    set_local_db_connection_string
+  fi
+fi
+
+source tools/set_path.sh
+python tools/run_metrics_locally.py --input_dir $INPUT_DIR --config $CONFIG $NUM_PROCESSES